@@ -1,10 +1,12 @@
 #!/usr/bin/env python
 
 from deeptoolsintervals import tree
-from deeptoolsintervals.parse import GTF, openPossiblyCompressed
+from deeptoolsintervals.parse import GTF, readIndex, indexIsCurrent, strandIndex, batchColumn, supportsNumpy, readRegions, expandRegions, inRegions, treeThreads, nativeStr
+import array
 import sys
 from os.path import basename
-import csv
+if supportsNumpy:
+    import numpy
 
 
 class Enrichment(GTF):
@@ -12,6 +14,57 @@ class Enrichment(GTF):
     This is like the GTF object, but has no groups or exons (but a "features" list). BED files are given a 'peaks' feature and GTF files use column 3.
     """
 
+    def addEntry(self, chrom, start, end, strand, score, feature):
+        """
+        Add an entry to the tree. With attributeKeys, feature is a tuple of the
+        features for each key.
+        """
+        if self.attributeKeys is None:
+            self.tree.addEnrichmentEntry(chrom, start, end, strand, score, feature)
+        else:
+            self.tree.addEnrichmentEntry(chrom, start, end, strand, score, feature[0], list(feature[1:]))
+
+    def addFeature(self, feature):
+        """
+        Append a feature (or, with attributeKeys, each of a tuple of them) to
+        the features list, if it isn't already there
+        """
+        for f in (feature,) if self.attributeKeys is None else feature:
+            if f not in self.features:
+                self.features.append(f)
+
+    def labelFeature(self, label):
+        """
+        The feature of an entry with a label (a label column or deepTools_group
+        attribute), which is used for every attribute key
+        """
+        if self.attributeKeys is None:
+            return label
+        return (label,) * len(self.attributeKeys)
+
+    def gtfFeature(self, cols, keys):
+        """
+        The feature of a GTF line, given its columns and the attribute keys to
+        parse (see parseGTF())
+        """
+        values = tree.parseAttributes(cols[8], keys)
+        if values[0] is not None:
+            return self.labelFeature(values[0])
+        if self.attributeKeys is None:
+            if self.attributeKey:
+                return values[1] if values[1] is not None else "None"
+            return cols[2]
+
+        feature = []
+        values = iter(values[1:])
+        for key in self.attributeKeys:
+            if key is None:
+                feature.append(cols[2])
+            else:
+                value = next(values)
+                feature.append(value if value is not None else "None")
+        return tuple(feature)
+
     def parseBEDcore(self, line, ncols, feature):
         strand = 3
         cols = line.split("\t")
@@ -33,14 +86,14 @@ class Enrichment(GTF):
             score = cols[4]
 
         if ncols != 12 or self.keepExons is False:
-            self.tree.addEnrichmentEntry(self.mungeChromosome(cols[0]), int(cols[1]), int(cols[2]), strand, score, feature)
+            self.addEntry(self.mungeChromosome(cols[0]), int(cols[1]), int(cols[2]), strand, score, feature)
         else:
             starts = cols[11].strip(",").split(",")
             widths = cols[10].strip(",").split(",")
             starts = [int(x) + int(cols[1]) for x in starts]
             ends = [x + int(y) for x, y in zip(starts, widths)]
             for x, y in zip(starts, ends):
-                self.tree.addEnrichmentEntry(self.mungeChromosome(cols[0]), x, y, strand, score, feature)
+                self.addEntry(self.mungeChromosome(cols[0]), x, y, strand, score, feature)
 
     def parseBED(self, fp, line, ncols=3, feature='peaks', labelColumn=None):
         """
@@ -64,14 +117,14 @@ class Enrichment(GTF):
         >>> assert(o == frozenset(['None']))
         """
 
-        # Handle the first line
-        if labelColumn is not None:
-            cols = line.split("\t")
-            feature = cols.pop(labelColumn)
-            line = "\t".join(cols)
-        self.parseBEDcore(line, ncols, feature)
-        if feature not in self.features:
-            self.features.append(feature)
+        # Handle the first line, unless it's outside of the regions
+        if self.bedInRegions(line, labelColumn):
+            if labelColumn is not None:
+                cols = line.split("\t")
+                feature = self.labelFeature(cols.pop(labelColumn))
+                line = "\t".join(cols)
+            self.parseBEDcore(line, ncols, feature)
+            self.addFeature(feature)
 
         # iterate over the remaining lines
         for line in fp:
@@ -82,17 +135,16 @@ class Enrichment(GTF):
                 # Apparently this happens, some people seem to like trying to break things
                 continue
 
-            if line.startswith("#"):
+            if line.startswith("#") or not self.bedInRegions(line, labelColumn):
                 continue
             else:
                 if labelColumn is not None:
                     cols = line.split("\t")
-                    feature = cols.pop(labelColumn)
+                    feature = self.labelFeature(cols.pop(labelColumn))
                     line = "\t".join(cols)
                 self.parseBEDcore(line, ncols, feature)
 
-            if feature not in self.features:
-                self.features.append(feature)
+            self.addFeature(feature)
 
     def parseGTF(self, fp, line):
         """
@@ -106,30 +158,25 @@ class Enrichment(GTF):
         >>> assert(o == frozenset(['miRNA', 'group 1', 'group 2', 'transcribed_unprocessed_pseudogene', 'processed_pseudogene', 'lincRNA', 'unprocessed_pseudogene', 'protein_coding']))
         """
 
-        # Handle the first line
+        # The attribute keys holding the feature, in order of precedence
+        keys = ["deepTools_group"]
+        if self.attributeKeys is not None:
+            keys.extend(k for k in self.attributeKeys if k is not None)
+        elif self.attributeKey:
+            keys.append(self.attributeKey)
+
+        # Handle the first line, unless it's outside of the regions
         cols = line.split("\t")
+        if self.regions is None or inRegions(self.regions, cols[0], int(cols[3]) - 1, int(cols[4])):
+            strand = 3
+            if cols[6] == '+':
+                strand = 0
+            elif cols[6] == '-':
+                strand = 1
 
-        strand = 3
-        if cols[6] == '+':
-            strand = 0
-        elif cols[6] == '-':
-            strand = 1
-
-        feature = cols[2]
-        if self.attributeKey:
-            feature = "None"
-            if self.attributeKey in cols[8]:
-                s = next(csv.reader([cols[8]], delimiter=' '))
-                if s[-1] != self.attributeKey:
-                    feature = s[s.index(self.attributeKey) + 1].rstrip(";")
-        if "deepTools_group" in cols[8]:
-            s = next(csv.reader([cols[8]], delimiter=' '))
-            if s[-1] != "deepTools_group":
-                feature = s[s.index("deepTools_group") + 1].rstrip(";")
-
-        self.tree.addEnrichmentEntry(self.mungeChromosome(cols[0]), int(cols[3]) - 1, int(cols[4]), strand, cols[5], feature)
-        if feature not in self.features:
-            self.features.append(feature)
+            feature = self.gtfFeature(cols, keys)
+            self.addEntry(self.mungeChromosome(cols[0]), int(cols[3]) - 1, int(cols[4]), strand, cols[5], feature)
+            self.addFeature(feature)
 
         # Handle the remaining lines
         for line in fp:
@@ -139,6 +186,8 @@ class Enrichment(GTF):
                 cols = line.split("\t")
                 if len(cols) == 0:
                     continue
+                if self.regions is not None and not inRegions(self.regions, cols[0], int(cols[3]) - 1, int(cols[4])):
+                    continue
 
                 strand = 3
                 if cols[6] == '+':
@@ -146,23 +195,11 @@ class Enrichment(GTF):
                 elif cols[6] == '-':
                     strand = 1
 
-                feature = cols[2]
-                if self.attributeKey:
-                    feature = "None"
-                    if self.attributeKey in cols[8]:
-                        s = next(csv.reader([cols[8]], delimiter=' '))
-                        if s[-1] != self.attributeKey:
-                            feature = s[s.index(self.attributeKey) + 1].rstrip(";")
-                if "deepTools_group" in cols[8]:
-                    s = next(csv.reader([cols[8]], delimiter=" "))
-                    if s[-1] != "deepTools_group":
-                        feature = s[s.index("deepTools_group") + 1].rstrip(";")
-
-                self.tree.addEnrichmentEntry(self.mungeChromosome(cols[0]), int(cols[3]) - 1, int(cols[4]), strand, cols[5], feature)
-                if feature not in self.features:
-                    self.features.append(feature)
+                feature = self.gtfFeature(cols, keys)
+                self.addEntry(self.mungeChromosome(cols[0]), int(cols[3]) - 1, int(cols[4]), strand, cols[5], feature)
+                self.addFeature(feature)
 
-    def __init__(self, fnames, keepExons=False, attributeKey=None, labels=None, verbose=False):
+    def __init__(self, fnames, keepExons=False, attributeKey=None, labels=None, verbose=False, nativeParser=True, index=None, flatten=False, threads=None, chromAliases=None, cacheSize=0, regions=None, attributeKeys=None):
         """
         Driver function to actually parse files. The steps are as follows:
 
@@ -186,46 +223,143 @@ class Enrichment(GTF):
         labels:       Override the feature labels supplied in the file(s).
                       Note that this might instead be replaced later in the .features attribute.
         verbose:      Whether to print warnings (default: False)
+        nativeParser: Whether to parse files in C (the default). Otherwise, or
+                      for bzip2 compressed files, files are parsed line by line
+                      in python. Both produce identical results.
+        index:        The path to an index file (see GTF.save()). If it was
+                      made from the same files with the same options, it's
+                      loaded instead of parsing the files. Otherwise, the files
+                      are parsed and the index is (re)written.
+        flatten:      Whether to store the finished tree as a sorted, flat
+                      array rather than a centered interval tree (default:
+                      False). See GTF.
+        threads:      The number of files to read in parallel threads when
+                      parsing in C (default: one per file, up to the number of
+                      CPUs) and of threads building the tree (default: one per
+                      CPU). See GTF.
+        chromAliases: Chromosome aliases, as a dictionary mapping aliases to
+                      names or the path to a file of them. See GTF.
+        cacheSize:    The number of findOverlaps() results to cache (default:
+                      0, no caching). See GTF.setCacheSize().
+        regions:      Only load entries overlapping these regions, a BED file
+                      or a list of chromosomes and (chromosome, start, end)
+                      tuples. Features found only outside of them aren't
+                      added. See GTF.
+        attributeKeys: A list of attribute keys, as attributeKey, with None
+                      for the feature column (or the file name, for BED
+                      files). Each entry then has a feature for every key, so
+                      overlaps for several keys are found without parsing the
+                      files once per key. findOverlaps() returns a tuple of
+                      the features overlapped for each key. This can't be used
+                      with attributeKey.
+
+        >>> from deeptoolsintervals import enrichment
+        >>> from os.path import dirname
+        >>> d = dirname(enrichment.__file__)
+        >>> fnames = ["{0}/test/{1}".format(d, x) for x in ["GRCh38.84.gtf.gz", "GRCh38.84.labels.bed", "GRCh38.84.bed6"]]
+        >>> native = enrichment.Enrichment(fnames, keepExons=True, attributeKey="gene_biotype")
+        >>> python = enrichment.Enrichment(fnames, keepExons=True, attributeKey="gene_biotype", nativeParser=False)
+        >>> assert(native.features == python.features)
+        >>> assert(native.findOverlaps("1", [(0, 30000000)]) == python.findOverlaps("1", [(0, 30000000)]))
+        >>> flat = enrichment.Enrichment(fnames, keepExons=True, attributeKey="gene_biotype", flatten=True)
+        >>> assert(flat.findOverlaps("1", [(0, 30000000)]) == native.findOverlaps("1", [(0, 30000000)]))
+        >>> import tempfile
+        >>> idx = "{0}/enrichment.idx".format(tempfile.mkdtemp())
+        >>> _ = enrichment.Enrichment(fnames, keepExons=True, attributeKey="gene_biotype", index=idx)
+        >>> loaded = enrichment.Enrichment.load(idx)
+        >>> assert(loaded.features == native.features)
+        >>> assert(loaded.findOverlaps("1", [(0, 30000000)]) == native.findOverlaps("1", [(0, 30000000)]))
+        >>> tabix = "{0}/test/GRCh38.84.tabix.bed.gz".format(d)
+        >>> restricted = enrichment.Enrichment(tabix, regions=[("1", 12000, 15000)])
+        >>> restricted.countOverlaps("1", [(0, 30000000)])
+        3
+        >>> assert(restricted.findOverlaps("1", [(0, 30000000)]) == enrichment.Enrichment(tabix, regions=[("1", 12000, 15000)], nativeParser=False).findOverlaps("1", [(0, 30000000)]))
         """
         self.fname = []
         self.filename = ""
-        self.chroms = []
+        self.initChroms([], chromAliases)
+        self.setCacheSize(cacheSize)
+        regions = readRegions(regions)
+        self.regions = expandRegions(regions, self.aliasGroups)
         self.features = []
         self.tree = tree.initTree()
         self.keepExons = keepExons
         self.verbose = verbose
         self.attributeKey = attributeKey
+        self.attributeKeys = None
+        self.nativeParser = nativeParser
+        if attributeKeys is not None:
+            if attributeKey is not None:
+                raise RuntimeError("attributeKey and attributeKeys can't both be used!")
+            if not isinstance(attributeKeys, (list, tuple)):
+                attributeKeys = [attributeKeys]
+            if len(attributeKeys) == 0:
+                raise RuntimeError("attributeKeys must hold at least one key!")
+            self.attributeKeys = list(attributeKeys)
 
         if not isinstance(fnames, list):
             fnames = [fnames]
+        self.fname = [getattr(f, "fname", f) for f in fnames]
+        self.indexOptions = {"keepExons": keepExons, "attributeKey": attributeKey, "labels": labels}
+        if chromAliases is not None:
+            self.indexOptions["chromAliases"] = chromAliases
+        if regions is not None:
+            self.indexOptions["regions"] = regions
+        if self.attributeKeys is not None:
+            self.indexOptions["attributeKeys"] = self.attributeKeys
+
+        if index is not None:
+            loaded = readIndex(index)
+            if loaded is not None and indexIsCurrent(loaded[1], type(self).__name__, fnames, self.indexOptions):
+                self.initFromIndex(loaded[0], loaded[1])
+                return
+            if self.verbose:
+                sys.stderr.write("Warning, {0} is missing or out of date, it will be rebuilt.\n".format(index))
+
+        self.loadFiles(fnames, labels, threads)
 
-        # Load the files
-        for labelIdx, fname in enumerate(fnames):
-            self.filename = fname
-            fp = openPossiblyCompressed(fname)
-            line, labelColumn = self.firstNonComment(fp)
-            if line is None:
-                # This will only ever happen if a file is empty or just has a header/comment
-                continue
-            line = line.strip()
+        # vine -> tree
+        self.tree.finish(flatten, treeThreads(threads))
 
-            ftype = self.inferType(fp, line, labelColumn)
+        if index is not None:
+            self.save(index)
 
-            if ftype != 'GTF' and labels is not None:
-                assert(len(labels) > labelIdx)
-                bname = labels[labelIdx]
-            else:
-                bname = basename(fname)
-            feature = "None" if attributeKey is not None else bname
-            if ftype == 'GTF':
-                self.parseGTF(fp, line)
-            elif ftype == 'BED3':
-                self.parseBED(fp, line, 3, feature=feature, labelColumn=labelColumn)
-            elif ftype == 'BED6':
-                self.parseBED(fp, line, 6, feature=feature, labelColumn=labelColumn)
-            else:
-                self.parseBED(fp, line, 12, feature=feature, labelColumn=labelColumn)
-            fp.close()
+    def loadFiles(self, fnames, labels=None, threads=None):
+        """
+        Parse a list of files, adding their entries to the tree. labels, if
+        given, are the features of BED files. See the constructor.
+        """
+        # Load the files
+        def stage(fname, ftype, labelColumn):
+            return tree.stageFile(fname, ftype, labelColumn, self.keepExons, None, None, None, self.attributeKey, True, self.regions, self.attributeKeys)
+
+        files = self.readFiles(fnames, stage, threads)
+        try:
+            for labelIdx, fname, fp, line, labelColumn, ftype, staged in files:
+                if ftype != 'GTF' and labels is not None:
+                    assert(len(labels) > labelIdx)
+                    bname = labels[labelIdx]
+                else:
+                    bname = basename(fname)
+                if self.attributeKeys is not None:
+                    feature = tuple("None" if k is not None else bname for k in self.attributeKeys)
+                else:
+                    feature = "None" if self.attributeKey is not None else bname
+                if staged is not None:
+                    self.tree.loadEnrichmentFile(staged, ftype, labelColumn, self.keepExons, self.attributeKey, feature, self.features, self.mungeChromosome, self.attributeKeys)
+                    continue
+
+                if ftype == 'GTF':
+                    self.parseGTF(fp, line)
+                elif ftype == 'BED3':
+                    self.parseBED(fp, line, 3, feature=feature, labelColumn=labelColumn)
+                elif ftype == 'BED6':
+                    self.parseBED(fp, line, 6, feature=feature, labelColumn=labelColumn)
+                else:
+                    self.parseBED(fp, line, 12, feature=feature, labelColumn=labelColumn)
+                fp.close()
+        finally:
+            files.close()
 
         # Sanity check
         if self.tree.countEntries() == 0:
@@ -234,14 +368,49 @@ class Enrichment(GTF):
         if len(self.features) == 0:
             raise RuntimeError("There were no valid feature labels!")
 
-        # vine -> tree
-        self.tree.finish()
+    @classmethod
+    def stagingOptions(cls, options):
+        """
+        The arguments to tree.stageFile() and tree.openChunks() following the
+        file name, type and label column. See GTF.
+        """
+        return (options.get("keepExons", False), None, None, None, options.get("attributeKey"), True)
+
+    @classmethod
+    def stagedAttributes(cls, options):
+        """
+        The final argument to tree.openChunks(), the attribute keys whose
+        features are staged. See GTF.
+        """
+        attributeKeys = options.get("attributeKeys")
+        if attributeKeys is not None and not isinstance(attributeKeys, (list, tuple)):
+            return [attributeKeys]
+        return None if attributeKeys is None else list(attributeKeys)
+
+    def indexMetadata(self):
+        """
+        The python-side information stored in an index, beyond the tree itself
+        """
+        return {"features": self.features, "chroms": self.chroms}
+
+    def initFromIndex(self, t, meta):
+        """
+        Use a tree and its metadata from an index
+        """
+        self.tree = t
+        self.features = nativeStr(meta["features"])
+        self.attributeKeys = nativeStr(self.indexOptions.get("attributeKeys"))
+        self.initChroms(nativeStr(meta["chroms"]), self.indexOptions.get("chromAliases"))
 
     # findOverlaps()
     def findOverlaps(self, chrom, blocks, strand=".", matchType=0, strandType=0):
         """
         Given a chromosome and start/end coordinates with an optional strand,
-        return a frozenset of the overlap features.
+        return a frozenset of the overlap features. With attributeKeys, a tuple
+        of frozensets is returned instead, holding the features overlapped for
+        each key. These all come from a single search of the tree. As they
+        can't be modified, results from the query cache are returned as is
+        rather than copied.
 
         If there are no overlaps, return None. This function allows stranded
         searching, though the default is to ignore strand!
@@ -258,6 +427,40 @@ class Enrichment(GTF):
                       1, GTF_SAME_STRAND
                       2, GTF_OPPOSITE_STRAND
                       3, GTF_EXACT_SAME_STRAND
+
+        >>> from deeptoolsintervals import enrichment
+        >>> from os.path import dirname
+        >>> gtf = enrichment.Enrichment("{0}/test/GRCh38.84.gtf.gz".format(dirname(enrichment.__file__)), cacheSize=10)
+        >>> o = gtf.findOverlaps("1", [(0, 20000), (30000, 40000)])
+        >>> sorted(o)
+        ['exon', 'gene', 'group 1', 'group 2', 'transcript']
+        >>> assert(gtf.findOverlaps("1", [[0, 20000], [30000, 40000]]) is o)
+        >>> o.add("foo")
+        Traceback (most recent call last):
+        ...
+        AttributeError: 'frozenset' object has no attribute 'add'
+        >>> gtf.cacheStats()["hits"]
+        1
+        >>> gtf = enrichment.Enrichment("{0}/test/GRCh38.84.gtf.gz".format(dirname(enrichment.__file__)), attributeKeys=[None, "gene_biotype", "transcript_biotype"])
+        >>> features, biotypes, transcriptBiotypes = gtf.findOverlaps("1", [(0, 20000), (30000, 40000)])
+        >>> sorted(features), sorted(biotypes), sorted(transcriptBiotypes)
+        (['exon', 'gene', 'group 1', 'group 2', 'transcript'], ['group 1', 'group 2', 'lincRNA', 'miRNA', 'transcribed_unprocessed_pseudogene', 'unprocessed_pseudogene'], ['None', 'group 1', 'group 2', 'lincRNA', 'miRNA', 'processed_transcript', 'transcribed_unprocessed_pseudogene', 'unprocessed_pseudogene'])
+        >>> biotypes == enrichment.Enrichment("{0}/test/GRCh38.84.gtf.gz".format(dirname(enrichment.__file__)), attributeKey="gene_biotype").findOverlaps("1", [(0, 20000), (30000, 40000)])
+        True
+        """
+        if self.cache is None:
+            return self.queryOverlaps(chrom, blocks, strand, matchType, strandType)
+
+        key = (chrom, tuple((int(b[0]), int(b[1])) for b in blocks), strand, matchType, strandType)
+        overlaps = self.cache.get(key, self.cache)
+        if overlaps is self.cache:
+            overlaps = self.queryOverlaps(chrom, blocks, strand, matchType, strandType)
+            self.cache.put(key, overlaps)
+        return overlaps
+
+    def queryOverlaps(self, chrom, blocks, strand=".", matchType=0, strandType=0):
+        """
+        findOverlaps(), bypassing the query cache
         """
         chrom = self.mungeChromosome(chrom, append=False)
         if not chrom:
@@ -271,12 +474,16 @@ class Enrichment(GTF):
             raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
 
         # Convert the strand to a number
-        if strand == '+':
-            strand = 1
-        elif strand == '-':
-            strand = 2
-        else:
-            strand = 0
+        strand = strandIndex(strand)
+
+        if self.attributeKeys is not None:
+            osets = [set() for k in self.attributeKeys]
+            for block in blocks:
+                overlaps = self.tree.findOverlappingFeatures(chrom, int(block[0]), int(block[1]), strand, matchType, strandType, len(self.attributeKeys))
+                if overlaps is not None:
+                    for oset, o in zip(osets, overlaps):
+                        oset.update(o)
+            return tuple(frozenset(oset) for oset in osets)
 
         oset = frozenset()
         for block in blocks:
@@ -285,3 +492,129 @@ class Enrichment(GTF):
                 oset = oset.union(frozenset(overlaps))
 
         return oset
+
+    def countOverlaps(self, chrom, blocks, strand=".", matchType=0, strandType=0):
+        """
+        The number of intervals overlapping each of the blocks, summed. An
+        interval overlapping two blocks is then counted twice. The options are
+        as in findOverlaps().
+
+        >>> from deeptoolsintervals import enrichment
+        >>> from os.path import dirname
+        >>> gtf = enrichment.Enrichment("{0}/test/GRCh38.84.gtf.gz".format(dirname(enrichment.__file__)))
+        >>> gtf.countOverlaps("1", [(0, 15000), (17000, 18000)])
+        24
+        >>> gtf.overlapsAny("1", [(0, 100), (11000, 11869)])
+        True
+        >>> gtf.overlapsAny("1", [(0, 100), (11000, 11868)])
+        False
+        """
+        chrom = self.mungeChromosome(chrom, append=False)
+        if not chrom:
+            return 0
+
+        if not self.tree.isTree():
+            raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
+
+        strand = strandIndex(strand)
+        return sum(self.tree.countOverlaps(chrom, int(block[0]), int(block[1]), strand, matchType, strandType) for block in blocks)
+
+    def overlapsAny(self, chrom, blocks, strand=".", matchType=0, strandType=0):
+        """
+        Whether any of the blocks overlaps an interval, which is faster than
+        findOverlaps(). See countOverlaps().
+        """
+        chrom = self.mungeChromosome(chrom, append=False)
+        if not chrom:
+            return False
+
+        if not self.tree.isTree():
+            raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
+
+        strand = strandIndex(strand)
+        return any(self.tree.overlapsAny(chrom, int(block[0]), int(block[1]), strand, matchType, strandType) for block in blocks)
+
+    def findFeaturesBatch(self, chroms, starts, ends, offsets=None, strands=None, matchType=0, strandType=0, keyIdx=0):
+        """
+        The batch equivalent of findOverlaps(), for many reads at once. The
+        blocks of every read are given as columns, as in
+        GTF.findOverlapsBatch(), with the blocks of read i being entries
+        offsets[i] to offsets[i + 1] - 1 (if offsets is None, each block is
+        its own read). The features overlapped by each read are returned in
+        the same style, as a tuple of columns:
+
+         * offsets: the features of read i are entries offsets[i] to offsets[i + 1] - 1
+         * feature indices, into self.features, sorted for each read
+
+        With attributeKeys, the features are those of the keyIdx-th key.
+
+        >>> from deeptoolsintervals import enrichment
+        >>> from os.path import dirname
+        >>> gtf = enrichment.Enrichment("{0}/test/GRCh38.84.gtf.gz".format(dirname(enrichment.__file__)))
+        >>> blocks = [(0, 100), (11000, 11869), (0, 15000), (17000, 18000), (0, 100)]
+        >>> offsets, features = gtf.findFeaturesBatch("1", [b[0] for b in blocks], [b[1] for b in blocks], offsets=[0, 2, 4, 5])
+        >>> [int(x) for x in offsets]
+        [0, 3, 7, 7]
+        >>> [gtf.features[f] for f in features[3:7]] == sorted(gtf.findOverlaps("1", blocks[2:4]), key=gtf.features.index)
+        True
+        """
+        if not self.tree.isTree():
+            raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
+
+        def munge(chrom):
+            return self.mungeChromosome(chrom, append=False)
+
+        cols = self.tree.findFeaturesBatch(chroms, starts, ends, offsets, strands, matchType, strandType, munge, None, self.featureKeyIdx(keyIdx))
+        return (batchColumn(cols[0], "q", "int64"), batchColumn(cols[1], "i", "int32"))
+
+    def countFeaturesBatch(self, chroms, starts, ends, offsets=None, strands=None, matchType=0, strandType=0, counts=None, keyIdx=0):
+        """
+        As findFeaturesBatch(), but only counting the number of reads that
+        overlap each feature. The counts are added to counts, an int64 array
+        with a value for each of self.features, which is created (with zeros)
+        if it's None. The counts are returned. keyIdx is as in
+        findFeaturesBatch().
+
+        >>> from deeptoolsintervals import enrichment
+        >>> from os.path import dirname
+        >>> gtf = enrichment.Enrichment("{0}/test/GRCh38.84.gtf.gz".format(dirname(enrichment.__file__)))
+        >>> counts = gtf.countFeaturesBatch("1", [0, 0, 17000], [100, 15000, 18000], offsets=[0, 1, 3])
+        >>> counts = gtf.countFeaturesBatch(["chr1", "1"], [11000, 14000], [11869, 14001], counts=counts)
+        >>> sorted((gtf.features[i], int(c)) for i, c in enumerate(counts) if c)
+        [('exon', 3), ('gene', 3), ('group 1', 3), ('group 2', 1)]
+        >>> gtf = enrichment.Enrichment("{0}/test/GRCh38.84.gtf.gz".format(dirname(enrichment.__file__)), attributeKeys=["gene_biotype", None])
+        >>> counts = gtf.countFeaturesBatch("1", [0, 0, 17000], [100, 15000, 18000], offsets=[0, 1, 3], keyIdx=1)
+        >>> sorted((gtf.features[i], int(c)) for i, c in enumerate(counts) if c)
+        [('exon', 1), ('gene', 1), ('group 1', 1), ('group 2', 1)]
+        """
+        if not self.tree.isTree():
+            raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
+
+        if counts is None:
+            if supportsNumpy:
+                counts = numpy.zeros(len(self.features), dtype="int64")
+            elif sys.version_info[0] < 3:
+                counts = array.array("l", [0] * len(self.features))
+            else:
+                counts = array.array("q", [0] * len(self.features))
+
+        if isinstance(counts, array.array) and sys.version_info[0] < 3:
+            # Python 2's arrays can't be written to in C, so count the features of each read here
+            for f in self.findFeaturesBatch(chroms, starts, ends, offsets, strands, matchType, strandType, keyIdx)[1]:
+                counts[f] += 1
+            return counts
+
+        def munge(chrom):
+            return self.mungeChromosome(chrom, append=False)
+
+        self.tree.findFeaturesBatch(chroms, starts, ends, offsets, strands, matchType, strandType, munge, counts, self.featureKeyIdx(keyIdx))
+        return counts
+
+    def featureKeyIdx(self, keyIdx):
+        """
+        Check the index of an attribute key for the batch functions
+        """
+        nKeys = 1 if self.attributeKeys is None else len(self.attributeKeys)
+        if keyIdx < 0 or keyIdx >= nKeys:
+            raise RuntimeError("keyIdx must be the index of one of the {0} attribute keys!".format(nKeys))
+        return keyIdx
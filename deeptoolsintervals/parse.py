@@ -8,8 +8,43 @@ try:
     supportsBZ2 = True
 except:
     supportsBZ2 = False
+import os
 import os.path
-import csv
+import json
+import hashlib
+import array
+import bisect
+import copy
+import threading
+from collections import OrderedDict
+try:
+    import numpy
+    supportsNumpy = True
+except:
+    supportsNumpy = False
+try:
+    from multiprocessing import shared_memory
+    supportsSharedMemory = True
+except:
+    supportsSharedMemory = False
+try:
+    from concurrent.futures import ThreadPoolExecutor
+    from multiprocessing import cpu_count
+    supportsThreads = True
+except:
+    supportsThreads = False
+
+
+def treeThreads(threads):
+    """
+    The number of threads to build a tree with: threads, if given, and
+    otherwise one per CPU.
+    """
+    if threads:
+        return threads
+    if supportsThreads:
+        return cpu_count()
+    return 1
 
 
 def getNext(fp):
@@ -41,27 +76,33 @@ def seemsLikeGTF(cols):
         cols[6] in ['+', '-', '.']
         if cols[7] != '.':
             int(cols[7]) in [0, 1, 2]
-        s = next(csv.reader([cols[8]], delimiter=' '))
-        assert("gene_id" in s)
-        assert(s[-1] != "gene_id")
+        assert(tree.parseAttributes(cols[8], ["gene_id"])[0] is not None)
         return True
     except:
         return False
 
 
-def findRandomLabel(labels, name):
+def findRandomLabel(labels, name, suffixes=None):
     """
     Because some people are too clever by half, ensure that group labels are unique...
+
+    suffixes, if given, is a dictionary of the last suffix given to each name
+    in labels. Many copies of a name (e.g., identical BED3 intervals) then
+    don't each need to try every suffix in turn.
     """
     if name not in labels:
         return name
 
     # This is what the heatmapper.py did to ensure unique names
     i = 0
+    if suffixes is not None:
+        i = suffixes.get(name, 0)
     while True:
         i += 1
         nameTry = name + "_r" + str(i)
         if nameTry not in labels:
+            if suffixes is not None:
+                suffixes[name] = i
             return nameTry
 
 
@@ -109,6 +150,421 @@ def openPossiblyCompressed(fname):
         return open(fname, mode)
 
 
+def canParseNatively(fname):
+    """
+    The C parser can handle uncompressed and gzipped files, but not bzip2 compressed ones
+    """
+    with open(fname, "rb") as f:
+        first3 = bytes(f.read(3))
+    return first3 != b"\x42\x5a\x68"
+
+
+def fileStats(fnames):
+    """
+    The absolute path, size and modification time of each file
+    """
+    return [{"path": os.path.abspath(f), "size": os.path.getsize(f), "mtime": os.path.getmtime(f)} for f in fnames]
+
+
+def sourceChecksum(fnames, options):
+    """
+    The md5 checksum of the contents of a list of files and a dictionary of the options used to parse them
+    """
+    h = hashlib.md5()
+    h.update(json.dumps(options, sort_keys=True).encode("utf-8"))
+    for fname in fnames:
+        with open(fname, "rb") as f:
+            while True:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                h.update(chunk)
+    return h.hexdigest()
+
+
+def indexIsCurrent(meta, className, fnames, options):
+    """
+    Whether the metadata of an index matches a class, a list of files and the
+    options used to parse them. Files that no longer exist are assumed to be
+    unchanged. The checksum is only computed if a file's size or modification
+    time differs from when the index was made.
+    """
+    if meta["class"] != className:
+        return False
+    if meta["options"] != json.loads(json.dumps(options)):
+        return False
+    if [x["path"] for x in meta["sources"]] != [os.path.abspath(f) for f in fnames]:
+        return False
+    fnames = [f for f in fnames if os.path.exists(f)]
+    stats = [x for x in meta["sources"] if os.path.exists(x["path"])]
+    if fileStats(fnames) == stats:
+        return True
+    return sourceChecksum(fnames, options) == meta["checksum"]
+
+
+def nativeStr(s):
+    """
+    Convert the strings from JSON, which are unicode on python 2, to str,
+    including those in lists and dictionaries
+    """
+    if sys.version_info[0] >= 3 or isinstance(s, str):
+        return s
+    if isinstance(s, list):
+        return [nativeStr(x) for x in s]
+    if isinstance(s, dict):
+        return dict((nativeStr(k), nativeStr(v)) for k, v in s.items())
+    if hasattr(s, "encode"):
+        return s.encode("utf-8")
+    return s
+
+
+def readIndex(fname):
+    """
+    Memory-map an index, returning a tuple of the tree and its metadata (or None if fname isn't a usable index)
+    """
+    try:
+        t, meta = tree.loadIndex(fname)
+        return t, json.loads(meta.decode("utf-8"))
+    except (RuntimeError, ValueError):
+        return None
+
+
+def attachSharedMemory(name):
+    """
+    Attach to an existing shared memory segment without taking ownership of
+    it. Before python 3.13, attaching also registered the segment to be deleted
+    when this process exits, so registration is skipped here.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        from multiprocessing import resource_tracker
+        register = resource_tracker.register
+        resource_tracker.register = lambda name, rtype: None
+        try:
+            return shared_memory.SharedMemory(name=name)
+        finally:
+            resource_tracker.register = register
+
+
+def strandIndex(strand):
+    """
+    Convert a strand ('+', '-' or anything else for unstranded) to the number used by the tree
+    """
+    if strand == '+':
+        return 0
+    elif strand == '-':
+        return 1
+    return 3
+
+
+def batchColumn(col, typecode, dtype):
+    """
+    Wrap a bytearray returned by a batch query as a numpy array, if possible, or an array.array
+    """
+    if supportsNumpy:
+        return numpy.frombuffer(col, dtype=dtype)
+    if typecode == "q" and sys.version_info[0] < 3:
+        # Python 2 lacks "q", but "l" is 64 bits on the platforms we build on
+        typecode = "l"
+    return array.array(typecode, bytes(col))
+
+
+def readChromAliases(aliases):
+    """
+    Read chromosome aliases, returning a dictionary mapping each name to the
+    list of all names for that sequence. aliases is either None, a dictionary
+    mapping aliases to names, or the path to a (possibly compressed) file with
+    a line per sequence listing its names separated by tabs, such as UCSC's
+    chromAlias.txt. Lines starting with # are ignored.
+
+    >>> from deeptoolsintervals import parse
+    >>> groups = parse.readChromAliases({"NC_000001.11": "1", "CM000663.2": "1"})
+    >>> sorted(groups["CM000663.2"])
+    ['1', 'CM000663.2', 'NC_000001.11']
+    """
+    if aliases is None:
+        return dict()
+    if isinstance(aliases, dict):
+        lines = [[k, v] for k, v in aliases.items()]
+    else:
+        lines = []
+        fp = openPossiblyCompressed(aliases)
+        line = getNext(fp)
+        while line:
+            if not line.startswith("#"):
+                names = [x.strip() for x in line.split("\t")]
+                lines.append([x for x in names if x])
+            line = getNext(fp)
+        fp.close()
+
+    groups = dict()
+    for names in lines:
+        group = set(names)
+        for name in names:
+            if name in groups:
+                group.update(groups[name])
+        group = sorted(group)
+        for name in group:
+            groups[name] = group
+    return groups
+
+
+def readRegions(regions):
+    """
+    Read the regions to which loading should be restricted, returning a sorted
+    list of non-overlapping (chromosome, start, end) tuples, or None if regions
+    is None. regions is either the path to a (possibly compressed) BED file of
+    windows or a list of chromosome names and (chromosome, start, end) tuples.
+    A name alone includes the whole chromosome. Overlapping and adjacent
+    windows are merged.
+
+    >>> from deeptoolsintervals import parse
+    >>> parse.readRegions(["2", ("1", 100, 200), ("1", 150, 300), ("1", 0, 50)])
+    [('1', 0, 50), ('1', 100, 300), ('2', 0, 4294967295)]
+    >>> parse.readRegions([("1", 200, 100)])
+    Traceback (most recent call last):
+    ...
+    RuntimeError: ('1', 200, 100) is an invalid region!
+    """
+    if regions is None:
+        return None
+    if isinstance(regions, str):
+        windows = []
+        fp = openPossiblyCompressed(regions)
+        line = getNext(fp)
+        while line:
+            line = line.strip()
+            if line and not line.startswith("#") and not line.startswith("track") and not line.startswith("browser"):
+                cols = line.split("\t")
+                if len(cols) < 3:
+                    fp.close()
+                    raise RuntimeError("{0} is not a BED file, it has a line with fewer than 3 columns!".format(regions))
+                windows.append((cols[0], cols[1], cols[2]))
+            line = getNext(fp)
+        fp.close()
+    else:
+        windows = [(r, 0, 4294967295) if isinstance(r, str) else tuple(r) for r in regions]
+
+    byChrom = dict()
+    for w in windows:
+        try:
+            chrom, start, end = w[0], int(w[1]), min(int(w[2]), 4294967295)
+            assert(len(w) == 3 and 0 <= start < end)
+        except:
+            raise RuntimeError("{0} is an invalid region!".format(w))
+        byChrom.setdefault(chrom, []).append((start, end))
+
+    merged = []
+    for chrom in sorted(byChrom):
+        last = None
+        for start, end in sorted(byChrom[chrom]):
+            if last is not None and start <= last[1]:
+                last[1] = max(last[1], end)
+                continue
+            last = [start, end]
+            merged.append((chrom, last))
+    return [(chrom, w[0], w[1]) for chrom, w in merged]
+
+
+def expandRegions(regions, aliasGroups):
+    """
+    Convert regions, as returned by readRegions(), to a dictionary of the
+    (starts, ends) lists of windows on each chromosome. Each chromosome is also
+    listed under every name GTF.addChrom() would resolve to it (its aliases,
+    chr1 <-> 1 and chrM <-> MT), since files may use any of them.
+
+    >>> from deeptoolsintervals import parse
+    >>> sorted(parse.expandRegions([("MT", 0, 100)], {}))
+    ['MT', 'chrM', 'chrMT']
+    >>> parse.expandRegions([("1", 0, 100), ("chr1", 50, 200)], {})["1"]
+    ([0], [200])
+    """
+    if regions is None:
+        return None
+    windows = dict()
+    for chrom, start, end in regions:
+        names = set([chrom] + list(aliasGroups.get(chrom, [])))
+        if chrom == "chrM":
+            names.add("MT")
+        elif chrom == "MT":
+            names.add("chrM")
+        if len(chrom) > 0:
+            names.add("chr" + chrom)
+        if chrom.startswith("chr"):
+            names.add(chrom[3:])
+        for name in names:
+            windows.setdefault(name, []).append((start, end))
+
+    out = dict()
+    for name, w in windows.items():
+        starts = []
+        ends = []
+        for start, end in sorted(w):
+            if ends and start <= ends[-1]:
+                ends[-1] = max(ends[-1], end)
+            else:
+                starts.append(start)
+                ends.append(end)
+        out[name] = (starts, ends)
+    return out
+
+
+def inRegions(regions, chrom, start, end):
+    """
+    Whether [start, end) overlaps one of the windows returned by
+    expandRegions(). As with tabix, intervals are at least 1 base long and
+    negative starts are treated as 0.
+    """
+    if chrom not in regions:
+        return False
+    starts, ends = regions[chrom]
+    start = max(start, 0)
+    end = max(end, start + 1)
+    # The first window ending after start
+    idx = bisect.bisect_right(ends, start)
+    return idx < len(starts) and starts[idx] < end
+
+
+def attributeKeys(attributes):
+    """
+    Normalize the attributes option of the GTF class: None (keep no
+    attributes), True (keep all of them) or a key or list of keys to keep.
+
+    >>> from deeptoolsintervals import parse
+    >>> parse.attributeKeys("gene_name"), parse.attributeKeys(("gene_name", "tag")), parse.attributeKeys(True)
+    (['gene_name'], ['gene_name', 'tag'], True)
+    """
+    if attributes is None or attributes is True:
+        return attributes
+    if isinstance(attributes, str):
+        return [attributes]
+    return [str(k) for k in attributes]
+
+
+def requireKey(require):
+    """
+    A hashable version of the require option of the query functions, for the
+    query cache.
+    """
+    if require is None:
+        return None
+    return frozenset((k, v if isinstance(v, str) else frozenset(v)) for k, v in require.items())
+
+
+class StagedChunk(object):
+    """
+    The staged entries on a single chromosome of a file, as produced by
+    GTF.stream(). These can be given to GTF() or Enrichment() in place of file
+    names.
+    """
+    def __init__(self, fname, ftype, labelColumn, staged):
+        self.fname = fname
+        self.ftype = ftype
+        self.labelColumn = labelColumn
+        self.staged = staged
+
+
+class OverlapColumns(object):
+    """
+    The overlaps of a region as columns, as returned by GTF.findOverlaps()
+    with columns=True. starts, ends, labelIdx (into GTF.labels), scores (NaN
+    for '.') and strandIdx (0: '+', 1: '-', 3: '.') are numpy arrays if numpy
+    is installed and array.array objects otherwise. The names, labels and
+    strands are only converted to strings when first accessed. The overlaps
+    are sorted by start and then end position.
+    """
+    def __init__(self, gtf, cols):
+        self.gtf = gtf
+        self.nameIdx, self.starts, self.ends, self.labelIdx, self.scores, self.strandIdx = (batchColumn(col, typecode, dtype) for col, typecode, dtype in zip(cols, ["i", "I", "I", "I", "d", "B"], ["int32", "uint32", "uint32", "uint32", "float64", "uint8"]))
+        self._names = None
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def names(self):
+        if self._names is None:
+            self._names = self.gtf.getNames(self.nameIdx)
+        return self._names
+
+    @property
+    def labels(self):
+        return [self.gtf.labels[x] for x in self.labelIdx]
+
+    @property
+    def strands(self):
+        return ["+-?."[x] for x in self.strandIdx]
+
+    def copy(self):
+        """
+        A copy whose columns can be modified without affecting these
+        """
+        other = copy.copy(self)
+        other.nameIdx, other.starts, other.ends, other.labelIdx, other.scores, other.strandIdx = (copy.copy(col) for col in (self.nameIdx, self.starts, self.ends, self.labelIdx, self.scores, self.strandIdx))
+        if self._names is not None:
+            other._names = list(self._names)
+        return other
+
+
+def copyOverlaps(overlaps):
+    """
+    Copy a result of GTF.findOverlaps(), including the exon lists, so that a
+    cached result isn't changed when the copy is
+    """
+    if overlaps is None:
+        return None
+    if isinstance(overlaps, OverlapColumns):
+        return overlaps.copy()
+    return [o[:4] + (list(o[4]),) + o[5:] for o in overlaps]
+
+
+class QueryCache(object):
+    """
+    A bounded cache of query results, evicting the least recently used once
+    more than capacity results are held. hits, misses and evictions count
+    what the name implies. Queries can run in several threads at once, so
+    the cache is locked while it's used.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        """
+        Return the result cached under key, or default if there isn't one
+        """
+        with self.lock:
+            if key not in self.results:
+                self.misses += 1
+                return default
+            self.hits += 1
+            # Reinserting moves it to the end (move_to_end() needs python 3)
+            result = self.results.pop(key)
+            self.results[key] = result
+            return result
+
+    def put(self, key, result):
+        with self.lock:
+            self.results.pop(key, None)
+            self.results[key] = result
+            if len(self.results) > self.capacity:
+                self.results.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.results.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"size": len(self.results), "capacity": self.capacity, "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+
 def getLabel(line):
     """
     Split by tabs and return the index of "deepTools_group" (or None)
@@ -154,6 +610,85 @@ class GTF(object):
             return None
         return line, labelColumn
 
+    def sniffFile(self, fname, keepOpen=False):
+        """
+        Open a file and infer its type, returning a tuple of its first line,
+        label column and type, or None if the file is empty. If keepOpen is
+        True, the file pointer (positioned after the first line) is also
+        returned, at the start of the tuple.
+        """
+        self.filename = fname
+        fp = openPossiblyCompressed(fname)
+        first = self.firstNonComment(fp)
+        if first is None:
+            # This will only ever happen if a file is empty or just has a header/comment
+            fp.close()
+            return None
+        line, labelColumn = first
+        line = line.strip()
+        ftype = self.inferType(fp, line, labelColumn)
+        if keepOpen:
+            return fp, line, labelColumn, ftype
+        fp.close()
+        return line, labelColumn, ftype
+
+    def readFiles(self, fnames, stage, threads=None):
+        """
+        A generator that opens each file and infers its type, yielding tuples
+        of the file's index in fnames, name, file pointer, first line, label
+        column, type and staged file. Empty files are skipped.
+
+        Files that can be parsed in C are staged (read and tokenized) with
+        stage(fname, ftype, labelColumn), which releases the GIL, in up to
+        threads threads at once (by default, one per file up to the number of
+        CPUs). Their file pointer is then None. Otherwise, the staged file is
+        None and the file pointer is positioned after the first line, for the
+        caller to parse and close. Either way, files are yielded in order, so
+        the results never depend on the number of threads. StagedChunks in
+        fnames are yielded as they are.
+        """
+        files = []
+        staged = dict()
+        chunks = dict()
+        pool = None
+        try:
+            for idx, fname in enumerate(fnames):
+                if isinstance(fname, StagedChunk):
+                    chunks[idx] = fname.staged
+                    files.append((idx, fname.fname, None, None, fname.labelColumn, fname.ftype))
+                    continue
+                sniffed = self.sniffFile(fname, keepOpen=True)
+                if sniffed is None:
+                    continue
+                fp, line, labelColumn, ftype = sniffed
+                if self.nativeParser and canParseNatively(fname):
+                    fp.close()
+                    fp = None
+                files.append((idx, fname, fp, line, labelColumn, ftype))
+
+            native = [f for f in files if f[2] is None and f[0] not in chunks]
+            if supportsThreads and len(native) > 1 and threads != 1:
+                pool = ThreadPoolExecutor(max_workers=threads or min(len(native), cpu_count()))
+                for idx, fname, fp, line, labelColumn, ftype in native:
+                    staged[idx] = pool.submit(stage, fname, ftype, labelColumn)
+
+            for idx, fname, fp, line, labelColumn, ftype in files:
+                self.filename = fname
+                sf = None
+                if idx in chunks:
+                    sf = chunks[idx]
+                elif fp is None:
+                    sf = staged.pop(idx).result() if pool is not None else stage(fname, ftype, labelColumn)
+                yield idx, fname, fp, line, labelColumn, ftype, sf
+        finally:
+            if pool is not None:
+                for f in staged.values():
+                    f.cancel()
+                pool.shutdown(wait=True)
+            for f in files:
+                if f[2] is not None:
+                    f[2].close()
+
     def inferType(self, fp, line, labelColumn=None):
         """
         Attempt to infer a file type from a single line. This is largely based on the number of columns plus looking for "gene_id".
@@ -185,28 +720,87 @@ class GTF(object):
                 sys.stderr.write("Warning, {0} has an abnormal format. Assuming BED12 format.\n".format(self.filename))
             return 'BED12'
 
-    def mungeChromosome(self, chrom, append=True):
+    def initChroms(self, chroms=[], aliases=None):
         """
-        Return the chromosome name, possibly munged to match one already found in the chromosome dictionary
+        Reset the list of chromosomes and the table of their aliases used by
+        mungeChromosome(). aliases are as in readChromAliases().
         """
-        if chrom in self.chroms:
-            return chrom
+        self.chroms = []
+        self.chromAliases = dict()
+        self.aliasGroups = readChromAliases(aliases)
+        for chrom in chroms:
+            self.addChrom(chrom)
 
-        # chrM <-> MT and chr1 <-> 1 conversions
-        if chrom == "MT" and "chrM" in self.chroms:
-            chrom = "chrM"
-        elif chrom == "chrM" and "MT" in self.chroms:
-            chrom = "MT"
-        elif chrom.startswith("chr") and len(chrom) > 3 and chrom[3:] in self.chroms:
-            chrom = chrom[3:]
-        elif "chr" + chrom in self.chroms:
-            chrom = "chr" + chrom
+    def setChromAlias(self, alias, priority, chrom):
+        """
+        Resolve alias to chrom, unless it already resolves to a chromosome with a better (lower) priority
+        """
+        current = self.chromAliases.get(alias)
+        if current is None or current[0] > priority:
+            self.chromAliases[alias] = (priority, chrom)
+
+    def addChrom(self, chrom):
+        """
+        Add a chromosome, along with every name that mungeChromosome() should
+        resolve to it. In order of priority, these are the name itself, its
+        aliases, then the chrM <-> MT and chr1 <-> 1 conversions.
+        """
+        if self.chromAliases.get(chrom, (None,))[0] == 0:
+            return
+        self.chroms.append(chrom)
+        self.setChromAlias(chrom, 0, chrom)
+        for alias in self.aliasGroups.get(chrom, []):
+            self.setChromAlias(alias, 1, chrom)
+        if chrom == "chrM":
+            self.setChromAlias("MT", 2, chrom)
+        elif chrom == "MT":
+            self.setChromAlias("chrM", 3, chrom)
+        if len(chrom) > 0:
+            self.setChromAlias("chr" + chrom, 4, chrom)
+        if chrom.startswith("chr"):
+            self.setChromAlias(chrom[3:], 5, chrom)
+
+    def mungeChromosome(self, chrom, append=True):
+        """
+        Return the chromosome name, possibly munged to match one already found
+        in the chromosome dictionary. If there's no match and append is True,
+        the name is added as a new chromosome.
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.bed6".format(dirname(parse.__file__)), chromAliases={"NC_000001.11": "1"})
+        >>> gtf.mungeChromosome("chr1", append=False)
+        '1'
+        >>> gtf.mungeChromosome("NC_000001.11", append=False)
+        '1'
+        >>> gtf.mungeChromosome("chrUn", append=False)
+        'chrUn'
+        >>> gtf.findOverlaps("NC_000001.11", 1, 20000) == gtf.findOverlaps("1", 1, 20000)
+        True
+        """
+        hit = self.chromAliases.get(chrom)
+        if hit is not None:
+            return hit[1]
 
         if append:
-            self.chroms.append(chrom)
+            self.addChrom(chrom)
 
         return chrom
 
+    def bedInRegions(self, line, labelColumn=None):
+        """
+        Whether a BED line overlaps the regions loading is restricted to (always
+        True if it isn't restricted)
+        """
+        if self.regions is None:
+            return True
+        cols = line.split("\t")
+        if labelColumn is not None:
+            cols.pop(labelColumn)
+        if len(cols) < 3:
+            return True
+        return inRegions(self.regions, cols[0], int(cols[1]), int(cols[2]))
+
     def parseBEDcore(self, line, ncols):
         """
         Returns True if the entry was added, otherwise False
@@ -216,6 +810,24 @@ class GTF(object):
         >>> gtf = parse.GTF("{0}/test/GRCh38.84.bed12.bz2".format(dirname(parse.__file__)), keepExons=True, labels=["foo"])
         >>> gtf.findOverlaps("1", 1, 20000)
         [(11868, 14409, 'ENST00000456328.2', 'foo', [(11868, 12227), (12612, 12721), (13220, 14409)], 0.0), (12009, 13670, 'ENST00000450305.2', 'foo', [(12009, 12057), (12178, 12227), (12612, 12697), (12974, 13052), (13220, 13374), (13452, 13670)], 0.0), (14403, 29570, 'ENST00000488147.1', 'foo', [(14403, 14501), (15004, 15038), (15795, 15947), (16606, 16765), (16857, 17055), (17232, 17368), (17605, 17742), (17914, 18061), (18267, 18366), (24737, 24891), (29533, 29570)], 0.0), (17368, 17436, 'ENST00000619216.1', 'foo', [(17368, 17436)], 0.0)]
+
+        Pathological files, with many identical (and so identically named),
+        nested or spanning intervals, are handled without deep recursion:
+
+        >>> import tempfile
+        >>> fname = "{0}/stress.bed".format(tempfile.mkdtemp())
+        >>> with open(fname, "w") as f:
+        ...     _ = f.write("1\\t1000\\t2000\\n" * 20000)
+        ...     _ = f.write("".join("1\\t{0}\\t{1}\\n".format(i, 100000 - i) for i in range(20000)))
+        ...     _ = f.write("".join("1\\t{0}\\t{1}\\n".format(i * 10, i * 10 + 5) for i in range(20000)))
+        >>> native = parse.GTF(fname)
+        >>> python = parse.GTF(fname, nativeParser=False)
+        >>> o = native.findOverlaps("1", 1500, 1501)
+        >>> len(o), len(set(x[2] for x in o))
+        (21502, 21502)
+        >>> assert(o == python.findOverlaps("1", 1500, 1501))
+        >>> native.countOverlaps("1", 19999, 80001), native.countOverlaps("1", 0, 200000, matchType=2)
+        (26001, 60000)
         """
 
         strand = 3
@@ -240,7 +852,7 @@ class GTF(object):
             score = cols[4]
 
         # Ensure that the name is unique
-        name = findRandomLabel(self.exons[self.labelIdx], name)
+        name = findRandomLabel(self.exons[self.labelIdx], name, self.nameSuffixes.setdefault(self.labelIdx, dict()))
         self.tree.addEntry(self.mungeChromosome(cols[0]), int(cols[1]), int(cols[2]), name, strand, self.labelIdx, score)
         if ncols != 12 or self.keepExons is False:
             self.exons[self.labelIdx][name] = [(int(cols[1]), int(cols[2]))]
@@ -296,26 +908,36 @@ class GTF(object):
         >>> assert(labels['group 4'] == 1)
         >>> assert(labels['group2'] == 9)
         >>> assert(labels['GRCh38.84.bed2'] == 1)
+        >>> gtf2 = parse.GTF(["{0}/test/GRCh38.84.bed2".format(dirname(parse.__file__)), "{0}/test/GRCh38.84.labels.bed".format(dirname(parse.__file__))], threads=1)
+        >>> gtf2.labels == gtf.labels
+        True
+        >>> gtf2.findOverlaps("1", 1, 30000000) == overlaps
+        True
         """
         groupLabelsFound = 0
         groupEntries = 0
+        self.nameSuffixes = dict()
+        # Whether the entries before the first group label have yet to be given a place in self.exons
+        first = labelColumn is None
 
-        # Handle the first line
-        if labelColumn is not None:
-            cols = line.split("\t")
-            label = cols.pop(labelColumn)
-            line = "\t".join(cols)
-            if label in self.labels:
-                self.labelIdx = self.labels.index(label)
+        # Handle the first line, unless it's outside of the regions
+        if self.bedInRegions(line, labelColumn):
+            if labelColumn is not None:
+                cols = line.split("\t")
+                label = cols.pop(labelColumn)
+                line = "\t".join(cols)
+                if label in self.labels:
+                    self.labelIdx = self.labels.index(label)
+                else:
+                    self.labels.append(label)
+                    self.exons.append(dict())
+                    self.labelIdx = len(self.labels) - 1
             else:
-                self.labels.append(label)
                 self.exons.append(dict())
-                self.labelIdx = len(self.labels) - 1
-        else:
-            self.exons.append(dict())
+                first = False
 
-        self.parseBEDcore(line, ncols)
-        groupEntries = 1
+            self.parseBEDcore(line, ncols)
+            groupEntries = 1
 
         # iterate over the remaining lines
         for line in fp:
@@ -327,10 +949,14 @@ class GTF(object):
                 continue
 
             if line.startswith("#") and labelColumn is None:
+                if first:
+                    self.exons.append(dict())
+                    first = False
+
                 # If there was a previous group AND it had no entries then remove it
                 if groupLabelsFound > 0:
                     if groupEntries == 0:
-                        sys.stderr.write("Warning, the '{0}' group had no valid entries! Removing it.\n".format(self.labels[self.labelIdx]))
+                        sys.stderr.write("Warning, the '{0}' group had no valid entries! Removing it.\n".format(self.labels[-1]))
                         del self.labels[-1]
                         groupLabelsFound -= 1
                         self.labelIdx -= 1
@@ -349,6 +975,8 @@ class GTF(object):
             elif line.startswith("#") and labelColumn is not None:
                 continue
             else:
+                if not self.bedInRegions(line, labelColumn):
+                    continue
                 if labelColumn is not None:
                     cols = line.split("\t")
                     label = cols.pop(labelColumn)
@@ -359,6 +987,9 @@ class GTF(object):
                         self.labels.append(label)
                         self.exons.append(dict())
                         self.labelIdx = len(self.labels) - 1
+                elif first:
+                    self.exons.append(dict())
+                    first = False
                 self.parseBEDcore(line, ncols)
                 if labelColumn is None:
                     groupEntries += 1
@@ -376,21 +1007,24 @@ class GTF(object):
         """
         Parse and add a transcript entry
         """
-        if int(cols[3]) - 1 < 0:
-            sys.stderr.write("Warning: Invalid start in '{0}', skipping\n".format("\t".join(cols)))
-            return
-
         if len(cols) < 9:
             sys.stderr.write("Warning: non-GTF line encountered! {0}\n".format("\t".join(cols)))
             return
 
-        s = next(csv.reader([cols[8]], delimiter=' '))
-        if "deepTools_group" in s and s[-1] != "deepTools_group":
-            label = s[s.index("deepTools_group") + 1].rstrip(";")
+        if self.regions is not None and not inRegions(self.regions, cols[0], int(cols[3]) - 1, int(cols[4])):
+            return
+
+        if int(cols[3]) - 1 < 0:
+            sys.stderr.write("Warning: Invalid start in '{0}', skipping\n".format("\t".join(cols)))
+            return
+
+        group, name = tree.parseAttributes(cols[8], ["deepTools_group", self.transcript_id_designator])
+        if group is not None:
+            label = group
         elif self.defaultGroup is not None:
             label = self.defaultGroup
 
-        if self.transcript_id_designator not in s or s[-1] == self.transcript_id_designator:
+        if name is None:
             sys.stderr.write("Warning: {0} is malformed!\n".format("\t".join(cols)))
             return
 
@@ -413,34 +1047,47 @@ class GTF(object):
         self.labelIdx = self.labels.index(label)
 
         # Ensure unique names within GTF files
-        name = s[s.index(self.transcript_id_designator) + 1].rstrip(";")
         if name in self.exons[self.labelIdx]:
             sys.stderr.write("Warning: {0} occurs more than once! Only using the first instance.\n".format(name))
             self.transcriptIDduplicated.append(name)
             return
 
         chrom = self.mungeChromosome(cols[0])
-        self.tree.addEntry(chrom, int(cols[3]) - 1, int(cols[4]), name, strand, self.labelIdx, score)
+        if self.attributes is None:
+            self.tree.addEntry(chrom, int(cols[3]) - 1, int(cols[4]), name, strand, self.labelIdx, score)
+        else:
+            self.tree.addEntry(chrom, int(cols[3]) - 1, int(cols[4]), name, strand, self.labelIdx, score, cols[8], self.attributes)
 
         # Exon bounds placeholder
         self.exons[self.labelIdx][name] = []
 
     def parseGTFexon(self, cols):
         """
-        Parse an exon entry and add it to the transcript hash
+        Parse an exon entry and add it to the transcript hash. Exons are kept
+        wherever they are on a chromosome with regions, since their transcript
+        may overlap them.
         """
+        if len(cols) < 9:
+            sys.stderr.write("Warning: {0} is malformed!\n".format("\t".join(cols)))
+            return
+
+        if self.regions is not None and cols[0] not in self.regions:
+            return
+
         if int(cols[3]) - 1 < 0:
             sys.stderr.write("Warning: Invalid start in '{0}', skipping\n".format("\t".join(cols)))
             return
 
-        s = next(csv.reader([cols[8]], delimiter=' '))
-        if self.transcript_id_designator not in s or s[-1] == self.transcript_id_designator:
+        name = tree.parseAttributes(cols[8], [self.transcript_id_designator])[0]
+        if name is None:
             sys.stderr.write("Warning: {0} is malformed!\n".format("\t".join(cols)))
             return
 
-        name = s[s.index(self.transcript_id_designator) + 1].rstrip(";")
         if name in self.transcriptIDduplicated:
             return
+        if self.labelIdx >= len(self.exons):
+            # There's been no transcript (e.g., they were all outside of the regions)
+            return
         if name not in self.exons[self.labelIdx]:
             self.exons[self.labelIdx][name] = []
 
@@ -524,7 +1171,10 @@ class GTF(object):
         # Reset self.labelIdx
         self.labelIdx = len(self.labels)
 
-    def __init__(self, fnames, exonID="exon", transcriptID="transcript", keepExons=False, labels=[], transcript_id_designator="transcript_id", defaultGroup=None, verbose=False):
+    # See setCacheSize()
+    cache = None
+
+    def __init__(self, fnames, exonID="exon", transcriptID="transcript", keepExons=False, labels=[], transcript_id_designator="transcript_id", defaultGroup=None, verbose=False, nativeParser=True, index=None, flatten=False, threads=None, chromAliases=None, cacheSize=0, regions=None, attributes=None):
         """
         Driver function to actually parse files. The steps are as follows:
 
@@ -556,10 +1206,103 @@ class GTF(object):
                       the attributes.
         defaultGroup: The default group name. If None, the file name is used.
         verbose:      Whether to produce warning messages (default: False)
+        nativeParser: Whether to parse files in C (the default). Otherwise, or
+                      for bzip2 compressed files, files are parsed line by line
+                      in python. Both produce identical results.
+        index:        The path to an index file (see save()). If it was made
+                      from the same files with the same options, it's loaded
+                      instead of parsing the files. Otherwise, the files are
+                      parsed and the index is (re)written.
+        flatten:      Whether to store the finished tree as a sorted, flat
+                      array rather than a centered interval tree (default:
+                      False). This is faster to query, particularly for large
+                      files, at the cost of a little more memory and time
+                      when loading.
+        threads:      The number of files to read in parallel threads when
+                      parsing in C. The default is one per file, up to the
+                      number of CPUs. Files are always added in order, so the
+                      results are the same regardless. This is also the
+                      number of threads that build the tree (default: one
+                      per CPU), which is likewise the same regardless.
+        chromAliases: Chromosome aliases (e.g., between UCSC, Ensembl and
+                      GenBank names), either a dictionary mapping aliases to
+                      names or the path to a file with a tab-separated line of
+                      names per sequence, such as UCSC's chromAlias.txt. Names
+                      in input files and queries are converted to whichever
+                      alias was seen first. chr1 <-> 1 and chrM <-> MT are
+                      always converted.
+        cacheSize:    The number of findOverlaps() results to cache (default:
+                      0, no caching). See setCacheSize().
+        regions:      Only load entries overlapping these regions, either the
+                      path to a BED file of windows or a list of chromosome
+                      names and (chromosome, start, end) tuples (see
+                      readRegions()). Other lines are skipped as they're read,
+                      as though they weren't in the files, so they don't add
+                      group labels either. GTF exons are kept if they're on a
+                      chromosome with regions, since their transcript may
+                      overlap one. If a bgzipped file has a tabix or CSI index
+                      (file.gz.tbi or file.gz.csi), only the parts of it that
+                      can overlap the regions are read, in which case group
+                      label lines in BED files are never seen.
+        attributes:   GTF attributes to keep for each transcript, either a
+                      list of keys or True for all of them (default: None,
+                      only the transcript ID is kept). The keys and values
+                      are interned, so overlaps can then be filtered by them
+                      in C (see the require option of findOverlaps()) and
+                      their values counted (see attributeCounts()). BED
+                      entries have no attributes. These can't be stored in
+                      an index.
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> d = dirname(parse.__file__)
+        >>> fnames = ["{0}/test/{1}".format(d, x) for x in ["GRCh38.84.gtf.gz", "GRCh38.84.bed", "GRCh38.84.labels.bed", "GRCh38.84.bed6", "GRCh38.84.2.gtf.gz"]]
+        >>> native = parse.GTF(fnames, keepExons=True)
+        >>> python = parse.GTF(fnames, keepExons=True, nativeParser=False)
+        >>> assert(native.labels == python.labels)
+        >>> native.findOverlaps("1", 14500, 14600)[2][2:5]
+        ('ENST00000488147', 'group 1', [(14403, 14501), (15004, 15038), (15795, 15947), (16606, 16765), (16857, 17055), (17232, 17368), (17605, 17742), (17914, 18061), (18267, 18366), (24737, 24891), (29533, 29570)])
+        >>> assert(native.findOverlaps("1", 0, 30000000) == python.findOverlaps("1", 0, 30000000))
+        >>> flat = parse.GTF(fnames, keepExons=True, flatten=True)
+        >>> assert(flat.findOverlaps("1", 0, 30000000, includeStrand=True) == native.findOverlaps("1", 0, 30000000, includeStrand=True))
+        >>> assert(flat.findOverlaps("1", 14000, 30000, matchType=2, strandType=1, strand="+") == native.findOverlaps("1", 14000, 30000, matchType=2, strandType=1, strand="+"))
+        >>> regions = [("1", 12000, 15000), ("chr1", 100000, 140000)]
+        >>> restricted = parse.GTF(fnames[0], keepExons=True, regions=regions)
+        >>> [o[2] for o in restricted.findOverlaps("1", 0, 30000000)]
+        ['ENST00000456328', 'ENST00000450305', 'ENST00000488147', 'ENST00000466430', 'ENST00000477740', 'ENST00000471248', 'ENST00000610542', 'ENST00000453576', 'ENST00000442987', 'ENST00000494149', 'ENST00000595919']
+        >>> full = parse.GTF(fnames[0], keepExons=True).findOverlaps("1", 0, 30000000)
+        >>> assert(restricted.findOverlaps("1", 0, 30000000) == [o for o in full if o[0] < 15000 and o[1] > 12000 or o[0] < 140000 and o[1] > 100000])
+        >>> tabix = "{0}/test/GRCh38.84.tabix.gtf.gz".format(d)
+        >>> indexed = parse.GTF(tabix, keepExons=True, regions=regions)
+        >>> assert(indexed.findOverlaps("1", 0, 30000000) == parse.GTF(tabix, keepExons=True, regions=regions, nativeParser=False).findOverlaps("1", 0, 30000000))
+
+        Truncated transcript and exon lines are skipped with a warning by both
+        parsers:
+
+        >>> import tempfile
+        >>> fname = "{0}/truncated.gtf".format(tempfile.mkdtemp())
+        >>> with open(fname, "w") as f:
+        ...     _ = f.write('1\\ts\\ttranscript\\t10\\t100\\t.\\t+\\t.\\tgene_id "g"; transcript_id "a";\\n1\\ts\\texon\\t10\\t50\\t.\\t+\\t.\\tgene_id "g"; transcript_id "a";\\n1\\ts\\texon\\t60\\t70\\n1\\ts\\ttranscript\\t10\\n1\\ts\\ttranscript\\t20\\t200\\t.\\t-\\t.\\tgene_id "g"; transcript_id "b";\\n')
+        >>> [o[2] for o in parse.GTF(fname).findOverlaps("1", 0, 1000)]
+        ['a', 'b']
+        >>> [o[2] for o in parse.GTF(fname, nativeParser=False).findOverlaps("1", 0, 1000)]
+        ['a', 'b']
+        >>> parse.GTF(fname, keepExons=True).findOverlaps("1", 0, 1000)[0][4]
+        [(9, 50)]
+        >>> parse.GTF(fname, keepExons=True, nativeParser=False).findOverlaps("1", 0, 1000)[0][4]
+        [(9, 50)]
+        >>> [o[2] for o in parse.GTF(fname, regions=[("1", 0, 150)]).findOverlaps("1", 0, 1000)]
+        ['a', 'b']
+        >>> [o[2] for o in parse.GTF(fname, regions=[("1", 0, 150)], nativeParser=False).findOverlaps("1", 0, 1000)]
+        ['a', 'b']
         """
         self.fname = []
         self.filename = ""
-        self.chroms = []
+        self.initChroms([], chromAliases)
+        self.setCacheSize(cacheSize)
+        regions = readRegions(regions)
+        self.regions = expandRegions(regions, self.aliasGroups)
+        self.attributes = attributeKeys(attributes)
         self.exons = []
         self.labels = []
         self.transcriptIDduplicated = []
@@ -571,50 +1314,519 @@ class GTF(object):
         self.keepExons = keepExons
         self.defaultGroup = defaultGroup
         self.verbose = verbose
+        self.nativeParser = nativeParser
 
         if labels != []:
             self.already_input_labels = True
 
         if not isinstance(fnames, list):
             fnames = [fnames]
+        self.fname = [getattr(f, "fname", f) for f in fnames]
+        self.indexOptions = {"exonID": exonID, "transcriptID": transcriptID, "keepExons": keepExons, "labels": labels,
+                             "transcript_id_designator": transcript_id_designator, "defaultGroup": defaultGroup}
+        if chromAliases is not None:
+            self.indexOptions["chromAliases"] = chromAliases
+        if regions is not None:
+            self.indexOptions["regions"] = regions
+
+        if index is not None:
+            if self.attributes is not None:
+                raise RuntimeError("Attributes can't be stored in an index!")
+            loaded = readIndex(index)
+            if loaded is not None and indexIsCurrent(loaded[1], type(self).__name__, fnames, self.indexOptions):
+                self.initFromIndex(loaded[0], loaded[1])
+                return
+            if self.verbose:
+                sys.stderr.write("Warning, {0} is missing or out of date, it will be rebuilt.\n".format(index))
+
+        self.loadFiles(fnames, labels, threads)
+
+        # vine -> tree, which then holds the exons
+        self.tree.finish(False, treeThreads(threads))
+        self.tree.storeExons(self.exons)
+        self.exons = None
+        if flatten:
+            self.tree.finish(True)
+
+        if index is not None:
+            self.save(index)
+
+    @property
+    def labels(self):
+        return self._labels
+
+    @labels.setter
+    def labels(self, labels):
+        # Cached results hold the old labels
+        self._labels = labels
+        self.clearCache()
+
+    def setCacheSize(self, capacity):
+        """
+        Cache the results of up to capacity findOverlaps() queries, so that
+        repeating a query (e.g., the same bins for each of a number of
+        samples) is nearly free. The least recently used results are evicted
+        first. A capacity of 0 (the default) disables the cache. Each query
+        returns a copy of the cached result, which can be modified freely.
+
+        The cache is cleared whenever the labels are reassigned or files are
+        added. Call clearCache() after modifying the labels in place.
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.gtf.gz".format(dirname(parse.__file__)), cacheSize=2)
+        >>> o = gtf.findOverlaps("1", 0, 20000)
+        >>> expected = [(x[0], x[1], x[2], x[3], list(x[4]), x[5]) for x in o]
+        >>> o[0][4].append((0, 1))
+        >>> del o[1:]
+        >>> assert(gtf.findOverlaps("1", 0, 20000) == expected)
+        >>> c = gtf.findOverlaps("1", 0, 20000, columns=True)
+        >>> c.starts[0] = 0
+        >>> c.names[0] = "foo"
+        >>> c = gtf.findOverlaps("1", 0, 20000, columns=True)
+        >>> int(c.starts[0]), c.names[0]
+        (11868, 'ENST00000456328')
+        >>> sorted(gtf.cacheStats().items())
+        [('capacity', 2), ('evictions', 0), ('hits', 2), ('misses', 2), ('size', 2)]
+        >>> _ = gtf.findOverlaps("1", 0, 30000)
+        >>> gtf.cacheStats()["evictions"]
+        1
+        >>> gtf.labels = ["foo", "bar"]
+        >>> gtf.findOverlaps("1", 0, 20000)[0][3]
+        'foo'
+        >>> gtf.setCacheSize(0)
+        >>> gtf.cacheStats() is None
+        True
+        """
+        if capacity:
+            self.cache = QueryCache(capacity)
+        else:
+            self.cache = None
+
+    def clearCache(self):
+        """
+        Empty the query cache, if there is one. See setCacheSize().
+        """
+        if self.cache is not None:
+            self.cache.clear()
+
+    def cacheStats(self):
+        """
+        Return a dictionary of the size, capacity and the number of hits,
+        misses and evictions of the query cache, or None if there isn't one.
+        """
+        if self.cache is None:
+            return None
+        return self.cache.stats()
+
+    def loadFiles(self, fnames, labels=[], threads=None):
+        """
+        Parse a list of files, adding their entries to the tree. labels, if
+        given, replace the group labels found in them. See the constructor.
+        """
+        nLabels = len(self.labels)
+        if self.exons is None:
+            # The exons of a finished tree are stored in it
+            self.exons = [dict() for x in self.labels]
 
         # Load the files
-        for fname in fnames:
-            self.filename = fname
-            fp = openPossiblyCompressed(fname)
-            line, labelColumn = self.firstNonComment(fp)
-            if line is None:
-                # This will only ever happen if a file is empty or just has a header/comment
-                continue
-            line = line.strip()
+        def stage(fname, ftype, labelColumn):
+            return tree.stageFile(fname, ftype, labelColumn, self.keepExons, self.exonID, self.transcriptID, self.transcript_id_designator, None, False, self.regions, self.attributes)
 
-            ftype = self.inferType(fp, line, labelColumn)
-            if ftype == 'GTF':
-                self.parseGTF(fp, line)
-            elif ftype == 'BED3':
-                self.parseBED(fp, line, 3, labelColumn)
-            elif ftype == 'BED6':
-                self.parseBED(fp, line, 6, labelColumn)
-            else:
-                self.parseBED(fp, line, 12, labelColumn)
-            fp.close()
+        files = self.readFiles(fnames, stage, threads)
+        try:
+            for idx, fname, fp, line, labelColumn, ftype, staged in files:
+                if staged is not None:
+                    self.tree.loadFile(staged, ftype, labelColumn, self.keepExons, self.exonID, self.transcriptID, self.transcript_id_designator, self.defaultGroup, os.path.basename(fname), self.labels, self.exons, self.transcriptIDduplicated, self.mungeChromosome)
+                    self.labelIdx = len(self.labels)
+                    continue
+
+                if ftype == 'GTF':
+                    self.parseGTF(fp, line)
+                elif ftype == 'BED3':
+                    self.parseBED(fp, line, 3, labelColumn)
+                elif ftype == 'BED6':
+                    self.parseBED(fp, line, 6, labelColumn)
+                else:
+                    self.parseBED(fp, line, 12, labelColumn)
+                fp.close()
+        finally:
+            files.close()
 
         # Sanity check
         if self.tree.countEntries() == 0:
             raise RuntimeError("None of the input BED/GTF files had valid regions")
 
         # Replace labels
-        if len(labels) > 0:
-            if len(labels) != len(self.labels):
-                raise RuntimeError("The number of labels found ({0}) does not match the number input ({1})!".format(self.labels, labels))
+        if labels:
+            if len(labels) != len(self.labels) - nLabels:
+                raise RuntimeError("The number of labels found ({0}) does not match the number input ({1})!".format(self.labels[nLabels:], labels))
             else:
-                self.labels = labels
+                self.labels[nLabels:] = labels
 
-        # vine -> tree
-        self.tree.finish()
+    def addFiles(self, fnames, labels=None, threads=None):
+        """
+        Add the entries in more files to a finished object (e.g., a set of
+        peaks to a base annotation) without rebuilding it. The files are
+        parsed with the options given to the constructor and labels are as
+        in the constructor, applying only to the new files.
+
+        The new entries are held in a small, unsorted list per chromosome,
+        which queries scan in addition to the tree. Chromosomes with more
+        than 1024 new entries are then rebuilt (compacted), while compact()
+        rebuilds every chromosome. Results are the same as if the files had
+        been given to the constructor. Flattened trees, including those
+        loaded from an index, can't be added to.
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> d = dirname(parse.__file__)
+        >>> base, peaks = ["{0}/test/{1}".format(d, x) for x in ["GRCh38.84.gtf.gz", "GRCh38.84.bed"]]
+        >>> gtf = parse.GTF(base, keepExons=True)
+        >>> gtf.addFiles(peaks)
+        >>> expected = parse.GTF([base, peaks], keepExons=True)
+        >>> gtf.labels == expected.labels
+        True
+        >>> regions = [("1", s, s + w, "+-."[s % 3]) for s in range(0, 2000000, 10000) for w in (1, 5000, 200000)]
+        >>> assert([gtf.findOverlaps(*r, strandType=1) for r in regions] == [expected.findOverlaps(*r, strandType=1) for r in regions])
+        >>> assert(list(gtf.sweep(regions)) == list(expected.sweep(regions)))
+        >>> assert(gtf.hasOverlaps(True) == expected.hasOverlaps(True))
+        >>> gtf.addFiles([peaks] * 60)
+        >>> expected = parse.GTF([base] + [peaks] * 61, keepExons=True)
+        >>> assert([gtf.countOverlaps(*r) for r in regions] == [expected.countOverlaps(*r) for r in regions])
+        >>> gtf.compact(flatten=True, threads=3)
+        >>> assert([gtf.findOverlaps(*r) for r in regions] == [expected.findOverlaps(*r) for r in regions])
+        >>> gtf.addFiles(peaks)
+        Traceback (most recent call last):
+        ...
+        RuntimeError: Flattened trees, such as those loaded from an index, can't be modified!
+        >>> gtf = parse.GTF(base)
+        >>> gtf.addFiles("{0}/test/strands.bed".format(d), labels=["strands"])
+        >>> gtf.labels
+        ['group 1', 'group 2', 'GRCh38.84.gtf.gz', 'strands']
+        """
+        if not isinstance(fnames, list):
+            fnames = [fnames]
+        self.loadFiles(fnames, labels, threads)
+        self.clearCache()
+        self.fname.extend(getattr(f, "fname", f) for f in fnames)
+        if getattr(self, "exons", None) is not None:
+            self.tree.storeExons(self.exons)
+            self.exons = None
+        self.tree.compact(treeThreads(threads))
+
+    def compact(self, flatten=False, threads=None):
+        """
+        Compact all of the entries added by addFiles() into the tree, making
+        queries as fast as for a tree built from scratch. If flatten is True,
+        the tree is then flattened (see the constructor) and can no longer be
+        added to. Chromosomes are compacted in parallel on threads threads
+        (default: one per CPU).
+        """
+        self.tree.finish(flatten, treeThreads(threads))
+
+    @classmethod
+    def stagingOptions(cls, options):
+        """
+        The arguments to tree.stageFile() and tree.openChunks() following the
+        file name, type and label column, given a dictionary of the options
+        that would be passed to the constructor.
+        """
+        return (options.get("keepExons", False), options.get("exonID", "exon"), options.get("transcriptID", "transcript"),
+                options.get("transcript_id_designator", "transcript_id"), None, False)
+
+    @classmethod
+    def stagedAttributes(cls, options):
+        """
+        The final argument to tree.stageFile() and tree.openChunks(), the
+        attribute keys to keep, given the options passed to the constructor.
+        """
+        return attributeKeys(options.get("attributes"))
+
+    @classmethod
+    def stream(cls, fnames, **options):
+        """
+        A generator for files sorted by chromosome, yielding a tuple of the
+        chromosome name and an object holding only the entries on that
+        chromosome, one chromosome at a time. Each chromosome is only read once
+        the previous one has been yielded, so memory use depends on the largest
+        chromosome rather than on the size of the files, as long as the object
+        for the previous chromosome isn't kept.
+
+        options are those of the constructor, except for index. Files must be
+        uncompressed or gzipped, with the entries on each chromosome in a
+        single block (e.g., sorted with sort -k1,1). regions are applied as
+        lines are read, without using tabix/CSI indices. If there are multiple
+        files, their chromosomes must be in the same order, though not every
+        file needs every chromosome. Chromosomes are yielded in that order.
+
+        Labels are specific to each object, so numeric group indices from one
+        object may not match those from another. BED files can't use group
+        labels (lines starting with #), but can use a deepTools_group column.
+        If labels are given, there must be one per file.
+
+        >>> from deeptoolsintervals import parse
+        >>> import tempfile
+        >>> fname = "{0}/sorted.bed".format(tempfile.mkdtemp())
+        >>> with open(fname, "w") as f:
+        ...     _ = f.write("chr1\\t0\\t100\\tA\\t0\\t+\\nchr1\\t50\\t150\\tB\\t0\\t-\\nchr2\\t0\\t100\\tC\\t0\\t+\\n")
+        >>> for chrom, gtf in parse.GTF.stream(fname):
+        ...     print("{0} {1}".format(chrom, gtf.findOverlaps(chrom, 0, 1000)))
+        chr1 [(0, 100, 'A', 'sorted.bed', [(0, 100)], 0.0), (50, 150, 'B', 'sorted.bed', [(50, 150)], 0.0)]
+        chr2 [(0, 100, 'C', 'sorted.bed', [(0, 100)], 0.0)]
+        >>> with open(fname, "a") as f:
+        ...     _ = f.write("chr1\\t200\\t300\\tD\\t0\\t+\\n")
+        >>> [chrom for chrom, gtf in parse.GTF.stream(fname)]  # doctest: +ELLIPSIS
+        Traceback (most recent call last):
+        ...
+        RuntimeError: ... isn't sorted by chromosome (chr1 was already passed)!
+        """
+        if not isinstance(fnames, list):
+            fnames = [fnames]
+        labels = options.pop("labels", None)
+        if labels and len(labels) != len(fnames):
+            raise RuntimeError("The number of labels ({0}) must match the number of files ({1}) when streaming!".format(len(labels), len(fnames)))
+        if options.get("index") is not None:
+            raise RuntimeError("Index files can't be used when streaming!")
+
+        # This only keeps track of the chromosomes found so far
+        seen = cls.__new__(cls)
+        seen.verbose = options.get("verbose", False)
+        seen.initChroms([], options.get("chromAliases"))
+        # The readers skip lines outside of the regions, so the objects needn't
+        regions = expandRegions(readRegions(options.pop("regions", None)), seen.aliasGroups)
+
+        readers = []
+        for idx, fname in enumerate(fnames):
+            if not options.get("nativeParser", True) or not canParseNatively(fname):
+                raise RuntimeError("{0} can't be streamed, only uncompressed or gzipped files can be!".format(fname))
+            sniffed = seen.sniffFile(fname)
+            if sniffed is None:
+                continue
+            line, labelColumn, ftype = sniffed
+            reader = tree.openChunks(fname, ftype, labelColumn, *(cls.stagingOptions(options) + (regions, cls.stagedAttributes(options))))
+            readers.append([idx, fname, ftype, labelColumn, reader, tree.nextChunk(reader)])
+
+        passed = set()
+        while True:
+            pending = [r for r in readers if r[5] is not None]
+            if len(pending) == 0:
+                return
+
+            # The next chromosome is the one the first file is on
+            chrom = seen.mungeChromosome(pending[0][5][0])
+            chunks = []
+            chunkLabels = []
+            for r in pending:
+                idx, fname, ftype, labelColumn, reader, chunk = r
+                if seen.mungeChromosome(chunk[0], append=False) != chrom:
+                    continue
+                if chunk[1] > 0:
+                    chunks.append(StagedChunk(fname, ftype, labelColumn, chunk[2]))
+                    if labels:
+                        chunkLabels.append(labels[idx])
+                r[5] = tree.nextChunk(reader)
+                if r[5] is not None:
+                    nextChrom = seen.mungeChromosome(r[5][0], append=False)
+                    if nextChrom == chrom or nextChrom in passed:
+                        raise RuntimeError("{0} isn't sorted by chromosome ({1} was already passed)!".format(fname, r[5][0]))
+            passed.add(chrom)
+
+            if len(chunks) > 0:
+                if labels:
+                    options["labels"] = chunkLabels
+                obj = cls(chunks, **options)
+                del chunks
+                yield chrom, obj
+                del obj
+
+    def indexMetadata(self):
+        """
+        The python-side information stored in an index, beyond the tree itself
+        """
+        return {"labels": self.labels, "chroms": self.chroms}
+
+    def initFromIndex(self, t, meta):
+        """
+        Use a tree and its metadata from an index, which holds the exons.
+        """
+        self.tree = t
+        self.labels = nativeStr(meta["labels"])
+        self.initChroms(nativeStr(meta["chroms"]), self.indexOptions.get("chromAliases"))
+        self.exons = None
+
+    def save(self, fname):
+        """
+        Write the tree, labels, exons and scores to an index file. This can
+        later be loaded with load(), or via the index option when the object is
+        created, which is far faster than parsing the original files. The index
+        also records the files and options used, so it can be rebuilt if
+        either changes. Indices aren't portable between architectures.
+
+        The file is written to a temporary file next to fname and then renamed,
+        so processes that are already using an index aren't affected.
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> import tempfile
+        >>> d = dirname(parse.__file__)
+        >>> fnames = ["{0}/test/{1}".format(d, x) for x in ["GRCh38.84.gtf.gz", "GRCh38.84.labels.bed", "GRCh38.84.bed12.bz2"]]
+        >>> idx = "{0}/GRCh38.84.idx".format(tempfile.mkdtemp())
+        >>> gtf = parse.GTF(fnames, keepExons=True)
+        >>> gtf.save(idx)
+        >>> loaded = parse.GTF.load(idx)
+        >>> assert(loaded.labels == gtf.labels)
+        >>> assert(loaded.findOverlaps("1", 0, 30000000) == gtf.findOverlaps("1", 0, 30000000))
+        >>> assert(loaded.findOverlaps("chr1", 0, 30000000, numericGroups=True, includeStrand=True) == gtf.findOverlaps("1", 0, 30000000, numericGroups=True, includeStrand=True))
+        >>> assert(loaded.hasOverlaps(returnDistance=True) == gtf.hasOverlaps(returnDistance=True))
+        """
+        if getattr(self, "attributes", None) is not None:
+            raise RuntimeError("Attributes can't be stored in an index!")
+        meta = self.indexMetadata()
+        meta["class"] = type(self).__name__
+        meta["sources"] = fileStats(self.fname)
+        meta["options"] = self.indexOptions
+        meta["checksum"] = sourceChecksum(self.fname, self.indexOptions)
+
+        tmp = "{0}.tmp{1}".format(fname, os.getpid())
+        try:
+            # Enrichment objects have no exons
+            self.tree.saveIndex(tmp, json.dumps(meta).encode("utf-8"), getattr(self, "exons", None))
+            os.rename(tmp, fname)
+        except:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    @classmethod
+    def load(cls, fname, verbose=False):
+        """
+        Load an index written by save(). The index is memory-mapped, so this
+        is nearly instantaneous and the memory is shared with other processes
+        using the same index. Such objects can't be modified.
+
+        If any of the files the index was made from have since changed, they
+        are parsed again with the same options and the index is rebuilt.
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> import tempfile
+        >>> import shutil
+        >>> d = tempfile.mkdtemp()
+        >>> _ = shutil.copy("{0}/test/strands.bed".format(dirname(parse.__file__)), d)
+        >>> gtf = parse.GTF("{0}/strands.bed".format(d), index="{0}/strands.idx".format(d))
+        >>> parse.GTF.load("{0}/strands.idx".format(d)).findOverlaps("1", 0, 3000)
+        [(0, 1000, 'first', 'strands.bed', [(0, 1000)], 0.0), (1000, 2000, 'second', 'strands.bed', [(1000, 2000)], 0.0), (2000, 3000, 'third', 'strands.bed', [(2000, 3000)], 0.0)]
+        >>> with open("{0}/strands.bed".format(d), "a") as f:
+        ...     _ = f.write("1\\t2500\\t2600\\tfourth\\t0\\t+\\n")
+        >>> parse.GTF.load("{0}/strands.idx".format(d)).findOverlaps("1", 2000, 3000)
+        [(2000, 3000, 'third', 'strands.bed', [(2000, 3000)], 0.0), (2500, 2600, 'fourth', 'strands.bed', [(2500, 2600)], 0.0)]
+        """
+        meta = json.loads(tree.loadIndex(fname)[1].decode("utf-8"))
+        if meta["class"] != cls.__name__:
+            raise RuntimeError("{0} is an index for the {1} class, not {2}!".format(fname, meta["class"], cls.__name__))
+        fnames = [nativeStr(x["path"]) for x in meta["sources"]]
+        options = dict((str(k), nativeStr(v)) for k, v in meta["options"].items())
+        return cls(fnames, verbose=verbose, index=fname, **options)
+
+    def share(self, name=None):
+        """
+        Move the tree, labels and exons to a shared memory segment (named name,
+        or something random if that's None) and return its name. Other
+        processes, such as multiprocessing workers, can then attach() to it
+        rather than each parsing the files or holding a copy, so memory use
+        stays about the same regardless of the number of workers. This object
+        then uses the shared memory as well and can no longer be modified.
+
+        The segment is deleted by unshare(), which should be called once other
+        processes have attached to it. Requires python 3.8 or newer.
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> fnames = ["{0}/test/{1}".format(dirname(parse.__file__), x) for x in ["GRCh38.84.gtf.gz", "GRCh38.84.labels.bed"]]
+        >>> gtf = parse.GTF(fnames, keepExons=True)
+        >>> expected = gtf.findOverlaps("1", 0, 30000000, includeStrand=True)
+        >>> try:
+        ...     name = gtf.share()
+        ... except RuntimeError:
+        ...     assert(not parse.supportsSharedMemory)
+        ... else:
+        ...     assert(gtf.findOverlaps("1", 0, 30000000, includeStrand=True) == expected)
+        ...     attached = parse.GTF.attach(name)
+        ...     assert(attached.labels == gtf.labels)
+        ...     assert(attached.findOverlaps("chr1", 0, 30000000, includeStrand=True) == expected)
+        ...     gtf.unshare()
+        ...     assert(attached.findOverlaps("1", 0, 30000000, includeStrand=True) == expected)
+        """
+        if not supportsSharedMemory:
+            raise RuntimeError("Shared memory requires python 3.8 or newer!")
+        if getattr(self, "sharedMemory", None) is not None:
+            return self.sharedMemory.name
+        if getattr(self, "attributes", None) is not None:
+            raise RuntimeError("Attributes can't be stored in shared memory!")
+
+        meta = self.indexMetadata()
+        meta["class"] = type(self).__name__
+        meta["sources"] = fileStats([f for f in self.fname if os.path.exists(f)])
+        meta["options"] = self.indexOptions
+
+        segments = []
+
+        def allocate(size):
+            segments.append(shared_memory.SharedMemory(name=name, create=True, size=size))
+            return segments[0].buf
+
+        try:
+            self.tree.dumpIndex(json.dumps(meta).encode("utf-8"), getattr(self, "exons", None), allocate)
+            shm = segments[0]
+            self.attachTree(shm)
+        except:
+            for shm in segments:
+                shm.close()
+                shm.unlink()
+            raise
+        self.ownsSharedMemory = True
+        return shm.name
+
+    def unshare(self):
+        """
+        Delete the shared memory segment created by share(). Processes that
+        have already attached to it, including this one, can continue to use it.
+        """
+        if getattr(self, "ownsSharedMemory", False):
+            self.sharedMemory.unlink()
+            self.ownsSharedMemory = False
+
+    def attachTree(self, shm):
+        """
+        Use the tree and metadata in a shared memory segment
+        """
+        t, meta = tree.loadIndexBuffer(shm.buf, shm)
+        meta = json.loads(meta.decode("utf-8"))
+        if meta["class"] != type(self).__name__:
+            raise RuntimeError("{0} holds an object of the {1} class, not {2}!".format(shm.name, meta["class"], type(self).__name__))
+        self.fname = [nativeStr(x["path"]) for x in meta["sources"]]
+        self.indexOptions = meta["options"]
+        self.initFromIndex(t, meta)
+        self.sharedMemory = shm
+
+    @classmethod
+    def attach(cls, name, verbose=False):
+        """
+        Attach to a shared memory segment created by share() in another
+        process, returning a read-only object. Nothing is copied, so this is
+        nearly instantaneous. See share() for an example.
+        """
+        if not supportsSharedMemory:
+            raise RuntimeError("Shared memory requires python 3.8 or newer!")
+        obj = cls.__new__(cls)
+        obj.verbose = verbose
+        obj.ownsSharedMemory = False
+        obj.attachTree(attachSharedMemory(name))
+        return obj
 
     # findOverlaps()
-    def findOverlaps(self, chrom, start, end, strand=".", matchType=0, strandType=0, trimOverlap=False, numericGroups=False, includeStrand=False):
+    def findOverlaps(self, chrom, start, end, strand=".", matchType=0, strandType=0, trimOverlap=False, numericGroups=False, includeStrand=False, columns=False, require=None):
         """
         Given a chromosome and start/end coordinates with an optional strand,
         return a list of tuples comprised of:
@@ -655,6 +1867,21 @@ class GTF(object):
 
         includeStrand: Whether to include the strand in the output. The default is False
 
+        columns:       If True, an OverlapColumns object is returned instead,
+                       holding each of the above (other than exons) as an
+                       array. No tuples are then created for the overlaps,
+                       which is much faster when there are many of them and
+                       only a few columns are needed. numericGroups and
+                       includeStrand are then ignored.
+
+        require:       A dict of attribute keys to a value or list of values,
+                       one of which each overlap must have for every key
+                       (e.g., {"gene_biotype": "protein_coding"}). Only the
+                       attributes kept by the constructor (see its attributes
+                       option) and the name, under "transcript_id", can be
+                       required. Overlaps are filtered in C as the tree is
+                       searched. This can't be used with an index.
+
         >>> from deeptoolsintervals import parse
         >>> from os.path import dirname, basename
         >>> gtf = parse.GTF(["{0}/test/GRCh38.84.bed6".format(dirname(parse.__file__)), "{0}/test/GRCh38.84.bed2".format(dirname(parse.__file__))], keepExons=True)
@@ -689,6 +1916,75 @@ class GTF(object):
         >>> assert(o == [(1000, 2000, 'second', 'strands.bed', [(1000, 2000)], '-', 0.0)])
         >>> o = gtf.findOverlaps("1", 0, 3000, strand=".", includeStrand=True, strandType=3)  # same strand
         >>> assert(o == [(2000, 3000, 'third', 'strands.bed', [(2000, 3000)], '.', 0.0)])
+        >>> o = gtf.findOverlaps("1", 0, 3000, strand="-", strandType=2, columns=True)
+        >>> len(o), o.names, o.labels, o.strands
+        (2, ['first', 'third'], ['strands.bed', 'strands.bed'], ['+', '.'])
+        >>> [(int(s), int(e)) for s, e in zip(o.starts, o.ends)]
+        [(0, 1000), (2000, 3000)]
+        >>> o = gtf.findOverlaps("1", 500, 3000, trimOverlap=True, columns=True)
+        >>> o.names
+        ['second', 'third']
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.gtf.gz".format(dirname(parse.__file__)), attributes=["gene_name", "transcript_biotype", "tag"])
+        >>> [o[2] for o in gtf.findOverlaps("1", 0, 200000, require={"transcript_biotype": "lincRNA", "gene_name": ["RP11-34P13.7", "FAM138A"]})]
+        ['ENST00000417324', 'ENST00000461467', 'ENST00000466430', 'ENST00000477740', 'ENST00000471248', 'ENST00000610542', 'ENST00000453576']
+        >>> gtf.findOverlaps("1", 0, 200000, require={"transcript_biotype": "lincRNA", "gene_name": "foo"})
+        []
+        >>> gtf.countOverlaps("1", 0, 200000, require={"transcript_biotype": "protein_coding"}), gtf.overlapsAny("1", 0, 60000, require={"tag": "basic", "transcript_biotype": "miRNA"})
+        (1, True)
+
+        The GIL is released while the tree is searched, so a finished object
+        can be queried from multiple threads at once:
+
+        >>> import threading
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.gtf.gz".format(dirname(parse.__file__)), keepExons=True)
+        >>> regions = [(s, s + w) for s in range(0, 140000, 700) for w in (1, 1000, 20000)]
+        >>> expected = ([gtf.findOverlaps("1", s, e) for s, e in regions], list(gtf.findOverlapsBatch("1", [s for s, e in regions], [e for s, e in regions])[0]))
+        >>> results = dict()
+        >>> def query(i):
+        ...     for rep in range(10):
+        ...         o = [gtf.findOverlaps("chr1", s, e) for s, e in regions]
+        ...         b = gtf.findOverlapsBatch("chr1", [s for s, e in regions], [e for s, e in regions])
+        ...         results[(i, rep)] = (o, list(b[0]))
+        >>> threads = [threading.Thread(target=query, args=(i,)) for i in range(8)]
+        >>> for t in threads:
+        ...     t.start()
+        >>> for t in threads:
+        ...     t.join()
+        >>> len(results)
+        80
+        >>> assert(all(r == expected for r in results.values()))
+
+        This holds with a cache of results as well, which is shared between
+        the threads:
+
+        >>> gtf.setCacheSize(8)
+        >>> results = dict()
+        >>> def cachedQuery(i):
+        ...     for rep in range(10):
+        ...         results[(i, rep)] = [gtf.findOverlaps("1", s, e) for s, e in regions[:50]]
+        >>> threads = [threading.Thread(target=cachedQuery, args=(i,)) for i in range(8)]
+        >>> for t in threads:
+        ...     t.start()
+        >>> for t in threads:
+        ...     t.join()
+        >>> assert(all(r == expected[0][:50] for r in results.values()))
+        >>> stats = gtf.cacheStats()
+        >>> stats["hits"] + stats["misses"]
+        4000
+        """
+        if self.cache is None:
+            return self.queryOverlaps(chrom, start, end, strand, matchType, strandType, trimOverlap, numericGroups, includeStrand, columns, require)
+
+        key = (chrom, start, end, strand, matchType, strandType, trimOverlap, numericGroups, includeStrand, columns, requireKey(require))
+        overlaps = self.cache.get(key, self.cache)
+        if overlaps is self.cache:
+            overlaps = self.queryOverlaps(chrom, start, end, strand, matchType, strandType, trimOverlap, numericGroups, includeStrand, columns, require)
+            self.cache.put(key, overlaps)
+        return copyOverlaps(overlaps)
+
+    def queryOverlaps(self, chrom, start, end, strand=".", matchType=0, strandType=0, trimOverlap=False, numericGroups=False, includeStrand=False, columns=False, require=None):
+        """
+        findOverlaps(), bypassing the query cache
         """
         chrom = self.mungeChromosome(chrom, append=False)
         if not chrom:
@@ -702,22 +1998,26 @@ class GTF(object):
             raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
 
         # Convert the strand to a number
-        if strand == '+':
-            strand = 0
-        elif strand == '-':
-            strand = 1
-        else:
-            strand = 3
+        strand = strandIndex(strand)
 
-        overlaps = self.tree.findOverlaps(chrom, start, end, strand, matchType, strandType, "transcript_id", includeStrand)
+        if columns:
+            return OverlapColumns(self, self.tree.findOverlapsColumns(chrom, start, end, strand, matchType, strandType, trimOverlap, require))
+
+        overlaps = self.tree.findOverlaps(chrom, start, end, strand, matchType, strandType, "transcript_id", includeStrand, True, require)
         if overlaps is None:
             return None
 
+        return self.formatOverlaps(overlaps, start, trimOverlap, numericGroups, includeStrand)
+
+    def formatOverlaps(self, overlaps, start, trimOverlap=False, numericGroups=False, includeStrand=False):
+        """
+        Convert the tuples returned by the tree's findOverlaps() (or
+        sweepOverlaps()) for a region starting at start to those returned by
+        findOverlaps(), which are returned.
+        """
         for i, o in enumerate(overlaps):
-            if o[2] not in self.exons[o[3]] or len(self.exons[o[3]][o[2]]) == 0:
-                exons = [(o[0], o[1])]
-            else:
-                exons = sorted(self.exons[o[3]][o[2]])
+            # Exons are stored (sorted) in the tree
+            exons = o[4]
 
             if numericGroups:
                 overlaps[i] = (o[0], o[1], o[2], o[3], exons)
@@ -746,6 +2046,256 @@ class GTF(object):
 
         return overlaps
 
+    def sweep(self, regions, matchType=0, strandType=0, trimOverlap=False, numericGroups=False, includeStrand=False):
+        """
+        Find the overlaps of each of a stream of regions, yielding what
+        findOverlaps() would return for each. The regions are (chrom, start,
+        end) or (chrom, start, end, strand) tuples and those on the same
+        chromosome must be sorted by start position, which is typically the
+        case for a scan along the genome. Rather than searching the tree for
+        each, the entries of a chromosome are then walked alongside the
+        regions in a single pass.
+
+        The chromosomes themselves needn't be sorted, but returning to a
+        chromosome starts its pass over. A RuntimeError is raised if a region
+        starts before the previous one on the same chromosome. The other
+        options are as in findOverlaps().
+
+        The tree may be changed (e.g., by addFiles() or compact()) while a
+        sweep is partly consumed, in which case the pass over the current
+        chromosome starts over and later regions reflect the change.
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.gtf.gz".format(dirname(parse.__file__)), keepExons=True)
+        >>> regions = [("1", s, s + w, "+-."[s % 3]) for s in range(0, 200000, 500) for w in (1, 1000, 50000)]
+        >>> for o in gtf.sweep([("1", 0, 12000), ("chr1", 11868, 14409), ("foo", 0, 10), ("1", 14000, 15000, "+")]):
+        ...     print([x[2] for x in o])
+        ['ENST00000456328']
+        ['ENST00000456328', 'ENST00000450305', 'ENST00000488147']
+        []
+        ['ENST00000456328', 'ENST00000488147']
+        >>> assert(all(list(gtf.sweep(regions, matchType=m, strandType=t, trimOverlap=m == 0)) == [gtf.findOverlaps(*r, matchType=m, strandType=t, trimOverlap=m == 0) for r in regions] for m in range(6) for t in range(4)))
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.gtf.gz".format(dirname(parse.__file__)), flatten=True)
+        >>> assert(list(gtf.sweep(regions, includeStrand=True)) == [gtf.findOverlaps(*r, includeStrand=True) for r in regions])
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.gtf.gz".format(dirname(parse.__file__)))
+        >>> sweep = gtf.sweep(regions)
+        >>> first = [next(sweep) for r in regions[:100]]
+        >>> gtf.addFiles("{0}/test/GRCh38.84.bed".format(dirname(parse.__file__)))
+        >>> second = [next(sweep) for r in regions[100:200]]
+        >>> gtf.compact(flatten=True)
+        >>> assert(list(sweep) == [gtf.findOverlaps(*r) for r in regions[200:]])
+        >>> assert(second == [gtf.findOverlaps(*r) for r in regions[100:200]])
+        >>> list(gtf.sweep([("1", 100, 200), ("1", 50, 60)]))
+        Traceback (most recent call last):
+        ...
+        RuntimeError: The regions aren't sorted, 1:50 comes after 1:100!
+        """
+        if not self.tree.isTree():
+            raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
+
+        cursor = self.tree.openSweep()
+        empty = self.tree.countEntries() == 0
+        name = None
+        for region in regions:
+            if region[0] != name:
+                name = region[0]
+                chrom = self.mungeChromosome(name, append=False)
+            if not chrom or empty:
+                yield None
+                continue
+
+            strand = strandIndex(region[3] if len(region) > 3 else ".")
+            start = region[1]
+            overlaps = self.tree.sweepOverlaps(cursor, chrom, start, region[2], strand, matchType, strandType, "transcript_id", includeStrand, True)
+            yield self.formatOverlaps(overlaps, start, trimOverlap, numericGroups, includeStrand)
+
+    def findOverlapsBatch(self, chroms, starts, ends, strands=None, matchType=0, strandType=0, trimOverlap=False):
+        """
+        The batch equivalent of findOverlaps(). The regions are given as
+        columns, typically numpy arrays: chroms (a single chromosome name or one
+        per region), starts, ends and, optionally, strands ('+', '-', '.' or 0,
+        1, 3). The whole batch is queried in C and the results are returned as
+        a tuple of columns in the CSR style:
+
+         * offsets: the overlaps of region i are entries offsets[i] to offsets[i + 1] - 1
+         * name indices, which getNames() converts to names
+         * starts
+         * ends
+         * label indices, into self.labels
+         * scores (NaN for '.')
+
+        The overlaps of each region are sorted by start and then end position.
+        The columns are numpy arrays if numpy is installed and array.array
+        objects otherwise. Exons are not included. The other options are as
+        in findOverlaps(). Starts and ends must be integers, and a RuntimeError
+        is raised for a region with a negative start or that ends before it
+        starts. As with findOverlaps(), a region whose end is its start finds
+        the intervals overlapping that position.
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.bed12.bz2".format(dirname(parse.__file__)), keepExons=True, labels=["foo"])
+        >>> offsets, names, starts, ends, labels, scores = gtf.findOverlapsBatch(["1", "chr1", "foo"], [1, 14000, 0], [20000, 14500, 10])
+        >>> [int(x) for x in offsets]
+        [0, 4, 6, 6]
+        >>> gtf.getNames(names[4:6])
+        ['ENST00000456328.2', 'ENST00000488147.1']
+        >>> [(int(s), int(e), gtf.labels[l]) for s, e, l in zip(starts, ends, labels)][:2]
+        [(11868, 14409, 'foo'), (12009, 13670, 'foo')]
+        >>> o = gtf.findOverlapsBatch("1", [1, 14000], [20000, 14500], trimOverlap=True)
+        >>> [int(x) for x in o[0]]
+        [0, 4, 5]
+        >>> o = gtf.findOverlapsBatch("1", [14000], [14000])
+        >>> gtf.getNames(o[1]) == [x[2] for x in gtf.findOverlaps("1", 14000, 14000)]
+        True
+        >>> gtf = parse.GTF("{0}/test/strands.bed".format(dirname(parse.__file__)))
+        >>> o = gtf.findOverlapsBatch("1", [0, 0, 0], [3000, 3000, 3000], strands="+-.", strandType=3)
+        >>> [int(x) for x in o[0]], gtf.getNames(o[1])
+        ([0, 1, 2, 3], ['first', 'second', 'third'])
+        >>> gtf.findOverlapsBatch("1", [0, 10.5], [3000, 3000])
+        Traceback (most recent call last):
+        ...
+        RuntimeError: Expected an integer, but received a float!
+        >>> gtf.findOverlapsBatch("1", [-5], [3000])
+        Traceback (most recent call last):
+        ...
+        RuntimeError: Region 0 (-5-3000) has a negative start or ends before it starts!
+        >>> gtf.findOverlapsBatch("1", [0, 3000], [3000, 2000])
+        Traceback (most recent call last):
+        ...
+        RuntimeError: Region 1 (3000-2000) has a negative start or ends before it starts!
+        """
+        if not self.tree.isTree():
+            raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
+
+        def munge(chrom):
+            return self.mungeChromosome(chrom, append=False)
+
+        cols = self.tree.findOverlapsBatch(chroms, starts, ends, strands, matchType, strandType, trimOverlap, munge)
+        return tuple(batchColumn(col, typecode, dtype) for col, typecode, dtype in zip(cols, ["q", "i", "I", "I", "I", "d"], ["int64", "int32", "uint32", "uint32", "uint32", "float64"]))
+
+    def countOverlaps(self, chrom, start, end, strand=".", matchType=0, strandType=0, require=None):
+        """
+        The number of intervals that findOverlaps() would return, which is
+        much faster to compute since nothing is returned for each of them.
+        trimOverlap isn't supported. The options are otherwise as in
+        findOverlaps().
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.gtf.gz".format(dirname(parse.__file__)))
+        >>> gtf.countOverlaps("1", 0, 30000)
+        5
+        >>> gtf.countOverlaps("chr1", 11868, 14409, matchType=1)
+        1
+        >>> gtf.countOverlaps("1", 0, 30000, strand="+", strandType=3)
+        3
+        >>> gtf.countOverlaps("foo", 0, 30000)
+        0
+        >>> assert(all(gtf.countOverlaps("1", s, s + w, strand="-", matchType=m, strandType=t) == len(gtf.findOverlaps("1", s, s + w, strand="-", matchType=m, strandType=t)) for s in range(0, 200000, 3000) for w in (1, 5000) for m in range(6) for t in range(4)))
+        """
+        chrom = self.mungeChromosome(chrom, append=False)
+        if not chrom:
+            return 0
+
+        if not self.tree.isTree():
+            raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
+
+        return self.tree.countOverlaps(chrom, start, end, strandIndex(strand), matchType, strandType, require)
+
+    def overlapsAny(self, chrom, start, end, strand=".", matchType=0, strandType=0, require=None):
+        """
+        Whether findOverlaps() would return any intervals. The search stops at
+        the first overlap. The options are as in countOverlaps().
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.gtf.gz".format(dirname(parse.__file__)))
+        >>> gtf.overlapsAny("1", 0, 30000)
+        True
+        >>> gtf.overlapsAny("1", 0, 11868)
+        False
+        """
+        chrom = self.mungeChromosome(chrom, append=False)
+        if not chrom:
+            return False
+
+        if not self.tree.isTree():
+            raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
+
+        return self.tree.overlapsAny(chrom, start, end, strandIndex(strand), matchType, strandType, require)
+
+    def attributeCounts(self, chrom, start, end, key, strand=".", matchType=0, strandType=0, require=None):
+        """
+        A dictionary of the values of an attribute (one kept by the
+        constructor, see its attributes option) among the intervals that
+        findOverlaps() would return, with the number of intervals having each.
+        Intervals without the attribute aren't counted, while those with
+        several values for it (e.g., tag) are counted once for each. The
+        options are as in countOverlaps(). The values are counted in C, so
+        no tuples are created for the overlaps.
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.gtf.gz".format(dirname(parse.__file__)), attributes=True)
+        >>> sorted(gtf.attributeCounts("chr1", 0, 200000, "transcript_biotype").items())
+        [('lincRNA', 10), ('miRNA', 2), ('processed_pseudogene', 3), ('processed_transcript', 1), ('protein_coding', 1), ('transcribed_unprocessed_pseudogene', 1), ('unprocessed_pseudogene', 3)]
+        >>> gtf.attributeCounts("1", 0, 200000, "gene_name", strand="+", strandType=3, require={"transcript_biotype": "lincRNA"})
+        {'RP11-34P13.3': 2}
+        >>> gtf.attributeCounts("1", 0, 200000, "foo")
+        {}
+        """
+        chrom = self.mungeChromosome(chrom, append=False)
+        if not chrom:
+            return dict()
+
+        if not self.tree.isTree():
+            raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
+
+        return self.tree.attributeCounts(chrom, start, end, strandIndex(strand), matchType, strandType, key, require)
+
+    def countOverlapsBatch(self, chroms, starts, ends, strands=None, matchType=0, strandType=0):
+        """
+        The batch equivalent of countOverlaps(), taking columns of regions as
+        findOverlapsBatch() does. A column of the number of overlaps of each
+        region is returned.
+
+        >>> from deeptoolsintervals import parse
+        >>> from os.path import dirname
+        >>> gtf = parse.GTF("{0}/test/GRCh38.84.gtf.gz".format(dirname(parse.__file__)))
+        >>> [int(x) for x in gtf.countOverlapsBatch(["1", "chr1", "foo"], [0, 0, 0], [30000, 11868, 30000])]
+        [5, 0, 0]
+        >>> [bool(x) for x in gtf.overlapsAnyBatch("1", [0, 0], [30000, 11868], strands="+-")]
+        [True, False]
+        """
+        if not self.tree.isTree():
+            raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
+
+        def munge(chrom):
+            return self.mungeChromosome(chrom, append=False)
+
+        return batchColumn(self.tree.countOverlapsBatch(chroms, starts, ends, strands, matchType, strandType, munge), "i", "int32")
+
+    def overlapsAnyBatch(self, chroms, starts, ends, strands=None, matchType=0, strandType=0):
+        """
+        The batch equivalent of overlapsAny(). A boolean column is returned
+        (of 0/1 values if numpy isn't available). See countOverlapsBatch().
+        """
+        if not self.tree.isTree():
+            raise RuntimeError('The GTFtree is actually a vine! There must have been an error during creation (this shouldn\'t happen)...')
+
+        def munge(chrom):
+            return self.mungeChromosome(chrom, append=False)
+
+        return batchColumn(self.tree.overlapsAnyBatch(chroms, starts, ends, strands, matchType, strandType, munge), "B", "bool")
+
+    def getNames(self, nameIdx):
+        """
+        Convert the name indices returned by findOverlapsBatch() to a list of names
+        """
+        return self.tree.getAttributeValues(nameIdx)
+
     def hasOverlaps(self, returnDistance=False):
         """
         By default, returns True if ANY intervals in the tree overlap each other, regardless of strand, and False otherwise.
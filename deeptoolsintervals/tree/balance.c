@@ -0,0 +1,416 @@
+#include <assert.h>
+#include <stdlib.h>
+#include <string.h>
+#include <pthread.h>
+#include "gtf.h"
+
+/*******************************************************************************
+*
+* Parallel balancing
+*
+* Chromosomes share nothing while they're balanced, so they're handed to a
+* pool of threads, largest first. Each thread allocates nodes from its own
+* arena, which is merged into the tree's afterwards. A chromosome holding more
+* than its share of the entries would leave the other threads idle, so it's
+* instead built by all of them together: its entries are sorted in parallel
+* and the upper levels of its interval tree are built a level at a time, after
+* which the subtrees below them are built in parallel. Either way, the trees
+* are identical to those made by sortGTF() and compactGTFtree().
+*
+*******************************************************************************/
+//Chromosomes with fewer entries are never built by more than one thread
+#define BULK_MIN 65536
+//Upper levels are built one at a time until there are this many subtrees per thread
+#define BULK_SUBTREES 4
+
+typedef int (*PARALLEL_FUNC)(void *data, uint64_t i, int thread);
+
+typedef struct {
+    PARALLEL_FUNC func;
+    void *data;
+    uint64_t n, next;
+    int err;
+    pthread_mutex_t lock;
+} parallelFor;
+
+typedef struct {
+    parallelFor *pf;
+    int thread;
+} parallelWorker;
+
+static void *runWorker(void *arg) {
+    parallelWorker *w = arg;
+    parallelFor *pf = w->pf;
+    uint64_t i;
+    int err;
+
+    while(1) {
+        pthread_mutex_lock(&(pf->lock));
+        i = pf->next++;
+        err = pf->err;
+        pthread_mutex_unlock(&(pf->lock));
+        if(err || i >= pf->n) break;
+        if(pf->func(pf->data, i, w->thread)) {
+            pthread_mutex_lock(&(pf->lock));
+            pf->err = 1;
+            pthread_mutex_unlock(&(pf->lock));
+        }
+    }
+    return NULL;
+}
+
+/*
+    Call func(data, i, thread) for each i in [0, n) on up to nThreads threads,
+    where thread (from 0 to nThreads-1) identifies the one making the call. The
+    calling thread is one of them, so if threads can't be started the work is
+    still done, only more slowly. Returns 1 if any call returned an error.
+*/
+static int runParallel(int nThreads, uint64_t n, PARALLEL_FUNC func, void *data) {
+    parallelFor pf;
+    parallelWorker *workers = NULL;
+    pthread_t *threads = NULL;
+    int i, nStarted = 0;
+
+    if((uint64_t) nThreads > n) nThreads = (int) n;
+    pf.func = func;
+    pf.data = data;
+    pf.n = n;
+    pf.next = 0;
+    pf.err = 0;
+    if(nThreads > 1) {
+        workers = malloc(nThreads * sizeof(parallelWorker));
+        threads = malloc(nThreads * sizeof(pthread_t));
+    }
+    if(!workers || !threads || pthread_mutex_init(&(pf.lock), NULL)) {
+        //Serially
+        if(workers) free(workers);
+        if(threads) free(threads);
+        for(; pf.next<n; pf.next++) {
+            if(func(data, pf.next, 0)) return 1;
+        }
+        return 0;
+    }
+
+    for(i=0; i<nThreads; i++) {
+        workers[i].pf = &pf;
+        workers[i].thread = i;
+    }
+    for(i=1; i<nThreads; i++) {
+        if(pthread_create(threads + nStarted, NULL, runWorker, workers + i)) break;
+        nStarted++;
+    }
+    runWorker(workers);
+    for(i=0; i<nStarted; i++) pthread_join(threads[i], NULL);
+    pthread_mutex_destroy(&(pf.lock));
+    free(workers);
+    free(threads);
+    return pf.err;
+}
+
+/*******************************************************************************
+*
+* Building a single chromosome with many threads
+*
+*******************************************************************************/
+/*
+    An entry and its position in the vine. sortChrom() keeps entries with the
+    same bounds in vine order when sorting by start and, since the list sorted
+    by end starts from the end of the vine, in vine order there as well. Ties
+    are then broken by position to get the same order.
+*/
+typedef struct {
+    GTFentry *e;
+    uint32_t idx;
+} sortKey;
+
+static int cmpStartKeys(const void *a, const void *b) {
+    sortKey *ka = (sortKey*) a, *kb = (sortKey*) b;
+
+    if(ka->e->start != kb->e->start) return (ka->e->start < kb->e->start) ? -1 : 1;
+    if(ka->e->end != kb->e->end) return (ka->e->end < kb->e->end) ? -1 : 1;
+    return (ka->idx < kb->idx) ? -1 : (ka->idx > kb->idx);
+}
+
+//Descending by end and then start
+static int cmpEndKeys(const void *a, const void *b) {
+    sortKey *ka = (sortKey*) a, *kb = (sortKey*) b;
+
+    if(ka->e->end != kb->e->end) return (ka->e->end > kb->e->end) ? -1 : 1;
+    if(ka->e->start != kb->e->start) return (ka->e->start > kb->e->start) ? -1 : 1;
+    return (ka->idx < kb->idx) ? -1 : (ka->idx > kb->idx);
+}
+
+/*
+    Both sorts of a chromosome's entries. Each of the keys arrays is split into
+    nRuns runs, which are sorted and then merged pairwise, width runs at a time,
+    into the other of keys and tmp. Vines that are already sorted by start
+    (first is then 1) are only sorted by end.
+*/
+typedef struct {
+    sortKey *keys[2], *tmp[2];
+    uint64_t *bounds;
+    int nRuns, width, first;
+} bulkSort;
+
+static int (*cmpKeys[2])(const void *, const void *) = {cmpStartKeys, cmpEndKeys};
+
+static int sortRunJob(void *data, uint64_t i, int thread) {
+    bulkSort *bs = data;
+    int which = bs->first + (int) (i / bs->nRuns), r = (int) (i % bs->nRuns);
+
+    qsort(bs->keys[which] + bs->bounds[r], bs->bounds[r + 1] - bs->bounds[r], sizeof(sortKey), cmpKeys[which]);
+    return 0;
+}
+
+static int mergeRunsJob(void *data, uint64_t i, int thread) {
+    bulkSort *bs = data;
+    int nMerges = (bs->nRuns + 2 * bs->width - 1) / (2 * bs->width);
+    int which = bs->first + (int) (i / nMerges), r = (int) (i % nMerges) * 2 * bs->width;
+    uint64_t a, aEnd, b, bEnd, o;
+    sortKey *src = bs->keys[which], *dst = bs->tmp[which];
+
+    a = bs->bounds[r];
+    aEnd = bs->bounds[(r + bs->width < bs->nRuns) ? r + bs->width : bs->nRuns];
+    b = aEnd;
+    bEnd = bs->bounds[(r + 2 * bs->width < bs->nRuns) ? r + 2 * bs->width : bs->nRuns];
+    o = a;
+    while(a < aEnd && b < bEnd) {
+        if(cmpKeys[which](src + a, src + b) <= 0) {
+            dst[o++] = src[a++];
+        } else {
+            dst[o++] = src[b++];
+        }
+    }
+    if(a < aEnd) memcpy(dst + o, src + a, (aEnd - a) * sizeof(sortKey));
+    if(b < bEnd) memcpy(dst + o + (aEnd - a), src + b, (bEnd - b) * sizeof(sortKey));
+    return 0;
+}
+
+//The entries sorted by start are linked by their right pointers, those sorted by end by their left
+static int linkKeysJob(void *data, uint64_t i, int thread) {
+    bulkSort *bs = data;
+    uint64_t j, n = bs->bounds[bs->nRuns];
+    sortKey *keys = bs->keys[i];
+
+    for(j=0; j<n; j++) {
+        if(i == 0) {
+            keys[j].e->right = (j + 1 < n) ? keys[j + 1].e : NULL;
+        } else {
+            keys[j].e->left = (j + 1 < n) ? keys[j + 1].e : NULL;
+        }
+    }
+    return 0;
+}
+
+/*
+    The parallel equivalent of sortChrom(), returning the entries sorted by end
+    (or NULL on error, in which case the chromosome is unchanged)
+*/
+static GTFentry *bulkSortChrom(GTFchrom *c, int nThreads) {
+    bulkSort bs;
+    sortKey *swap;
+    GTFentry *e, *ends = NULL;
+    uint64_t i, n = c->n_entries;
+    int which;
+
+    memset(&bs, 0, sizeof(bulkSort));
+    bs.nRuns = nThreads;
+    bs.first = !c->unsorted;
+    bs.bounds = malloc((bs.nRuns + 1) * sizeof(uint64_t));
+    for(which=0; which<2; which++) {
+        bs.keys[which] = malloc(n * sizeof(sortKey));
+        bs.tmp[which] = malloc(n * sizeof(sortKey));
+        if(!bs.keys[which] || !bs.tmp[which]) goto out;
+    }
+    if(!bs.bounds) goto out;
+
+    for(i=0, e=(GTFentry*) c->tree; i<n; i++, e=e->right) {
+        assert(e);
+        bs.keys[0][i].e = bs.keys[1][i].e = e;
+        bs.keys[0][i].idx = bs.keys[1][i].idx = (uint32_t) i;
+    }
+    for(i=0; i<=(uint64_t) bs.nRuns; i++) bs.bounds[i] = (n * i) / bs.nRuns;
+
+    runParallel(nThreads, (2 - bs.first) * bs.nRuns, sortRunJob, &bs);
+    for(bs.width=1; bs.width<bs.nRuns; bs.width*=2) {
+        runParallel(nThreads, (2 - bs.first) * ((bs.nRuns + 2 * bs.width - 1) / (2 * bs.width)), mergeRunsJob, &bs);
+        for(which=bs.first; which<2; which++) {
+            swap = bs.keys[which];
+            bs.keys[which] = bs.tmp[which];
+            bs.tmp[which] = swap;
+        }
+    }
+    runParallel(nThreads, 2, linkKeysJob, &bs);
+
+    c->tree = (void*) bs.keys[0][0].e;
+    ends = bs.keys[1][0].e;
+
+out:
+    for(which=0; which<2; which++) {
+        if(bs.keys[which]) free(bs.keys[which]);
+        if(bs.tmp[which]) free(bs.tmp[which]);
+    }
+    if(bs.bounds) free(bs.bounds);
+    return ends;
+}
+
+//A subtree still to be built and where to store it
+typedef struct {
+    GTFentry *starts, *ends;
+    GTFnode **node;
+} subtree;
+
+typedef struct {
+    subtree *cur, *next;
+    memArena *arenas;
+} bulkTree;
+
+static int buildNodeJob(void *data, uint64_t i, int thread) {
+    bulkTree *bt = data;
+    subtree *st = bt->cur + i, *l = bt->next + 2 * i, *r = l + 1;
+    GTFnode *node;
+
+    node = makeIntervalNode(bt->arenas + thread, st->starts, st->ends, &(l->starts), &(l->ends), &(r->starts), &(r->ends));
+    *(st->node) = node;
+    l->node = &(node->left);
+    r->node = &(node->right);
+    return 0;
+}
+
+static int buildSubtreeJob(void *data, uint64_t i, int thread) {
+    bulkTree *bt = data;
+    subtree *st = bt->cur + i;
+
+    *(st->node) = makeIntervalTree(bt->arenas + thread, st->starts, st->ends);
+    return 0;
+}
+
+//The parallel equivalent of makeIntervalTree(). Returns 1 on error, in which case the chromosome is unchanged
+static int bulkBuildChrom(GTFchrom *c, memArena *arenas, int nThreads) {
+    bulkTree bt;
+    GTFentry *ends;
+    GTFnode *root = NULL;
+    uint64_t i, n = 1, m = 2 * BULK_SUBTREES * (uint64_t) nThreads;
+    int rv = 1;
+
+    bt.arenas = arenas;
+    bt.cur = malloc(m * sizeof(subtree));
+    bt.next = malloc(m * sizeof(subtree));
+    if(!bt.cur || !bt.next) goto out;
+
+    ends = bulkSortChrom(c, nThreads);
+    if(!ends) goto out;
+    bt.cur[0].starts = (GTFentry*) c->tree;
+    bt.cur[0].ends = ends;
+    bt.cur[0].node = &root;
+
+    //The upper levels, one at a time
+    while(n && n < BULK_SUBTREES * (uint64_t) nThreads) {
+        runParallel(nThreads, n, buildNodeJob, &bt);
+        //Keep the subtrees that aren't empty
+        for(i=0, m=0, n*=2; i<n; i++) {
+            if(bt.next[i].starts) bt.cur[m++] = bt.next[i];
+        }
+        n = m;
+    }
+    runParallel(nThreads, n, buildSubtreeJob, &bt);
+
+    c->tree = (void*) root;
+    rv = 0;
+
+out:
+    if(bt.cur) free(bt.cur);
+    if(bt.next) free(bt.next);
+    return rv;
+}
+
+/*******************************************************************************
+*
+* Building many chromosomes at once
+*
+*******************************************************************************/
+typedef struct {
+    GTFchrom **chroms;
+    memArena *arenas;
+    int compact;
+} balanceJob;
+
+static int balanceChromJob(void *data, uint64_t i, int thread) {
+    balanceJob *job = data;
+    GTFchrom *c = job->chroms[i];
+    GTFentry *ends;
+
+    if(job->compact && vineChrom(c)) return 1;
+    ends = sortChrom(c);
+    c->tree = (void*) makeIntervalTree(job->arenas + thread, (GTFentry*) c->tree, ends);
+    return 0;
+}
+
+//Largest first
+static int cmpChromSizes(const void *a, const void *b) {
+    GTFchrom *ca = *(GTFchrom**) a;
+    GTFchrom *cb = *(GTFchrom**) b;
+
+    if(ca->n_entries != cb->n_entries) return (ca->n_entries > cb->n_entries) ? -1 : 1;
+    return (ca->chrom < cb->chrom) ? -1 : (ca->chrom > cb->chrom);
+}
+
+/*
+    The equivalent of sortGTF() for a tree that isn't yet balanced or, for one
+    that is, of compactGTFtree(), using up to nThreads threads. Returns 1 on
+    error (i.e., out of memory), in which case chromosomes may have been left
+    unbalanced.
+*/
+int balanceGTFtree(GTFtree *t, uint32_t minDelta, int nThreads) {
+    balanceJob job;
+    GTFchrom **chroms, *c;
+    GTFentry *ends;
+    uint64_t total = 0;
+    int32_t i, n = 0, nBulk = 0;
+    int rv = 1;
+
+    if(t->flat) return 0;
+    if(nThreads <= 1) {
+        if(t->balanced) return compactGTFtree(t, minDelta);
+        sortGTF(t);
+        return 0;
+    }
+
+    job.compact = t->balanced;
+    chroms = malloc((t->n_targets + 1) * sizeof(GTFchrom*));
+    job.arenas = calloc(nThreads, sizeof(memArena));
+    if(!chroms || !job.arenas) goto out;
+    for(i=0; i<t->n_targets; i++) {
+        if(t->balanced && t->chroms[i]->n_delta <= minDelta) continue;
+        chroms[n++] = t->chroms[i];
+        total += t->chroms[i]->n_entries;
+    }
+    qsort(chroms, n, sizeof(GTFchrom*), cmpChromSizes);
+
+    //Chromosomes that would keep the other threads waiting
+    for(nBulk=0; nBulk<n; nBulk++) {
+        c = chroms[nBulk];
+        if(c->n_entries < BULK_MIN || (uint64_t) c->n_entries * nThreads <= total) break;
+        if(job.compact && vineChrom(c)) goto out;
+        t->version++;
+        if(bulkBuildChrom(c, job.arenas, nThreads)) {
+            //Build it alone instead
+            ends = sortChrom(c);
+            c->tree = (void*) makeIntervalTree(job.arenas, (GTFentry*) c->tree, ends);
+        }
+    }
+    job.chroms = chroms + nBulk;
+    rv = runParallel(nThreads, n - nBulk, balanceChromJob, &job);
+    t->version++;
+    if(!rv && !t->balanced) t->balanced = 1;
+
+out:
+    if(job.arenas) {
+        for(i=0; i<nThreads; i++) {
+            if(mergeArena(&(t->arena), job.arenas + i)) rv = 1;
+        }
+        free(job.arenas);
+    }
+    if(chroms) free(chroms);
+    return rv;
+}
@@ -130,36 +130,55 @@ static void os_sort(overlapSet *os) {
     qsort((void *) os->overlaps, os->l, sizeof(GTFentry**), os_sortFunc);
 }
 
-//Non-existant keys/values will be ignored
+//Whether an entry has the attribute key with any of the n values in vals
+static int hasAttributeValue(GTFentry *e, int32_t key, int32_t *vals, int n) {
+    int i, j;
+
+    for(i=0; i<e->nAttributes; i++) {
+        if(e->attrib[i].key != key) continue;
+        for(j=0; j<n; j++) {
+            if(e->attrib[i].val == vals[j]) return 1;
+        }
+    }
+    return 0;
+}
+
+//Keep only the overlaps with every key[i] equal to val[i]. Since no entry can have a key or value that doesn't exist, these exclude everything.
 void os_requireAttributes(overlapSet *os, char **key, char **val, int len) {
-    int i, j, k, filter;
+    int i, j, l;
     int32_t keyHash, valHash;
+    GTFentry *e;
 
     for(i=0; i<len; i++) {
         if(!os->l) break;
 
         keyHash = str2valHT(os->tree->htAttributes, key[i]);
         valHash = str2valHT(os->tree->htAttributes, val[i]);
-        assert(keyHash>=0);
-        assert(valHash>=0);
-        for(j=0; j<os->l; j++) {
-            filter = 1;
-            for(k=0; k<os->overlaps[j]->nAttributes; k++) {
-                if(os->overlaps[j]->attrib[k]->key == keyHash) {
-                    if(os->overlaps[j]->attrib[k]->val == valHash) {
-                        filter = 0;
-                        break;
-                    }
-                }
-            }
-            if(filter) {
-                os_exclude(os, j);
-                j--; //os_exclude shifts everything
-            }
+        for(j=0, l=0; j<os->l; j++) {
+            e = os->overlaps[j];
+            if(keyHash >= 0 && valHash >= 0 && hasAttributeValue(e, keyHash, &valHash, 1)) os->overlaps[l++] = e;
         }
+        for(j=l; j<os->l; j++) os->overlaps[j] = NULL;
+        os->l = l;
     }
 }
 
+/*
+    A FILTER_ENTRY_FUNC keeping entries that have the attribute values in an
+    attributeFilter, which is given as data. Keys and values that no entry
+    has are -1 in the filter, so nothing can match them.
+*/
+int requireAttributes(GTFtree *t, GTFentry *e, void *data) {
+    attributeFilter *af = data;
+    int i;
+
+    for(i=0; i<af->n; i++) {
+        if(af->keys[i] < 0) return 0;
+        if(!hasAttributeValue(e, af->keys[i], af->vals + af->offsets[i], af->offsets[i+1] - af->offsets[i])) return 0;
+    }
+    return 1;
+}
+
 //This is an inefficient implementation. It would be faster to sort according
 //to COMPARE_FUNC and then do an O(n) merge.
 overlapSet *os_intersect(overlapSet *os1, overlapSet *os2, COMPARE_FUNC f) {
@@ -178,6 +197,33 @@ overlapSet *os_intersect(overlapSet *os1, overlapSet *os2, COMPARE_FUNC f) {
 
     return os;
 }
+/*******************************************************************************
+*
+* flatOverlapSet functions
+*
+*******************************************************************************/
+flatOverlapSet *fos_init(GTFtree *t) {
+    flatOverlapSet *os = calloc(1, sizeof(flatOverlapSet));
+    assert(os);
+    os->tree = t;
+    return os;
+}
+
+void fos_destroy(flatOverlapSet *os) {
+    if(os->overlaps) free(os->overlaps);
+    free(os);
+}
+
+static void fos_push(flatOverlapSet *os, flatEntry *e) {
+    if(os->l+1 >= os->m) {
+        os->m++;
+        kroundup32(os->m);
+        os->overlaps = realloc(os->overlaps, os->m * sizeof(flatEntry*));
+        assert(os->overlaps);
+    }
+    os->overlaps[os->l++] = e;
+}
+
 /*******************************************************************************
 *
 * OverlapSetList functions
@@ -326,65 +372,80 @@ static int int32_t_cmp(const void *a, const void *b) {
     return ia-ib;
 }
 
-int32_t cntAttributes(overlapSet *os, char *attributeName) {
-    int32_t IDs[os->l], i, j, key, last, n = 0;
-    if(!strExistsHT(os->tree->htAttributes, attributeName)) return n;
+/*
+    The values of an attribute in the overlaps, sorted, with each value
+    appearing once per entry having it. Returns the number of values, or -1 if
+    memory couldn't be allocated.
+*/
+static int64_t attributeValues(overlapSet *os, char *attributeName, int32_t **IDs) {
+    int64_t n = 0, m = 0;
+    int32_t i, j, k, key, *tmp;
+    GTFentry *e;
 
+    *IDs = NULL;
     key = str2valHT(os->tree->htAttributes, attributeName);
+    if(key < 0) return 0;
     for(i=0; i<os->l; i++) {
-        IDs[i] = -1;
-        for(j=0; j<os->overlaps[i]->nAttributes; j++) {
-            if(os->overlaps[i]->attrib[j]->key == key) {
-                IDs[i] = os->overlaps[i]->attrib[j]->val;
-                break;
+        e = os->overlaps[i];
+        for(j=0; j<e->nAttributes; j++) {
+            if(e->attrib[j].key != key) continue;
+            for(k=0; k<j; k++) {
+                if(e->attrib[k].key == key && e->attrib[k].val == e->attrib[j].val) break;
             }
+            if(k<j) continue;
+            if(n >= m) {
+                m = m ? 2 * m : 64;
+                tmp = realloc(*IDs, m * sizeof(int32_t));
+                if(!tmp) {
+                    free(*IDs);
+                    *IDs = NULL;
+                    return -1;
+                }
+                *IDs = tmp;
+            }
+            (*IDs)[n++] = e->attrib[j].val;
         }
     }
-    qsort((void*) IDs, os->l, sizeof(int32_t), int32_t_cmp);
-
-    last = IDs[0];
-    n = (last >= 0) ? 1 : 0;
-    for(i = 1; i<os->l; i++) {
-        if(IDs[i] != last) {
-            n++;
-            last = IDs[i];
-        }
-    }
+    if(n) qsort((void*) *IDs, n, sizeof(int32_t), int32_t_cmp);
     return n;
 }
 
-uniqueSet *uniqueAttributes(overlapSet *os, char *attributeName) {
-    if(!os) return NULL;
-    if(os->l == 0) return NULL;
-    int32_t IDs[os->l], i, j, key, last;
-    if(!strExistsHT(os->tree->htAttributes, attributeName)) return NULL;
-    uniqueSet *us = us_init(os->tree->htAttributes);
+//The number of distinct values of an attribute in the overlaps, or -1 on error
+int32_t cntAttributes(overlapSet *os, char *attributeName) {
+    int32_t *IDs, cnt = 0;
+    int64_t i, n = attributeValues(os, attributeName, &IDs);
 
-    key = str2valHT(os->tree->htAttributes, attributeName);
-    for(i=0; i<os->l; i++) {
-        IDs[i] = -1;
-        for(j=0; j<os->overlaps[i]->nAttributes; j++) {
-            if(os->overlaps[i]->attrib[j]->key == key) {
-                IDs[i] = os->overlaps[i]->attrib[j]->val;
-                break;
-            }
-        }
+    if(n < 0) return -1;
+    for(i=0; i<n; i++) {
+        if(!i || IDs[i] != IDs[i-1]) cnt++;
     }
-    qsort((void*) IDs, os->l, sizeof(int32_t), int32_t_cmp);
+    if(IDs) free(IDs);
+    return cnt;
+}
 
-    last = -1;
-    for(i=0; i<os->l; i++) {
-        if(IDs[i] != last || last < 0) {
+/*
+    The distinct values of an attribute in the overlaps, with the number of
+    entries having each. Returns NULL if there are none or on error.
+*/
+uniqueSet *uniqueAttributes(overlapSet *os, char *attributeName) {
+    int32_t *IDs;
+    int64_t i, n;
+    uniqueSet *us;
+
+    if(!os || os->l == 0) return NULL;
+    n = attributeValues(os, attributeName, &IDs);
+    if(n <= 0) return NULL;
+
+    us = us_init(os->tree->htAttributes);
+    for(i=0; i<n; i++) {
+        if(!i || IDs[i] != IDs[i-1]) {
             us_push(us, IDs[i]);
-            last = IDs[i];
         } else {
             us_inc(us);
         }
     }
-
-    if(us->l) return us;
-    us_destroy(us);
-    return NULL;
+    free(IDs);
+    return us;
 }
 
 /*******************************************************************************
@@ -414,171 +475,270 @@ static int matchingStrand(GTFentry *e, int strand, int strandType) {
     return 1;
 }
 
+//Remove the overlaps on the wrong strand in a single pass, keeping the others in order
 static void filterStrand(overlapSet *os, int strand, int strandType) {
-    int i;
+    int i, l = 0;
 
-    if(strandType == GTF_IGNORE_STRAND) return;
+    if(strandType != GTF_SAME_STRAND && strandType != GTF_OPPOSITE_STRAND && strandType != GTF_EXACT_SAME_STRAND) return;
 
-    for(i=os->l-1; i>=0; i--) {
-        if(strandType == GTF_SAME_STRAND) {
-            if(!sameStrand(strand, os->overlaps[i])) os_exclude(os, i);
-        } else if(strandType == GTF_OPPOSITE_STRAND) {
-            if(!oppositeStrand(strand, os->overlaps[i])) os_exclude(os, i);
-        } else if(strandType == GTF_EXACT_SAME_STRAND) {
-            if(!exactSameStrand(strand, os->overlaps[i])) os_exclude(os, i);
-        }
+    for(i=0; i<os->l; i++) {
+        if(matchingStrand(os->overlaps[i], strand, strandType)) os->overlaps[l++] = os->overlaps[i];
     }
+    for(i=l; i<os->l; i++) os->overlaps[i] = NULL;
+    os->l = l;
 }
 
-static void pushOverlaps(overlapSet *os, GTFtree *t, GTFentry *e, uint32_t start, uint32_t end, int comparisonType, int direction, FILTER_ENTRY_FUNC ffunc) {
-    int dir;
-    int keep = 1;
-    if(!e) return;
-
-    if(ffunc) keep = ffunc(t, e);
-
-    switch(comparisonType) {
+//Whether an entry that overlaps [start, end) matches it
+static int entryMatches(uint32_t start, uint32_t end, GTFentry *e, int matchType) {
+    switch(matchType) {
     case GTF_MATCH_EXACT :
-        if((dir = rangeExact(start, end, e)) == 0) {
-            if(keep) os_push(os, e);
-        }
-        break;
+        return rangeExact(start, end, e) == 0;
     case GTF_MATCH_WITHIN :
-        if((dir = rangeAny(start, end, e)) == 0) {
-            if(keep) if(rangeWithin(start, end ,e) == 0) os_push(os, e);
-        }
-        break;
+        return rangeWithin(start, end, e) == 0;
     case GTF_MATCH_CONTAIN :
-        if((dir = rangeAny(start, end, e)) == 0) {
-            if(keep) if(rangeContains(start, end, e) == 0) os_push(os, e);
-        }
-        break;
+        return rangeContains(start, end, e) == 0;
     case GTF_MATCH_START :
-        if((dir = rangeStart(start, end, e)) == 0) {
-            if(keep) os_push(os, e);
-        }
-        break;
+        return rangeStart(start, end, e) == 0;
     case GTF_MATCH_END :
-        if((dir = rangeEnd(start, end, e)) == 0) {
-            if(keep) os_push(os, e);
-        }
-        break;
+        return rangeEnd(start, end, e) == 0;
     default :
-        if((dir = rangeAny(start, end, e)) == 0) {
-            if(keep) os_push(os, e);
-        }
-        break;
+        return 1;
     }
+}
 
-    if(direction) {
-        if(dir > 0) return;
-        pushOverlaps(os, t, e->right, start, end, comparisonType, direction, ffunc);
-    } else {
-        if(dir < 0) return;
-        pushOverlaps(os, t, e->left, start, end, comparisonType, direction, ffunc);
+/*
+    The entries of a node are walked in order of their starts (direction 1) or
+    ends (direction 0) until they can no longer overlap [start, end). Whether
+    they match is then a separate test, since the other comparison functions
+    don't order entries the same way.
+*/
+static void pushOverlaps(overlapSet *os, GTFtree *t, GTFentry *e, uint32_t start, uint32_t end, int comparisonType, int direction, FILTER_ENTRY_FUNC ffunc, void *fdata) {
+    int dir;
+
+    for(; e; e = direction ? e->right : e->left) {
+        if((dir = rangeAny(start, end, e)) == 0) {
+            if(entryMatches(start, end, e, comparisonType) && (!ffunc || ffunc(t, e, fdata))) os_push(os, e);
+        }
+        if(direction ? dir > 0 : dir < 0) return;
     }
 }
 
-static int32_t countOverlapsEntry(GTFtree *t, GTFentry *e, uint32_t start, uint32_t end, int strand, int matchType, int strandType, int direction, int32_t max, FILTER_ENTRY_FUNC ffunc) {
+static int32_t countOverlapsEntry(GTFtree *t, GTFentry *e, uint32_t start, uint32_t end, int strand, int matchType, int strandType, int direction, int32_t max, FILTER_ENTRY_FUNC ffunc, void *fdata) {
     int dir;
     int32_t cnt = 0;
-    if(!e) return cnt;
-    
-    switch(matchType) {
-    case GTF_MATCH_EXACT :
-        if((dir = rangeExact(start, end, e)) == 0) {
-            cnt = 1;
-        }
-        break;
-    case GTF_MATCH_WITHIN :
-        if((dir = rangeAny(start, end, e)) == 0) {
-            if(rangeWithin(start, end, e) == 0) cnt = 1;
-        }
-        break;
-    case GTF_MATCH_CONTAIN :
-        if((dir = rangeAny(start, end, e)) == 0) {
-            if(rangeContains(start, end, e) == 0) cnt = 1;
-        }
-        break;
-    case GTF_MATCH_START :
-        if((dir = rangeStart(start, end, e)) == 0) {
-            cnt = 1;
-        }
-        break;
-    case GTF_MATCH_END :
-        if((dir = rangeEnd(start, end, e)) == 0) {
-            cnt = 1;
-        }
-        break;
-    default :
+
+    for(; e; e = direction ? e->right : e->left) {
         if((dir = rangeAny(start, end, e)) == 0) {
-            cnt = 1;
+            if(entryMatches(start, end, e, matchType) && matchingStrand(e, strand, strandType) && (!ffunc || ffunc(t, e, fdata))) cnt++;
+            if(max && cnt >= max) return max;
         }
-        break;
+        if(direction ? dir > 0 : dir < 0) break;
     }
+    return cnt;
+}
 
-    if(cnt) {
-        if(!matchingStrand(e, strand, strandType)) cnt = 0;
-    }
+/*
+    The nodes overlapping [start, end), in the order that they'd be visited
+    recursively: a node's starts, its left subtree, its ends and then its right
+    subtree. An explicit stack is used, each entry being a node and whether its
+    left side (0) or right side (1) is next.
+*/
+typedef struct {
+    GTFnode *stack[2 * MAX_TREE_DEPTH];
+    int side[2 * MAX_TREE_DEPTH];
+    int l;
+} nodeWalk;
 
-    if(cnt && ffunc) {
-        if(!ffunc(t, e)) cnt = 0;
+static void nw_push(nodeWalk *nw, GTFnode *n, int side) {
+    if(!n) return;
+    assert(nw->l < 2 * MAX_TREE_DEPTH);
+    nw->stack[nw->l] = n;
+    nw->side[nw->l++] = side;
+}
+
+static void pushOverlapsNode(overlapSet *os, GTFtree *t, GTFnode *n, uint32_t start, uint32_t end, int matchType, FILTER_ENTRY_FUNC ffunc, void *fdata) {
+    nodeWalk nw;
+    int dir, side;
+
+    nw.l = 0;
+    nw_push(&nw, n, 0);
+    while(nw.l) {
+        n = nw.stack[--nw.l];
+        side = nw.side[nw.l];
+        dir = centerDirection(start, end, n);
+
+        if(!side) {
+            if(dir&2) nw_push(&nw, n, 1);
+            if(dir&1) {
+                pushOverlaps(os, t, n->starts, start, end, matchType, 1, ffunc, fdata);
+                nw_push(&nw, n->left, 0);
+            }
+        } else {
+            if(dir!=3) pushOverlaps(os, t, n->ends, start, end, matchType, 0, ffunc, fdata);
+            nw_push(&nw, n->right, 0);
+        }
     }
+}
 
-    if(max && cnt >= max) return max;
+static int32_t countOverlapsNode(GTFtree *t, GTFnode *n, uint32_t start, uint32_t end, int strand, int matchType, int strandType, int32_t max, FILTER_ENTRY_FUNC ffunc, void *fdata) {
+    int32_t cnt = 0;
+    nodeWalk nw;
+    int dir;
 
-    if(direction) {
-        if(dir > 0) return cnt;
-        return cnt + countOverlapsEntry(t, e->right, start, end, strand, matchType, strandType, direction, max, ffunc);
-    } else {
-        if(dir < 0) return cnt;
-        return cnt + countOverlapsEntry(t, e->left, start, end, strand, matchType, strandType, direction, max, ffunc);
+    //The order doesn't matter when counting
+    nw.l = 0;
+    nw_push(&nw, n, 0);
+    while(nw.l) {
+        n = nw.stack[--nw.l];
+        dir = centerDirection(start, end, n);
+
+        if(dir&1) {
+            cnt += countOverlapsEntry(t, n->starts, start, end, strand, matchType, strandType, 1, max, ffunc, fdata);
+            if(max && cnt >= max) return max;
+            nw_push(&nw, n->left, 0);
+        }
+        if(dir&2) {
+            if(dir!=3) cnt += countOverlapsEntry(t, n->ends, start, end, strand, matchType, strandType, 0, max, ffunc, fdata);
+            if(max && cnt >= max) return max;
+            nw_push(&nw, n->right, 0);
+        }
     }
+    return cnt;
 }
 
-static void pushOverlapsNode(overlapSet *os, GTFtree *t, GTFnode *n, uint32_t start, uint32_t end, int matchType, FILTER_ENTRY_FUNC ffunc) {
-    int dir;
-    if(!n) return;
-    dir = centerDirection(start, end, n);
-
-    if(dir&1) {
-        pushOverlaps(os, t, n->starts, start, end, matchType, 1, ffunc);
-        pushOverlapsNode(os, t, n->left, start, end, matchType, ffunc);
-    } 
-    if(dir&2) {
-        if(dir!=3) pushOverlaps(os, t, n->ends, start, end, matchType, 0, ffunc);
-        pushOverlapsNode(os, t, n->right, start, end, matchType, ffunc);
+//Entries added after the tree was balanced are kept in an unsorted list (the delta), which is scanned
+static void pushOverlapsDelta(overlapSet *os, GTFtree *t, GTFentry *e, uint32_t start, uint32_t end, int matchType, FILTER_ENTRY_FUNC ffunc, void *fdata) {
+    for(; e; e = e->right) {
+        if(rangeAny(start, end, e) == 0 && entryMatches(start, end, e, matchType) && (!ffunc || ffunc(t, e, fdata))) os_push(os, e);
     }
 }
 
-static int32_t countOverlapsNode(GTFtree *t, GTFnode *n, uint32_t start, uint32_t end, int strand, int matchType, int strandType, int32_t max, FILTER_ENTRY_FUNC ffunc) {
+static int32_t countOverlapsDelta(GTFtree *t, GTFentry *e, uint32_t start, uint32_t end, int strand, int matchType, int strandType, int32_t max, FILTER_ENTRY_FUNC ffunc, void *fdata) {
     int32_t cnt = 0;
-    int dir;
-    if(!n) return cnt;
-    dir = centerDirection(start, end, n);
 
-    if(dir&1) {
-        cnt += countOverlapsEntry(t, n->starts, start, end, strand, matchType, strandType, 1, max, ffunc);
-        if(max && cnt >= max) return max;
-        cnt += countOverlapsNode(t, n->left, start, end, strand, matchType, strandType, max, ffunc);
-        if(max && cnt >= max) return max;
-    } 
-    if(dir&2) {
-        if(dir!=3) cnt += countOverlapsEntry(t, n->starts, start, end, strand, matchType, strandType, 0, max, ffunc);
-        if(max && cnt >= max) return max;
-        cnt += countOverlapsNode(t, n->right, start, end, strand, matchType, strandType, max, ffunc);
+    for(; e; e = e->right) {
+        if(rangeAny(start, end, e) != 0 || !entryMatches(start, end, e, matchType) || !matchingStrand(e, strand, strandType)) continue;
+        if(ffunc && !ffunc(t, e, fdata)) continue;
+        cnt++;
         if(max && cnt >= max) return max;
     }
     return cnt;
 }
 
+/*******************************************************************************
+*
+* Flattened tree iterator functions
+*
+*******************************************************************************/
+//Whether an entry that overlaps [start, end) matches it
+static int flatMatches(uint32_t start, uint32_t end, flatEntry *e, int matchType) {
+    switch(matchType) {
+    case GTF_MATCH_EXACT :
+        return start == e->start && end == e->end;
+    case GTF_MATCH_WITHIN :
+        return start >= e->start && end <= e->end;
+    case GTF_MATCH_CONTAIN :
+        return e->start >= start && e->end <= end;
+    case GTF_MATCH_START :
+        return start == e->start;
+    case GTF_MATCH_END :
+        return end == e->end;
+    default :
+        return 1;
+    }
+}
+
+static int flatMatchingStrand(flatEntry *e, int strand, int strandType) {
+    if(strandType == GTF_IGNORE_STRAND) return 1;
+    if(strand == 3 || e->strand == 3) return strandType != GTF_EXACT_SAME_STRAND || strand == e->strand;
+    if(strandType == GTF_SAME_STRAND) return strand == e->strand;
+    if(strandType == GTF_OPPOSITE_STRAND) return strand != e->strand;
+    if(strandType == GTF_EXACT_SAME_STRAND) return strand == e->strand;
+
+    fprintf(stderr, "[flatMatchingStrand] Unknown strand type %i. Assuming a match.\n", strandType);
+    return 1;
+}
+
+//Handle a possible overlap, entries[i], returning 1 if it's counted
+static inline int visitFlat(GTFtree *t, GTFchrom *c, uint64_t i, uint32_t start, uint32_t end, int strand, int matchType, int strandType, flatOverlapSet *fos, overlapSet *os, FILTER_ENTRY_FUNC ffunc, void *fdata) {
+    flatEntry *e = ((flatEntry*) c->tree) + i;
+
+    if(start >= e->end) return 0;
+    if(!flatMatches(start, end, e, matchType) || !flatMatchingStrand(e, strand, strandType)) return 0;
+    //Trees loaded from an index have no GTFentries to filter
+    if(ffunc && c->entries && !ffunc(t, c->entries[i], fdata)) return 0;
+    if(fos) fos_push(fos, e);
+    if(os) os_push(os, c->entries[i]);
+    return 1;
+}
+
+/*
+    Find the entries overlapping [start, end) in a flattened chromosome, in
+    order. This is the implicit interval tree search from cgranges: subtrees
+    whose maxEnd is at most start are skipped and small subtrees are scanned
+    linearly. Matches are pushed to fos and/or os (either may be NULL, os
+    requires c->entries) and counted. The search stops once max (if not 0)
+    matches are found.
+*/
+static int32_t walkOverlapsFlat(GTFtree *t, GTFchrom *c, uint32_t start, uint32_t end, int strand, int matchType, int strandType, flatOverlapSet *fos, overlapSet *os, int32_t max, FILTER_ENTRY_FUNC ffunc, void *fdata) {
+    struct {
+        uint64_t x;
+        int k, w;
+    } stack[64], z;
+    flatEntry *entries = (flatEntry*) c->tree;
+    uint64_t i, i0, i1, y, n = c->n_entries;
+    int32_t cnt = 0;
+    int sp = 0, k = 0;
+
+    if(!n) return 0;
+    while((1ULL<<(k+1)) <= n) k++;
+    stack[sp].k = k;
+    stack[sp].x = (1ULL<<k) - 1;
+    stack[sp++].w = 0;
+    while(sp) {
+        z = stack[--sp];
+        if(z.k <= 3) {
+            //Small subtree, just scan it
+            i0 = z.x >> z.k << z.k;
+            i1 = i0 + (1ULL<<(z.k+1)) - 1;
+            if(i1 > n) i1 = n;
+            for(i=i0; i<i1 && entries[i].start < end; i++) {
+                cnt += visitFlat(t, c, i, start, end, strand, matchType, strandType, fos, os, ffunc, fdata);
+                if(max && cnt >= max) return cnt;
+            }
+        } else if(z.w == 0) {
+            //Revisit this node after its left child
+            y = z.x - (1ULL<<(z.k-1));
+            stack[sp].k = z.k;
+            stack[sp].x = z.x;
+            stack[sp++].w = 1;
+            if(y >= n || entries[y].maxEnd > start) {
+                stack[sp].k = z.k - 1;
+                stack[sp].x = y;
+                stack[sp++].w = 0;
+            }
+        } else if(z.x < n && entries[z.x].start < end) {
+            cnt += visitFlat(t, c, z.x, start, end, strand, matchType, strandType, fos, os, ffunc, fdata);
+            if(max && cnt >= max) return cnt;
+            stack[sp].k = z.k - 1;
+            stack[sp].x = z.x + (1ULL<<(z.k-1));
+            stack[sp++].w = 0;
+        }
+    }
+    return cnt;
+}
+
 /*******************************************************************************
 *
 * Driver functions for end use.
 *
 *******************************************************************************/
-overlapSet * findOverlaps(overlapSet *os, GTFtree *t, char *chrom, uint32_t start, uint32_t end, int strand, int matchType, int strandType, int keepOS, FILTER_ENTRY_FUNC ffunc) {
-    int32_t tid = str2valHT(t->htChroms, chrom);
+overlapSet * findOverlaps(overlapSet *os, GTFtree *t, char *chrom, uint32_t start, uint32_t end, int strand, int matchType, int strandType, int keepOS, FILTER_ENTRY_FUNC ffunc, void *fdata) {
+    return findOverlapsChrom(os, t, str2valHT(t->htChroms, chrom), start, end, strand, matchType, strandType, keepOS, ffunc, fdata);
+}
+
+//As findOverlaps(), but with the chromosome already converted to its index in t->htChroms
+overlapSet * findOverlapsChrom(overlapSet *os, GTFtree *t, int32_t tid, uint32_t start, uint32_t end, int strand, int matchType, int strandType, int keepOS, FILTER_ENTRY_FUNC ffunc, void *fdata) {
     overlapSet *out = os;
 
     if(out && !keepOS) os_reset(out);
@@ -589,34 +749,193 @@ overlapSet * findOverlaps(overlapSet *os, GTFtree *t, char *chrom, uint32_t star
         fprintf(stderr, "[findOverlaps] The tree has not been balanced! No overlaps will be returned.\n");
         return out;
     }
+    if(t->flat) {
+        //The overlaps are then already filtered and sorted
+        if(t->chroms[tid]->entries) {
+            walkOverlapsFlat(t, t->chroms[tid], start, end, strand, matchType, strandType, NULL, out, 0, ffunc, fdata);
+        } else {
+            fprintf(stderr, "[findOverlaps] The tree was loaded from an index, use findOverlapsFlat()! No overlaps will be returned.\n");
+        }
+        return out;
+    }
 
-    pushOverlapsNode(out, t, (GTFnode*) t->chroms[tid]->tree, start, end, matchType, ffunc);
+    pushOverlapsNode(out, t, (GTFnode*) t->chroms[tid]->tree, start, end, matchType, ffunc, fdata);
+    pushOverlapsDelta(out, t, t->chroms[tid]->delta, start, end, matchType, ffunc, fdata);
     if(out->l) filterStrand(out, strand, strandType);
     if(out->l) os_sort(out);
 
     return out;
 }
 
-int32_t countOverlaps(GTFtree *t, char *chrom, uint32_t start, uint32_t end, int strand, int matchType, int strandType, FILTER_ENTRY_FUNC ffunc) {
-    int32_t tid = str2valHT(t->htChroms, chrom);
+//The flattened tree equivalent of findOverlaps(). The overlaps are sorted by start and then end position.
+flatOverlapSet *findOverlapsFlat(flatOverlapSet *os, GTFtree *t, char *chrom, uint32_t start, uint32_t end, int strand, int matchType, int strandType) {
+    return findOverlapsFlatChrom(os, t, str2valHT(t->htChroms, chrom), start, end, strand, matchType, strandType);
+}
+
+flatOverlapSet *findOverlapsFlatChrom(flatOverlapSet *os, GTFtree *t, int32_t tid, uint32_t start, uint32_t end, int strand, int matchType, int strandType) {
+    flatOverlapSet *out = os;
+
+    if(out) out->l = 0;
+    else out = fos_init(t);
+
+    if(tid<0 || !t->flat) return out;
+    walkOverlapsFlat(t, t->chroms[tid], start, end, strand, matchType, strandType, out, NULL, 0, NULL, NULL);
+
+    return out;
+}
+
+//Count the entries overlapping [start, end), stopping once max (if not 0) are found
+static int32_t countOverlapsTid(GTFtree *t, int32_t tid, uint32_t start, uint32_t end, int strand, int matchType, int strandType, int32_t max, FILTER_ENTRY_FUNC ffunc, void *fdata) {
+    int32_t cnt;
+
     if(tid<0) return 0;
 
     if(!t->balanced) {
-        fprintf(stderr, "[countOverlaps] The tree has not been balanced! No overlaps will be returned.\n");
+        fprintf(stderr, "[%s] The tree has not been balanced! No overlaps will be returned.\n", max ? "overlapsAny" : "countOverlaps");
         return 0;
     }
+    if(t->flat) return walkOverlapsFlat(t, t->chroms[tid], start, end, strand, matchType, strandType, NULL, NULL, max, ffunc, fdata);
+
+    cnt = countOverlapsNode(t, (GTFnode*) t->chroms[tid]->tree, start, end, strand, matchType, strandType, max, ffunc, fdata);
+    if(max && cnt >= max) return max;
+    return cnt + countOverlapsDelta(t, t->chroms[tid]->delta, start, end, strand, matchType, strandType, max ? max - cnt : 0, ffunc, fdata);
+}
 
-    return countOverlapsNode(t, (GTFnode*) t->chroms[tid]->tree, start, end, strand, matchType, strandType, 0, ffunc);
+//The number of entries that findOverlaps() would return, without storing them
+int32_t countOverlaps(GTFtree *t, char *chrom, uint32_t start, uint32_t end, int strand, int matchType, int strandType, FILTER_ENTRY_FUNC ffunc, void *fdata) {
+    return countOverlapsTid(t, str2valHT(t->htChroms, chrom), start, end, strand, matchType, strandType, 0, ffunc, fdata);
 }
 
-int overlapsAny(GTFtree *t, char *chrom, uint32_t start, uint32_t end, int strand, int matchType, int strandType, FILTER_ENTRY_FUNC ffunc) {
-    int32_t tid = str2valHT(t->htChroms, chrom);
-    if(tid<0) return 0;
+int32_t countOverlapsChrom(GTFtree *t, int32_t tid, uint32_t start, uint32_t end, int strand, int matchType, int strandType, FILTER_ENTRY_FUNC ffunc, void *fdata) {
+    return countOverlapsTid(t, tid, start, end, strand, matchType, strandType, 0, ffunc, fdata);
+}
 
-    if(!t->balanced) {
-        fprintf(stderr, "[overlapsAny] The tree has not been balanced! No overlaps will be returned.\n");
-        return 0;
+//Whether findOverlaps() would return anything, stopping at the first overlap
+int overlapsAny(GTFtree *t, char *chrom, uint32_t start, uint32_t end, int strand, int matchType, int strandType, FILTER_ENTRY_FUNC ffunc, void *fdata) {
+    return countOverlapsTid(t, str2valHT(t->htChroms, chrom), start, end, strand, matchType, strandType, 1, ffunc, fdata) > 0;
+}
+
+int overlapsAnyChrom(GTFtree *t, int32_t tid, uint32_t start, uint32_t end, int strand, int matchType, int strandType, FILTER_ENTRY_FUNC ffunc, void *fdata) {
+    return countOverlapsTid(t, tid, start, end, strand, matchType, strandType, 1, ffunc, fdata) > 0;
+}
+
+/*******************************************************************************
+*
+* Sweep-line functions
+*
+* For regions sorted by start position, the entries of a chromosome are walked
+* in start order alongside them, keeping a list of the entries that have been
+* reached and haven't yet ended. Each entry is then visited once for every
+* region it could overlap, rather than the tree being searched from its root.
+*
+*******************************************************************************/
+sweepCursor *sc_init(GTFtree *t) {
+    sweepCursor *sc = calloc(1, sizeof(sweepCursor));
+    if(!sc) return NULL;
+    sc->t = t;
+    sc->tid = -1;
+    return sc;
+}
+
+void sc_destroy(sweepCursor *sc) {
+    if(sc->active) free(sc->active);
+    if(sc->entries) free(sc->entries);
+    free(sc);
+}
+
+//Move the cursor to the start of a chromosome (or none, if tid is -1). Returns 1 on error
+static int sc_seek(sweepCursor *sc, int32_t tid) {
+    sc->version = sc->t->version;
+    sc->tid = -1;
+    sc->start = 0;
+    sc->n = 0;
+    sc->next = 0;
+    sc->l = 0;
+    if(sc->entries) free(sc->entries);
+    sc->entries = NULL;
+    if(tid < 0) return 0;
+
+    if(!sc->t->flat) {
+        sc->entries = getSortedChromEntries(sc->t->chroms[tid]);
+        if(!sc->entries) return 1;
+    }
+    sc->n = sc->t->chroms[tid]->n_entries;
+    sc->tid = tid;
+    return 0;
+}
+
+static inline uint32_t sweepStart(sweepCursor *sc, GTFchrom *c, uint32_t i) {
+    if(sc->entries) return sc->entries[i]->start;
+    return ((flatEntry*) c->tree)[i].start;
+}
+
+static inline uint32_t sweepEnd(sweepCursor *sc, GTFchrom *c, uint32_t i) {
+    if(sc->entries) return sc->entries[i]->end;
+    return ((flatEntry*) c->tree)[i].end;
+}
+
+//Handle an entry overlapping [start, end), returning 1 if it matches
+static inline int visitSweep(sweepCursor *sc, GTFchrom *c, uint32_t i, uint32_t start, uint32_t end, int strand, int matchType, int strandType, flatOverlapSet *fos, overlapSet *os) {
+    flatEntry *fe;
+    GTFentry *e;
+
+    if(sc->entries) {
+        e = sc->entries[i];
+        if(!entryMatches(start, end, e, matchType) || !matchingStrand(e, strand, strandType)) return 0;
+        if(os) os_push(os, e);
+    } else {
+        fe = ((flatEntry*) c->tree) + i;
+        if(!flatMatches(start, end, fe, matchType) || !flatMatchingStrand(fe, strand, strandType)) return 0;
+        if(fos) fos_push(fos, fe);
+    }
+    return 1;
+}
+
+/*
+    Find the entries overlapping [start, end) on chromosome tid, which are
+    appended to fos (for flattened trees) or os (otherwise) in order of their
+    start and then end positions. Either may be NULL, in which case the matches
+    are only counted. Regions on the same chromosome must be given in order of
+    their start positions, moving to another chromosome restarts the cursor.
+    So does any change to the tree (e.g., compaction or flattening) since the
+    previous region, as the cursor's entries are then out of date.
+    Returns the number of matches, -1 on error or -2 if start is before that of
+    the previous region.
+*/
+int32_t sweepOverlaps(sweepCursor *sc, int32_t tid, uint32_t start, uint32_t end, int strand, int matchType, int strandType, flatOverlapSet *fos, overlapSet *os) {
+    GTFchrom *c;
+    uint32_t i, j, k, *tmp;
+    int32_t cnt = 0;
+
+    if(!sc->t->balanced) return 0;
+    if((tid != sc->tid || sc->version != sc->t->version) && sc_seek(sc, tid)) return -1;
+    if(tid < 0) return 0;
+    if(start < sc->start) return -2;
+    sc->start = start;
+    c = sc->t->chroms[tid];
+
+    //Entries starting before end become active, unless they've already ended
+    while(sc->next < sc->n && sweepStart(sc, c, sc->next) < end) {
+        if(sweepEnd(sc, c, sc->next) > start) {
+            if(sc->l >= sc->m) {
+                sc->m = sc->m ? 2 * sc->m : 64;
+                tmp = realloc(sc->active, sc->m * sizeof(uint32_t));
+                if(!tmp) return -1;
+                sc->active = tmp;
+            }
+            sc->active[sc->l++] = sc->next;
+        }
+        sc->next++;
     }
 
-    return countOverlapsNode(t, (GTFnode*) t->chroms[tid]->tree, start, end, strand, matchType, strandType, 1, ffunc);
+    //Entries ending by start can't overlap this or any later region
+    for(i=0, j=0; i<sc->l; i++) {
+        k = sc->active[i];
+        if(sweepEnd(sc, c, k) <= start) continue;
+        sc->active[j++] = k;
+        if(sweepStart(sc, c, k) < end) cnt += visitSweep(sc, c, k, start, end, strand, matchType, strandType, fos, os);
+    }
+    sc->l = j;
+
+    return cnt;
 }
@@ -2,6 +2,8 @@
 #include <stdio.h>
 #include <assert.h>
 #include <float.h>
+#include <string.h>
+#include <sys/mman.h>
 #include "gtf.h"
 
 //Nodes for the interval tree
@@ -28,42 +30,118 @@ GTFtree * initGTFtree() {
     return t;
 }
 
-void destroyGTFentry(GTFentry *e) {
-    int32_t i;
-    if(!e) return;
-    if(e->right) destroyGTFentry(e->right);
-    for(i=0; i<e->nAttributes; i++) {
-        if(e->attrib[i]) free(e->attrib[i]);
+/*******************************************************************************
+*
+* Arena allocation
+*
+*******************************************************************************/
+//Returns size bytes with the given alignment (a power of 2), or NULL on error
+static void *arenaReserve(memArena *a, size_t size, size_t align) {
+    uint64_t offset = (a->used + align - 1) & ~((uint64_t) align - 1);
+    char **tmp, *block;
+
+    if(a->n && offset + size <= ARENA_CHUNK_SIZE) {
+        a->used = offset + size;
+        return a->chunks[a->n - 1] + offset;
+    }
+
+    if(a->n >= a->m) {
+        tmp = realloc(a->chunks, (a->m + 16) * sizeof(char*));
+        if(!tmp) return NULL;
+        a->chunks = tmp;
+        a->m += 16;
+    }
+
+    //Oversized requests get a block of their own, which goes before the one being filled
+    if(size > ARENA_CHUNK_SIZE) {
+        block = malloc(size);
+        if(!block) return NULL;
+        if(a->n) {
+            a->chunks[a->n] = a->chunks[a->n - 1];
+            a->chunks[a->n - 1] = block;
+        } else {
+            a->chunks[0] = block;
+            a->used = ARENA_CHUNK_SIZE;
+        }
+        a->n++;
+        return block;
     }
-    if(e->attrib) free(e->attrib);
-    free(e);
+
+    a->chunks[a->n] = malloc(ARENA_CHUNK_SIZE);
+    if(!a->chunks[a->n]) return NULL;
+    a->n++;
+    a->used = size;
+    return a->chunks[a->n - 1];
 }
 
-void destroyGTFnode(GTFnode *n) {
-    if(n->left) destroyGTFnode(n->left);
-    if(n->starts) destroyGTFentry(n->starts);
-    if(n->right) destroyGTFnode(n->right);
-    free(n);
+//Returns size bytes aligned to 8 bytes, or NULL on error
+void *arenaAlloc(memArena *a, size_t size) {
+    return arenaReserve(a, size, 8);
+}
+
+//Returns NULL on error
+char *arenaStrdup(memArena *a, char *s) {
+    size_t len = strlen(s) + 1;
+    char *out = arenaReserve(a, len, 1);
+    if(out) memcpy(out, s, len);
+    return out;
+}
+
+/*
+    Move the blocks of src to dst, after which src is empty. The block dst is
+    filling remains the last one. Returns 1 on error, in which case neither
+    arena is changed.
+*/
+int mergeArena(memArena *dst, memArena *src) {
+    char **tmp;
+    uint32_t i;
+
+    if(!src->n) return 0;
+    if(dst->n + src->n > dst->m) {
+        tmp = realloc(dst->chunks, (dst->n + src->n) * sizeof(char*));
+        if(!tmp) return 1;
+        dst->chunks = tmp;
+        dst->m = dst->n + src->n;
+    }
+    if(dst->n) {
+        dst->chunks[dst->n + src->n - 1] = dst->chunks[dst->n - 1];
+        for(i=0; i<src->n; i++) dst->chunks[dst->n - 1 + i] = src->chunks[i];
+    } else {
+        for(i=0; i<src->n; i++) dst->chunks[i] = src->chunks[i];
+        dst->used = src->used;
+    }
+    dst->n += src->n;
+    free(src->chunks);
+    memset(src, 0, sizeof(memArena));
+    return 0;
 }
 
-void destroyGTFchrom(GTFchrom *c, int balanced) {
-    if(balanced) destroyGTFnode((GTFnode*) c->tree);
-    else destroyGTFentry((GTFentry*) c->tree);
-    free(c);
+void destroyArena(memArena *a) {
+    uint32_t i;
+    for(i=0; i<a->n; i++) free(a->chunks[i]);
+    if(a->chunks) free(a->chunks);
 }
 
-//This need to handle htTargets and htGenes still
 void destroyGTFtree(GTFtree *t) {
     uint32_t i;
     for(i=0; i<t->n_targets; i++) {
-        destroyGTFchrom(t->chroms[i], t->balanced);
+        //Mapped entries belong to the image, otherwise they're in the arena
+        if(t->flat && !t->image) free(t->chroms[i]->tree);
+        if(t->chroms[i]->entries) free(t->chroms[i]->entries);
+        free(t->chroms[i]);
     }
+    destroyArena(&(t->arena));
 
     destroyHT(t->htChroms);
     destroyHT(t->htSources);
     destroyHT(t->htFeatures);
     destroyHT(t->htAttributes);
 
+    if(t->image) {
+        if(t->imageMapped) munmap(t->image, t->imageSize);
+    } else if(t->exons) {
+        free(t->exons);
+    }
     free(t->chroms);
     free(t);
 }
@@ -87,73 +165,111 @@ void addChrom(GTFtree *t) {
 }
 
 
-//Returns NULL on error
-static Attribute *makeAttribute(GTFtree *t, char *value) {
-    int32_t idx;
-    Attribute *a = malloc(sizeof(Attribute));
+/*
+    The attributes of an entry: its name, under the transcript_id key, followed
+    by the n key/value pairs in attributes (alternating NUL-terminated keys and
+    values). Pairs already present are skipped, nAttributes is set to the
+    number kept. Returns NULL on error.
+*/
+static Attribute *makeAttributes(GTFtree *t, char *value, char *attributes, uint32_t n, int *nAttributes) {
+    Attribute *a = arenaAlloc(&(t->arena), (n + 1) * sizeof(Attribute));
+    uint32_t i;
+    int j, l = 1;
     if(!a) return NULL;
 
-    if(!strExistsHT(t->htAttributes, "transcript_id")) {
-        idx = addHTelement(t->htAttributes, "transcript_id");
-    } else {
-        idx = str2valHT(t->htAttributes, "transcript_id");
+    a->key = getOrAddHT(t->htAttributes, "transcript_id", NULL);
+    a->val = getOrAddHT(t->htAttributes, value, NULL);
+    if(a->key < 0 || a->val < 0) return NULL;
+
+    for(i=0; i<n; i++) {
+        a[l].key = getOrAddHT(t->htAttributes, attributes, NULL);
+        attributes += strlen(attributes) + 1;
+        a[l].val = getOrAddHT(t->htAttributes, attributes, NULL);
+        attributes += strlen(attributes) + 1;
+        if(a[l].key < 0 || a[l].val < 0) return NULL;
+        for(j=0; j<l; j++) {
+            if(a[j].key == a[l].key && a[j].val == a[l].val) break;
+        }
+        if(j == l) l++;
+    }
+    *nAttributes = l;
+
+    return a;
+}
+
+//Whether a sorts strictly before b, by start and then end
+static int isBefore(GTFentry *a, GTFentry *b) {
+    if(a->start != b->start) return a->start < b->start;
+    return a->end < b->end;
+}
+
+/*
+    Append an entry to the vine of its chromosome or, once the tree has been
+    balanced, to the chromosome's delta (see GTFchrom). Returns 1 on error.
+*/
+static int insertEntry(GTFtree *t, GTFentry *e) {
+    GTFchrom *c = t->chroms[e->chrom];
+
+    t->version++;
+    if(t->balanced) {
+        e->left = NULL;
+        e->right = c->delta;
+        c->delta = e;
+        c->n_delta++;
+        c->n_entries++;
+        if(c->n_delta > DELTA_MIN && c->n_delta > c->n_entries / DELTA_FRACTION) return compactChrom(t, c);
+        return 0;
     }
-    a->key = idx;
-    if(!strExistsHT(t->htAttributes, value)) {
-        idx = addHTelement(t->htAttributes, value);
+
+    if(c->tree) {
+        e->left = ((GTFentry*) c->tree)->left;
+        if(isBefore(e, e->left)) c->unsorted = 1;
+        e->left->right = e;
+        ((GTFentry*) c->tree)->left = e;
     } else {
-        idx = str2valHT(t->htAttributes, value);
+        c->tree = (void *) e;
+        e->left = e;
     }
-    a->val = idx;
+    c->n_entries++;
 
-    return a;
+    return 0;
 }
 
 /* This currently hard-codes the following:
     feature
     source
     frame
-    all attributes (most are skipped)
+
+    Other than the transcript ID, only the nAttributes key/value pairs in
+    attributes (see makeAttributes()) are kept, which may be none.
 
     returns 1 on error
 */
-int addGTFentry(GTFtree *t, char *chrom, uint32_t start, uint32_t end, uint8_t strand, char *transcriptID, uint32_t labelIDX, double score) {
+int addGTFentry(GTFtree *t, char *chrom, uint32_t start, uint32_t end, uint8_t strand, char *transcriptID, uint32_t labelIDX, double score, char *attributes, uint32_t nAttributes) {
     int32_t IDchrom, IDfeature, IDsource;
+    int added, nAttrib = 0;
     char feature[] = "transcript", source[] = "deepTools";
     uint8_t frame = 3;
     GTFentry *e = NULL;
     Attribute *a = NULL;
-    Attribute **attribs = calloc(1, sizeof(Attribute *));
-    if(!attribs) return 1;
 
     //Get the chromosome ID
-    if(!strExistsHT(t->htChroms, chrom)) {
-        addChrom(t);
-        IDchrom = addHTelement(t->htChroms, chrom);
-    } else {
-        IDchrom = str2valHT(t->htChroms, chrom);
-    }
+    IDchrom = getOrAddHT(t->htChroms, chrom, &added);
+    if(IDchrom < 0) return 1;
+    if(added) addChrom(t);
 
     //Handle the hard-coded stuff, which in case they're ever requested
-    if(!strExistsHT(t->htSources, source)) {
-        IDsource = addHTelement(t->htSources, source);
-    } else {
-        IDsource = str2valHT(t->htSources, source);
-    }
-    if(!strExistsHT(t->htFeatures, feature)) {
-        IDfeature = addHTelement(t->htFeatures, feature);
-    } else {
-        IDfeature = str2valHT(t->htFeatures, feature);
-    }
+    IDsource = getOrAddHT(t->htSources, source, NULL);
+    IDfeature = getOrAddHT(t->htFeatures, feature, NULL);
+    if(IDsource < 0 || IDfeature < 0) return 1;
 
-    //Create the attribute
-    a = makeAttribute(t, transcriptID);
-    if(!a) goto error;
-    attribs[0] = a;
+    //Create the attributes
+    a = makeAttributes(t, transcriptID, attributes, nAttributes, &nAttrib);
+    if(!a) return 1;
 
     //Initialize the entry
-    e = malloc(sizeof(GTFentry));
-    if(!e) goto error;
+    e = arenaAlloc(&(t->arena), sizeof(GTFentry));
+    if(!e) return 1;
     e->right = NULL;
 
     e->chrom = IDchrom;
@@ -164,27 +280,13 @@ int addGTFentry(GTFtree *t, char *chrom, uint32_t start, uint32_t end, uint8_t s
     e->strand = strand;
     e->frame = frame;
     e->score = score;
-    e->nAttributes = 1;
-    e->attrib = attribs;
+    e->nAttributes = nAttrib;
+    e->attrib = a;
     e->labelIdx = labelIDX;
+    e->nExons = 0;
+    e->exons = 0;
 
-    if(t->chroms[IDchrom]->tree) {
-        e->left = ((GTFentry*) t->chroms[IDchrom]->tree)->left;
-        e->left->right = e;
-        ((GTFentry*) t->chroms[IDchrom]->tree)->left = e;
-    } else {
-        t->chroms[IDchrom]->tree = (void *) e;
-        e->left = e;
-    }
-    t->chroms[IDchrom]->n_entries++;
-
-    return 0;
-
-error:
-    if(attribs) free(attribs);
-    if(a) free(a);
-    if(e) free(e);
-    return 1;
+    return insertEntry(t, e);
 }
 
 /* This currently hard-codes the following:
@@ -193,40 +295,33 @@ error:
     frame
     all attributes
 
+    With several attribute keys, feature is that of the first and the nFeatures
+    others are stored as the entry's exons (see GTFentry).
+
     returns 1 on error
 */
-int addEnrichmententry(GTFtree *t, char *chrom, uint32_t start, uint32_t end, uint8_t strand, double score, char *feature) {
-    int32_t IDchrom, IDfeature, IDsource;
+#define ENRICHMENT_STACK 16
+int addEnrichmententry(GTFtree *t, char *chrom, uint32_t start, uint32_t end, uint8_t strand, double score, char *feature, char **features, uint32_t nFeatures) {
+    int32_t IDchrom, IDfeature, IDsource, ID;
+    int added, rv;
     char source[] = "deepTools";
     uint8_t frame = 3;
+    uint32_t i, stackPairs[2 * ENRICHMENT_STACK], *pairs = stackPairs;
     GTFentry *e = NULL;
-    //Attribute **attribs = calloc(1, sizeof(Attribute *));
-    //if(!attribs) return 1;
 
     //Get the chromosome ID
-    if(!strExistsHT(t->htChroms, chrom)) {
-        addChrom(t);
-        IDchrom = addHTelement(t->htChroms, chrom);
-    } else {
-        IDchrom = str2valHT(t->htChroms, chrom);
-    }
+    IDchrom = getOrAddHT(t->htChroms, chrom, &added);
+    if(IDchrom < 0) return 1;
+    if(added) addChrom(t);
 
     //Handle the hard-coded stuff, in case they're ever requested
-    if(!strExistsHT(t->htSources, source)) {
-        IDsource = addHTelement(t->htSources, source);
-    } else {
-        IDsource = str2valHT(t->htSources, source);
-    }
-
-    if(!strExistsHT(t->htFeatures, feature)) {
-        IDfeature = addHTelement(t->htFeatures, feature);
-    } else {
-        IDfeature = str2valHT(t->htFeatures, feature);
-    }
+    IDsource = getOrAddHT(t->htSources, source, NULL);
+    IDfeature = getOrAddHT(t->htFeatures, feature, NULL);
+    if(IDsource < 0 || IDfeature < 0) return 1;
 
     //Initialize the entry
-    e = malloc(sizeof(GTFentry));
-    if(!e) goto error;
+    e = arenaAlloc(&(t->arena), sizeof(GTFentry));
+    if(!e) return 1;
     e->right = NULL;
 
     e->chrom = IDchrom;
@@ -239,24 +334,62 @@ int addEnrichmententry(GTFtree *t, char *chrom, uint32_t start, uint32_t end, ui
     e->score = score;
     e->nAttributes = 0;
     e->attrib = NULL;
-
-    if(t->chroms[IDchrom]->tree) {
-        e->left = ((GTFentry*) t->chroms[IDchrom]->tree)->left;
-        e->left->right = e;
-        ((GTFentry*) t->chroms[IDchrom]->tree)->left = e;
-    } else {
-        t->chroms[IDchrom]->tree = (void *) e;
-        e->left = e;
+    e->nExons = 0;
+    e->exons = 0;
+
+    if(nFeatures) {
+        if(nFeatures > ENRICHMENT_STACK) pairs = malloc(2 * nFeatures * sizeof(uint32_t));
+        if(!pairs) return 1;
+        for(i=0; i<nFeatures; i++) {
+            ID = getOrAddHT(t->htFeatures, features[i], NULL);
+            if(ID < 0) break;
+            pairs[2*i] = i + 1;
+            pairs[2*i + 1] = (uint32_t) ID;
+        }
+        rv = (i < nFeatures) || addExons(t, e, pairs, nFeatures);
+        if(pairs != stackPairs) free(pairs);
+        if(rv) return 1;
     }
-    t->chroms[IDchrom]->n_entries++;
 
+    return insertEntry(t, e);
+}
+
+//Order exons (start/end pairs) by start and then end position
+int cmpExons(const void *a, const void *b) {
+    uint32_t *ea = (uint32_t*) a;
+    uint32_t *eb = (uint32_t*) b;
+
+    if(ea[0] < eb[0]) return -1;
+    if(eb[0] < ea[0]) return 1;
+    if(ea[1] < eb[1]) return -1;
+    if(eb[1] < ea[1]) return 1;
     return 0;
+}
 
-error:
-    //if(attribs) free(attribs);
-    //if(a) free(a);
-    if(e) free(e);
-    return 1;
+/*
+    Store the exons of an entry, n start/end pairs in any order, in the tree's
+    exons array. They're sorted there, so findOverlaps() can return them as is.
+    Returns 1 on error.
+*/
+int addExons(GTFtree *t, GTFentry *e, uint32_t *bounds, uint32_t n) {
+    uint32_t *tmp;
+    uint64_t m;
+
+    if(!n) return 0;
+    if(t->image) return 1;
+    if(t->nExons + n > t->mExons) {
+        m = 2 * (t->nExons + n);
+        tmp = realloc(t->exons, 2 * m * sizeof(uint32_t));
+        if(!tmp) return 1;
+        t->exons = tmp;
+        t->mExons = m;
+    }
+    memcpy(t->exons + 2 * t->nExons, bounds, 2 * n * sizeof(uint32_t));
+    qsort(t->exons + 2 * t->nExons, n, 2 * sizeof(uint32_t), cmpExons);
+    e->exons = t->nExons;
+    e->nExons = n;
+    t->nExons += n;
+    return 0;
 }
 
 /*******************************************************************************
@@ -409,10 +542,72 @@ GTFentry *sortTreeEnd(GTFentry *e, uint32_t l) {
 *
 *******************************************************************************/
 
-//Note the returned object is the rightmost interval sorted by end position
+typedef struct {
+    uint32_t key;
+    GTFentry *e;
+} endKey;
+
+/*
+    Link a vine that's already sorted by start by left pointers in the order
+    sortTreeEnd() would: by descending end and then start, with entries having
+    the same bounds in vine order. The entries are reversed, other than runs
+    with the same bounds, and then radix sorted by end, which is stable.
+    Returns the first entry or NULL on error, in which case nothing is changed.
+*/
+GTFentry *sortSortedEnds(GTFentry *starts, uint32_t n) {
+    endKey *keys = malloc(n * sizeof(endKey)), *tmp = malloc(n * sizeof(endKey)), *swap;
+    uint32_t i, j, k, b, shift, counts[256];
+    GTFentry *e = NULL;
+
+    if(!keys || !tmp) goto out;
+    for(i=0, e=starts; i<n; i++, e=e->right) {
+        assert(e);
+        tmp[i].key = ~(e->end); //Ascending order is then descending by end
+        tmp[i].e = e;
+    }
+    for(i=n, j=0; i>0; i=k) {
+        for(k=i-1; k>0 && tmp[k-1].e->start == tmp[i-1].e->start && tmp[k-1].e->end == tmp[i-1].e->end; k--);
+        memcpy(keys + j, tmp + k, (i - k) * sizeof(endKey));
+        j += i - k;
+    }
+
+    //A byte at a time, skipping those all keys share
+    for(shift=0; shift<32; shift+=8) {
+        memset(counts, 0, 256 * sizeof(uint32_t));
+        for(i=0; i<n; i++) counts[(keys[i].key >> shift) & 0xff]++;
+        if(counts[(keys[0].key >> shift) & 0xff] == n) continue;
+        for(b=0, j=0; b<256; b++) {
+            k = counts[b];
+            counts[b] = j;
+            j += k;
+        }
+        for(i=0; i<n; i++) tmp[counts[(keys[i].key >> shift) & 0xff]++] = keys[i];
+        swap = keys;
+        keys = tmp;
+        tmp = swap;
+    }
+
+    for(i=0; i<n; i++) keys[i].e->left = (i + 1 < n) ? keys[i + 1].e : NULL;
+    e = keys[0].e;
+
+out:
+    if(keys) free(keys);
+    if(tmp) free(tmp);
+    return e;
+}
+
+/*
+    Sort the vine of a chromosome by start (linked by right pointers) and by
+    end (linked by left pointers). Vines that were added in order needn't be
+    sorted by start and are sorted by end more quickly.
+
+    Note the returned object is the rightmost interval sorted by end position
+*/
 GTFentry *sortChrom(GTFchrom *c) {
-    GTFentry *e = ((GTFentry *)c->tree)->left;
+    GTFentry *e = ((GTFentry *)c->tree)->left, *ends = NULL;
     ((GTFentry*) c->tree)->left = NULL;
+    if(!c->unsorted) ends = sortSortedEnds((GTFentry *) c->tree, c->n_entries);
+    if(ends) return ends;
     c->tree = (void *) sortTreeStart((GTFentry *) c->tree, c->n_entries);
     e = sortTreeEnd(e, c->n_entries);
     return e;
@@ -500,32 +695,67 @@ GTFentry *getRMembers(GTFentry **members, GTFentry **lEnds, GTFentry *ends, uint
     return newEnds;
 }
 
-GTFnode *makeIntervalTree(GTFentry *starts, GTFentry *ends) {
-    uint32_t center = getCenter(ends);//, nMembers;
-    GTFentry *rStarts = NULL; //getRStarts(starts, center);
-    GTFentry *lEnds = NULL; //getLEnds(ends, center);
-    GTFentry *memberStarts = NULL, *memberEnds = NULL;
-    GTFnode *out = calloc(1, sizeof(GTFnode));
-    assert(out);
+/*
+    Make the node of an interval tree holding the entries in starts/ends, which
+    are sorted by start and end, respectively, that overlap its center. The
+    entries of its left and right subtrees are returned in the same way, with
+    NULL lists if there are none.
+*/
+GTFnode *makeIntervalNode(memArena *a, GTFentry *starts, GTFentry *ends, GTFentry **lStarts, GTFentry **lEnds, GTFentry **rStarts, GTFentry **rEnds) {
+    GTFentry *memberStarts, *memberEnds;
+    GTFnode *out = arenaAlloc(a, sizeof(GTFnode));
+    uint32_t center;
 
-    starts = getMembers(&memberStarts, &rStarts, starts, center);
-    ends = getRMembers(&memberEnds, &lEnds, ends, center);
+    assert(out);
+    center = getCenter(ends);
+    *lStarts = getMembers(&memberStarts, rStarts, starts, center);
+    *rEnds = getRMembers(&memberEnds, lEnds, ends, center);
 
     out->center = center;
     out->starts = memberStarts;
     out->ends = memberEnds;
-    if(lEnds && starts) {
-        out->left = makeIntervalTree(starts, lEnds);
-    } else {
-        out->left = NULL;
-    }
-    if(rStarts && ends) {
-        out->right = makeIntervalTree(rStarts, ends);
-    } else {
-        out->right = NULL;
+    out->left = NULL;
+    out->right = NULL;
+    if(!*rStarts || !*rEnds) *rStarts = *rEnds = NULL;
+    if(!*lStarts || !*lEnds) *lStarts = *lEnds = NULL;
+    return out;
+}
+
+/*
+    Build the interval tree of the entries in starts/ends, which are sorted by
+    start and end, respectively. Rather than recursing, the subtrees still to be
+    built are kept on a stack, along with where to store them.
+*/
+GTFnode *makeIntervalTree(memArena *a, GTFentry *starts, GTFentry *ends) {
+    GTFentry *stackStarts[2 * MAX_TREE_DEPTH], *stackEnds[2 * MAX_TREE_DEPTH];
+    GTFnode **stackNodes[2 * MAX_TREE_DEPTH];
+    GTFentry *lStarts, *lEnds, *rStarts, *rEnds;
+    GTFnode *root = NULL, *out;
+    int l = 0;
+
+    stackStarts[l] = starts;
+    stackEnds[l] = ends;
+    stackNodes[l++] = &root;
+    while(l) {
+        starts = stackStarts[--l];
+        ends = stackEnds[l];
+        out = makeIntervalNode(a, starts, ends, &lStarts, &lEnds, &rStarts, &rEnds);
+        *stackNodes[l] = out;
+
+        assert(l + 2 <= 2 * MAX_TREE_DEPTH);
+        if(rStarts) {
+            stackStarts[l] = rStarts;
+            stackEnds[l] = rEnds;
+            stackNodes[l++] = &(out->right);
+        }
+        if(lStarts) {
+            stackStarts[l] = lStarts;
+            stackEnds[l] = lEnds;
+            stackNodes[l++] = &(out->left);
+        }
     }
 
-    return out;
+    return root;
 }
 
 void sortGTF(GTFtree *t) {
@@ -534,44 +764,307 @@ void sortGTF(GTFtree *t) {
 
     for(i=0; i<t->n_targets; i++) {
         ends = sortChrom(t->chroms[i]);
-        t->chroms[i]->tree = (void*) makeIntervalTree((GTFentry*) t->chroms[i]->tree, ends);
+        t->chroms[i]->tree = (void*) makeIntervalTree(&(t->arena), (GTFentry*) t->chroms[i]->tree, ends);
     }
     t->balanced = 1;
+    t->version++;
+}
+
+/*
+    Relink the entries of a balanced chromosome, including its delta, into a
+    vine, as sortChrom() expects. Returns 1 on error, in which case the
+    chromosome is unchanged.
+*/
+int vineChrom(GTFchrom *c) {
+    GTFentry **entries;
+    uint32_t i, n = c->n_entries;
+
+    entries = getChromEntries(c);
+    if(!entries) return 1;
+    c->unsorted = 0;
+    for(i=0; i<n; i++) {
+        entries[i]->left = entries[i ? i - 1 : n - 1];
+        entries[i]->right = (i + 1 < n) ? entries[i + 1] : NULL;
+        if(i && isBefore(entries[i], entries[i - 1])) c->unsorted = 1;
+    }
+    c->tree = (void*) entries[0];
+    c->delta = NULL;
+    c->n_delta = 0;
+    free(entries);
+    return 0;
+}
+
+/*
+    Rebuild the interval tree of a balanced chromosome to include the entries
+    in its delta. The previous nodes are left in the arena. Returns 1 on error,
+    in which case the chromosome is unchanged.
+*/
+int compactChrom(GTFtree *t, GTFchrom *c) {
+    GTFentry *ends;
+
+    if(!c->n_delta) return 0;
+    if(vineChrom(c)) return 1;
+    t->version++;
+    ends = sortChrom(c);
+    c->tree = (void*) makeIntervalTree(&(t->arena), (GTFentry*) c->tree, ends);
+    return 0;
+}
+
+//Compact the deltas of a balanced tree holding more than minDelta entries. Returns 1 on error
+int compactGTFtree(GTFtree *t, uint32_t minDelta) {
+    int32_t i;
+
+    if(!t->balanced || t->flat) return 0;
+    for(i=0; i<t->n_targets; i++) {
+        if(t->chroms[i]->n_delta > minDelta && compactChrom(t, t->chroms[i])) return 1;
+    }
+    return 0;
+}
+
+/*******************************************************************************
+*
+* Functions for flattened trees
+*
+*******************************************************************************/
+//The entries of each node, in order (left subtree, node, right subtree)
+static void pushNodeEntries(GTFnode *n, GTFentry **entries, uint32_t *i) {
+    GTFnode *stack[MAX_TREE_DEPTH];
+    GTFentry *e;
+    int l = 0;
+
+    while(n || l) {
+        if(n) {
+            assert(l < MAX_TREE_DEPTH);
+            stack[l++] = n;
+            n = n->left;
+        } else {
+            n = stack[--l];
+            for(e = n->starts; e; e = e->right) entries[(*i)++] = e;
+            n = n->right;
+        }
+    }
+}
+
+//Returns an array of all of the entries (including the delta) in a balanced chromosome, or NULL on error
+GTFentry **getChromEntries(GTFchrom *c) {
+    uint32_t i = 0;
+    GTFentry *e, **entries = malloc((c->n_entries + 1) * sizeof(GTFentry*));
+    if(!entries) return NULL;
+    pushNodeEntries((GTFnode*) c->tree, entries, &i);
+    for(e = c->delta; e; e = e->right) entries[i++] = e;
+    assert(i == c->n_entries);
+    return entries;
+}
+
+static int cmpEntryPointers(const void *a, const void *b) {
+    GTFentry *ea = *(GTFentry**) a;
+    GTFentry *eb = *(GTFentry**) b;
+
+    if(ea->start < eb->start) return -1;
+    if(eb->start < ea->start) return 1;
+    if(ea->end < eb->end) return -1;
+    if(eb->end < ea->end) return 1;
+    return 0;
+}
+
+//As getChromEntries(), but sorted by start and then end position
+GTFentry **getSortedChromEntries(GTFchrom *c) {
+    GTFentry **entries = getChromEntries(c);
+    if(entries) qsort(entries, c->n_entries, sizeof(GTFentry*), cmpEntryPointers);
+    return entries;
+}
+
+/*
+    Compute the maxEnd of each entry, which must already be sorted. The array
+    is treated as an implicit binary tree (as in cgranges): entries at odd
+    indices are leaves and an entry whose index ends in k 1 bits sits at level
+    k, with children at i - 2^(k-1) and i + 2^(k-1).
+*/
+void indexFlatChrom(flatEntry *entries, uint32_t n) {
+    uint64_t i, x, lastI = 0;
+    uint32_t last = 0, el, er, e;
+    int k;
+
+    if(!n) return;
+    for(i=0; i<n; i+=2) {
+        lastI = i;
+        last = entries[i].maxEnd = entries[i].end;
+    }
+    for(k=1; (1ULL<<k) <= n; k++) {
+        x = 1ULL<<(k-1);
+        for(i=(x<<1)-1; i<n; i+=x<<2) {
+            el = entries[i-x].maxEnd;
+            er = (i+x < n) ? entries[i+x].maxEnd : last;
+            e = entries[i].end;
+            if(el > e) e = el;
+            if(er > e) e = er;
+            entries[i].maxEnd = e;
+        }
+        //The last real entry may have a missing right sibling, so track the maximum through its ancestors
+        lastI = ((lastI>>k)&1) ? lastI - x : lastI + x;
+        if(lastI < n && entries[lastI].maxEnd > last) last = entries[lastI].maxEnd;
+    }
+}
+
+/*
+    Fill out with a flattened (sorted and indexed) copy of entries. nameKey is
+    the attribute key holding the name, normally transcript_id. Exons are not
+    set. entries is sorted as well, so entries[i] corresponds to out[i].
+*/
+void flattenEntries(GTFentry **entries, uint32_t n, flatEntry *out, int32_t nameKey) {
+    uint32_t i;
+    int32_t j;
+    GTFentry *e;
+
+    qsort(entries, n, sizeof(GTFentry*), cmpEntryPointers);
+    for(i=0; i<n; i++) {
+        e = entries[i];
+        memset(out + i, 0, sizeof(flatEntry));
+        out[i].start = e->start;
+        out[i].end = e->end;
+        out[i].labelIdx = e->labelIdx;
+        out[i].feature = e->feature;
+        out[i].score = e->score;
+        out[i].strand = e->strand;
+        out[i].exons = e->exons;
+        out[i].nExons = e->nExons;
+        out[i].name = -1;
+        for(j=0; j<e->nAttributes; j++) {
+            if(e->attrib[j].key == nameKey) {
+                out[i].name = e->attrib[j].val;
+                break;
+            }
+        }
+    }
+    indexFlatChrom(out, n);
+}
+
+/*
+    Replace the centered interval tree of each chromosome of a balanced tree
+    with a flattened one, which is generally faster to query. The GTFentries
+    are kept, so the tree can still be used with findOverlaps() and similar.
+    Returns 1 on error, in which case the tree is unchanged.
+*/
+int flattenGTFtree(GTFtree *t) {
+    flatEntry **flat = NULL;
+    GTFentry ***entries = NULL;
+    int32_t i, nameKey = -1;
+    int rv = 1;
+
+    if(!t->balanced || t->flat) return 1;
+    nameKey = str2valHT(t->htAttributes, "transcript_id");
+    flat = calloc(t->n_targets + 1, sizeof(flatEntry*));
+    entries = calloc(t->n_targets + 1, sizeof(GTFentry**));
+    if(!flat || !entries) goto out;
+    for(i=0; i<t->n_targets; i++) {
+        flat[i] = malloc((t->chroms[i]->n_entries + 1) * sizeof(flatEntry));
+        entries[i] = getChromEntries(t->chroms[i]);
+        if(!flat[i] || !entries[i]) goto out;
+    }
+
+    for(i=0; i<t->n_targets; i++) {
+        flattenEntries(entries[i], t->chroms[i]->n_entries, flat[i], nameKey);
+        //The nodes themselves are left in the arena
+        t->chroms[i]->tree = (void*) flat[i];
+        t->chroms[i]->entries = entries[i];
+        t->chroms[i]->delta = NULL;
+        t->chroms[i]->n_delta = 0;
+    }
+    t->flat = 1;
+    t->version++;
+    rv = 0;
+
+out:
+    for(i=0; rv && i<t->n_targets; i++) {
+        if(flat && flat[i]) free(flat[i]);
+        if(entries && entries[i]) free(entries[i]);
+    }
+    if(flat) free(flat);
+    if(entries) free(entries);
+    return rv;
 }
 
+//Nodes are visited in order, so the entries are in order of their starts
 int nodeHasOverlaps(GTFnode *node, int firstNode, uint32_t *lpos, uint32_t *minDistance) {
-    int rv = 0;
-    GTFentry *e = node->starts;
+    GTFnode *stack[MAX_TREE_DEPTH];
+    GTFentry *e;
+    int l = 0;
+
+    while(node || l) {
+        if(node) {
+            assert(l < MAX_TREE_DEPTH);
+            stack[l++] = node;
+            node = node->left;
+            continue;
+        }
+        node = stack[--l];
+        e = node->starts;
+        if(firstNode) {
+            //This only has to be specially set on the left-most node
+            *lpos = e->end;
+            *minDistance = e->start;
+            e = e->right;
+            firstNode = 0;
+        }
 
-    // Go down the left
-    if(node->left) {
-        rv = nodeHasOverlaps(node->left, firstNode, lpos, minDistance);
-        if(rv) return rv;
-    } else if(firstNode) {
-        //This only has to be specially set on the left-most node
-        *lpos = e->end;
-        *minDistance = e->start;
-        e = e->right;
+        // Test this node
+        while(e) {
+            if(e->start < *lpos) {
+                *minDistance = 0;
+                return 1;
+            }
+            if(e->start - *lpos < *minDistance) *minDistance = e->start - *lpos;
+            *lpos = e->end;
+            e = e->right;
+        }
+        node = node->right;
     }
+    return 0;
+}
+
+//As nodeHasOverlaps(), but the entries of a flattened chromosome are already in order
+int flatHasOverlaps(flatEntry *entries, uint32_t n, uint32_t *minDistance) {
+    uint32_t i, lpos = entries[0].end;
 
-    // Test this node
-    while(e) {
-        if(e->start < *lpos) {
+    *minDistance = entries[0].start;
+    for(i=1; i<n; i++) {
+        if(entries[i].start < lpos) {
             *minDistance = 0;
             return 1;
         }
-        if(e->start - *lpos < *minDistance) *minDistance = e->start - *lpos;
-        *lpos = e->end;
-        e = e->right;
+        if(entries[i].start - lpos < *minDistance) *minDistance = entries[i].start - lpos;
+        lpos = entries[i].end;
     }
+    return 0;
+}
+
+//As flatHasOverlaps(), for a chromosome with a delta, whose entries must first be sorted
+static int deltaHasOverlaps(GTFchrom *c, uint32_t *minDistance) {
+    GTFentry **entries = getSortedChromEntries(c);
+    uint32_t i, lpos;
+    int rv = 0;
+    assert(entries);
 
-    if(node->right) return nodeHasOverlaps(node->right, 0, lpos, minDistance);
+    lpos = entries[0]->end;
+    *minDistance = entries[0]->start;
+    for(i=1; i<c->n_entries; i++) {
+        if(entries[i]->start < lpos) {
+            *minDistance = 0;
+            rv = 1;
+            break;
+        }
+        if(entries[i]->start - lpos < *minDistance) *minDistance = entries[i]->start - lpos;
+        lpos = entries[i]->end;
+    }
+    free(entries);
     return rv;
 }
 
-int hasOverlapsChrom(GTFchrom *chrom, uint32_t *minDistance) {
+int hasOverlapsChrom(GTFchrom *chrom, int flat, uint32_t *minDistance) {
     uint32_t lpos;
     if(chrom->n_entries < 2) return 0;
+    if(flat) return flatHasOverlaps((flatEntry*) chrom->tree, chrom->n_entries, minDistance);
+    if(chrom->n_delta) return deltaHasOverlaps(chrom, minDistance);
     return nodeHasOverlaps((GTFnode*) chrom->tree, 1, &lpos, minDistance);
 }
 
@@ -583,7 +1076,7 @@ int hasOverlaps(GTFtree *t, uint32_t *minDistance) {
     *minDistance = (uint32_t) -1;
 
     for(i=0; i<t->n_targets; i++) {
-        rv = hasOverlapsChrom(t->chroms[i], minDistance);
+        rv = hasOverlapsChrom(t->chroms[i], t->flat, minDistance);
         if(rv) return rv;
     }
     return rv;
@@ -627,10 +1120,9 @@ void printBalancedGTF(GTFnode *n, const char *chrom) {
 }
 
 void printGTFvineR(GTFentry *e, const char* chrom) {
-    if(e->left == e) return;
-    if(!e->left) return;
-    printf("\t\"%s:%"PRIu32"-%"PRIu32"\" -> \"%s:%"PRIu32"-%"PRIu32"\" [color=red];\n", chrom, e->start, e->end, chrom, e->left->start, e->left->end);
-    printGTFvineR(e->left, chrom);
+    for(; e->left && e->left != e; e = e->left) {
+        printf("\t\"%s:%"PRIu32"-%"PRIu32"\" -> \"%s:%"PRIu32"-%"PRIu32"\" [color=red];\n", chrom, e->start, e->end, chrom, e->left->start, e->left->end);
+    }
 }
 void printGTFvineStartR(GTFentry *e, const char *chrom, const char *str) {
     printf("\t\"%s\" -> \"%s:%"PRIu32"-%"PRIu32"\" [color=red];\n", str, chrom, e->start, e->end);
@@ -638,26 +1130,40 @@ void printGTFvineStartR(GTFentry *e, const char *chrom, const char *str) {
 }
 
 void printGTFvine(GTFentry *e, const char* chrom) {
-    if(!e->right) return;
-    printf("\t\"%s:%"PRIu32"-%"PRIu32"\" -> \"%s:%"PRIu32"-%"PRIu32"\";\n", chrom, e->start, e->end, chrom, e->right->start, e->right->end);
-    printGTFvine(e->right, chrom);
+    for(; e->right; e = e->right) {
+        printf("\t\"%s:%"PRIu32"-%"PRIu32"\" -> \"%s:%"PRIu32"-%"PRIu32"\";\n", chrom, e->start, e->end, chrom, e->right->start, e->right->end);
+    }
 }
 void printGTFvineStart(GTFentry *e, const char *chrom, const char *str) {
     printf("\t\"%s\" -> \"%s:%"PRIu32"-%"PRIu32"\";\n", str, chrom, e->start, e->end);
     if(e->right) printGTFvine(e, chrom);
 }
 
+//Flattened trees are printed as a vine in start order
+void printFlatGTF(flatEntry *entries, uint32_t n, const char *chrom) {
+    uint32_t i;
+    if(!n) return;
+    printf("\t\"%s\" -> \"%s:%"PRIu32"-%"PRIu32"\";\n", chrom, chrom, entries[0].start, entries[0].end);
+    for(i=1; i<n; i++) {
+        printf("\t\"%s:%"PRIu32"-%"PRIu32"\" -> \"%s:%"PRIu32"-%"PRIu32"\";\n", chrom, entries[i-1].start, entries[i-1].end, chrom, entries[i].start, entries[i].end);
+    }
+}
+
 void printGTFtree(GTFtree *t) {
     int32_t i;
     const char *chromName;
 
-    if(t->balanced) printf("digraph balancedTree {\n");
+    if(t->flat) printf("digraph flatTree {\n");
+    else if(t->balanced) printf("digraph balancedTree {\n");
     else printf("digraph unbalancedTree {\n");
 
     for(i=0; i<t->n_targets; i++) {
         chromName = val2strHT(t->htChroms, i);
-        if(t->balanced) {
-            printBalancedGTF((GTFnode*) t->chroms[i]->tree, chromName);
+        if(t->flat) {
+            printFlatGTF((flatEntry*) t->chroms[i]->tree, t->chroms[i]->n_entries, chromName);
+        } else if(t->balanced) {
+            if(t->chroms[i]->tree) printBalancedGTF((GTFnode*) t->chroms[i]->tree, chromName);
+            if(t->chroms[i]->delta) printGTFvineStart(t->chroms[i]->delta, chromName, chromName);
         } else {
             printGTFvineStart((GTFentry*) t->chroms[i]->tree, chromName, chromName);
         }
@@ -1,4 +1,5 @@
 #include <inttypes.h>
+#include <stdio.h>
 #include "kstring.h"
 
 /*****************
@@ -36,7 +37,16 @@ typedef struct {
  @field  frame         0: '0'; 1: '1'; 2: '2'; 3: '.'
  @field  gene_id       Index into the gene_id hash table
  @field  transcript_id Index into the transcript_id hash table
+ @field  exons         Index into the tree's exons of the first exon start
+ @field  nExons        The number of exons (start/end pairs), 0 if there are none
+ @field  nAttributes   The number of attributes
+ @field  attrib        Key/value pairs, as indices into the attribute hash table
  @discussion Positions are 0-based half open ([start, end)), like BED files.
+ The first attribute of an entry added by addGTFentry() is its name, under
+ the transcript_id key, followed by any attributes kept from the file.
+ Entries added by addEnrichmententry() have no exons. With several attribute
+ keys, the exons instead hold a (key index, feature) pair for each key after
+ the first, whose feature is the entry's feature.
 */
 
 typedef struct GTFentry {
@@ -45,13 +55,15 @@ typedef struct GTFentry {
     int32_t feature;
     uint32_t start;
     uint32_t end;
+    uint32_t labelIdx;
     double score;
-    uint8_t strand:4, frame:4;
     int32_t gene_id;
     int32_t transcript_id;
-    uint32_t labelIdx;
     int nAttributes;
-    Attribute **attrib;
+    uint8_t strand:4, frame:4;
+    uint32_t nExons;
+    uint64_t exons;
+    Attribute *attrib;
     struct GTFentry *left, *right;
 } GTFentry;
 
@@ -75,31 +87,146 @@ typedef struct GTFnode {
     struct GTFnode *left, *right;
 } GTFnode;
 
+/*
+  Each subtree of a GTFnode holds at most half of the entries below its parent
+  (see makeIntervalTree()), so a tree of 2^32 entries has at most 33 levels.
+  Trees are built and walked with explicit stacks of this depth.
+*/
+#define MAX_TREE_DEPTH 64
+
+/*! @typedef
+ @abstract The intervals on a single chromosome
+ @field  chrom      Index into the chrom hash table
+ @field  n_entries  The number of intervals, including those in the delta
+ @field  tree       A vine of GTFentries, a GTFnode tree or, for flattened trees, a flatEntry array
+ @field  entries    For trees flattened by finish(), the GTFentry corresponding to each flatEntry (otherwise NULL)
+ @field  delta      Entries added after the tree was balanced, linked by their right pointers
+ @field  n_delta    The number of entries in the delta
+ @field  unsorted   Set if the vine isn't sorted by start (and end), in which case sortChrom() sorts it
+ @discussion Queries scan the delta in addition to searching the tree, so
+  deltas of more than DELTA_MIN entries are compacted into the tree after
+  each file is added (see compactGTFtree()). A delta is also compacted as
+  soon as it holds more than DELTA_MIN entries and more than 1/DELTA_FRACTION
+  of the chromosome's entries, which bounds the cost of adding many entries
+  one at a time.
+*/
+#define DELTA_MIN 1024
+#define DELTA_FRACTION 2
 typedef struct {
     int32_t chrom;
     uint32_t n_entries;
     void **tree;
+    GTFentry **entries;
+    GTFentry *delta;
+    uint32_t n_delta;
+    uint8_t unsorted;
 } GTFchrom;
 
-typedef struct hashTableElement {
+/*! @typedef
+ @abstract A single interval in a flattened tree
+ @field  start    0-based starting position
+ @field  end      1-based end position
+ @field  maxEnd   The largest end position in the implicit subtree rooted at this entry
+ @field  labelIdx The group label index
+ @field  name     Index into the attribute hash table of the name, or -1
+ @field  feature  Index into the feature hash table
+ @field  score    The score field. A value of DBL_MAX indicates a "."
+ @field  strand   0: '+'; 1: '-'; 3: '.'
+ @field  nExons   The number of exons (start/end pairs)
+ @field  exons    Offset into the tree's exons of the first exon start
+ @discussion As in GTFentry, Enrichment entries may hold features rather than
+ exons. A flattened chromosome is an array of these, sorted by start and
+ then end position. It contains no pointers, so it can be written to and
+ memory-mapped from a file as is. The array is also an implicit interval tree,
+ with the same layout as Heng Li's cgranges.
+*/
+typedef struct {
+    uint32_t start;
+    uint32_t end;
+    uint32_t maxEnd;
+    uint32_t labelIdx;
+    int32_t name;
+    int32_t feature;
+    double score;
+    uint8_t strand;
+    uint8_t pad[3];
+    uint32_t nExons;
+    uint64_t exons;
+} flatEntry;
+
+/*! @typedef
+ @abstract Memory from which a tree's entries, attributes and nodes, or a hash table's strings, are allocated
+ @field  chunks       Blocks of ARENA_CHUNK_SIZE bytes
+ @field  n, m         The number of blocks used and allocated
+ @field  used         The number of bytes used in the last block
+ @discussion Nothing allocated from an arena is freed individually, the whole
+  arena is freed with its tree. This avoids a malloc()/free() per entry.
+*/
+#define ARENA_CHUNK_SIZE (1<<20)
+typedef struct {
+    char **chunks;
+    uint32_t n, m;
+    uint64_t used;
+} memArena;
+
+typedef struct {
+    uint32_t hash;
     int32_t val;
-    struct hashTableElement *next;
-} hashTableElement;
+} hashTableSlot;
 
+/*! @typedef
+ @abstract A table of interned strings
+ @field  l, m      The number of strings and the number of slots (a power of 2)
+ @field  slots     The open-addressed slots, each holding a value (-1 if empty) and the hash of its string
+ @field  str       The strings, indexed by value
+ @field  strings   Holds the strings themselves
+ @field  blob      For a table mapped from an index, the NUL-terminated strings (otherwise NULL)
+ @field  offsets   For a table mapped from an index, the offset of each string in blob
+ @field  sorted    For a table mapped from an index, the values sorted by their strings
+ @discussion Collisions are resolved by linear probing and the table is kept at
+  most 3/4 full. Since the hashes are stored, growing the table never rehashes a
+  string. Mapped tables are read-only, their lookups are binary searches.
+*/
 typedef struct {
     uint64_t l, m;
-    hashTableElement **elements;
+    hashTableSlot *slots;
     char **str;
+    memArena strings;
+    char *blob;
+    uint64_t *offsets;
+    int32_t *sorted;
 } hashTable;
 
+/*! @typedef
+ @abstract An interval tree
+ @field  n_targets    The number of chromosomes
+ @field  balanced     0 while entries are still being added, 1 once the tree can be queried
+ @field  flat         1 if the chromosomes hold flatEntry arrays rather than GTFnodes
+ @field  exons        The exon starts/ends referred to by the entries, each entry's sorted
+ @field  nExons       The number of exons (start/end pairs)
+ @field  mExons       The number of exons there's space for in exons, unless it belongs to image
+ @field  image        The index image holding a flattened tree, or NULL
+ @field  imageSize    The size of image
+ @field  imageMapped  1 if image is a memory-mapped file, 0 if it belongs to someone else (e.g., shared memory)
+ @field  arena        Holds the entries, their attributes and the nodes of a tree that isn't flattened
+ @field  version      Incremented whenever entries are added or the tree is rebuilt or flattened, so that sweep cursors can tell
+*/
 typedef struct {
     int32_t n_targets, m;
     int balanced;
+    int flat;
     hashTable *htChroms;
     hashTable *htSources;
     hashTable *htFeatures;
     hashTable *htAttributes;
     GTFchrom **chroms;
+    uint32_t *exons;
+    uint64_t nExons, mExons;
+    void *image;
+    uint64_t imageSize;
+    int imageMapped;
+    memArena arena;
+    uint64_t version;
 } GTFtree;
 
 typedef struct {
@@ -108,11 +235,41 @@ typedef struct {
     GTFtree *tree;
 } overlapSet;
 
+typedef struct {
+    int32_t l, m;
+    flatEntry **overlaps;
+    GTFtree *tree;
+} flatOverlapSet;
+
 typedef struct {
     int32_t l, m;
     overlapSet **os;
 } overlapSetList;
 
+/*! @typedef
+ @abstract A cursor for finding the overlaps of regions sorted by start position
+ @field  t        The tree, which must be balanced
+ @field  version  The tree's version when the cursor reached its chromosome
+ @field  tid      The chromosome the cursor is on, or -1
+ @field  start    The start position of the previous region
+ @field  n        The number of entries on the chromosome when the cursor reached it
+ @field  next     The index (in start order) of the next entry that hasn't been reached
+ @field  l, m     The number of active entries and the space allocated for them
+ @field  active   The indices of the entries that may overlap the next region, in start order
+ @field  entries  For trees that aren't flattened, the chromosome's entries sorted by start and then end position
+*/
+typedef struct {
+    GTFtree *t;
+    uint64_t version;
+    int32_t tid;
+    uint32_t start;
+    uint32_t n;
+    uint32_t next;
+    uint32_t l, m;
+    uint32_t *active;
+    GTFentry **entries;
+} sweepCursor;
+
 typedef struct {
     int32_t l, m;
     int32_t *IDs;
@@ -120,11 +277,151 @@ typedef struct {
     hashTable *ht;
 } uniqueSet;
 
+/*! @typedef
+ @abstract A single staged line from a BED or GTF file, prior to being added to a GTFtree
+ @field  type    One of the STAGED_* macros
+ @field  strand  0: '+'; 1: '-'; 3: '.'
+ @field  chrom   Index into the stagedFile chroms hash table
+ @field  label   Index into the stagedFile labels hash table, or -1
+ @field  start   0-based starting position
+ @field  end     1-based end position
+ @field  score   The score field. A value of DBL_MAX indicates a "."
+ @field  name    Offset into the stagedFile strings of the name (or a group label)
+ @field  exons   Offset into the stagedFile exons of the first exon start
+ @field  nExons  The number of exons (start/end pairs)
+ @field  attributes  Offset into the stagedFile strings of the attributes kept, as alternating keys and values
+ @field  nAttributes The number of attributes (key/value pairs) kept
+ @discussion For Enrichment, with several attribute keys, the label is the
+ feature of the first key and attributes instead holds those of the others.
+*/
+#define STAGED_ENTRY   0
+#define STAGED_EXON    1
+#define STAGED_GROUP   2
+#define STAGED_INVALID 3
+
+typedef struct {
+    uint8_t type;
+    uint8_t strand;
+    int32_t chrom;
+    int32_t label;
+    uint32_t start;
+    uint32_t end;
+    double score;
+    uint64_t name;
+    uint64_t exons;
+    uint32_t nExons;
+    uint32_t nAttributes;
+    uint64_t attributes;
+} stagedEntry;
+
+typedef struct {
+    uint64_t l, m;
+    stagedEntry *entries;
+    kstring_t strings;
+    uint64_t nExons, mExons;
+    uint32_t *exons;
+    hashTable *chroms;
+    hashTable *labels;
+    kstring_t err;
+} stagedFile;
+
+/*****************
+ * Loader macros *
+ *****************/
+#define LOAD_GTF   0
+#define LOAD_BED3  3
+#define LOAD_BED6  6
+#define LOAD_BED12 12
+
+/*! @typedef
+ @abstract The regions to which loading is restricted
+ @field  chroms  The chromosomes with regions, under every name they might have in a file
+ @field  starts  For each chromosome, the sorted start positions of its windows
+ @field  ends    For each chromosome, the end positions of its windows
+ @field  n       For each chromosome, the number of windows, which don't overlap
+ @discussion Whole chromosomes are a single window from 0 to UINT32_MAX.
+*/
+typedef struct {
+    hashTable *chroms;
+    uint32_t **starts;
+    uint32_t **ends;
+    uint32_t *n;
+} regionSet;
+
+/*! @typedef
+ @abstract How a file should be staged
+ @field  ftype        One of the LOAD_* macros
+ @field  enrichment   Whether to use the semantics of the Enrichment class
+ @field  labelColumn  The column holding the deepTools_group label, or -1
+ @field  keepExons    Whether exons/blocks should be kept
+ @field  exonID       The GTF feature used for exons
+ @field  transcriptID The GTF feature used for transcripts
+ @field  designator   The GTF attribute key holding the transcript ID
+ @field  attributeKey For Enrichment, the attribute key used as the feature (or NULL)
+ @field  regions      If not NULL, lines outside of these regions are skipped
+ @field  attributes   The GTF attribute keys to keep for each transcript. For
+                      Enrichment, the keys whose features are staged, with
+                      NULL for the feature column, in place of attributeKey
+ @field  nAttributes  The number of keys in attributes, or -1 to keep every attribute
+*/
+typedef struct {
+    int ftype;
+    int enrichment;
+    int labelColumn;
+    int keepExons;
+    char *exonID;
+    char *transcriptID;
+    char *designator;
+    char *attributeKey;
+    regionSet *regions;
+    char **attributes;
+    int nAttributes;
+} loadOpts;
+
+/*! @typedef
+ @abstract A file being staged one chromosome at a time (see stageChunk())
+ @field  fp, ks    The file (a gzFile) and the kstream it's read through
+ @field  opts      How the file is staged, with copies of the strings
+ @field  line      The last line read
+ @field  pending   1 if line starts the next chunk and hasn't been staged yet
+ @field  chrom     The chromosome of the last chunk
+ @field  inHeader  1 until the first line after the header
+ @field  first     1 until the first line is staged
+ @field  eof       1 once the end of the file has been reached
+*/
+typedef struct {
+    void *fp;
+    void *ks;
+    loadOpts opts;
+    kstring_t line;
+    int pending;
+    kstring_t chrom;
+    int inHeader, first, eof;
+    char **cols;
+    int mCols;
+} chunkReader;
+
 //A function that can be applied to all entries in a GTF/BED/etc. file as it's
 //being processed. The pointer as input is currently a GTFline *. The return
 //value is 0 (ignore entry) or 1 (keep entry).
 typedef int (*FILTER_FUNC)(void*);
-typedef int (*FILTER_ENTRY_FUNC)(GTFtree *, GTFentry *);
+//The last argument is whatever was given to the search function along with it.
+typedef int (*FILTER_ENTRY_FUNC)(GTFtree *, GTFentry *, void *);
+
+/*! @typedef
+ @abstract The attribute values that entries must have (see requireAttributes())
+ @field  n        The number of keys
+ @field  keys     Index into the attribute hash table of each key, or -1 if no entry has it
+ @field  offsets  The values allowed for keys[i] are vals[offsets[i]] through vals[offsets[i+1]-1]
+ @field  vals     Index into the attribute hash table of each value, or -1 if no entry has it
+ @discussion An entry must have one of the allowed values for every key.
+*/
+typedef struct {
+    int n;
+    int32_t *keys;
+    int *offsets;
+    int32_t *vals;
+} attributeFilter;
 
 //A function used to compare to GTFentry items to see if the intersect in some
 //way (e.g., due to sharing a gene_id). This is used to intersect overlapsets.
@@ -134,25 +431,81 @@ typedef int (*COMPARE_FUNC)(GTFentry *, GTFentry *);
 GTFtree * initGTFtree(void);
 void destroyGTFtree(GTFtree *t);
 void sortGTF(GTFtree *o);
+int compactChrom(GTFtree *t, GTFchrom *c);
+int compactGTFtree(GTFtree *t, uint32_t minDelta);
+int vineChrom(GTFchrom *c);
+GTFentry *sortChrom(GTFchrom *c);
+GTFnode *makeIntervalNode(memArena *a, GTFentry *starts, GTFentry *ends, GTFentry **lStarts, GTFentry **lEnds, GTFentry **rStarts, GTFentry **rEnds);
+GTFnode *makeIntervalTree(memArena *a, GTFentry *starts, GTFentry *ends);
+int flattenGTFtree(GTFtree *t);
 void printGTFtree(GTFtree *t);
 void printGTFvineStart(GTFentry *e, const char *chrom, const char *str);
 void printGTFvineStartR(GTFentry *e, const char *chrom, const char *str);
-int addGTFentry(GTFtree *t, char *chrom, uint32_t start, uint32_t end, uint8_t strand, char *transcriptID, uint32_t labelIDX, double score);
-int addEnrichmententry(GTFtree *t, char *chrom, uint32_t start, uint32_t end, uint8_t strand, double score, char *feature);
+int addGTFentry(GTFtree *t, char *chrom, uint32_t start, uint32_t end, uint8_t strand, char *transcriptID, uint32_t labelIDX, double score, char *attributes, uint32_t nAttributes);
+int addEnrichmententry(GTFtree *t, char *chrom, uint32_t start, uint32_t end, uint8_t strand, double score, char *feature, char **features, uint32_t nFeatures);
+int addExons(GTFtree *t, GTFentry *e, uint32_t *bounds, uint32_t n);
+int cmpExons(const void *a, const void *b);
 int hasOverlaps(GTFtree *t, uint32_t *minOverlap);
 
+void flattenEntries(GTFentry **entries, uint32_t n, flatEntry *out, int32_t nameKey);
+void indexFlatChrom(flatEntry *entries, uint32_t n);
+GTFentry **getChromEntries(GTFchrom *c);
+GTFentry **getSortedChromEntries(GTFchrom *c);
+void *arenaAlloc(memArena *a, size_t size);
+char *arenaStrdup(memArena *a, char *s);
+int mergeArena(memArena *dst, memArena *src);
+void destroyArena(memArena *a);
+
+//balance.c
+int balanceGTFtree(GTFtree *t, uint32_t minDelta, int nThreads);
+
 //hashTable.c
 hashTable *initHT(uint64_t size);
-void destroyHTelement(hashTableElement *e);
+hashTable *mapHT(uint64_t n, char *blob, uint64_t *offsets, int32_t *sorted);
 void destroyHT(hashTable *ht);
-int32_t addHTelement(hashTable *ht, char *s);
-uint64_t hashString(char *s);
+int32_t getOrAddHT(hashTable *ht, char *s, int *added); //-1 on error
+uint32_t hashString(char *s, size_t len);
 int strExistsHT(hashTable *ht, char *s);
 int32_t str2valHT(hashTable *ht, char *s);
 char *val2strHT(hashTable *ht, int32_t val);
 int hasAttribute(GTFtree *t, GTFentry *e, char *str);
 char *getAttribute(GTFtree *t, GTFentry *e, char *str); //NULL if the attribute isn't there
 
+//load.c
+int parseAttributes(char *s, char **keys, int nKeys, kstring_t *vals, int *found);
+int splitAttributes(char *s, char **keys, int nKeys, kstring_t *out);
+char **copyAttributeKeys(char **keys, int nKeys);
+void destroyAttributeKeys(char **keys, int nKeys);
+stagedFile *stageFile(char *fname, loadOpts *opts);
+void destroyStagedFile(stagedFile *sf);
+chunkReader *openChunkReader(char *fname, loadOpts *opts);
+stagedFile *stageChunk(chunkReader *r);
+void closeChunkReader(chunkReader *r);
+
+//regions.c
+typedef struct bgzfReader bgzfReader;
+typedef struct tabixIndex tabixIndex;
+regionSet *initRegionSet(void);
+void destroyRegionSet(regionSet *rs);
+int addRegionWindows(regionSet *rs, char *chrom, uint32_t n, uint32_t *starts, uint32_t *ends);
+regionSet *copyRegionSet(regionSet *rs);
+int chromInRegionSet(regionSet *rs, char *chrom);
+int inRegionSet(regionSet *rs, char *chrom, int64_t start, int64_t end);
+bgzfReader *bgzfOpen(char *fname);
+void bgzfClose(bgzfReader *b);
+int bgzfSeek(bgzfReader *b, uint64_t voffset);
+int bgzfGetLine(bgzfReader *b, kstring_t *line, uint64_t *voffset);
+tabixIndex *openTabixIndex(char *fname);
+void destroyTabixIndex(tabixIndex *idx);
+int tabixChunks(tabixIndex *idx, regionSet *rs, uint64_t **chunks, uint64_t *nChunks);
+
+//index.c
+int writeIndex(GTFtree *t, FILE *fp, char *meta, uint64_t metaLen, int (*getExons)(void *, flatEntry *, uint32_t **, uint32_t *), void *exonData);
+int saveIndex(GTFtree *t, char *fname, char *meta, uint64_t metaLen, int (*getExons)(void *, flatEntry *, uint32_t **, uint32_t *), void *exonData);
+int dumpIndex(GTFtree *t, char **image, uint64_t *size, char *meta, uint64_t metaLen, int (*getExons)(void *, flatEntry *, uint32_t **, uint32_t *), void *exonData);
+GTFtree *imageIndex(char *image, uint64_t size, char **meta, uint64_t *metaLen, char **err);
+GTFtree *mapIndex(char *fname, char **meta, uint64_t *metaLen, char **err);
+
 //findOverlaps.c
 //overlapSet functions
 overlapSet *os_init(GTFtree *t);
@@ -161,6 +514,7 @@ void os_destroy(overlapSet *os);
 overlapSet *os_grow(overlapSet *os);
 void os_exclude(overlapSet *os, int i);
 void os_requireAttributes(overlapSet *os, char **keys, char **vals, int len);
+int requireAttributes(GTFtree *t, GTFentry *e, void *data);
 void os_requireSource(overlapSet *os, char *val);
 void os_requireFeature(overlapSet *os, char *val);
 overlapSet *os_intersect(overlapSet *os1, overlapSet *os2, COMPARE_FUNC f);
@@ -176,5 +530,25 @@ overlapSet *osl_union(overlapSetList *osl);
 void us_destroy(uniqueSet *us);
 uint32_t us_cnt(uniqueSet *us, int32_t i);
 char *us_val(uniqueSet *us, int32_t i);
-//Driver functions
-overlapSet * findOverlaps(overlapSet *os, GTFtree *t, char *chrom, uint32_t start, uint32_t end, int strand, int matchType, int strandType, int keepOS, FILTER_ENTRY_FUNC ffunc);
+int32_t cntAttributes(overlapSet *os, char *attributeName);
+uniqueSet *uniqueAttributes(overlapSet *os, char *attributeName);
+/*
+    Driver functions. Searching a balanced (or flattened) tree only reads from
+    it, so any number of threads can query the same tree concurrently, as long
+    as each uses its own overlapSet and nothing modifies the tree meanwhile.
+*/
+overlapSet * findOverlaps(overlapSet *os, GTFtree *t, char *chrom, uint32_t start, uint32_t end, int strand, int matchType, int strandType, int keepOS, FILTER_ENTRY_FUNC ffunc, void *fdata);
+overlapSet * findOverlapsChrom(overlapSet *os, GTFtree *t, int32_t tid, uint32_t start, uint32_t end, int strand, int matchType, int strandType, int keepOS, FILTER_ENTRY_FUNC ffunc, void *fdata);
+int32_t countOverlaps(GTFtree *t, char *chrom, uint32_t start, uint32_t end, int strand, int matchType, int strandType, FILTER_ENTRY_FUNC ffunc, void *fdata);
+int32_t countOverlapsChrom(GTFtree *t, int32_t tid, uint32_t start, uint32_t end, int strand, int matchType, int strandType, FILTER_ENTRY_FUNC ffunc, void *fdata);
+int overlapsAny(GTFtree *t, char *chrom, uint32_t start, uint32_t end, int strand, int matchType, int strandType, FILTER_ENTRY_FUNC ffunc, void *fdata);
+int overlapsAnyChrom(GTFtree *t, int32_t tid, uint32_t start, uint32_t end, int strand, int matchType, int strandType, FILTER_ENTRY_FUNC ffunc, void *fdata);
+//flatOverlapSet functions
+flatOverlapSet *fos_init(GTFtree *t);
+void fos_destroy(flatOverlapSet *os);
+flatOverlapSet *findOverlapsFlat(flatOverlapSet *os, GTFtree *t, char *chrom, uint32_t start, uint32_t end, int strand, int matchType, int strandType);
+flatOverlapSet *findOverlapsFlatChrom(flatOverlapSet *os, GTFtree *t, int32_t tid, uint32_t start, uint32_t end, int strand, int matchType, int strandType);
+//sweepCursor functions
+sweepCursor *sc_init(GTFtree *t);
+void sc_destroy(sweepCursor *sc);
+int32_t sweepOverlaps(sweepCursor *sc, int32_t tid, uint32_t start, uint32_t end, int strand, int matchType, int strandType, flatOverlapSet *fos, overlapSet *os);
@@ -5,24 +5,21 @@
 #include "murmur3.h"
 #include "gtf.h"
 
-uint64_t hashString(char *s) {
-    int len = strlen(s);
-    uint64_t hash_val[2];
-    uint32_t seed = 0xAAAAAAAA;
-#if UINTPTR_MAX == 0xffffffff
-    MurmurHash3_x86_128((void *) s, len, seed, (void *) &hash_val);
-#else
-    MurmurHash3_x64_128((void *) s, len, seed, (void *) &hash_val);
-#endif
-    return hash_val[0];
+uint32_t hashString(char *s, size_t len) {
+    uint32_t hash_val;
+    MurmurHash3_x86_32((void *) s, (int) len, 0xAAAAAAAA, (void *) &hash_val);
+    return hash_val;
 }
 
 hashTable *initHT(uint64_t size) {
     hashTable *ht = calloc(1, sizeof(hashTable));
     assert(ht);
 
-    ht->elements = calloc(size, sizeof(hashTableElement*));
-    assert(ht->elements);
+    if(size < 8) size = 8;
+    kroundup32(size);
+    ht->slots = malloc(size * sizeof(hashTableSlot));
+    assert(ht->slots);
+    memset(ht->slots, 0xff, size * sizeof(hashTableSlot));
     ht->str = calloc(size, sizeof(char*));
     assert(ht->str);
 
@@ -30,113 +27,130 @@ hashTable *initHT(uint64_t size) {
     return ht;
 }
 
-void insertHTelement(hashTable *ht, hashTableElement *e, uint64_t hash) {
-    uint64_t i = hash%ht->m;
-    hashTableElement *curr = ht->elements[i];
-    if(!curr) ht->elements[i] = e;
-    else {
-        while(curr->next) curr = curr->next;
-        curr->next = e;
-    }
+//A read-only table of n strings, as written by saveIndex(). Returns NULL on error
+hashTable *mapHT(uint64_t n, char *blob, uint64_t *offsets, int32_t *sorted) {
+    hashTable *ht = calloc(1, sizeof(hashTable));
+    if(!ht) return NULL;
+
+    ht->l = n;
+    ht->m = n;
+    ht->blob = blob;
+    ht->offsets = offsets;
+    ht->sorted = sorted;
+    return ht;
 }
 
-static void rehashElement(hashTable *ht, hashTableElement *e) {
-    hashTableElement *next = e->next;
-    if(!e) return;
-    uint64_t hash = hashString(ht->str[e->val]);
-    e->next = NULL;
-    insertHTelement(ht, e, hash);
-    if(next) rehashElement(ht, next);
+//Returns -1 if not present
+static int32_t searchMappedHT(hashTable *ht, char *s) {
+    uint64_t lo = 0, hi = ht->l, mid;
+    int rv;
+
+    while(lo < hi) {
+        mid = lo + (hi - lo)/2;
+        rv = strcmp(ht->blob + ht->offsets[ht->sorted[mid]], s);
+        if(rv == 0) return ht->sorted[mid];
+        if(rv < 0) lo = mid + 1;
+        else hi = mid;
+    }
+    return -1;
 }
 
-static void rehashHT(hashTable *ht) {
-    int32_t i;
-    hashTableElement *e;
-    for(i=0; i<ht->l; i++) {
-        if(ht->elements[i]) {
-            e = ht->elements[i];
-            ht->elements[i] = NULL;
-            rehashElement(ht, e);
-        }
+//The slot holding s, or the empty slot where it would go
+static hashTableSlot *findSlot(hashTable *ht, char *s, uint32_t hash) {
+    uint64_t mask = ht->m - 1, i = hash & mask;
+    hashTableSlot *slot;
+
+    while(1) {
+        slot = ht->slots + i;
+        if(slot->val < 0) return slot;
+        if(slot->hash == hash && strcmp(ht->str[slot->val], s) == 0) return slot;
+        i = (i + 1) & mask;
     }
 }
 
-static void growHT(hashTable *ht) {
-    int i;
-    ht->m = ht->l+1;
-    kroundup32(ht->m);
-    ht->str = realloc(ht->str, ht->m*sizeof(char*));
-    assert(ht->str);
-    ht->elements = realloc(ht->elements, ht->m*sizeof(hashTableElement*));
+//Double the number of slots, returns 1 on error
+static int growHT(hashTable *ht) {
+    uint64_t i, j, m = ht->m * 2;
+    hashTableSlot *slots = malloc(m * sizeof(hashTableSlot));
+    char **str = realloc(ht->str, m * sizeof(char*));
+
+    if(str) ht->str = str;
+    if(!slots || !str) {
+        if(slots) free(slots);
+        return 1;
+    }
+    memset(slots, 0xff, m * sizeof(hashTableSlot));
 
-    for(i=ht->l; i<ht->m; i++) {
-        ht->str[i] = NULL;
-        ht->elements[i] = NULL;
+    //The hashes are stored, so the strings needn't be looked at
+    for(i=0; i<ht->m; i++) {
+        if(ht->slots[i].val < 0) continue;
+        j = ht->slots[i].hash & (m - 1);
+        while(slots[j].val >= 0) j = (j + 1) & (m - 1);
+        slots[j] = ht->slots[i];
     }
-    rehashHT(ht);
+    free(ht->slots);
+    ht->slots = slots;
+    ht->m = m;
+    return 0;
 }
 
-//don't do this if the element's already in the table!
-int32_t addHTelement(hashTable *ht, char *s) {
+/*
+    Returns the value of s, adding it to the table if it isn't already there.
+    If added isn't NULL, it's set to 1 if s was added and 0 otherwise.
+
+    Returns -1 on error, which includes adding to a mapped table.
+*/
+int32_t getOrAddHT(hashTable *ht, char *s, int *added) {
+    hashTableSlot *slot;
+    uint32_t hash;
+
+    if(added) *added = 0;
     if(!s) return -1;
-    uint64_t hash = hashString(s);
-    int32_t val = ht->l++;
-    if(ht->l >= ht->m) growHT(ht);
-    ht->str[val] = strdup(s);
-
-    hashTableElement *e = calloc(1, sizeof(hashTableElement));
-    assert(e);
-    e->val = val;
-    insertHTelement(ht, e, hash);
-    return val;
-}
+    if(ht->blob) return searchMappedHT(ht, s);
 
-void destroyHTelement(hashTableElement *e) {
-    hashTableElement *next = e->next;
-    free(e);
-    if(next) destroyHTelement(next);
+    hash = hashString(s, strlen(s));
+    slot = findSlot(ht, s, hash);
+    if(slot->val >= 0) return slot->val;
+
+    //Keep the table at most 3/4 full
+    if(ht->l + 1 > ht->m - ht->m/4) {
+        if(ht->l >= INT32_MAX || growHT(ht)) return -1;
+        slot = findSlot(ht, s, hash);
+    }
+    ht->str[ht->l] = arenaStrdup(&(ht->strings), s);
+    if(!ht->str[ht->l]) return -1;
+    slot->hash = hash;
+    slot->val = ht->l++;
+    if(added) *added = 1;
+    return slot->val;
 }
 
 void destroyHT(hashTable *ht) {
-    int i;
-
-    for(i=0; i<ht->l; i++) free(ht->str[i]);
-
-    for(i=0; i<ht->m; i++) {
-        if(ht->elements[i]) destroyHTelement(ht->elements[i]);
+    //The strings of a mapped table belong to the image
+    if(!ht->blob) {
+        destroyArena(&(ht->strings));
+        free(ht->slots);
+        free(ht->str);
     }
-    free(ht->elements);
-    free(ht->str);
     free(ht);
 }
 
 int strExistsHT(hashTable *ht, char *s) {
-    if(!s) return 0;
-    uint64_t h = hashString(s);
-    hashTableElement *curr = ht->elements[h%ht->m];
-    while(curr) {
-        if(strcmp(ht->str[curr->val], s) == 0) return 1;
-        curr = curr->next;
-    }
-    return 0;
+    return str2valHT(ht, s) >= 0;
 }
 
 //Returns -1 if not present
 int32_t str2valHT(hashTable *ht, char *s) {
     if(!s) return -1;
-    uint64_t h = hashString(s);
-    hashTableElement *curr = ht->elements[h%ht->m];
-    while(curr) {
-        if(strcmp(ht->str[curr->val], s) == 0) return curr->val;
-        curr = curr->next;
-    }
-    return -1;
+    if(ht->blob) return searchMappedHT(ht, s);
+    return findSlot(ht, s, hashString(s, strlen(s)))->val;
 }
 
 //Returns NULL on error
 char *val2strHT(hashTable *ht, int32_t val) {
     if(val<0) return NULL;
     if(val>=ht->l) return NULL;
+    if(ht->blob) return ht->blob + ht->offsets[val];
     return ht->str[val];
 }
 
@@ -144,7 +158,7 @@ int hasAttribute(GTFtree *t, GTFentry *e, char *str) {
     int32_t i, key = str2valHT(t->htAttributes, str);
 
     for(i=0; i<e->nAttributes; i++) {
-        if(e->attrib[i]->key == key) return 1;
+        if(e->attrib[i].key == key) return 1;
     }
     return 0;
 }
@@ -154,7 +168,7 @@ char *getAttribute(GTFtree *t, GTFentry *e, char *str) {
     int32_t i, key = str2valHT(t->htAttributes, str);
 
     for(i=0; i<e->nAttributes; i++) {
-        if(e->attrib[i]->key == key) return val2strHT(t->htAttributes, e->attrib[i]->val);
+        if(e->attrib[i].key == key) return val2strHT(t->htAttributes, e->attrib[i].val);
     }
     return NULL;
 }
@@ -0,0 +1,437 @@
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <fcntl.h>
+#include <unistd.h>
+#include <sys/mman.h>
+#include <sys/stat.h>
+#include "gtf.h"
+
+/*******************************************************************************
+*
+* On-disk index of a flattened tree
+*
+* The file is laid out as follows, with every section starting on an 8 byte
+* boundary and all values in native byte order:
+*
+*   indexHeader
+*   metadata (metaLen bytes, opaque to the C code)
+*   4 string tables (chromosomes, sources, features, attributes), each holding:
+*     uint64_t n, blobLen
+*     uint64_t offsets[n]
+*     int32_t sorted[n]
+*     char blob[blobLen]
+*   indexChrom[nChroms]
+*   flatEntry[nEntries]
+*   uint32_t exons[2*nExons]
+*
+* Nothing in the file is a pointer, so a tree can be memory-mapped and queried
+* in place. Mapping is therefore O(number of chromosomes).
+*
+*******************************************************************************/
+#define INDEX_MAGIC "DTIVIDX"
+#define INDEX_VERSION 1
+#define INDEX_BYTE_ORDER 0x01020304
+
+typedef struct {
+    char magic[8];
+    uint32_t version;
+    uint32_t byteOrder;
+    uint32_t entrySize;
+    uint32_t nChroms;
+    uint64_t nEntries;
+    uint64_t nExons;
+    uint64_t metaOffset;
+    uint64_t metaLen;
+    uint64_t stringsOffset;
+    uint64_t chromsOffset;
+    uint64_t entriesOffset;
+    uint64_t exonsOffset;
+    uint64_t fileSize;
+} indexHeader;
+
+typedef struct {
+    uint64_t offset;
+    uint32_t n_entries;
+    uint32_t pad;
+} indexChrom;
+
+typedef struct {
+    char *s;
+    int32_t val;
+} sortableString;
+
+static uint64_t pad8(uint64_t l) {
+    return (l + 7) & ~((uint64_t) 7);
+}
+
+//Pad the len bytes just written to an 8 byte boundary. Returns 1 on error
+static int writePadding(FILE *fp, uint64_t len, uint64_t *pos) {
+    char zeros[8] = {0};
+    uint64_t padding = pad8(len) - len;
+
+    if(padding && fwrite(zeros, 1, padding, fp) != padding) return 1;
+    *pos += len + padding;
+    return 0;
+}
+
+//Write len bytes followed by enough padding to reach an 8 byte boundary. Returns 1 on error
+static int writePadded(FILE *fp, void *data, uint64_t len, uint64_t *pos) {
+    if(len && fwrite(data, 1, len, fp) != len) return 1;
+    return writePadding(fp, len, pos);
+}
+
+static int cmpSortableStrings(const void *a, const void *b) {
+    return strcmp(((sortableString*) a)->s, ((sortableString*) b)->s);
+}
+
+//Returns 1 on error
+static int writeHT(FILE *fp, hashTable *ht, uint64_t *pos) {
+    uint64_t i, sizes[2] = {ht->l, 0};
+    uint64_t *offsets = malloc((ht->l + 1) * sizeof(uint64_t));
+    int32_t *sorted = malloc((ht->l + 1) * sizeof(int32_t));
+    sortableString *strs = malloc((ht->l + 1) * sizeof(sortableString));
+    int rv = 1;
+
+    if(!offsets || !sorted || !strs) goto out;
+    for(i=0; i<ht->l; i++) {
+        strs[i].s = val2strHT(ht, (int32_t) i);
+        strs[i].val = (int32_t) i;
+        offsets[i] = sizes[1];
+        sizes[1] += strlen(strs[i].s) + 1;
+    }
+    qsort(strs, ht->l, sizeof(sortableString), cmpSortableStrings);
+    for(i=0; i<ht->l; i++) sorted[i] = strs[i].val;
+
+    if(writePadded(fp, sizes, 2*sizeof(uint64_t), pos)) goto out;
+    if(writePadded(fp, offsets, ht->l * sizeof(uint64_t), pos)) goto out;
+    if(writePadded(fp, sorted, ht->l * sizeof(int32_t), pos)) goto out;
+    //The strings themselves are in value order
+    for(i=0; i<ht->l; i++) {
+        if(fputs(val2strHT(ht, (int32_t) i), fp) == EOF || fputc('\0', fp) == EOF) goto out;
+    }
+    if(writePadding(fp, sizes[1], pos)) goto out;
+    rv = 0;
+
+out:
+    if(offsets) free(offsets);
+    if(sorted) free(sorted);
+    if(strs) free(strs);
+    return rv;
+}
+
+//Append the (sorted) exons of an entry to exons, updating the entry. Returns 1 on error
+static int pushExons(flatEntry *e, uint32_t *bounds, uint32_t n, uint32_t **exons, uint64_t *nExons, uint64_t *mExons) {
+    uint32_t *tmp;
+
+    e->exons = *nExons;
+    e->nExons = n;
+    if(!n) return 0;
+    if(*nExons + n > *mExons) {
+        *mExons = 2*(*nExons + n);
+        tmp = realloc(*exons, 2 * (*mExons) * sizeof(uint32_t));
+        if(!tmp) return 1;
+        *exons = tmp;
+    }
+    memcpy(*exons + 2*(*nExons), bounds, 2*n*sizeof(uint32_t));
+    qsort(*exons + 2*(*nExons), n, 2*sizeof(uint32_t), cmpExons);
+    *nExons += n;
+    return 0;
+}
+
+/*
+    Write a finished tree to fp, which must be at its start. meta is an opaque
+    blob stored alongside it.
+
+    Exons are taken from the tree, if it holds any (see addExons()). Otherwise,
+    if getExons isn't NULL, it's called for each entry to fill in the entry's
+    exon bounds (as start/end pairs, which needn't be sorted) and their number.
+    It returns 1 on error.
+
+    Returns 1 on error. fp is left at the end of what was written.
+*/
+int writeIndex(GTFtree *t, FILE *fp, char *meta, uint64_t metaLen, int (*getExons)(void *, flatEntry *, uint32_t **, uint32_t *), void *exonData) {
+    indexHeader hdr;
+    indexChrom *chroms = NULL;
+    flatEntry *entries = NULL;
+    GTFentry **chromEntries = NULL;
+    uint32_t *exons = NULL, *bounds, nBounds, maxEntries = 0;
+    uint64_t pos = 0, nExons = 0, mExons = 0;
+    int32_t i, nameKey;
+    uint32_t j;
+    int rv = 1;
+
+    if(!t->balanced) return 1;
+    memset(&hdr, 0, sizeof(indexHeader));
+    strcpy(hdr.magic, INDEX_MAGIC);
+    hdr.version = INDEX_VERSION;
+    hdr.byteOrder = INDEX_BYTE_ORDER;
+    hdr.entrySize = sizeof(flatEntry);
+    hdr.nChroms = t->n_targets;
+
+    //Leave space for the header, which is written last
+    if(writePadded(fp, &hdr, sizeof(indexHeader), &pos)) goto out;
+    hdr.metaOffset = pos;
+    hdr.metaLen = metaLen;
+    if(writePadded(fp, meta, metaLen, &pos)) goto out;
+    hdr.stringsOffset = pos;
+    if(writeHT(fp, t->htChroms, &pos)) goto out;
+    if(writeHT(fp, t->htSources, &pos)) goto out;
+    if(writeHT(fp, t->htFeatures, &pos)) goto out;
+    if(writeHT(fp, t->htAttributes, &pos)) goto out;
+
+    hdr.chromsOffset = pos;
+    chroms = calloc(t->n_targets + 1, sizeof(indexChrom));
+    if(!chroms) goto out;
+    for(i=0; i<t->n_targets; i++) {
+        chroms[i].offset = hdr.nEntries;
+        chroms[i].n_entries = t->chroms[i]->n_entries;
+        hdr.nEntries += t->chroms[i]->n_entries;
+        if(t->chroms[i]->n_entries > maxEntries) maxEntries = t->chroms[i]->n_entries;
+    }
+    if(writePadded(fp, chroms, t->n_targets * sizeof(indexChrom), &pos)) goto out;
+
+    hdr.entriesOffset = pos;
+    if(t->flat && t->exons) {
+        for(i=0; i<t->n_targets; i++) {
+            if(writePadded(fp, t->chroms[i]->tree, t->chroms[i]->n_entries * sizeof(flatEntry), &pos)) goto out;
+        }
+        hdr.nExons = t->nExons;
+        hdr.exonsOffset = pos;
+        if(writePadded(fp, t->exons, 2 * t->nExons * sizeof(uint32_t), &pos)) goto out;
+    } else {
+        nameKey = str2valHT(t->htAttributes, "transcript_id");
+        entries = malloc((maxEntries + 1) * sizeof(flatEntry));
+        if(!entries) goto out;
+        for(i=0; i<t->n_targets; i++) {
+            if(t->flat) {
+                //Flattened by finish() without any exons stored in the tree
+                memcpy(entries, t->chroms[i]->tree, t->chroms[i]->n_entries * sizeof(flatEntry));
+            } else {
+                chromEntries = getChromEntries(t->chroms[i]);
+                if(!chromEntries) goto out;
+                flattenEntries(chromEntries, t->chroms[i]->n_entries, entries, nameKey);
+                free(chromEntries);
+                chromEntries = NULL;
+            }
+            //Exons already stored in the tree are referred to by the entries
+            for(j=0; !t->exons && j<t->chroms[i]->n_entries; j++) {
+                bounds = NULL;
+                nBounds = 0;
+                if(getExons && getExons(exonData, entries + j, &bounds, &nBounds)) goto out;
+                if(pushExons(entries + j, bounds, nBounds, &exons, &nExons, &mExons)) goto out;
+            }
+            if(writePadded(fp, entries, t->chroms[i]->n_entries * sizeof(flatEntry), &pos)) goto out;
+        }
+        hdr.exonsOffset = pos;
+        if(t->exons) {
+            hdr.nExons = t->nExons;
+            if(writePadded(fp, t->exons, 2 * t->nExons * sizeof(uint32_t), &pos)) goto out;
+        } else {
+            hdr.nExons = nExons;
+            if(writePadded(fp, exons, 2 * nExons * sizeof(uint32_t), &pos)) goto out;
+        }
+    }
+    hdr.fileSize = pos;
+
+    if(fseek(fp, 0, SEEK_SET)) goto out;
+    if(fwrite(&hdr, sizeof(indexHeader), 1, fp) != 1) goto out;
+    if(fseek(fp, (long) pos, SEEK_SET)) goto out;
+    rv = 0;
+
+out:
+    if(chroms) free(chroms);
+    if(entries) free(entries);
+    if(chromEntries) free(chromEntries);
+    if(exons) free(exons);
+    return rv;
+}
+
+//writeIndex() to the file fname. Returns 1 on error
+int saveIndex(GTFtree *t, char *fname, char *meta, uint64_t metaLen, int (*getExons)(void *, flatEntry *, uint32_t **, uint32_t *), void *exonData) {
+    FILE *fp = fopen(fname, "wb");
+    int rv;
+
+    if(!fp) return 1;
+    rv = writeIndex(t, fp, meta, metaLen, getExons, exonData);
+    if(fclose(fp)) rv = 1;
+    return rv;
+}
+
+/*
+    writeIndex() to memory. On success, image is set to a buffer of size bytes
+    that the caller must free(). Returns 1 on error.
+*/
+int dumpIndex(GTFtree *t, char **image, uint64_t *size, char *meta, uint64_t metaLen, int (*getExons)(void *, flatEntry *, uint32_t **, uint32_t *), void *exonData) {
+    size_t len = 0;
+    char *buf = NULL;
+    FILE *fp = open_memstream(&buf, &len);
+    int rv;
+
+    if(!fp) return 1;
+    rv = writeIndex(t, fp, meta, metaLen, getExons, exonData);
+    if(fclose(fp)) rv = 1;
+    if(rv) {
+        free(buf);
+        return 1;
+    }
+    *image = buf;
+    *size = (uint64_t) len;
+    return 0;
+}
+
+//Returns a mapped table and advances *pos past it, or NULL if it doesn't fit in size bytes
+static hashTable *mapTable(char *image, uint64_t size, uint64_t *pos) {
+    uint64_t n, blobLen, offsetsPos, sortedPos, blobPos;
+
+    if(*pos + 2*sizeof(uint64_t) > size) return NULL;
+    n = ((uint64_t*) (image + *pos))[0];
+    blobLen = ((uint64_t*) (image + *pos))[1];
+    offsetsPos = *pos + 2*sizeof(uint64_t);
+    sortedPos = offsetsPos + pad8(n * sizeof(uint64_t));
+    blobPos = sortedPos + pad8(n * sizeof(int32_t));
+    if(n > size || blobLen > size || blobPos + blobLen > size) return NULL;
+    if(blobLen && image[blobPos + blobLen - 1] != '\0') return NULL;
+    *pos = blobPos + pad8(blobLen);
+
+    return mapHT(n, image + blobPos, (uint64_t*) (image + offsetsPos), (int32_t*) (image + sortedPos));
+}
+
+/*
+    Create a flattened tree from an index image (i.e., the contents of an index
+    file) of size bytes, which must be 8 byte aligned. The tree refers to the
+    image rather than copying it, so the image must outlive the tree and is not
+    freed with it. Returns NULL on error, with err set to a description. meta
+    and metaLen are set to the metadata blob within the image.
+
+    The header and section bounds are checked, the contents are trusted.
+*/
+GTFtree *imageIndex(char *image, uint64_t size, char **meta, uint64_t *metaLen, char **err) {
+    indexHeader *hdr;
+    indexChrom *chroms;
+    uint64_t pos, nEntries = 0;
+    int32_t i;
+    GTFtree *t = NULL;
+
+    *err = "it is too small";
+    if(size < sizeof(indexHeader)) return NULL;
+    *err = "it is not 8 byte aligned";
+    if(((uintptr_t) image) & 7) return NULL;
+
+    hdr = (indexHeader*) image;
+    *err = "it is not an index file";
+    if(memcmp(hdr->magic, INDEX_MAGIC, sizeof(INDEX_MAGIC))) goto error;
+    *err = "it was written by an incompatible version or on an incompatible system";
+    if(hdr->version != INDEX_VERSION) goto error;
+    if(hdr->byteOrder != INDEX_BYTE_ORDER) goto error;
+    if(hdr->entrySize != sizeof(flatEntry)) goto error;
+    *err = "it is truncated or corrupt";
+    //Shared memory segments may be rounded up to a page
+    if(hdr->fileSize > size) goto error;
+    size = hdr->fileSize;
+    if(hdr->metaOffset + hdr->metaLen > size) goto error;
+    if(hdr->chromsOffset + hdr->nChroms * sizeof(indexChrom) > size) goto error;
+    if(hdr->entriesOffset + hdr->nEntries * sizeof(flatEntry) > size) goto error;
+    if(hdr->exonsOffset + 2 * hdr->nExons * sizeof(uint32_t) > size) goto error;
+
+    *err = "memory could not be allocated";
+    t = calloc(1, sizeof(GTFtree));
+    if(!t) goto error;
+    t->image = image;
+    t->imageSize = size;
+    t->balanced = 1;
+    t->flat = 1;
+    t->exons = (uint32_t*) (image + hdr->exonsOffset);
+    t->nExons = hdr->nExons;
+
+    *err = "it is truncated or corrupt";
+    pos = hdr->stringsOffset;
+    if(!(t->htChroms = mapTable(image, size, &pos))) goto error;
+    if(!(t->htSources = mapTable(image, size, &pos))) goto error;
+    if(!(t->htFeatures = mapTable(image, size, &pos))) goto error;
+    if(!(t->htAttributes = mapTable(image, size, &pos))) goto error;
+    if(t->htChroms->l != hdr->nChroms) goto error;
+
+    chroms = (indexChrom*) (image + hdr->chromsOffset);
+    for(i=0; i<(int32_t) hdr->nChroms; i++) {
+        if(chroms[i].offset != nEntries) goto error;
+        nEntries += chroms[i].n_entries;
+    }
+    if(nEntries != hdr->nEntries) goto error;
+
+    *err = "memory could not be allocated";
+    t->chroms = calloc(hdr->nChroms + 1, sizeof(GTFchrom*));
+    if(!t->chroms) goto error;
+    t->m = hdr->nChroms + 1;
+    for(i=0; i<(int32_t) hdr->nChroms; i++) {
+        t->chroms[i] = calloc(1, sizeof(GTFchrom));
+        if(!t->chroms[i]) goto error;
+        t->n_targets++;
+        t->chroms[i]->chrom = i;
+        t->chroms[i]->n_entries = chroms[i].n_entries;
+        t->chroms[i]->tree = (void*) (image + hdr->entriesOffset + chroms[i].offset * sizeof(flatEntry));
+    }
+
+    *meta = image + hdr->metaOffset;
+    *metaLen = hdr->metaLen;
+    *err = NULL;
+    return t;
+
+error:
+    if(t) {
+        //destroyGTFtree() can't be used on a partially constructed tree
+        for(i=0; i<t->n_targets; i++) free(t->chroms[i]);
+        if(t->chroms) free(t->chroms);
+        if(t->htChroms) destroyHT(t->htChroms);
+        if(t->htSources) destroyHT(t->htSources);
+        if(t->htFeatures) destroyHT(t->htFeatures);
+        if(t->htAttributes) destroyHT(t->htAttributes);
+        free(t);
+    }
+    return NULL;
+}
+
+/*
+    Memory-map an index written by saveIndex(), returning a flattened tree
+    (or NULL on error, with err set to a description). meta and metaLen are set
+    to the metadata blob, which remains valid for as long as the tree.
+*/
+GTFtree *mapIndex(char *fname, char **meta, uint64_t *metaLen, char **err) {
+    struct stat st;
+    char *image = NULL;
+    uint64_t size = 0;
+    int fd;
+    GTFtree *t = NULL;
+
+    fd = open(fname, O_RDONLY);
+    if(fd < 0) {
+        *err = "it could not be opened";
+        return NULL;
+    }
+    if(fstat(fd, &st) || st.st_size < (off_t) sizeof(indexHeader)) {
+        *err = "it is too small";
+        close(fd);
+        return NULL;
+    }
+    size = (uint64_t) st.st_size;
+    image = mmap(NULL, size, PROT_READ, MAP_SHARED, fd, 0);
+    close(fd);
+    if(image == MAP_FAILED) {
+        *err = "it could not be memory-mapped";
+        return NULL;
+    }
+
+    t = imageIndex(image, size, meta, metaLen, err);
+    if(!t) {
+        munmap(image, size);
+        return NULL;
+    }
+    t->imageMapped = 1;
+    if(t->imageSize != size) {
+        *err = "it is truncated or corrupt";
+        t->imageSize = size;
+        destroyGTFtree(t);
+        return NULL;
+    }
+    return t;
+}
@@ -0,0 +1,1071 @@
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <strings.h>
+#include <ctype.h>
+#include <errno.h>
+#include <float.h>
+#include <zlib.h>
+#include "gtf.h"
+#include "kseq.h"
+
+KSTREAM_INIT(gzFile, gzread, 65536)
+
+/*******************************************************************************
+*
+* Attribute (GTF column 9) tokenizing
+*
+* This mimics what python's csv.reader(delimiter=' ') does with the attribute
+* column, since that's what the python parsing functions have always used.
+*
+*******************************************************************************/
+//Returns the number of tokens, which are written NUL-terminated into tok
+//with their offsets in offs (which must hold an entry per space in s, plus 2)
+static int tokenizeAttributes(char *s, kstring_t *tok, size_t *offs) {
+    int n = 0, state = 0; //0: start of field, 1: in field, 2: in quotes, 3: quote in quotes
+    char *p;
+
+    tok->l = 0;
+    if(!*s) return 0;
+    for(p = s; *p; p++) {
+        if(state == 0) offs[n] = tok->l;
+        if(*p == '\n' || *p == '\r') {
+            if(state != 2) break;
+        }
+        switch(state) {
+        case 0:
+            if(*p == '"') {
+                state = 2;
+            } else if(*p == ' ') {
+                kputc('\0', tok);
+                n++;
+            } else {
+                kputc(*p, tok);
+                state = 1;
+            }
+            break;
+        case 1:
+            if(*p == ' ') {
+                kputc('\0', tok);
+                n++;
+                state = 0;
+            } else {
+                kputc(*p, tok);
+            }
+            break;
+        case 2:
+            if(*p == '"') state = 3;
+            else kputc(*p, tok);
+            break;
+        default:
+            if(*p == '"') {
+                kputc('"', tok);
+                state = 2;
+            } else if(*p == ' ') {
+                kputc('\0', tok);
+                n++;
+                state = 0;
+            } else {
+                kputc(*p, tok);
+                state = 1;
+            }
+            break;
+        }
+    }
+    //The last field
+    if(state == 0) offs[n] = tok->l;
+    if(p != s) {
+        kputc('\0', tok);
+        n++;
+    }
+    return n;
+}
+
+/*
+  Find the values associated with nKeys keys in a GTF attribute column, in a
+  single pass. For each key found[i] is set to 1 and vals[i] is filled with
+  the value (with any trailing ';' removed) if it's present. A key is only
+  considered present if it isn't the last token in the column.
+
+  Returns the number of keys found or -1 on error.
+*/
+#define ATTRIBUTE_STACK 64
+int parseAttributes(char *s, char **keys, int nKeys, kstring_t *vals, int *found) {
+    kstring_t tok = {0, 0, NULL};
+    size_t stackOffs[ATTRIBUTE_STACK], *offs = stackOffs, l, nSpaces = 0;
+    int32_t stackIdx[ATTRIBUTE_STACK], *idx = stackIdx;
+    int i, j, n, nFound = 0;
+    char *v;
+
+    for(j=0; j<nKeys; j++) {
+        found[j] = 0;
+        vals[j].l = 0;
+    }
+    //Most columns have few enough tokens and keys to avoid allocating these
+    for(v = s; *v; v++) nSpaces += (*v == ' ');
+    if(nSpaces + 2 > ATTRIBUTE_STACK) offs = malloc((nSpaces + 2) * sizeof(size_t));
+    if(nKeys + 1 > ATTRIBUTE_STACK) idx = malloc((nKeys + 1) * sizeof(int32_t));
+    if(!offs || !idx) goto error;
+
+    n = tokenizeAttributes(s, &tok, offs);
+    for(j=0; j<nKeys; j++) idx[j] = -1;
+    for(i=0; i<n; i++) {
+        for(j=0; j<nKeys; j++) {
+            if(idx[j] < 0 && strcmp(tok.s + offs[i], keys[j]) == 0) idx[j] = i;
+        }
+    }
+    for(j=0; j<nKeys; j++) {
+        if(idx[j] < 0 || idx[j] == n - 1) continue;
+        if(strcmp(tok.s + offs[n - 1], keys[j]) == 0) continue;
+        v = tok.s + offs[idx[j] + 1];
+        l = strlen(v);
+        while(l && v[l - 1] == ';') l--;
+        kputsn(v, l, &vals[j]);
+        found[j] = 1;
+        nFound++;
+    }
+
+    if(offs != stackOffs) free(offs);
+    if(idx != stackIdx) free(idx);
+    if(tok.s) free(tok.s);
+    return nFound;
+
+error:
+    if(offs && offs != stackOffs) free(offs);
+    if(idx && idx != stackIdx) free(idx);
+    return -1;
+}
+
+//Whether key is one of the nKeys keys, or nKeys is -1 (every key is wanted)
+static int wantedAttribute(char *key, char **keys, int nKeys) {
+    int i;
+
+    if(nKeys < 0) return 1;
+    for(i=0; i<nKeys; i++) {
+        if(keys[i] && strcmp(key, keys[i]) == 0) return 1;
+    }
+    return 0;
+}
+
+/*
+  Append the key/value pairs in a GTF attribute column whose keys are among
+  nKeys keys (or all of them, if nKeys is -1) to out, as alternating
+  NUL-terminated keys and values. Tokens are paired up in order, skipping
+  empty ones where a key would be, and any trailing ';' is removed from the
+  values, as in parseAttributes(). Keys appearing more than once (e.g., tag)
+  are kept each time.
+
+  Returns the number of pairs appended or -1 on error.
+*/
+int splitAttributes(char *s, char **keys, int nKeys, kstring_t *out) {
+    kstring_t tok = {0, 0, NULL};
+    size_t stackOffs[ATTRIBUTE_STACK], *offs = stackOffs, l, nSpaces = 0;
+    int i, n, nPairs = 0;
+    char *k, *v;
+
+    if(!nKeys) return 0;
+    for(v = s; *v; v++) nSpaces += (*v == ' ');
+    if(nSpaces + 2 > ATTRIBUTE_STACK) offs = malloc((nSpaces + 2) * sizeof(size_t));
+    if(!offs) return -1;
+
+    n = tokenizeAttributes(s, &tok, offs);
+    for(i=0; i+1<n;) {
+        k = tok.s + offs[i];
+        if(!*k) {
+            i++;
+            continue;
+        }
+        v = tok.s + offs[i + 1];
+        i += 2;
+        if(!wantedAttribute(k, keys, nKeys)) continue;
+        l = strlen(v);
+        while(l && v[l - 1] == ';') l--;
+        kputs(k, out);
+        kputc('\0', out);
+        kputsn(v, l, out);
+        kputc('\0', out);
+        nPairs++;
+    }
+
+    if(offs != stackOffs) free(offs);
+    if(tok.s) free(tok.s);
+    return nPairs;
+}
+
+//A copy of nKeys attribute keys (see loadOpts), some of which may be NULL. NULL on error or if there are none
+char **copyAttributeKeys(char **keys, int nKeys) {
+    char **out;
+    int i;
+
+    if(nKeys <= 0) return NULL;
+    out = calloc(nKeys, sizeof(char*));
+    if(!out) return NULL;
+    for(i=0; i<nKeys; i++) {
+        if(!keys[i]) continue;
+        out[i] = strdup(keys[i]);
+        if(!out[i]) {
+            destroyAttributeKeys(out, i);
+            return NULL;
+        }
+    }
+    return out;
+}
+
+void destroyAttributeKeys(char **keys, int nKeys) {
+    int i;
+
+    if(!keys) return;
+    for(i=0; i<nKeys; i++) free(keys[i]);
+    free(keys);
+}
+
+/*******************************************************************************
+*
+* Staging
+*
+* Files are read and tokenized here into a stagedFile, without any reference to
+* python. Assigning labels, chromosome name munging and adding the entries to
+* a GTFtree are then done by the caller, in file order.
+*
+*******************************************************************************/
+static stagedFile *initStagedFile(void) {
+    stagedFile *sf = calloc(1, sizeof(stagedFile));
+    if(!sf) return NULL;
+    sf->chroms = initHT(128);
+    sf->labels = initHT(128);
+    return sf;
+}
+
+void destroyStagedFile(stagedFile *sf) {
+    if(!sf) return;
+    if(sf->entries) free(sf->entries);
+    if(sf->strings.s) free(sf->strings.s);
+    if(sf->exons) free(sf->exons);
+    if(sf->err.s) free(sf->err.s);
+    if(sf->chroms) destroyHT(sf->chroms);
+    if(sf->labels) destroyHT(sf->labels);
+    free(sf);
+}
+
+static int stageError(stagedFile *sf, const char *msg, const char *line) {
+    sf->err.l = 0;
+    kputs(msg, &(sf->err));
+    if(line) {
+        kputs(": ", &(sf->err));
+        kputs(line, &(sf->err));
+    }
+    return 1;
+}
+
+static stagedEntry *pushStaged(stagedFile *sf) {
+    stagedEntry *se;
+    if(sf->l + 1 >= sf->m) {
+        sf->m = sf->l + 1;
+        kroundup32(sf->m);
+        sf->entries = realloc(sf->entries, sf->m * sizeof(stagedEntry));
+        if(!sf->entries) return NULL;
+    }
+    se = sf->entries + sf->l++;
+    memset(se, 0, sizeof(stagedEntry));
+    se->chrom = -1;
+    se->label = -1;
+    se->strand = 3;
+    se->score = DBL_MAX;
+    return se;
+}
+
+//Strings are stored NUL-terminated, returns the offset
+static uint64_t pushString(stagedFile *sf, const char *s, size_t l) {
+    uint64_t offset = sf->strings.l;
+    kputsn(s, l, &(sf->strings));
+    kputc('\0', &(sf->strings));
+    return offset;
+}
+
+static int pushExon(stagedFile *sf, uint32_t start, uint32_t end) {
+    if(sf->nExons + 2 >= sf->mExons) {
+        sf->mExons = sf->nExons + 2;
+        kroundup32(sf->mExons);
+        sf->exons = realloc(sf->exons, sf->mExons * sizeof(uint32_t));
+        if(!sf->exons) return 1;
+    }
+    sf->exons[sf->nExons++] = start;
+    sf->exons[sf->nExons++] = end;
+    return 0;
+}
+
+//python's int(), returns 1 on error
+static int str2int(char *s, int64_t *val) {
+    char *end;
+    errno = 0;
+    *val = strtoll(s, &end, 10);
+    if(errno || end == s) return 1;
+    while(*end) {
+        if(!isspace(*end)) return 1;
+        end++;
+    }
+    return 0;
+}
+
+static double str2score(char *s) {
+    if(strcmp(s, ".") == 0) return DBL_MAX;
+    return strtod(s, NULL);
+}
+
+static uint8_t str2strand(char *s) {
+    if(strcmp(s, "+") == 0) return 0;
+    if(strcmp(s, "-") == 0) return 1;
+    return 3;
+}
+
+//Split a line on tabs, in place, returning the number of columns
+static int splitLine(kstring_t *line, char ***cols, int *mCols) {
+    int n = 1;
+    size_t i;
+
+    if(*mCols < 1) {
+        *mCols = 16;
+        *cols = realloc(*cols, *mCols * sizeof(char*));
+    }
+    (*cols)[0] = line->s;
+    for(i=0; i<line->l; i++) {
+        if(line->s[i] != '\t') continue;
+        line->s[i] = '\0';
+        if(n >= *mCols) {
+            *mCols *= 2;
+            *cols = realloc(*cols, *mCols * sizeof(char*));
+        }
+        (*cols)[n++] = line->s + i + 1;
+    }
+    return n;
+}
+
+static void stripLine(kstring_t *line) {
+    size_t start = 0;
+    while(line->l && isspace(line->s[line->l - 1])) line->l--;
+    line->s[line->l] = '\0';
+    while(start < line->l && isspace(line->s[start])) start++;
+    if(start) {
+        memmove(line->s, line->s + start, line->l - start + 1);
+        line->l -= start;
+    }
+}
+
+//Column strings joined by tabs, for warnings
+static char *joinCols(char **cols, int n, kstring_t *ks) {
+    int i;
+    ks->l = 0;
+    for(i=0; i<n; i++) {
+        if(i) kputc('\t', ks);
+        kputs(cols[i], ks);
+    }
+    return ks->s;
+}
+
+//s.strip(",").split(","), the offsets of each item in ks are returned
+static int *splitCommas(char *s, kstring_t *ks, int *n) {
+    int *offs;
+    size_t i;
+
+    while(*s == ',') s++;
+    kputs(s, ks);
+    if(!ks->s) kputs("", ks);
+    while(ks->l && ks->s[ks->l - 1] == ',') ks->s[--ks->l] = '\0';
+    offs = malloc((ks->l + 1) * sizeof(int));
+    if(!offs) return NULL;
+    *n = 1;
+    offs[0] = 0;
+    for(i=0; i<ks->l; i++) {
+        if(ks->s[i] != ',') continue;
+        ks->s[i] = '\0';
+        offs[(*n)++] = i + 1;
+    }
+    return offs;
+}
+
+/*
+  The equivalent of parseExonBounds() in parse.py. On a malformed entry a
+  warning is printed and the entry bounds are used.
+*/
+static int stageBED12exons(stagedFile *sf, stagedEntry *se, int64_t n, char *sizes, char *offsets) {
+    kstring_t sks = {0, 0, NULL}, oks = {0, 0, NULL};
+    int nSizes = 0, nOffsets = 0, i, ok = 1, rv = 0;
+    int *sIdx = NULL, *oIdx = NULL;
+    int64_t size, offset;
+    uint64_t first = sf->nExons;
+
+    sIdx = splitCommas(sizes, &sks, &nSizes);
+    oIdx = splitCommas(offsets, &oks, &nOffsets);
+    if(!sIdx || !oIdx) {
+        rv = stageError(sf, "Out of memory", NULL);
+        goto out;
+    }
+    if(n < nSizes) nSizes = (n > 0) ? n : 0;
+    if(n < nOffsets) nOffsets = (n > 0) ? n : 0;
+
+    for(i=0; i<nOffsets && i<nSizes; i++) {
+        if(str2int(oks.s + oIdx[i], &offset) || str2int(sks.s + sIdx[i], &size)) {
+            ok = 0;
+            break;
+        }
+        if(pushExon(sf, se->start + offset, se->start + offset + size)) {
+            rv = stageError(sf, "Out of memory", NULL);
+            goto out;
+        }
+    }
+    if(ok) {
+        //Any remaining offsets still need to be integers
+        for(; i<nOffsets; i++) {
+            if(str2int(oks.s + oIdx[i], &offset)) ok = 0;
+        }
+        if(!ok) {
+            fprintf(stderr, "Warning: Received an invalid exon offset (%s) or size (%s), using the entry bounds instead (%"PRIu32"-%"PRIu32")\n", offsets, sizes, se->start, se->end);
+        } else if(nOffsets < n || nSizes < n) {
+            fprintf(stderr, "Warning: There were too few exon start/end offsets (%s) or sizes (%s), using the entry bounds instead (%"PRIu32"-%"PRIu32")\n", offsets, sizes, se->start, se->end);
+            ok = 0;
+        }
+    } else {
+        fprintf(stderr, "Warning: Received an invalid exon offset (%s) or size (%s), using the entry bounds instead (%"PRIu32"-%"PRIu32")\n", offsets, sizes, se->start, se->end);
+    }
+
+    if(!ok) {
+        sf->nExons = first;
+        if(pushExon(sf, se->start, se->end)) {
+            rv = stageError(sf, "Out of memory", NULL);
+            goto out;
+        }
+    }
+    se->exons = first;
+    se->nExons = (sf->nExons - first) / 2;
+
+out:
+    if(sIdx) free(sIdx);
+    if(oIdx) free(oIdx);
+    if(sks.s) free(sks.s);
+    if(oks.s) free(oks.s);
+    return rv;
+}
+
+//Enrichment objects use every BED12 block as an entry, without any checks
+static int stageEnrichmentBlocks(stagedFile *sf, stagedEntry *se, char *sizes, char *offsets) {
+    kstring_t sks = {0, 0, NULL}, oks = {0, 0, NULL};
+    int nSizes = 0, nOffsets = 0, i, rv = 0;
+    int *sIdx = NULL, *oIdx = NULL;
+    int64_t size, offset;
+
+    sIdx = splitCommas(sizes, &sks, &nSizes);
+    oIdx = splitCommas(offsets, &oks, &nOffsets);
+    if(!sIdx || !oIdx) {
+        rv = stageError(sf, "Out of memory", NULL);
+        goto out;
+    }
+
+    se->exons = sf->nExons;
+    for(i=0; i<nOffsets && i<nSizes; i++) {
+        if(str2int(oks.s + oIdx[i], &offset) || str2int(sks.s + sIdx[i], &size)) {
+            rv = stageError(sf, "Invalid BED12 block", NULL);
+            goto out;
+        }
+        if(pushExon(sf, se->start + offset, se->start + offset + size)) {
+            rv = stageError(sf, "Out of memory", NULL);
+            goto out;
+        }
+    }
+    se->nExons = (sf->nExons - se->exons) / 2;
+
+out:
+    if(sIdx) free(sIdx);
+    if(oIdx) free(oIdx);
+    if(sks.s) free(sks.s);
+    if(oks.s) free(oks.s);
+    return rv;
+}
+
+//Handle a single BED line, which has already been stripped
+static int stageBEDline(stagedFile *sf, loadOpts *opts, kstring_t *line, char ***colsp, int *mCols) {
+    stagedEntry *se;
+    char **cols;
+    char *label = NULL;
+    int n, i, ncols = opts->ftype;
+    int64_t start, end, nExons;
+    kstring_t name = {0, 0, NULL};
+
+    n = splitLine(line, colsp, mCols);
+    cols = *colsp;
+
+    if(opts->labelColumn >= 0) {
+        if(opts->labelColumn >= n) return stageError(sf, "Missing the deepTools_group column", line->s);
+        label = cols[opts->labelColumn];
+        for(i=opts->labelColumn; i<n-1; i++) cols[i] = cols[i+1];
+        n--;
+    }
+
+    //Lines outside of the regions are skipped as though they weren't there
+    if(opts->regions && n >= 3) {
+        if(str2int(cols[1], &start) || str2int(cols[2], &end)) {
+            return stageError(sf, "Received an invalid start or end position", cols[0]);
+        }
+        if(!inRegionSet(opts->regions, cols[0], start, end)) return 0;
+    }
+    if(n < 3 || (ncols > 3 && n < 6) || (ncols == 12 && opts->keepExons && n < 12)) {
+        return stageError(sf, "Received a line with too few columns", cols[0]);
+    }
+
+    se = pushStaged(sf);
+    if(!se) return stageError(sf, "Out of memory", NULL);
+    if(label) se->label = getOrAddHT(sf->labels, label, NULL);
+
+    if(str2int(cols[1], &start) || str2int(cols[2], &end)) {
+        return stageError(sf, "Received an invalid start or end position", cols[0]);
+    }
+    if(ncols == 3) {
+        kputs(cols[0], &name);
+        kputc(':', &name);
+        kputs(cols[1], &name);
+        kputc('-', &name);
+        kputs(cols[2], &name);
+    }
+    if(start < 0) start = 0;
+    if(start >= end) {
+        fprintf(stderr, "Warning: %s:%s-%s is an invalid BED interval! Ignoring it.\n", cols[0], cols[1], cols[2]);
+        se->type = STAGED_INVALID;
+        if(name.s) free(name.s);
+        return 0;
+    }
+    if(start >= (uint32_t) -1 || end >= (uint32_t) -1) {
+        if(name.s) free(name.s);
+        return stageError(sf, "Received an interval with invalid bounds", cols[0]);
+    }
+
+    se->type = STAGED_ENTRY;
+    se->chrom = getOrAddHT(sf->chroms, cols[0], NULL);
+    se->start = (uint32_t) start;
+    se->end = (uint32_t) end;
+    if(ncols > 3) {
+        se->name = pushString(sf, cols[3], strlen(cols[3]));
+        se->strand = str2strand(cols[5]);
+        se->score = str2score(cols[4]);
+    } else {
+        se->name = pushString(sf, name.s, name.l);
+        free(name.s);
+    }
+
+    if(ncols == 12 && opts->keepExons) {
+        if(opts->enrichment) return stageEnrichmentBlocks(sf, se, cols[10], cols[11]);
+        if(str2int(cols[9], &nExons)) return stageError(sf, "Received an invalid block count", cols[0]);
+        return stageBED12exons(sf, se, nExons, cols[10], cols[11]);
+    }
+    return 0;
+}
+
+/*
+  The features of an Enrichment entry for each of several attribute keys (see
+  loadOpts). As with a single key, a deepTools_group attribute overrides them
+  all and missing attributes give "None". The first is the entry's label and
+  the others are appended to the staged strings.
+*/
+static int stageEnrichmentFeatures(stagedFile *sf, stagedEntry *se, loadOpts *opts, char **cols) {
+    char **keys = NULL, *feature;
+    kstring_t *vals = NULL;
+    int *found = NULL, i, nKeys = 1, rv = 1;
+
+    keys = calloc(opts->nAttributes + 1, sizeof(char*));
+    vals = calloc(opts->nAttributes + 1, sizeof(kstring_t));
+    found = calloc(opts->nAttributes + 1, sizeof(int));
+    if(!keys || !vals || !found) goto out;
+
+    keys[0] = "deepTools_group";
+    for(i=0; i<opts->nAttributes; i++) {
+        if(opts->attributes[i]) keys[nKeys++] = opts->attributes[i];
+    }
+    if(parseAttributes(cols[8], keys, nKeys, vals, found) < 0) goto out;
+
+    se->attributes = sf->strings.l;
+    se->nAttributes = opts->nAttributes - 1;
+    for(i=0, nKeys=1; i<opts->nAttributes; i++) {
+        if(found[0]) {
+            feature = vals[0].s;
+        } else if(!opts->attributes[i]) {
+            feature = cols[2];
+        } else {
+            feature = found[nKeys] ? vals[nKeys].s : "None";
+        }
+        if(opts->attributes[i]) nKeys++;
+        if(i == 0) {
+            se->label = getOrAddHT(sf->labels, feature, NULL);
+        } else {
+            pushString(sf, feature, strlen(feature));
+        }
+    }
+    rv = 0;
+
+out:
+    if(vals) {
+        for(i=0; i<=opts->nAttributes; i++) free(vals[i].s);
+        free(vals);
+    }
+    free(keys);
+    free(found);
+    return rv;
+}
+
+//Handle a single GTF line, which is passed to this as-is
+static int stageGTFline(stagedFile *sf, loadOpts *opts, kstring_t *line, char ***colsp, int *mCols, int first) {
+    stagedEntry *se;
+    char **cols;
+    char *keys[3];
+    kstring_t vals[3] = {{0, 0, NULL}, {0, 0, NULL}, {0, 0, NULL}}, ks = {0, 0, NULL};
+    int found[3], n, nPairs, isTranscript = 0, rv = 0;
+    int64_t start, end;
+
+    n = splitLine(line, colsp, mCols);
+    cols = *colsp;
+    if(n < 3) return 0;
+
+    if(!opts->enrichment) {
+        if(strcasecmp(cols[2], opts->transcriptID) == 0) {
+            isTranscript = 1;
+        } else if(strcasecmp(cols[2], opts->exonID) != 0 || !(opts->keepExons || first)) {
+            return 0;
+        }
+    }
+    if(opts->regions && !chromInRegionSet(opts->regions, cols[0])) return 0;
+    //Truncated transcripts and exons are skipped, as they are in python, rather than ending the load
+    if(!opts->enrichment && n < 5) {
+        if(isTranscript) {
+            fprintf(stderr, "Warning: non-GTF line encountered! %s\n", joinCols(cols, n, &ks));
+        } else {
+            fprintf(stderr, "Warning: %s is malformed!\n", joinCols(cols, n, &ks));
+        }
+        goto out;
+    }
+    if(n < 5) return stageError(sf, "Received a GTF line with too few columns", joinCols(cols, n, &ks));
+    if(str2int(cols[3], &start) || str2int(cols[4], &end)) {
+        rv = stageError(sf, "Received an invalid start or end position", joinCols(cols, n, &ks));
+        goto out;
+    }
+    //Exons are kept wherever they are on the chromosome, their transcript may overlap the regions
+    if(opts->regions && (isTranscript || opts->enrichment) && !inRegionSet(opts->regions, cols[0], start - 1, end)) goto out;
+
+    if(opts->enrichment) {
+        if(n < 9) {
+            rv = stageError(sf, "Received a GTF line with too few columns", joinCols(cols, n, &ks));
+            goto out;
+        }
+        keys[0] = "deepTools_group";
+        keys[1] = opts->attributeKey;
+        if(opts->nAttributes <= 0 && parseAttributes(cols[8], keys, opts->attributeKey ? 2 : 1, vals, found) < 0) {
+            rv = stageError(sf, "Out of memory", NULL);
+            goto out;
+        }
+        if(start - 1 < 0 || start - 1 >= end || end >= (uint32_t) -1) {
+            rv = stageError(sf, "Received an interval with invalid bounds", joinCols(cols, n, &ks));
+            goto out;
+        }
+        se = pushStaged(sf);
+        if(!se) {
+            rv = stageError(sf, "Out of memory", NULL);
+            goto out;
+        }
+        se->type = STAGED_ENTRY;
+        se->chrom = getOrAddHT(sf->chroms, cols[0], NULL);
+        se->start = start - 1;
+        se->end = end;
+        se->strand = str2strand(cols[6]);
+        se->score = str2score(cols[5]);
+        if(opts->nAttributes > 0) {
+            if(stageEnrichmentFeatures(sf, se, opts, cols)) rv = stageError(sf, "Out of memory", NULL);
+        } else if(found[0]) {
+            se->label = getOrAddHT(sf->labels, vals[0].s, NULL);
+        } else if(opts->attributeKey) {
+            se->label = getOrAddHT(sf->labels, found[1] ? vals[1].s : "None", NULL);
+        } else {
+            se->label = getOrAddHT(sf->labels, cols[2], NULL);
+        }
+        goto out;
+    }
+
+    if(start - 1 < 0) {
+        fprintf(stderr, "Warning: Invalid start in '%s', skipping\n", joinCols(cols, n, &ks));
+        goto out;
+    }
+    if(isTranscript && n < 9) {
+        fprintf(stderr, "Warning: non-GTF line encountered! %s\n", joinCols(cols, n, &ks));
+        goto out;
+    }
+    keys[0] = opts->designator;
+    keys[1] = "deepTools_group";
+    if(n < 9) {
+        found[0] = found[1] = 0;
+    } else if(parseAttributes(cols[8], keys, 2, vals, found) < 0) {
+        rv = stageError(sf, "Out of memory", NULL);
+        goto out;
+    }
+    if(!found[0]) {
+        fprintf(stderr, "Warning: %s is malformed!\n", joinCols(cols, n, &ks));
+        goto out;
+    }
+
+    if(isTranscript) {
+        if(start > end || start < 1) {
+            fprintf(stderr, "Warning: %s:%s-%s is an invalid GTF interval! Ignoring it.\n", cols[0], cols[3], cols[4]);
+            goto out;
+        }
+        if(end >= (uint32_t) -1 || start - 1 >= end) {
+            rv = stageError(sf, "Received an interval with invalid bounds", joinCols(cols, n, &ks));
+            goto out;
+        }
+        se = pushStaged(sf);
+        if(!se) {
+            rv = stageError(sf, "Out of memory", NULL);
+            goto out;
+        }
+        se->type = STAGED_ENTRY;
+        se->chrom = getOrAddHT(sf->chroms, cols[0], NULL);
+        se->strand = str2strand(cols[6]);
+        se->score = str2score(cols[5]);
+        if(found[1]) se->label = getOrAddHT(sf->labels, vals[1].s, NULL);
+        if(opts->nAttributes) {
+            se->attributes = sf->strings.l;
+            nPairs = splitAttributes(cols[8], opts->attributes, opts->nAttributes, &(sf->strings));
+            if(nPairs < 0) {
+                rv = stageError(sf, "Out of memory", NULL);
+                goto out;
+            }
+            se->nAttributes = nPairs;
+        }
+    } else {
+        se = pushStaged(sf);
+        if(!se) {
+            rv = stageError(sf, "Out of memory", NULL);
+            goto out;
+        }
+        se->type = STAGED_EXON;
+    }
+    se->start = start - 1;
+    se->end = end;
+    se->name = pushString(sf, vals[0].s, vals[0].l);
+
+out:
+    if(vals[0].s) free(vals[0].s);
+    if(vals[1].s) free(vals[1].s);
+    if(vals[2].s) free(vals[2].s);
+    if(ks.s) free(ks.s);
+    return rv;
+}
+
+//Whether a line is part of the header, which is skipped exactly as GTF.firstNonComment() does it
+static int isHeaderLine(kstring_t *line) {
+    return line->s[0] == '#' || strncmp(line->s, "track", 5) == 0 || strncmp(line->s, "browser", 7) == 0;
+}
+
+//A BED group label line. The label is line[1:].strip()
+static int stageGroupLine(stagedFile *sf, kstring_t *line) {
+    stagedEntry *se = pushStaged(sf);
+    if(!se) return stageError(sf, "Out of memory", NULL);
+    se->type = STAGED_GROUP;
+    line->s[0] = ' ';
+    stripLine(line);
+    se->name = pushString(sf, line->s, line->l);
+    return 0;
+}
+
+/*******************************************************************************
+*
+* Indexed staging
+*
+* When loading is restricted to regions and a bgzip compressed file has a
+* tabix/CSI index, only the parts of the file that may hold lines overlapping
+* the regions are read.
+*
+*******************************************************************************/
+//The virtual offset of the first line after the header, or (uint64_t) -1 if there isn't one
+static uint64_t firstLineOffset(bgzfReader *b, kstring_t *line) {
+    uint64_t voffset;
+
+    if(bgzfSeek(b, 0)) return (uint64_t) -1;
+    while(bgzfGetLine(b, line, &voffset) >= 0) {
+        if(!isHeaderLine(line)) return voffset;
+    }
+    return (uint64_t) -1;
+}
+
+/*
+  The regions widened to cover every transcript in a GTF file that overlaps
+  them, so that none of their exons are missed. Returns NULL on error.
+*/
+static regionSet *widenRegions(bgzfReader *b, tabixIndex *idx, loadOpts *opts, kstring_t *line, char ***cols, int *mCols) {
+    regionSet *rs = copyRegionSet(opts->regions);
+    uint64_t *chunks = NULL, nChunks = 0, i, voffset;
+    int64_t start, end;
+    uint32_t s, e;
+    int n;
+
+    if(!rs || tabixChunks(idx, opts->regions, &chunks, &nChunks)) goto error;
+    for(i=0; i<nChunks; i++) {
+        if(bgzfSeek(b, chunks[2*i])) goto error;
+        while(bgzfGetLine(b, line, &voffset) >= 0 && voffset < chunks[2*i+1]) {
+            if(line->s[0] == '#') continue;
+            n = splitLine(line, cols, mCols);
+            if(n < 5 || strcasecmp((*cols)[2], opts->transcriptID) != 0) continue;
+            if(str2int((*cols)[3], &start) || str2int((*cols)[4], &end)) continue;
+            if(start < 1 || start - 1 >= end || end >= (uint32_t) -1) continue;
+            if(!inRegionSet(opts->regions, (*cols)[0], start - 1, end)) continue;
+            s = start - 1;
+            e = end;
+            if(addRegionWindows(rs, (*cols)[0], 1, &s, &e)) goto error;
+        }
+    }
+    free(chunks);
+    return rs;
+
+error:
+    free(chunks);
+    destroyRegionSet(rs);
+    return NULL;
+}
+
+/*
+  Stage the lines of a file that may overlap opts->regions, in file order. The
+  result is the same as from reading the whole file, except that lines starting
+  with # (e.g., BED group labels) are never seen.
+*/
+static void stageIndexed(stagedFile *sf, char *fname, loadOpts *opts, tabixIndex *idx) {
+    kstring_t line = {0, 0, NULL};
+    regionSet *rs = opts->regions;
+    uint64_t *chunks = NULL, nChunks = 0, i, voffset, first;
+    bgzfReader *b = bgzfOpen(fname);
+    char **cols = NULL;
+    int mCols = 0, rv = 0;
+
+    if(!b) {
+        stageError(sf, "Unable to open", fname);
+        return;
+    }
+    first = firstLineOffset(b, &line);
+    if(opts->ftype == LOAD_GTF && !opts->enrichment) {
+        rs = widenRegions(b, idx, opts, &line, &cols, &mCols);
+        if(!rs) {
+            stageError(sf, "Unable to read", fname);
+            goto out;
+        }
+    }
+    if(tabixChunks(idx, rs, &chunks, &nChunks)) {
+        stageError(sf, "Unable to read the index of", fname);
+        goto out;
+    }
+
+    for(i=0; i<nChunks && !rv; i++) {
+        if(bgzfSeek(b, chunks[2*i])) {
+            rv = stageError(sf, "Unable to read", fname);
+            break;
+        }
+        while(!rv && bgzfGetLine(b, &line, &voffset) >= 0 && voffset < chunks[2*i+1]) {
+            if(opts->ftype == LOAD_GTF) {
+                if(line.s[0] == '#') continue;
+                rv = stageGTFline(sf, opts, &line, &cols, &mCols, voffset == first);
+            } else {
+                stripLine(&line);
+                if(!line.l || line.s[0] == '#') continue;
+                rv = stageBEDline(sf, opts, &line, &cols, &mCols);
+            }
+        }
+    }
+
+out:
+    if(rs != opts->regions) destroyRegionSet(rs);
+    free(chunks);
+    if(line.s) free(line.s);
+    if(cols) free(cols);
+    bgzfClose(b);
+}
+
+/*
+  Read and tokenize a (possibly gzipped) BED or GTF file.
+
+  This never returns NULL unless memory can't be allocated. On error,
+  sf->err.l is non-zero and holds the error message.
+*/
+stagedFile *stageFile(char *fname, loadOpts *opts) {
+    stagedFile *sf = initStagedFile();
+    kstring_t line = {0, 0, NULL};
+    kstream_t *ks = NULL;
+    gzFile fp = NULL;
+    tabixIndex *idx = NULL;
+    char **cols = NULL;
+    int mCols = 0, dret, inHeader = 1, first = 1;
+
+    if(!sf) return NULL;
+    if(opts->regions) idx = openTabixIndex(fname);
+    if(idx) {
+        stageIndexed(sf, fname, opts, idx);
+        destroyTabixIndex(idx);
+        return sf;
+    }
+
+    fp = gzopen(fname, "rb");
+    if(!fp) {
+        stageError(sf, "Unable to open", fname);
+        return sf;
+    }
+    ks = ks_init(fp);
+
+    while(ks_getuntil(ks, KS_SEP_LINE, &line, &dret) >= 0) {
+        if(inHeader) {
+            if(isHeaderLine(&line)) continue;
+            inHeader = 0;
+        }
+
+        if(opts->ftype == LOAD_GTF) {
+            if(line.s[0] == '#') continue;
+            if(stageGTFline(sf, opts, &line, &cols, &mCols, first)) break;
+        } else {
+            stripLine(&line);
+            if(!line.l) continue;
+            if(line.s[0] == '#') {
+                if(opts->labelColumn >= 0 || opts->enrichment) continue;
+                if(stageGroupLine(sf, &line)) break;
+                continue;
+            }
+            if(stageBEDline(sf, opts, &line, &cols, &mCols)) break;
+        }
+        first = 0;
+    }
+
+    if(line.s) free(line.s);
+    if(cols) free(cols);
+    ks_destroy(ks);
+    gzclose(fp);
+    return sf;
+}
+
+/*******************************************************************************
+*
+* Chunked staging
+*
+* For streaming, a file sorted by chromosome is staged one chromosome at a
+* time. Each chunk holds the lines from a single contiguous block of lines on
+* the same chromosome, the line starting the next block is kept for the next
+* call.
+*
+*******************************************************************************/
+static char *copyOpt(char *s) {
+    return s ? strdup(s) : NULL;
+}
+
+void closeChunkReader(chunkReader *r) {
+    if(!r) return;
+    if(r->ks) ks_destroy(r->ks);
+    if(r->fp) gzclose(r->fp);
+    if(r->line.s) free(r->line.s);
+    if(r->chrom.s) free(r->chrom.s);
+    if(r->cols) free(r->cols);
+    free(r->opts.exonID);
+    free(r->opts.transcriptID);
+    free(r->opts.designator);
+    free(r->opts.attributeKey);
+    destroyRegionSet(r->opts.regions);
+    destroyAttributeKeys(r->opts.attributes, r->opts.nAttributes);
+    free(r);
+}
+
+/*
+  The reader takes ownership of opts->regions and opts->attributes, if there
+  are any. Returns NULL if the file can't be opened or memory can't be
+  allocated.
+*/
+chunkReader *openChunkReader(char *fname, loadOpts *opts) {
+    chunkReader *r = calloc(1, sizeof(chunkReader));
+    if(!r) {
+        destroyRegionSet(opts->regions);
+        destroyAttributeKeys(opts->attributes, opts->nAttributes);
+        return NULL;
+    }
+    r->opts = *opts;
+    r->opts.exonID = copyOpt(opts->exonID);
+    r->opts.transcriptID = copyOpt(opts->transcriptID);
+    r->opts.designator = copyOpt(opts->designator);
+    r->opts.attributeKey = copyOpt(opts->attributeKey);
+    r->inHeader = 1;
+    r->first = 1;
+    r->fp = gzopen(fname, "rb");
+    if(!r->fp) {
+        closeChunkReader(r);
+        return NULL;
+    }
+    r->ks = ks_init(r->fp);
+    return r;
+}
+
+//The chromosome of a line, which is NUL-terminated at the first tab in ks
+static void lineChrom(chunkReader *r, kstring_t *ks) {
+    int col = (r->opts.ftype != LOAD_GTF && r->opts.labelColumn == 0) ? 1 : 0;
+    char *p = r->line.s, *end;
+
+    ks->l = 0;
+    for(; col && p; col--) {
+        p = strchr(p, '\t');
+        if(p) p++;
+    }
+    if(!p) p = "";
+    end = strchr(p, '\t');
+    kputsn(p, end ? (size_t) (end - p) : strlen(p), ks);
+}
+
+/*
+  Stage the next block of lines on a single chromosome, whose name is then in
+  r->chrom. At the end of the file, r->eof is set and no lines are staged.
+
+  This never returns NULL unless memory can't be allocated. On error,
+  sf->err.l is non-zero and holds the error message.
+*/
+stagedFile *stageChunk(chunkReader *r) {
+    stagedFile *sf = initStagedFile();
+    kstring_t chrom = {0, 0, NULL};
+    int dret, rv;
+
+    if(!sf) return NULL;
+    r->chrom.l = 0;
+    while(1) {
+        if(!r->pending) {
+            if(ks_getuntil(r->ks, KS_SEP_LINE, &(r->line), &dret) < 0) {
+                if(!r->chrom.l) r->eof = 1;
+                break;
+            }
+            if(r->inHeader) {
+                if(isHeaderLine(&(r->line))) continue;
+                r->inHeader = 0;
+            }
+            if(r->opts.ftype == LOAD_GTF) {
+                if(r->line.s[0] == '#') continue;
+            } else {
+                stripLine(&(r->line));
+                if(!r->line.l) continue;
+                if(r->line.s[0] == '#') {
+                    if(r->opts.labelColumn >= 0 || r->opts.enrichment) continue;
+                    stageError(sf, "Group labels (lines starting with #) can't be used when streaming", r->line.s);
+                    break;
+                }
+            }
+        }
+
+        lineChrom(r, &chrom);
+        if(r->chrom.l && strcmp(chrom.s, r->chrom.s) != 0) {
+            r->pending = 1;
+            break;
+        }
+        r->pending = 0;
+        if(!r->chrom.l) kputs(chrom.s, &(r->chrom));
+
+        if(r->opts.ftype == LOAD_GTF) {
+            rv = stageGTFline(sf, &(r->opts), &(r->line), &(r->cols), &(r->mCols), r->first);
+        } else {
+            rv = stageBEDline(sf, &(r->opts), &(r->line), &(r->cols), &(r->mCols));
+        }
+        if(rv) break;
+        r->first = 0;
+    }
+
+    if(chrom.s) free(chrom.s);
+    return sf;
+}
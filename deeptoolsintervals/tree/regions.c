@@ -0,0 +1,645 @@
+#include <stdlib.h>
+#include <stdio.h>
+#include <string.h>
+#include <sys/stat.h>
+#include <zlib.h>
+#include "gtf.h"
+
+/*******************************************************************************
+*
+* Region sets
+*
+* The windows of each chromosome are sorted and merged by the caller (see
+* readRegions() in parse.py), or by addRegionWindows() when windows are added
+* to a chromosome that already has some.
+*
+*******************************************************************************/
+regionSet *initRegionSet(void) {
+    regionSet *rs = calloc(1, sizeof(regionSet));
+    if(!rs) return NULL;
+    rs->chroms = initHT(128);
+    return rs;
+}
+
+void destroyRegionSet(regionSet *rs) {
+    uint64_t i;
+    if(!rs) return;
+    for(i=0; i<rs->chroms->l; i++) {
+        if(rs->starts) free(rs->starts[i]);
+        if(rs->ends) free(rs->ends[i]);
+    }
+    if(rs->starts) free(rs->starts);
+    if(rs->ends) free(rs->ends);
+    if(rs->n) free(rs->n);
+    destroyHT(rs->chroms);
+    free(rs);
+}
+
+typedef struct {
+    uint32_t start, end;
+} window;
+
+static int cmpWindows(const void *a, const void *b) {
+    const window *wa = a, *wb = b;
+    if(wa->start < wb->start) return -1;
+    if(wa->start > wb->start) return 1;
+    return 0;
+}
+
+/*
+    Add n windows to a chromosome, merging them with any it already has. The
+    windows needn't be sorted. Returns 1 on error.
+*/
+int addRegionWindows(regionSet *rs, char *chrom, uint32_t n, uint32_t *starts, uint32_t *ends) {
+    int added;
+    int32_t idx = getOrAddHT(rs->chroms, chrom, &added);
+    uint32_t i, nw = 0, m;
+    window *w = NULL;
+    void *tmp;
+
+    if(idx < 0) return 1;
+    if(added) {
+        //The arrays always have space for every chromosome in the table
+        if(!(idx & (idx - 1))) {
+            m = idx ? 2 * idx : 1;
+            if(!(tmp = realloc(rs->starts, m * sizeof(uint32_t*)))) return 1;
+            rs->starts = tmp;
+            if(!(tmp = realloc(rs->ends, m * sizeof(uint32_t*)))) return 1;
+            rs->ends = tmp;
+            if(!(tmp = realloc(rs->n, m * sizeof(uint32_t)))) return 1;
+            rs->n = tmp;
+        }
+        rs->starts[idx] = NULL;
+        rs->ends[idx] = NULL;
+        rs->n[idx] = 0;
+    }
+
+    w = malloc((rs->n[idx] + n + 1) * sizeof(window));
+    if(!w) return 1;
+    for(i=0; i<rs->n[idx]; i++) {
+        w[i].start = rs->starts[idx][i];
+        w[i].end = rs->ends[idx][i];
+    }
+    for(i=0; i<n; i++) {
+        w[rs->n[idx] + i].start = starts[i];
+        w[rs->n[idx] + i].end = ends[i];
+    }
+    m = rs->n[idx] + n;
+    qsort(w, m, sizeof(window), cmpWindows);
+    for(i=0; i<m; i++) {
+        if(w[i].start >= w[i].end) continue;
+        if(nw && w[i].start <= w[nw - 1].end) {
+            if(w[i].end > w[nw - 1].end) w[nw - 1].end = w[i].end;
+        } else {
+            w[nw++] = w[i];
+        }
+    }
+
+    free(rs->starts[idx]);
+    free(rs->ends[idx]);
+    rs->starts[idx] = malloc((nw + 1) * sizeof(uint32_t));
+    rs->ends[idx] = malloc((nw + 1) * sizeof(uint32_t));
+    rs->n[idx] = 0;
+    if(!rs->starts[idx] || !rs->ends[idx]) {
+        free(w);
+        return 1;
+    }
+    for(i=0; i<nw; i++) {
+        rs->starts[idx][i] = w[i].start;
+        rs->ends[idx][i] = w[i].end;
+    }
+    rs->n[idx] = nw;
+    free(w);
+    return 0;
+}
+
+//Returns NULL on error
+regionSet *copyRegionSet(regionSet *rs) {
+    regionSet *out = initRegionSet();
+    uint64_t i;
+
+    if(!out) return NULL;
+    for(i=0; i<rs->chroms->l; i++) {
+        if(addRegionWindows(out, val2strHT(rs->chroms, i), rs->n[i], rs->starts[i], rs->ends[i])) {
+            destroyRegionSet(out);
+            return NULL;
+        }
+    }
+    return out;
+}
+
+int chromInRegionSet(regionSet *rs, char *chrom) {
+    return str2valHT(rs->chroms, chrom) >= 0;
+}
+
+/*
+    Whether [start, end) overlaps a window. As with tabix, an interval is at
+    least 1 base long and negative starts are treated as 0.
+*/
+int inRegionSet(regionSet *rs, char *chrom, int64_t start, int64_t end) {
+    int32_t idx = str2valHT(rs->chroms, chrom);
+    uint32_t lo = 0, hi, mid;
+
+    if(idx < 0) return 0;
+    if(start < 0) start = 0;
+    if(end <= start) end = start + 1;
+
+    //The first window ending after start
+    hi = rs->n[idx];
+    while(lo < hi) {
+        mid = lo + (hi - lo)/2;
+        if(rs->ends[idx][mid] <= start) lo = mid + 1;
+        else hi = mid;
+    }
+    return lo < rs->n[idx] && rs->starts[idx][lo] < end;
+}
+
+/*******************************************************************************
+*
+* BGZF
+*
+* bgzip compressed files are a series of gzip blocks, each holding at most
+* 64KiB. A position in them (a virtual offset) is the offset of a block in the
+* file, shifted left 16 bits, plus an offset within the decompressed block.
+*
+*******************************************************************************/
+#define BGZF_BLOCK_SIZE 65536
+
+struct bgzfReader {
+    FILE *fp;
+    z_stream zs;
+    uint64_t address;
+    uint64_t next;
+    uint32_t len, pos;
+    uint8_t in[BGZF_BLOCK_SIZE];
+    uint8_t out[BGZF_BLOCK_SIZE];
+};
+
+static uint16_t le16(uint8_t *p) {
+    return p[0] | (p[1] << 8);
+}
+
+static uint32_t le32(uint8_t *p) {
+    return p[0] | (p[1] << 8) | (p[2] << 16) | ((uint32_t) p[3] << 24);
+}
+
+/*
+    The size of the block whose first 12 + xlen bytes are in header, or 0 if
+    it isn't a BGZF block
+*/
+static uint32_t bgzfBlockSize(uint8_t *header, uint16_t xlen) {
+    uint8_t *extra = header + 12;
+    uint16_t i = 0, slen;
+
+    while(i + 4 <= xlen) {
+        slen = le16(extra + i + 2);
+        if(extra[i] == 'B' && extra[i+1] == 'C' && slen == 2 && i + 6 <= xlen) return le16(extra + i + 4) + 1;
+        i += 4 + slen;
+    }
+    return 0;
+}
+
+//Returns 0 on success, -1 at the end of the file and -2 on error
+static int bgzfReadBlock(bgzfReader *b, uint64_t address) {
+    uint32_t size, isize;
+    uint16_t xlen;
+    size_t n;
+
+    if(address != b->next && fseeko(b->fp, (off_t) address, SEEK_SET)) return -2;
+    n = fread(b->in, 1, 12, b->fp);
+    if(n == 0) return -1;
+    if(n < 12 || b->in[0] != 0x1f || b->in[1] != 0x8b || b->in[2] != 8 || !(b->in[3] & 4)) return -2;
+    xlen = le16(b->in + 10);
+    if(12 + (size_t) xlen > BGZF_BLOCK_SIZE || fread(b->in + 12, 1, xlen, b->fp) != xlen) return -2;
+    size = bgzfBlockSize(b->in, xlen);
+    if(size < 12 + (uint32_t) xlen + 8 || size > BGZF_BLOCK_SIZE) return -2;
+    if(fread(b->in + 12 + xlen, 1, size - 12 - xlen, b->fp) != size - 12 - xlen) return -2;
+
+    isize = le32(b->in + size - 4);
+    if(isize > BGZF_BLOCK_SIZE || inflateReset(&(b->zs)) != Z_OK) return -2;
+    b->zs.next_in = b->in + 12 + xlen;
+    b->zs.avail_in = size - 12 - xlen - 8;
+    b->zs.next_out = b->out;
+    b->zs.avail_out = BGZF_BLOCK_SIZE;
+    if(inflate(&(b->zs), Z_FINISH) != Z_STREAM_END || b->zs.total_out != isize) return -2;
+
+    b->address = address;
+    b->next = address + size;
+    b->len = isize;
+    b->pos = 0;
+    return 0;
+}
+
+//Returns NULL if the file can't be opened or isn't BGZF compressed
+bgzfReader *bgzfOpen(char *fname) {
+    bgzfReader *b = calloc(1, sizeof(bgzfReader));
+    if(!b) return NULL;
+    if(inflateInit2(&(b->zs), -15) != Z_OK) {
+        free(b);
+        return NULL;
+    }
+    b->fp = fopen(fname, "rb");
+    if(!b->fp || bgzfReadBlock(b, 0)) {
+        bgzfClose(b);
+        return NULL;
+    }
+    return b;
+}
+
+void bgzfClose(bgzfReader *b) {
+    if(!b) return;
+    if(b->fp) fclose(b->fp);
+    inflateEnd(&(b->zs));
+    free(b);
+}
+
+//Returns 1 on error
+int bgzfSeek(bgzfReader *b, uint64_t voffset) {
+    if(voffset >> 16 != b->address || !b->len) {
+        if(bgzfReadBlock(b, voffset >> 16)) return 1;
+    }
+    if((voffset & 0xffff) > b->len) return 1;
+    b->pos = voffset & 0xffff;
+    return 0;
+}
+
+/*
+    Read the next line, without its line ending, into line. voffset is set to
+    where the line starts. Returns the length of the line, -1 at the end of
+    the file and -2 on error.
+*/
+int bgzfGetLine(bgzfReader *b, kstring_t *line, uint64_t *voffset) {
+    uint8_t *nl;
+    int rv, started = 0;
+
+    line->l = 0;
+    while(1) {
+        while(b->pos >= b->len) {
+            rv = bgzfReadBlock(b, b->next);
+            if(rv == -1 && started) goto out;
+            if(rv) return rv;
+        }
+        if(!started) *voffset = (b->address << 16) | b->pos;
+        started = 1;
+        nl = memchr(b->out + b->pos, '\n', b->len - b->pos);
+        if(!nl) {
+            kputsn((char*) b->out + b->pos, b->len - b->pos, line);
+            b->pos = b->len;
+            continue;
+        }
+        kputsn((char*) b->out + b->pos, nl - (b->out + b->pos), line);
+        b->pos = nl - b->out + 1;
+        break;
+    }
+
+out:
+    if(line->l > 1 && line->s[line->l - 1] == '\r') line->l--;
+    if(!line->s) kputs("", line);
+    line->s[line->l] = '\0';
+    return (int) line->l;
+}
+
+/*******************************************************************************
+*
+* Tabix and CSI indices
+*
+* These map each chromosome to a hierarchy of bins, each listing the chunks
+* (pairs of virtual offsets) of the file holding the lines that start in it.
+*
+*******************************************************************************/
+typedef struct {
+    uint32_t bin;
+    uint64_t loffset;
+    uint32_t n;
+    uint64_t *chunks;
+} tabixBin;
+
+typedef struct {
+    uint32_t nBins;
+    tabixBin *bins;
+    uint32_t nIntervals;
+    uint64_t *intervals;
+} tabixRef;
+
+struct tabixIndex {
+    int minShift, depth, csi;
+    int32_t nRefs;
+    char **names;
+    char *nameBlock;
+    tabixRef *refs;
+};
+
+void destroyTabixIndex(tabixIndex *idx) {
+    int32_t i;
+    uint32_t j;
+
+    if(!idx) return;
+    if(idx->refs) {
+        for(i=0; i<idx->nRefs; i++) {
+            for(j=0; j<idx->refs[i].nBins; j++) free(idx->refs[i].bins[j].chunks);
+            free(idx->refs[i].bins);
+            free(idx->refs[i].intervals);
+        }
+        free(idx->refs);
+    }
+    free(idx->names);
+    free(idx->nameBlock);
+    free(idx);
+}
+
+//The decompressed index, with a read position
+typedef struct {
+    uint8_t *s;
+    uint64_t l, pos;
+} indexBuffer;
+
+//Returns 1 if there aren't n more bytes
+static int readIndexBytes(indexBuffer *buf, void *out, uint64_t n) {
+    if(buf->pos + n > buf->l || buf->pos + n < buf->pos) return 1;
+    memcpy(out, buf->s + buf->pos, n);
+    buf->pos += n;
+    return 0;
+}
+
+//Returns 1 on error
+static int readIndexFile(char *fname, indexBuffer *buf) {
+    gzFile fp = gzopen(fname, "rb");
+    uint64_t m = 1 << 16;
+    uint8_t *tmp;
+    int n;
+
+    if(!fp) return 1;
+    buf->s = malloc(m);
+    buf->l = buf->pos = 0;
+    while(buf->s) {
+        if(buf->l == m) {
+            m *= 2;
+            tmp = realloc(buf->s, m);
+            if(!tmp) break;
+            buf->s = tmp;
+        }
+        n = gzread(fp, buf->s + buf->l, (unsigned) (m - buf->l));
+        if(n <= 0) {
+            gzclose(fp);
+            return n < 0;
+        }
+        buf->l += n;
+    }
+    gzclose(fp);
+    return 1;
+}
+
+static int cmpBins(const void *a, const void *b) {
+    const tabixBin *ba = a, *bb = b;
+    if(ba->bin < bb->bin) return -1;
+    if(ba->bin > bb->bin) return 1;
+    return 0;
+}
+
+//The names, which are NUL-terminated and concatenated. Returns 1 on error
+static int readIndexNames(indexBuffer *buf, tabixIndex *idx) {
+    int32_t lnm, i;
+    char *p;
+
+    if(readIndexBytes(buf, &lnm, 4) || lnm < 0) return 1;
+    idx->nameBlock = malloc(lnm + 1);
+    idx->names = calloc(idx->nRefs + 1, sizeof(char*));
+    if(!idx->nameBlock || !idx->names) return 1;
+    if(readIndexBytes(buf, idx->nameBlock, lnm)) return 1;
+    idx->nameBlock[lnm] = '\0';
+    for(i=0, p=idx->nameBlock; i<idx->nRefs; i++) {
+        if(p >= idx->nameBlock + lnm) return 1;
+        idx->names[i] = p;
+        p += strlen(p) + 1;
+    }
+    return 0;
+}
+
+//Returns 1 on error
+static int readIndexRefs(indexBuffer *buf, tabixIndex *idx) {
+    int32_t i, nBins, nChunks, nIntervals;
+    uint32_t j;
+    tabixRef *ref;
+    tabixBin *bin;
+
+    idx->refs = calloc(idx->nRefs + 1, sizeof(tabixRef));
+    if(!idx->refs) return 1;
+    for(i=0; i<idx->nRefs; i++) {
+        ref = idx->refs + i;
+        if(readIndexBytes(buf, &nBins, 4) || nBins < 0) return 1;
+        ref->bins = calloc(nBins + 1, sizeof(tabixBin));
+        if(!ref->bins) return 1;
+        for(j=0; j<(uint32_t) nBins; j++) {
+            bin = ref->bins + j;
+            ref->nBins++;
+            if(readIndexBytes(buf, &(bin->bin), 4)) return 1;
+            if(idx->csi && readIndexBytes(buf, &(bin->loffset), 8)) return 1;
+            if(readIndexBytes(buf, &nChunks, 4) || nChunks < 0) return 1;
+            if((uint64_t) nChunks * 16 > buf->l - buf->pos) return 1;
+            bin->chunks = malloc(((uint64_t) nChunks + 1) * 16);
+            if(!bin->chunks) return 1;
+            bin->n = nChunks;
+            if(readIndexBytes(buf, bin->chunks, (uint64_t) nChunks * 16)) return 1;
+        }
+        qsort(ref->bins, ref->nBins, sizeof(tabixBin), cmpBins);
+        if(idx->csi) continue;
+
+        if(readIndexBytes(buf, &nIntervals, 4) || nIntervals < 0) return 1;
+        if((uint64_t) nIntervals * 8 > buf->l - buf->pos) return 1;
+        ref->intervals = malloc(((uint64_t) nIntervals + 1) * 8);
+        if(!ref->intervals) return 1;
+        ref->nIntervals = nIntervals;
+        if(readIndexBytes(buf, ref->intervals, (uint64_t) nIntervals * 8)) return 1;
+    }
+    return 0;
+}
+
+//Parse a .tbi or .csi index, returns NULL on error
+static tabixIndex *parseIndex(indexBuffer *buf) {
+    tabixIndex *idx = calloc(1, sizeof(tabixIndex));
+    int32_t header[6], lAux;
+    char magic[4];
+    uint64_t auxEnd;
+
+    if(!idx) return NULL;
+    if(readIndexBytes(buf, magic, 4)) goto error;
+    if(memcmp(magic, "TBI\1", 4) == 0) {
+        idx->minShift = 14;
+        idx->depth = 5;
+        if(readIndexBytes(buf, &(idx->nRefs), 4) || idx->nRefs < 0) goto error;
+        if(readIndexBytes(buf, header, sizeof(header))) goto error;
+        if(readIndexNames(buf, idx)) goto error;
+    } else if(memcmp(magic, "CSI\1", 4) == 0) {
+        //Only CSI indices made by tabix hold the chromosome names
+        idx->csi = 1;
+        if(readIndexBytes(buf, &(idx->minShift), 4) || readIndexBytes(buf, &(idx->depth), 4)) goto error;
+        if(idx->minShift < 0 || idx->depth < 0 || idx->minShift + 3 * idx->depth > 62) goto error;
+        if(readIndexBytes(buf, &lAux, 4) || lAux < 28) goto error;
+        auxEnd = buf->pos + lAux;
+        if(readIndexBytes(buf, header, sizeof(header))) goto error;
+        if(auxEnd + 4 > buf->l) goto error;
+        //The number of names follows the aux data
+        memcpy(&(idx->nRefs), buf->s + auxEnd, 4);
+        if(idx->nRefs < 0) goto error;
+        if(readIndexNames(buf, idx)) goto error;
+        buf->pos = auxEnd + 4;
+    } else {
+        goto error;
+    }
+    if(readIndexRefs(buf, idx)) goto error;
+    return idx;
+
+error:
+    destroyTabixIndex(idx);
+    return NULL;
+}
+
+/*
+    The tabix (.tbi) or CSI index of a bgzip compressed file, if there's one
+    that's at least as new as the file. Returns NULL otherwise, or on error.
+*/
+tabixIndex *openTabixIndex(char *fname) {
+    char *suffixes[2] = {".tbi", ".csi"};
+    kstring_t iname = {0, 0, NULL};
+    indexBuffer buf = {NULL, 0, 0};
+    tabixIndex *idx = NULL;
+    struct stat fs, is;
+    bgzfReader *b;
+    int i;
+
+    b = bgzfOpen(fname);
+    if(!b) return NULL;
+    bgzfClose(b);
+    if(stat(fname, &fs)) return NULL;
+
+    for(i=0; i<2 && !idx; i++) {
+        iname.l = 0;
+        kputs(fname, &iname);
+        kputs(suffixes[i], &iname);
+        if(stat(iname.s, &is) || is.st_mtime < fs.st_mtime) continue;
+        if(readIndexFile(iname.s, &buf) == 0) idx = parseIndex(&buf);
+        free(buf.s);
+        buf.s = NULL;
+    }
+    free(iname.s);
+    return idx;
+}
+
+//Returns NULL if the bin isn't in the index
+static tabixBin *findBin(tabixRef *ref, uint32_t bin) {
+    uint32_t lo = 0, hi = ref->nBins, mid;
+    while(lo < hi) {
+        mid = lo + (hi - lo)/2;
+        if(ref->bins[mid].bin == bin) return ref->bins + mid;
+        if(ref->bins[mid].bin < bin) lo = mid + 1;
+        else hi = mid;
+    }
+    return NULL;
+}
+
+//Chunks ending at or before this can't hold lines overlapping a window starting at beg
+static uint64_t minOffset(tabixIndex *idx, tabixRef *ref, uint64_t beg) {
+    uint64_t i = beg >> idx->minShift, bin;
+    tabixBin *b;
+
+    if(!idx->csi) {
+        if(!ref->nIntervals) return 0;
+        return ref->intervals[(i < ref->nIntervals) ? i : ref->nIntervals - 1];
+    }
+    //The loffset of the smallest bin holding beg
+    bin = (((uint64_t) 1 << (3 * idx->depth)) - 1) / 7 + i;
+    while(1) {
+        b = findBin(ref, (uint32_t) bin);
+        if(b) return b->loffset;
+        if(!bin) return 0;
+        bin = (bin - 1) >> 3;
+    }
+}
+
+typedef struct {
+    uint64_t beg, end;
+} voffsetPair;
+
+static int cmpChunks(const void *a, const void *b) {
+    const voffsetPair *ca = a, *cb = b;
+    if(ca->beg < cb->beg) return -1;
+    if(ca->beg > cb->beg) return 1;
+    return 0;
+}
+
+//Append a chunk, returns 1 on error
+static int pushChunk(voffsetPair **chunks, uint64_t *n, uint64_t *m, uint64_t beg, uint64_t end) {
+    voffsetPair *tmp;
+    if(*n >= *m) {
+        *m = *m ? 2 * *m : 64;
+        tmp = realloc(*chunks, *m * sizeof(voffsetPair));
+        if(!tmp) return 1;
+        *chunks = tmp;
+    }
+    (*chunks)[*n].beg = beg;
+    (*chunks)[*n].end = end;
+    (*n)++;
+    return 0;
+}
+
+/*
+    The chunks of the file holding every line that may overlap a window in rs,
+    sorted and merged, as begin/end virtual offset pairs. Reading them in order
+    reads each of those lines once, in the order they're in the file. Returns
+    1 on error.
+*/
+int tabixChunks(tabixIndex *idx, regionSet *rs, uint64_t **out, uint64_t *nOut) {
+    voffsetPair *chunks = NULL;
+    uint64_t n = 0, m = 0, i, minOff, beg, end, b, e, t, maxPos = (uint64_t) 1 << (idx->minShift + 3 * idx->depth);
+    int32_t r, cidx;
+    uint32_t w, j;
+    int l, s;
+    tabixRef *ref;
+    tabixBin *bin;
+
+    for(r=0; r<idx->nRefs; r++) {
+        cidx = str2valHT(rs->chroms, idx->names[r]);
+        if(cidx < 0) continue;
+        ref = idx->refs + r;
+        for(w=0; w<rs->n[cidx]; w++) {
+            beg = rs->starts[cidx][w];
+            end = rs->ends[cidx][w];
+            if(end > maxPos) end = maxPos;
+            if(beg >= end) continue;
+            minOff = minOffset(idx, ref, beg);
+            //The bins overlapping [beg, end) on each level, as in htslib's reg2bins()
+            end--;
+            for(l=0, t=0, s=idx->minShift + 3 * idx->depth; l<=idx->depth; s-=3, t+=(uint64_t) 1 << (3 * l), l++) {
+                b = t + (beg >> s);
+                e = t + (end >> s);
+                for(; b<=e; b++) {
+                    bin = findBin(ref, (uint32_t) b);
+                    if(!bin) continue;
+                    for(j=0; j<bin->n; j++) {
+                        if(bin->chunks[2*j+1] <= minOff) continue;
+                        if(pushChunk(&chunks, &n, &m, bin->chunks[2*j], bin->chunks[2*j+1])) goto error;
+                    }
+                }
+            }
+        }
+    }
+
+    *nOut = 0;
+    if(n) {
+        qsort(chunks, n, sizeof(voffsetPair), cmpChunks);
+        for(i=1; i<n; i++) {
+            if(chunks[i].beg <= chunks[*nOut].end) {
+                if(chunks[i].end > chunks[*nOut].end) chunks[*nOut].end = chunks[i].end;
+            } else {
+                chunks[++(*nOut)] = chunks[i];
+            }
+        }
+        (*nOut)++;
+    }
+    *out = (uint64_t*) chunks;
+    return 0;
+
+error:
+    free(chunks);
+    return 1;
+}
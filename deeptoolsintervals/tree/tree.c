@@ -5,8 +5,23 @@
 #include <assert.h>
 #include <float.h>
 
+//Python 2 doesn't define this
+#ifndef PY_LITTLE_ENDIAN
+#ifdef WORDS_BIGENDIAN
+#define PY_LITTLE_ENDIAN 0
+#else
+#define PY_LITTLE_ENDIAN 1
+#endif
+#endif
+
 static void pyGTFDealloc(pyGTFtree_t *self) {
     if(self->t) destroyGTFtree(self->t);
+    //The image of a tree made by loadIndexBuffer() can only be released once the tree is gone
+    if(self->image) {
+        PyBuffer_Release(self->image);
+        free(self->image);
+    }
+    Py_XDECREF(self->imageOwner);
     PyObject_DEL(self);
 }
 
@@ -53,6 +68,95 @@ uint32_t Numeric2Uint(PyObject *obj) {
     return (uint32_t) l;
 }
 
+//Returns a UTF-8 representation, valid for as long as obj is
+static char *pyObj2str(PyObject *obj) {
+#if PY_MAJOR_VERSION >= 3
+    return (char*) PyUnicode_AsUTF8(obj);
+#else
+    return PyString_AsString(obj);
+#endif
+}
+
+//Counts are returned as ints, so they don't print as longs on python 2
+static PyObject *pyCount(long n) {
+#if PY_MAJOR_VERSION >= 3
+    return PyLong_FromLong(n);
+#else
+    return PyInt_FromLong(n);
+#endif
+}
+
+/*
+    Convert the attributes option of the GTF class (None, True or a list of
+    keys) to the attribute keys to keep (see loadOpts). keys is set to an array
+    of strings belonging to the list, which must be freed, or NULL if nKeys is
+    0 or -1 (every attribute). Returns 1 on error.
+*/
+static int pyAttributeKeys(PyObject *obj, char ***keys, int *nKeys) {
+    Py_ssize_t i, n;
+
+    *keys = NULL;
+    *nKeys = 0;
+    if(obj == Py_None) return 0;
+    if(obj == Py_True) {
+        *nKeys = -1;
+        return 0;
+    }
+    if(!PyList_Check(obj)) {
+        PyErr_SetString(PyExc_RuntimeError, "The attributes to keep must be True or a list of keys!");
+        return 1;
+    }
+    n = PyList_GET_SIZE(obj);
+    if(!n) return 0;
+    *keys = calloc(n, sizeof(char*));
+    if(!*keys) {
+        PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the attribute keys!");
+        return 1;
+    }
+    for(i=0; i<n; i++) {
+        //None is the feature column of an Enrichment object
+        if(PyList_GET_ITEM(obj, i) == Py_None) continue;
+        (*keys)[i] = pyObj2str(PyList_GET_ITEM(obj, i));
+        if(!(*keys)[i]) {
+            free(*keys);
+            *keys = NULL;
+            return 1;
+        }
+    }
+    *nKeys = (int) n;
+    return 0;
+}
+
+/*
+    Queries release the GIL while walking the tree, which is safe since they
+    only read from it. A tree can then only be modified when no queries are
+    running. Returns 1 (with an exception set) if the tree can't be modified.
+*/
+static int treeIsReadOnly(pyGTFtree_t *self) {
+    if(self->building) {
+        PyErr_SetString(PyExc_RuntimeError, "The tree can't be modified while it's being built!");
+        return 1;
+    }
+    if(self->readers) {
+        PyErr_SetString(PyExc_RuntimeError, "The tree can't be modified while it's being queried!");
+        return 1;
+    }
+    if(self->t->flat) {
+        PyErr_SetString(PyExc_RuntimeError, "Flattened trees, such as those loaded from an index, can't be modified!");
+        return 1;
+    }
+    return 0;
+}
+
+//Returns 1 (with an exception set) if the tree is being built on other threads and can't be queried
+static int treeIsBuilding(pyGTFtree_t *self) {
+    if(self->building) {
+        PyErr_SetString(PyExc_RuntimeError, "The tree can't be queried while it's being built!");
+        return 1;
+    }
+    return 0;
+}
+
 static PyObject *pyGTFinit(PyObject *self, PyObject *args) {
     GTFtree *t = NULL;
     pyGTFtree_t *pt;
@@ -64,6 +168,10 @@ static PyObject *pyGTFinit(PyObject *self, PyObject *args) {
     if(!pt) goto error;
 
     pt->t = t;
+    pt->readers = 0;
+    pt->building = 0;
+    pt->image = NULL;
+    pt->imageOwner = NULL;
     return (PyObject*) pt;
 
 error:
@@ -72,15 +180,23 @@ error:
     return NULL;
 }
 
+/*
+    The optional last two arguments are a GTF attribute column and the keys of
+    the attributes in it to keep (see pyAttributeKeys()).
+*/
 static PyObject *pyAddEntry(pyGTFtree_t *self, PyObject *args) {
     GTFtree *t = self->t;
-    char *chrom = NULL, *name = NULL, *sscore = NULL;
+    char *chrom = NULL, *name = NULL, *sscore = NULL, *column = NULL, **keys = NULL;
     uint32_t start, end, labelIdx;
     double score;
     uint8_t strand;
     unsigned long lstrand, lstart, lend, llabelIdx;
+    int nKeys, nPairs = 0, rv;
+    kstring_t attributes = {0, 0, NULL};
+    PyObject *oKeys = Py_None;
 
-    if(!(PyArg_ParseTuple(args, "skkskks", &chrom, &lstart, &lend, &name, &lstrand, &llabelIdx, &sscore))) {
+    if(treeIsReadOnly(self)) return NULL;
+    if(!(PyArg_ParseTuple(args, "skkskks|zO", &chrom, &lstart, &lend, &name, &lstrand, &llabelIdx, &sscore, &column, &oKeys))) {
         PyErr_SetString(PyExc_RuntimeError, "pyAddEntry received an invalid or missing argument!");
         return NULL;
     }
@@ -110,8 +226,21 @@ static PyObject *pyAddEntry(pyGTFtree_t *self, PyObject *args) {
         score = strtod(sscore, NULL);
     }
 
+    //Handle the attributes
+    if(column) {
+        if(pyAttributeKeys(oKeys, &keys, &nKeys)) return NULL;
+        nPairs = splitAttributes(column, keys, nKeys, &attributes);
+        free(keys);
+        if(nPairs < 0) {
+            PyErr_SetString(PyExc_MemoryError, "Could not allocate memory while parsing attributes!");
+            return NULL;
+        }
+    }
+
     //Actually add the entry
-    if(addGTFentry(t, chrom, start, end, strand, name, labelIdx, score)) {
+    rv = addGTFentry(t, chrom, start, end, strand, name, labelIdx, score, attributes.s, (uint32_t) nPairs);
+    if(attributes.s) free(attributes.s);
+    if(rv) {
         PyErr_SetString(PyExc_RuntimeError, "pyAddEntry received an error while inserting an entry!");
         return NULL;
     }
@@ -120,15 +249,22 @@ static PyObject *pyAddEntry(pyGTFtree_t *self, PyObject *args) {
     return Py_None;
 }
 
+/*
+    Arguments: chrom, start, end, strand, score, feature and, optionally, a
+    list of the features of any other attribute keys
+*/
 static PyObject *pyAddEnrichmentEntry(pyGTFtree_t *self, PyObject *args) {
     GTFtree *t = self->t;
-    char *chrom = NULL, *sscore = NULL, *feature = NULL;
+    char *chrom = NULL, *sscore = NULL, *feature = NULL, **features = NULL;
     uint32_t start, end;
     double score;
     uint8_t strand;
     unsigned long lstrand, lstart, lend;
+    PyObject *oFeatures = Py_None;
+    int nFeatures = 0, rv;
 
-    if(!(PyArg_ParseTuple(args, "skkkss", &chrom, &lstart, &lend, &lstrand, &sscore, &feature))) {
+    if(treeIsReadOnly(self)) return NULL;
+    if(!(PyArg_ParseTuple(args, "skkkss|O", &chrom, &lstart, &lend, &lstrand, &sscore, &feature, &oFeatures))) {
         PyErr_SetString(PyExc_RuntimeError, "pyAddEnrichmentEntry received an invalid or missing argument!");
         return NULL;
     }
@@ -154,7 +290,16 @@ static PyObject *pyAddEnrichmentEntry(pyGTFtree_t *self, PyObject *args) {
     }
 
     //Actually add the entry
-    if(addEnrichmententry(t, chrom, start, end, strand, score, feature)) {
+    if(pyAttributeKeys(oFeatures, &features, &nFeatures)) return NULL;
+    for(rv=0; rv<nFeatures && features[rv]; rv++);
+    if(nFeatures < 0 || rv < nFeatures) {
+        free(features);
+        PyErr_SetString(PyExc_RuntimeError, "pyAddEnrichmentEntry received an invalid list of features!");
+        return NULL;
+    }
+    rv = addEnrichmententry(t, chrom, start, end, strand, score, feature, features, (uint32_t) nFeatures);
+    free(features);
+    if(rv) {
         PyErr_SetString(PyExc_RuntimeError, "pyAddEnrichmentEntry received an error while inserting an entry!");
         return NULL;
     }
@@ -163,211 +308,2761 @@ static PyObject *pyAddEnrichmentEntry(pyGTFtree_t *self, PyObject *args) {
     return Py_None;
 }
 
-static PyObject *pyVine2Tree(pyGTFtree_t *self, PyObject *args) {
-    GTFtree *t = self->t;
-    sortGTF(t);
+/*******************************************************************************
+*
+* Native file loading
+*
+* Files are first staged (see load.c) and then added to the tree here. The
+* bookkeeping of labels and exons mirrors what the python parsing functions in
+* parse.py and enrichment.py do, so the two produce identical objects.
+*
+*******************************************************************************/
+typedef struct {
+    GTFtree *t;
+    stagedFile *sf;
+    PyObject *munge;
+    PyObject **chroms; //munged chromosome names, indexed like sf->chroms
+    PyObject *suffixes; //per label index, a dict of the last suffix given to each duplicated name
+} mergeState;
 
-    Py_INCREF(Py_None);
-    return Py_None;
+//Returns NULL on error
+static char *mungedChrom(mergeState *ms, int32_t idx) {
+    if(!ms->chroms[idx]) {
+        ms->chroms[idx] = PyObject_CallFunction(ms->munge, "s", val2strHT(ms->sf->chroms, idx));
+        if(!ms->chroms[idx]) return NULL;
+    }
+    return pyObj2str(ms->chroms[idx]);
 }
 
-static PyObject *pyPrintGTFtree(pyGTFtree_t *self, PyObject *args) {
-    GTFtree *t = self->t;
-    printGTFtree(t);
+static void destroyMergeState(mergeState *ms) {
+    uint64_t i;
+    if(ms->chroms) {
+        for(i=0; i<ms->sf->chroms->l; i++) Py_XDECREF(ms->chroms[i]);
+        free(ms->chroms);
+    }
+    Py_XDECREF(ms->suffixes);
+    destroyStagedFile(ms->sf);
+}
 
-    Py_INCREF(Py_None);
-    return Py_None;
+/*
+    stageFile() can be run from many threads at once, so the GIL is released
+    while it runs. Returns NULL with an exception set on error.
+*/
+static stagedFile *stageFileNoGIL(char *fname, loadOpts *opts) {
+    stagedFile *sf;
+
+    Py_BEGIN_ALLOW_THREADS
+    sf = stageFile(fname, opts);
+    Py_END_ALLOW_THREADS
+    if(!sf) {
+        PyErr_SetString(PyExc_MemoryError, "Could not allocate memory while staging a file!");
+        return NULL;
+    }
+    if(sf->err.l) {
+        PyErr_SetString(PyExc_RuntimeError, sf->err.s);
+        destroyStagedFile(sf);
+        return NULL;
+    }
+    return sf;
 }
 
-static PyObject *pyCountEntries(pyGTFtree_t *self, PyObject *args) {
-    GTFtree *t = self->t;
-    uint32_t nEntries = 0;
-    unsigned long lnEntries = 0;
-    int32_t i;
-    PyObject *out = NULL;
+/*
+    A file staged ahead of time by the stageFile python function is held in a
+    capsule until it's loaded, at which point sf is taken (and set to NULL).
+*/
+#define STAGED_CAPSULE "deeptoolsintervals.tree.stagedFile"
 
-    for(i=0; i<t->n_targets; i++) {
-        nEntries += t->chroms[i]->n_entries;
+typedef struct {
+    stagedFile *sf;
+} stagedHandle;
+
+static void destroyStagedCapsule(PyObject *capsule) {
+    stagedHandle *h = PyCapsule_GetPointer(capsule, STAGED_CAPSULE);
+    if(!h) return;
+    if(h->sf) destroyStagedFile(h->sf);
+    free(h);
+}
+
+//source is either a file name or a capsule from the stageFile python function
+static int initMergeState(mergeState *ms, GTFtree *t, PyObject *source, loadOpts *opts, PyObject *munge) {
+    stagedHandle *h;
+    char *fname;
+
+    ms->t = t;
+    ms->munge = munge;
+    ms->chroms = NULL;
+    ms->suffixes = NULL;
+    if(PyCapsule_CheckExact(source)) {
+        h = PyCapsule_GetPointer(source, STAGED_CAPSULE);
+        if(!h) return 1;
+        if(!h->sf) {
+            PyErr_SetString(PyExc_RuntimeError, "This staged file has already been loaded!");
+            return 1;
+        }
+        ms->sf = h->sf;
+        h->sf = NULL;
+    } else {
+        fname = pyObj2str(source);
+        if(!fname) return 1;
+        ms->sf = stageFileNoGIL(fname, opts);
+        if(!ms->sf) return 1;
     }
-    lnEntries = (unsigned long) nEntries;
-    out = PyLong_FromUnsignedLong(lnEntries);
+    ms->chroms = calloc(ms->sf->chroms->l + 1, sizeof(PyObject*));
+    ms->suffixes = PyDict_New();
+    if(!ms->chroms || !ms->suffixes) {
+        PyErr_SetString(PyExc_MemoryError, "Could not allocate memory while staging a file!");
+        destroyStagedFile(ms->sf);
+        return 1;
+    }
+    return 0;
+}
 
-    return out;
+static int str2ftype(char *ftype) {
+    if(strcmp(ftype, "GTF") == 0) return LOAD_GTF;
+    if(strcmp(ftype, "BED3") == 0) return LOAD_BED3;
+    if(strcmp(ftype, "BED6") == 0) return LOAD_BED6;
+    return LOAD_BED12;
 }
 
-static PyObject *pyIsTree(pyGTFtree_t *self, PyObject *args) {
-    GTFtree *t = self->t;
-    if(t->balanced) Py_RETURN_TRUE;
-    Py_RETURN_FALSE;
+//labelColumn is either None or an int
+static int labelColumn2int(PyObject *labelColumn) {
+    if(labelColumn == Py_None) return -1;
+    return (int) PyLong_AsLong(labelColumn);
 }
 
-static PyObject *pyHasOverlaps(pyGTFtree_t *self, PyObject *args) {
-    GTFtree *t = self->t;
-    int rv;
-    uint32_t minDistance = (uint32_t) -1;
-    unsigned long long ominDistance;
-    PyObject *otuple = NULL, *oval = NULL;
+//The C equivalent of findRandomLabel() in parse.py, suffixes may be NULL. Returns a new reference
+static PyObject *findRandomLabel(PyObject *labels, PyObject *name, PyObject *suffixes) {
+    PyObject *nameTry, *oi;
+    unsigned long i = 0;
+    int rv = PySequence_Contains(labels, name);
 
-    rv = hasOverlaps(t, &minDistance);
-    ominDistance = minDistance; // ominDistance should have at least as much space as minDistance
-    otuple = PyTuple_New(2);
-    if(!otuple) {
-        PyErr_SetString(PyExc_RuntimeError, "Could not allocate space for a tuple!\n");
-        return NULL;
+    if(rv < 0) return NULL;
+    if(!rv) {
+        Py_INCREF(name);
+        return name;
     }
-    oval = PyLong_FromUnsignedLongLong(ominDistance);
-    if(!oval) {
-        PyErr_SetString(PyExc_RuntimeError, "Could not allocate space for a single integer!\n");
-        return NULL;
+    if(suffixes && (oi = PyDict_GetItem(suffixes, name))) i = PyLong_AsUnsignedLong(oi);
+    while(1) {
+        i++;
+#if PY_MAJOR_VERSION >= 3
+        nameTry = PyUnicode_FromFormat("%U_r%lu", name, i);
+#else
+        nameTry = PyString_FromFormat("%s_r%lu", PyString_AsString(name), i);
+#endif
+        if(!nameTry) return NULL;
+        rv = PySequence_Contains(labels, nameTry);
+        if(rv < 0) {
+            Py_DECREF(nameTry);
+            return NULL;
+        }
+        if(!rv) break;
+        Py_DECREF(nameTry);
+    }
+    if(suffixes) {
+        oi = PyLong_FromUnsignedLong(i);
+        rv = oi ? PyDict_SetItem(suffixes, name, oi) : -1;
+        Py_XDECREF(oi);
+        if(rv) {
+            Py_DECREF(nameTry);
+            return NULL;
+        }
     }
+    return nameTry;
+}
 
-    if(rv) {
-        Py_INCREF(Py_True);
-        PyTuple_SET_ITEM(otuple, 0, Py_True);
-    } else {
-        Py_INCREF(Py_False);
-        PyTuple_SET_ITEM(otuple, 0, Py_False);
+//The dict of suffixes given to the duplicated names of a label (see findRandomLabel()). Returns a borrowed reference
+static PyObject *labelSuffixes(mergeState *ms, Py_ssize_t labelIdx) {
+    PyObject *key, *d;
+
+    key = PyLong_FromSsize_t(labelIdx);
+    if(!key) return NULL;
+    d = PyDict_GetItem(ms->suffixes, key);
+    if(!d) {
+        d = PyDict_New();
+        if(d && PyDict_SetItem(ms->suffixes, key, d)) {
+            Py_DECREF(d);
+            d = NULL;
+        }
+        Py_XDECREF(d);
     }
-    PyTuple_SetItem(otuple, 1, oval);
+    Py_DECREF(key);
+    return d;
+}
 
-    return otuple;
+//Returns the index of label in labels, appending it (and a new exon dict) if needed. -1 on error
+static Py_ssize_t getLabelIdx(PyObject *labels, PyObject *exons, PyObject *label) {
+    Py_ssize_t idx;
+    PyObject *d;
+    int rv = PySequence_Contains(labels, label);
+
+    if(rv < 0) return -1;
+    if(rv) return PySequence_Index(labels, label);
+    if(PyList_Append(labels, label)) return -1;
+    d = PyDict_New();
+    if(!d) return -1;
+    rv = PyList_Append(exons, d);
+    Py_DECREF(d);
+    if(rv) return -1;
+    idx = PyList_Size(labels) - 1;
+    return idx;
 }
 
-static PyObject *pyFindOverlaps(pyGTFtree_t *self, PyObject *args) {
-    GTFtree *t = self->t;
-    char *chrom = NULL, *name = NULL, *transcript_id = NULL, strandChar;
-    int32_t i;
-    uint32_t start, end;
-    int strand = 3, strandType = 0, matchType = 0;
-    unsigned long lstrand, lstart, lend, lmatchType, lstrandType, llabelIdx;
-    overlapSet *os = NULL;
-    PyObject *olist = NULL, *otuple = NULL, *includeStrand = Py_False, *oscore = NULL;
+//Returns a new list of (start, end) tuples
+static PyObject *stagedExons(stagedFile *sf, stagedEntry *se, int useExons) {
+    PyObject *olist, *otuple;
+    uint32_t i;
 
-    if(!(PyArg_ParseTuple(args, "skkkkksO", &chrom, &lstart, &lend, &lstrand, &lmatchType, &lstrandType, &transcript_id, &includeStrand))) {
-        PyErr_SetString(PyExc_RuntimeError, "pyFindOverlaps received an invalid or missing argument!");
-        return NULL;
+    if(!useExons) return Py_BuildValue("[(kk)]", (unsigned long) se->start, (unsigned long) se->end);
+    olist = PyList_New(se->nExons);
+    if(!olist) return NULL;
+    for(i=0; i<se->nExons; i++) {
+        otuple = Py_BuildValue("(kk)", (unsigned long) sf->exons[se->exons + 2*i], (unsigned long) sf->exons[se->exons + 2*i + 1]);
+        if(!otuple) {
+            Py_DECREF(olist);
+            return NULL;
+        }
+        PyList_SET_ITEM(olist, i, otuple);
     }
+    return olist;
+}
 
-    //I'm assuming that this is never called outside of the module
-    strandType = (int) lstrandType;
-    strand = (int) lstrand;
-    matchType = (int) matchType;
-    start = (uint32_t) lstart;
-    end = (uint32_t) lend;
-
-    os = findOverlaps(NULL, t, chrom, start, end, strand, matchType, strandType, 0, NULL);
+//Equivalent to GTF.parseBEDcore()
+static int mergeBEDentry(mergeState *ms, stagedEntry *se, PyObject *exons, Py_ssize_t labelIdx, int useExons) {
+    PyObject *d, *name = NULL, *uname = NULL, *elist = NULL, *suffixes;
+    char *chrom;
+    int rv = 1;
 
-    // Did we receive an error?
-    if(!os) {
-        PyErr_SetString(PyExc_RuntimeError, "findOverlaps returned NULL!");
-        return NULL;
+    d = PyList_GetItem(exons, labelIdx);
+    if(!d) return 1;
+    name = PyString_FromString(ms->sf->strings.s + se->name);
+    if(!name) return 1;
+    suffixes = labelSuffixes(ms, labelIdx);
+    if(!suffixes) goto out;
+    uname = findRandomLabel(d, name, suffixes);
+    if(!uname) goto out;
+    chrom = mungedChrom(ms, se->chrom);
+    if(!chrom) goto out;
+    if(addGTFentry(ms->t, chrom, se->start, se->end, se->strand, pyObj2str(uname), (uint32_t) labelIdx, se->score, NULL, 0)) {
+        PyErr_SetString(PyExc_RuntimeError, "loadFile received an error while inserting an entry!");
+        goto out;
     }
+    elist = stagedExons(ms->sf, se, useExons);
+    if(!elist) goto out;
+    rv = PyDict_SetItem(d, uname, elist);
 
-    // Convert the overlapSet to a list of tuples
-    olist = PyList_New(os->l);
-    if(!olist) goto error;
-    for(i=0; i<os->l; i++) {
-        // Make the tuple
-        if(includeStrand == Py_True) {
-            otuple = PyTuple_New(6);
-        } else {
-            otuple = PyTuple_New(5);
+out:
+    Py_XDECREF(elist);
+    Py_XDECREF(uname);
+    Py_DECREF(name);
+    return rv;
+}
+
+//Equivalent to GTF.parseBED()
+static int mergeBED(mergeState *ms, loadOpts *opts, PyObject *labels, PyObject *exons, PyObject *defaultLabel, PyObject *bname) {
+    stagedFile *sf = ms->sf;
+    stagedEntry *se;
+    Py_ssize_t labelIdx = PyList_Size(labels);
+    uint64_t i, groupEntries = 0;
+    int groupLabelsFound = 0, useExons = (opts->ftype == LOAD_BED12 && opts->keepExons);
+    //Whether the entries before the first group label have yet to be given a place in exons
+    int first = (opts->labelColumn < 0);
+    PyObject *label = NULL, *ulabel = NULL, *d;
+
+    for(i=0; i<sf->l; i++) {
+        se = sf->entries + i;
+        if(first) {
+            // Lines outside of any regions aren't staged, so this may be a group label
+            d = PyDict_New();
+            if(!d) return 1;
+            if(PyList_Append(exons, d)) {
+                Py_DECREF(d);
+                return 1;
+            }
+            Py_DECREF(d);
+            first = 0;
         }
-        if(!otuple) goto error;
-        lstart = (unsigned long) os->overlaps[i]->start;
-        lend = (unsigned long) os->overlaps[i]->end;
-        name = getAttribute(t, os->overlaps[i], transcript_id);
-        llabelIdx = (unsigned long) os->overlaps[i]->labelIdx;
-        strandChar = '.';
-        if(os->overlaps[i]->strand == 0) {
-            strandChar = '+';
-        } else if(os->overlaps[i]->strand == 1) {
-            strandChar = '-';
-        }
-        if (os->overlaps[i]->score == DBL_MAX) {
-            oscore = Py_BuildValue("s", ".");
-        } else {
-            oscore = Py_BuildValue("d", os->overlaps[i]->score);
+        if(se->type == STAGED_GROUP) {
+            // If there was a previous group AND it had no entries then remove it
+            if(groupLabelsFound > 0 && groupEntries == 0) {
+                label = PyObject_Str(PyList_GetItem(labels, PyList_Size(labels) - 1));
+                if(!label) return 1;
+                fprintf(stderr, "Warning, the '%s' group had no valid entries! Removing it.\n", pyObj2str(label));
+                Py_DECREF(label);
+                if(PySequence_DelItem(labels, PyList_Size(labels) - 1)) return 1;
+                groupLabelsFound--;
+                labelIdx--;
+            }
+            if(strlen(sf->strings.s + se->name)) {
+                label = PyString_FromString(sf->strings.s + se->name);
+            } else {
+                label = bname;
+                Py_INCREF(label);
+            }
+            if(!label) return 1;
+            ulabel = findRandomLabel(labels, label, NULL);
+            Py_DECREF(label);
+            if(!ulabel) return 1;
+            if(PyList_Append(labels, ulabel)) {
+                Py_DECREF(ulabel);
+                return 1;
+            }
+            Py_DECREF(ulabel);
+            labelIdx++;
+            d = PyDict_New();
+            if(!d) return 1;
+            if(PyList_Append(exons, d)) {
+                Py_DECREF(d);
+                return 1;
+            }
+            Py_DECREF(d);
+            groupLabelsFound++;
+            groupEntries = 0;
+            continue;
         }
-        if(!oscore) goto error;
-        if(includeStrand == Py_True) {
-            otuple = Py_BuildValue("(kkskcO)", lstart, lend, name, llabelIdx, strandChar, oscore);
-        } else {
-            otuple = Py_BuildValue("(kkskO)", lstart, lend, name, llabelIdx, oscore);
+
+        if(opts->labelColumn >= 0) {
+            label = PyString_FromString(val2strHT(sf->labels, se->label));
+            if(!label) return 1;
+            labelIdx = getLabelIdx(labels, exons, label);
+            Py_DECREF(label);
+            if(labelIdx < 0) return 1;
         }
-        if(!otuple) goto error;
+        if(se->type == STAGED_ENTRY) {
+            if(mergeBEDentry(ms, se, exons, labelIdx, useExons)) return 1;
+        }
+        if(opts->labelColumn < 0) groupEntries++;
+    }
 
-        // Add the tuple
-        if(PyList_SetItem(olist, i, otuple)) goto error;
-        otuple = NULL;
+    if(groupEntries > 0 && opts->labelColumn < 0) {
+        ulabel = findRandomLabel(labels, (defaultLabel != Py_None) ? defaultLabel : bname, NULL);
+        if(!ulabel) return 1;
+        if(PyList_Append(labels, ulabel)) {
+            Py_DECREF(ulabel);
+            return 1;
+        }
+        Py_DECREF(ulabel);
     }
-    os_destroy(os);
 
-    return olist;
+    return 0;
+}
+
+//Equivalent to GTF.parseGTF()
+static int mergeGTF(mergeState *ms, PyObject *labels, PyObject *exons, PyObject *duplicated, PyObject *defaultLabel, PyObject *bname) {
+    stagedFile *sf = ms->sf;
+    stagedEntry *se;
+    Py_ssize_t labelIdx = PyList_Size(labels), defaultIdx = -1, *labelCache = NULL;
+    uint64_t i;
+    int rv = 1, contains;
+    char *chrom;
+    PyObject *fileLabel = NULL, *dupSet = NULL, *label, *name = NULL, *d, *elist, *otuple;
+
+    labelCache = malloc((sf->labels->l + 1) * sizeof(Py_ssize_t));
+    if(!labelCache) {
+        PyErr_SetString(PyExc_MemoryError, "Could not allocate memory while loading a GTF file!");
+        return 1;
+    }
+    for(i=0; i<sf->labels->l; i++) labelCache[i] = -1;
+    fileLabel = findRandomLabel(labels, bname, NULL);
+    if(!fileLabel) goto out;
+    dupSet = PySet_New(duplicated);
+    if(!dupSet) goto out;
+
+    for(i=0; i<sf->l; i++) {
+        se = sf->entries + i;
+        name = PyString_FromString(sf->strings.s + se->name);
+        if(!name) goto out;
+
+        if(se->type == STAGED_ENTRY) {
+            // The labels list only ever grows here, so the indices can be cached
+            if(se->label >= 0) {
+                if(labelCache[se->label] < 0) {
+                    label = PyString_FromString(val2strHT(sf->labels, se->label));
+                    if(!label) goto out;
+                    labelCache[se->label] = getLabelIdx(labels, exons, label);
+                    Py_DECREF(label);
+                    if(labelCache[se->label] < 0) goto out;
+                }
+                labelIdx = labelCache[se->label];
+            } else {
+                if(defaultIdx < 0) {
+                    defaultIdx = getLabelIdx(labels, exons, (defaultLabel != Py_None) ? defaultLabel : fileLabel);
+                    if(defaultIdx < 0) goto out;
+                }
+                labelIdx = defaultIdx;
+            }
+
+            d = PyList_GetItem(exons, labelIdx);
+            if(!d) goto out;
+            contains = PyDict_Contains(d, name);
+            if(contains < 0) goto out;
+            if(contains) {
+                fprintf(stderr, "Warning: %s occurs more than once! Only using the first instance.\n", pyObj2str(name));
+                if(PyList_Append(duplicated, name)) goto out;
+                if(PySet_Add(dupSet, name)) goto out;
+            } else {
+                chrom = mungedChrom(ms, se->chrom);
+                if(!chrom) goto out;
+                if(addGTFentry(ms->t, chrom, se->start, se->end, se->strand, pyObj2str(name), (uint32_t) labelIdx, se->score, sf->strings.s + se->attributes, se->nAttributes)) {
+                    PyErr_SetString(PyExc_RuntimeError, "loadFile received an error while inserting an entry!");
+                    goto out;
+                }
+                elist = PyList_New(0);
+                if(!elist) goto out;
+                if(PyDict_SetItem(d, name, elist)) {
+                    Py_DECREF(elist);
+                    goto out;
+                }
+                Py_DECREF(elist);
+            }
+        } else if(se->type == STAGED_EXON) {
+            contains = PySet_Contains(dupSet, name);
+            if(contains < 0) goto out;
+            if(!contains && labelIdx < PyList_Size(exons)) {
+                d = PyList_GetItem(exons, labelIdx);
+                elist = PyDict_GetItem(d, name);
+                if(!elist) {
+                    elist = PyList_New(0);
+                    if(!elist) goto out;
+                    if(PyDict_SetItem(d, name, elist)) {
+                        Py_DECREF(elist);
+                        goto out;
+                    }
+                    Py_DECREF(elist);
+                }
+                otuple = Py_BuildValue("(kk)", (unsigned long) se->start, (unsigned long) se->end);
+                if(!otuple) goto out;
+                if(PyList_Append(elist, otuple)) {
+                    Py_DECREF(otuple);
+                    goto out;
+                }
+                Py_DECREF(otuple);
+            }
+        }
+        Py_DECREF(name);
+        name = NULL;
+    }
+    rv = 0;
+
+out:
+    Py_XDECREF(name);
+    Py_XDECREF(dupSet);
+    Py_XDECREF(fileLabel);
+    free(labelCache);
+    return rv;
+}
+
+/*
+    Stage a file, which can then be given to loadFile() or loadEnrichmentFile()
+    in place of its name. This allows files to be read in parallel threads,
+    since the GIL is released while staging. The arguments are those of
+    loadFile() (exonID, transcriptID and designator) and loadEnrichmentFile()
+    (attributeKey) that affect staging, with None for any that don't apply.
+*/
+/*
+    Convert a dict of chromosome names to (starts, ends) lists, as returned by
+    readRegions() in parse.py, into a regionSet. Returns NULL on error.
+*/
+static regionSet *pyDict2regionSet(PyObject *regions) {
+    PyObject *key, *value, *oStarts, *oEnds;
+    Py_ssize_t pos = 0, i, n;
+    uint32_t *starts = NULL, *ends = NULL;
+    regionSet *rs;
+    char *chrom;
+
+    if(!PyDict_Check(regions)) {
+        PyErr_SetString(PyExc_RuntimeError, "The regions must be a dictionary!");
+        return NULL;
+    }
+    rs = initRegionSet();
+    if(!rs) {
+        PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the regions!");
+        return NULL;
+    }
+    while(PyDict_Next(regions, &pos, &key, &value)) {
+        if(!PyTuple_Check(value) || PyTuple_Size(value) != 2) goto error;
+        oStarts = PyTuple_GetItem(value, 0);
+        oEnds = PyTuple_GetItem(value, 1);
+        if(!PyList_Check(oStarts) || !PyList_Check(oEnds)) goto error;
+        n = PyList_Size(oStarts);
+        if(PyList_Size(oEnds) != n) goto error;
+        chrom = pyObj2str(key);
+        if(!chrom) goto error;
+        starts = malloc((n + 1) * sizeof(uint32_t));
+        ends = malloc((n + 1) * sizeof(uint32_t));
+        if(!starts || !ends) goto error;
+        for(i=0; i<n; i++) {
+            starts[i] = (uint32_t) PyLong_AsUnsignedLong(PyList_GetItem(oStarts, i));
+            ends[i] = (uint32_t) PyLong_AsUnsignedLong(PyList_GetItem(oEnds, i));
+        }
+        if(PyErr_Occurred()) goto error;
+        if(addRegionWindows(rs, chrom, (uint32_t) n, starts, ends)) goto error;
+        free(starts);
+        free(ends);
+        starts = NULL;
+        ends = NULL;
+    }
+    return rs;
 
 error:
-    if(otuple) Py_DECREF(otuple);
-    if(olist) Py_DECREF(olist);
-    PyErr_SetString(PyExc_RuntimeError, "findOverlaps received an error!");
+    if(starts) free(starts);
+    if(ends) free(ends);
+    destroyRegionSet(rs);
+    if(!PyErr_Occurred()) PyErr_SetString(PyExc_RuntimeError, "Received invalid regions!");
     return NULL;
 }
 
-static PyObject *pyFindOverlappingFeatures(pyGTFtree_t *self, PyObject *args) {
-    GTFtree *t = self->t;
-    char *chrom = NULL;
-    int32_t i;
-    uint32_t start, end;
-    int strand = 3, strandType = 0, matchType = 0;
-    unsigned long lstrand, lstart, lend, lmatchType, lstrandType;
-    overlapSet *os = NULL;
-    PyObject *olist = NULL, *ostring = NULL;
+//The arguments shared by stageFile() and openChunks(), returns 1 on error
+static int parseStageArgs(PyObject *args, char *funcName, char **fname, loadOpts *opts) {
+    char *ftype = NULL, **keys;
+    PyObject *labelColumn = NULL, *oKeepExons = NULL, *exonID, *transcriptID, *designator, *attributeKey, *enrichment, *regions = Py_None, *attributes = Py_None;
 
-    if(!(PyArg_ParseTuple(args, "skkkkk", &chrom, &lstart, &lend, &lstrand, &lmatchType, &lstrandType))) {
-        PyErr_SetString(PyExc_RuntimeError, "pyFindOverlaps received an invalid or missing argument!");
+    opts->regions = NULL;
+    opts->attributes = NULL;
+    opts->nAttributes = 0;
+    if(!(PyArg_ParseTuple(args, "ssOOOOOOO|OO", fname, &ftype, &labelColumn, &oKeepExons, &exonID, &transcriptID, &designator, &attributeKey, &enrichment, &regions, &attributes))) {
+        PyErr_Format(PyExc_RuntimeError, "%s received an invalid or missing argument!", funcName);
+        return 1;
+    }
+    opts->ftype = str2ftype(ftype);
+    opts->enrichment = PyObject_IsTrue(enrichment);
+    opts->labelColumn = labelColumn2int(labelColumn);
+    opts->keepExons = PyObject_IsTrue(oKeepExons);
+    opts->exonID = (exonID == Py_None) ? NULL : pyObj2str(exonID);
+    opts->transcriptID = (transcriptID == Py_None) ? NULL : pyObj2str(transcriptID);
+    opts->designator = (designator == Py_None) ? NULL : pyObj2str(designator);
+    opts->attributeKey = (attributeKey == Py_None) ? NULL : pyObj2str(attributeKey);
+    if(PyErr_Occurred()) return 1;
+    //Staging may not hold the GIL, so the keys are copied
+    if(pyAttributeKeys(attributes, &keys, &(opts->nAttributes))) return 1;
+    if(opts->nAttributes > 0) {
+        opts->attributes = copyAttributeKeys(keys, opts->nAttributes);
+        free(keys);
+        if(!opts->attributes) {
+            PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the attribute keys!");
+            return 1;
+        }
+    }
+    if(regions != Py_None) {
+        opts->regions = pyDict2regionSet(regions);
+        if(!opts->regions) {
+            destroyAttributeKeys(opts->attributes, opts->nAttributes);
+            return 1;
+        }
+    }
+    return 0;
+}
+
+//Wrap a staged file in a capsule, which takes ownership of it. Returns NULL on error
+static PyObject *stagedCapsule(stagedFile *sf) {
+    PyObject *capsule;
+    stagedHandle *h = malloc(sizeof(stagedHandle));
+
+    if(!h) {
+        PyErr_SetString(PyExc_MemoryError, "Could not allocate memory while staging a file!");
+        destroyStagedFile(sf);
+        return NULL;
+    }
+    h->sf = sf;
+    capsule = PyCapsule_New(h, STAGED_CAPSULE, destroyStagedCapsule);
+    if(!capsule) {
+        destroyStagedFile(sf);
+        free(h);
+    }
+    return capsule;
+}
+
+static PyObject *pyStageFile(PyObject *self, PyObject *args) {
+    char *fname = NULL;
+    loadOpts opts;
+    stagedFile *sf;
+
+    if(parseStageArgs(args, "pyStageFile", &fname, &opts)) return NULL;
+    sf = stageFileNoGIL(fname, &opts);
+    destroyRegionSet(opts.regions);
+    destroyAttributeKeys(opts.attributes, opts.nAttributes);
+    if(!sf) return NULL;
+    return stagedCapsule(sf);
+}
+
+/*
+    Files can also be staged a chromosome at a time, for streaming. The reader
+    is held in a capsule, each call to nextChunk() then returns a tuple of the
+    chromosome, the number of entries and a staged file for the next block of
+    lines on a single chromosome, or None at the end of the file.
+*/
+#define CHUNK_CAPSULE "deeptoolsintervals.tree.chunkReader"
+
+static void destroyChunkCapsule(PyObject *capsule) {
+    chunkReader *r = PyCapsule_GetPointer(capsule, CHUNK_CAPSULE);
+    if(r) closeChunkReader(r);
+}
+
+static PyObject *pyOpenChunks(PyObject *self, PyObject *args) {
+    char *fname = NULL;
+    loadOpts opts;
+    chunkReader *r;
+    PyObject *capsule;
+
+    if(parseStageArgs(args, "pyOpenChunks", &fname, &opts)) return NULL;
+    //The reader takes ownership of opts.regions and opts.attributes
+    r = openChunkReader(fname, &opts);
+    if(!r) {
+        PyErr_Format(PyExc_RuntimeError, "Unable to open %s", fname);
         return NULL;
     }
+    capsule = PyCapsule_New(r, CHUNK_CAPSULE, destroyChunkCapsule);
+    if(!capsule) closeChunkReader(r);
+    return capsule;
+}
 
-    //I'm assuming that this is never called outside of the module
-    strandType = (int) lstrandType;
-    strand = (int) lstrand;
-    matchType = (int) matchType;
-    start = (uint32_t) lstart;
-    end = (uint32_t) lend;
+/*
+    Return a tuple of the values of some keys in a GTF attribute column, or None
+    for those that aren't present. The column is tokenized as csv.reader() with
+    a space delimiter would, in a single pass for all of the keys.
+*/
+static PyObject *pyParseAttributes(PyObject *self, PyObject *args) {
+    PyObject *oKeys = NULL, *seq = NULL, *out = NULL, *val;
+    char *s = NULL, **keys = NULL;
+    kstring_t *vals = NULL;
+    int *found = NULL;
+    Py_ssize_t i, nKeys = 0;
 
-    os = findOverlaps(NULL, t, chrom, start, end, strand, matchType, strandType, 0, NULL);
+    if(!PyArg_ParseTuple(args, "sO", &s, &oKeys)) {
+        PyErr_SetString(PyExc_RuntimeError, "pyParseAttributes received an invalid or missing argument!");
+        return NULL;
+    }
+    seq = PySequence_Fast(oKeys, "pyParseAttributes requires a list of keys!");
+    if(!seq) return NULL;
+    nKeys = PySequence_Fast_GET_SIZE(seq);
+    keys = calloc(nKeys + 1, sizeof(char*));
+    vals = calloc(nKeys + 1, sizeof(kstring_t));
+    found = calloc(nKeys + 1, sizeof(int));
+    if(!keys || !vals || !found) {
+        PyErr_SetString(PyExc_MemoryError, "Could not allocate memory while parsing attributes!");
+        goto out;
+    }
+    for(i=0; i<nKeys; i++) {
+        keys[i] = pyObj2str(PySequence_Fast_GET_ITEM(seq, i));
+        if(!keys[i]) goto out;
+    }
+    if(parseAttributes(s, keys, (int) nKeys, vals, found) < 0) {
+        PyErr_SetString(PyExc_MemoryError, "Could not allocate memory while parsing attributes!");
+        goto out;
+    }
 
-    // Did we receive an error?
-    if(!os) {
-        PyErr_SetString(PyExc_RuntimeError, "findOverlaps returned NULL!");
+    out = PyTuple_New(nKeys);
+    if(!out) goto out;
+    for(i=0; i<nKeys; i++) {
+        if(found[i]) {
+            val = PyString_FromString(vals[i].s);
+            if(!val) {
+                Py_DECREF(out);
+                out = NULL;
+                goto out;
+            }
+        } else {
+            val = Py_None;
+            Py_INCREF(val);
+        }
+        PyTuple_SET_ITEM(out, i, val);
+    }
+
+out:
+    if(vals) {
+        for(i=0; i<nKeys; i++) {
+            if(vals[i].s) free(vals[i].s);
+        }
+        free(vals);
+    }
+    if(keys) free(keys);
+    if(found) free(found);
+    Py_DECREF(seq);
+    return out;
+}
+
+static PyObject *pyNextChunk(PyObject *self, PyObject *args) {
+    PyObject *capsule = NULL, *staged, *out;
+    chunkReader *r;
+    stagedFile *sf;
+    uint64_t i, nEntries = 0;
+
+    if(!PyArg_ParseTuple(args, "O", &capsule)) {
+        PyErr_SetString(PyExc_RuntimeError, "pyNextChunk received an invalid or missing argument!");
         return NULL;
     }
+    r = PyCapsule_GetPointer(capsule, CHUNK_CAPSULE);
+    if(!r) return NULL;
+    if(r->eof) Py_RETURN_NONE;
 
-    if(!os->l) {
-        os_destroy(os);
-        Py_INCREF(Py_None);
-        return Py_None;
+    sf = stageChunk(r);
+    if(!sf) {
+        PyErr_SetString(PyExc_MemoryError, "Could not allocate memory while staging a file!");
+        return NULL;
+    }
+    if(sf->err.l) {
+        PyErr_SetString(PyExc_RuntimeError, sf->err.s);
+        destroyStagedFile(sf);
+        return NULL;
+    }
+    if(r->eof) {
+        destroyStagedFile(sf);
+        Py_RETURN_NONE;
+    }
+    for(i=0; i<sf->l; i++) {
+        if(sf->entries[i].type == STAGED_ENTRY) nEntries++;
     }
 
-    // Convert the overlapSet to a list of tuples
-    olist = PyList_New(os->l);
-    if(!olist) goto error;
-    for(i=0; i<os->l; i++) {
-        //Make the python string
-        ostring = PyString_FromString(val2strHT(t->htFeatures, os->overlaps[i]->feature));
-        if(!ostring) goto error;
+    staged = stagedCapsule(sf);
+    if(!staged) return NULL;
+    out = Py_BuildValue("(sKO)", r->chrom.s, (unsigned long long) nEntries, staged);
+    Py_DECREF(staged);
+    return out;
+}
 
-        // Add the item
-        if(PyList_SetItem(olist, i, ostring)) goto error;
-        ostring = NULL;
+static PyObject *pyLoadFile(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    char *ftype = NULL;
+    int keepExons = 0, rv;
+    loadOpts opts;
+    mergeState ms;
+    PyObject *fname = NULL, *labelColumn = NULL, *oKeepExons = NULL, *defaultLabel = NULL, *bname = NULL;
+    PyObject *labels = NULL, *exons = NULL, *duplicated = NULL, *munge = NULL;
+
+    if(treeIsReadOnly(self)) return NULL;
+    if(!(PyArg_ParseTuple(args, "OsOOsssOOOOOO", &fname, &ftype, &labelColumn, &oKeepExons, &(opts.exonID), &(opts.transcriptID), &(opts.designator), &defaultLabel, &bname, &labels, &exons, &duplicated, &munge))) {
+        PyErr_SetString(PyExc_RuntimeError, "pyLoadFile received an invalid or missing argument!");
+        return NULL;
     }
-    os_destroy(os);
+    if(!PyList_Check(labels) || !PyList_Check(exons) || !PyList_Check(duplicated) || !PyCallable_Check(munge)) {
+        PyErr_SetString(PyExc_RuntimeError, "pyLoadFile received an invalid or missing argument!");
+        return NULL;
+    }
+    keepExons = PyObject_IsTrue(oKeepExons);
+    opts.ftype = str2ftype(ftype);
+    opts.enrichment = 0;
+    opts.labelColumn = labelColumn2int(labelColumn);
+    opts.keepExons = keepExons;
+    opts.attributeKey = NULL;
+    opts.regions = NULL;
+    opts.attributes = NULL;
+    opts.nAttributes = 0;
 
-    return olist;
+    if(initMergeState(&ms, t, fname, &opts, munge)) return NULL;
+    if(opts.ftype == LOAD_GTF) {
+        rv = mergeGTF(&ms, labels, exons, duplicated, defaultLabel, bname);
+    } else {
+        rv = mergeBED(&ms, &opts, labels, exons, defaultLabel, bname);
+    }
+    destroyMergeState(&ms);
+    if(rv) return NULL;
 
-error:
-    if(ostring) Py_DECREF(ostring);
-    if(olist) Py_DECREF(olist);
-    PyErr_SetString(PyExc_RuntimeError, "findOverlappingFeatures received an error!");
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+//Append a feature to the features list if it isn't already in it. Returns 1 on error
+static int appendFeature(PyObject *features, PyObject *featureSet, PyObject *ofeature) {
+    int contains = PySet_Contains(featureSet, ofeature);
+
+    if(contains < 0) return 1;
+    if(!contains) {
+        if(PyList_Append(features, ofeature)) return 1;
+        if(PySet_Add(featureSet, ofeature)) return 1;
+    }
+    return 0;
+}
+
+/*
+    Equivalent to Enrichment.parseBED()/parseGTF(). With several attribute keys,
+    defaultFeature is a tuple holding the default of each.
+*/
+static int mergeEnrichment(mergeState *ms, loadOpts *opts, PyObject *features, PyObject *defaultFeature) {
+    stagedFile *sf = ms->sf;
+    stagedEntry *se;
+    uint64_t i, offset;
+    uint32_t j, start, end;
+    int rv = 1, k, nFeatures = 0, *isNew = NULL;
+    char *chrom, *feature, **otherFeatures = NULL;
+    PyObject *featureSet = NULL, *ofeature = NULL, *oDefault = defaultFeature;
+
+    featureSet = PySet_New(features);
+    if(!featureSet) return 1;
+    if(PyTuple_Check(defaultFeature)) {
+        nFeatures = (int) PyTuple_GET_SIZE(defaultFeature) - 1;
+        oDefault = PyTuple_GET_ITEM(defaultFeature, 0);
+        otherFeatures = calloc(nFeatures + 1, sizeof(char*));
+        isNew = calloc(nFeatures + 1, sizeof(int));
+        if(!otherFeatures || !isNew) {
+            PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the features!");
+            goto out;
+        }
+    }
+
+    for(i=0; i<sf->l; i++) {
+        se = sf->entries + i;
+        if(se->type != STAGED_ENTRY && se->type != STAGED_INVALID) continue;
+        if(se->label >= 0) {
+            ofeature = PyString_FromString(val2strHT(sf->labels, se->label));
+        } else {
+            ofeature = oDefault;
+            Py_INCREF(ofeature);
+        }
+        if(!ofeature) goto out;
+        feature = pyObj2str(ofeature);
+        if(!feature) goto out;
+
+        //The features of the other keys, only those new to the tree need to be looked at from python
+        offset = se->attributes;
+        for(k=0; k<nFeatures; k++) {
+            if(se->nAttributes) {
+                otherFeatures[k] = sf->strings.s + offset;
+                offset += strlen(otherFeatures[k]) + 1;
+            } else if(se->label >= 0) {
+                otherFeatures[k] = feature;
+            } else {
+                otherFeatures[k] = pyObj2str(PyTuple_GET_ITEM(defaultFeature, k + 1));
+                if(!otherFeatures[k]) goto out;
+            }
+            isNew[k] = se->type != STAGED_ENTRY || str2valHT(ms->t->htFeatures, otherFeatures[k]) < 0;
+        }
+
+        if(se->type == STAGED_ENTRY) {
+            chrom = mungedChrom(ms, se->chrom);
+            if(!chrom) goto out;
+            if(opts->ftype == LOAD_BED12 && opts->keepExons) {
+                for(j=0; j<se->nExons; j++) {
+                    start = sf->exons[se->exons + 2*j];
+                    end = sf->exons[se->exons + 2*j + 1];
+                    if(end <= start) {
+                        PyErr_SetString(PyExc_RuntimeError, "pyAddEnrichmentEntry received invalid bounds!");
+                        goto out;
+                    }
+                    if(addEnrichmententry(ms->t, chrom, start, end, se->strand, se->score, feature, otherFeatures, nFeatures)) {
+                        PyErr_SetString(PyExc_RuntimeError, "loadEnrichmentFile received an error while inserting an entry!");
+                        goto out;
+                    }
+                }
+            } else if(addEnrichmententry(ms->t, chrom, se->start, se->end, se->strand, se->score, feature, otherFeatures, nFeatures)) {
+                PyErr_SetString(PyExc_RuntimeError, "loadEnrichmentFile received an error while inserting an entry!");
+                goto out;
+            }
+        }
+
+        if(appendFeature(features, featureSet, ofeature)) goto out;
+        Py_DECREF(ofeature);
+        ofeature = NULL;
+        for(k=0; k<nFeatures; k++) {
+            if(!isNew[k]) continue;
+            ofeature = PyString_FromString(otherFeatures[k]);
+            if(!ofeature) goto out;
+            if(appendFeature(features, featureSet, ofeature)) goto out;
+            Py_DECREF(ofeature);
+            ofeature = NULL;
+        }
+    }
+    rv = 0;
+
+out:
+    Py_XDECREF(ofeature);
+    Py_DECREF(featureSet);
+    free(otherFeatures);
+    free(isNew);
+    return rv;
+}
+
+static PyObject *pyLoadEnrichmentFile(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    char *ftype = NULL;
+    int rv;
+    loadOpts opts;
+    mergeState ms;
+    PyObject *fname = NULL, *labelColumn = NULL, *oKeepExons = NULL, *attributeKey = NULL, *defaultFeature = NULL;
+    PyObject *features = NULL, *munge = NULL, *attributes = Py_None;
+
+    if(treeIsReadOnly(self)) return NULL;
+    if(!(PyArg_ParseTuple(args, "OsOOOOOO|O", &fname, &ftype, &labelColumn, &oKeepExons, &attributeKey, &defaultFeature, &features, &munge, &attributes))) {
+        PyErr_SetString(PyExc_RuntimeError, "pyLoadEnrichmentFile received an invalid or missing argument!");
+        return NULL;
+    }
+    if(!PyList_Check(features) || !PyCallable_Check(munge)) {
+        PyErr_SetString(PyExc_RuntimeError, "pyLoadEnrichmentFile received an invalid or missing argument!");
+        return NULL;
+    }
+    opts.ftype = str2ftype(ftype);
+    opts.enrichment = 1;
+    opts.labelColumn = labelColumn2int(labelColumn);
+    opts.keepExons = PyObject_IsTrue(oKeepExons);
+    opts.exonID = NULL;
+    opts.transcriptID = NULL;
+    opts.designator = NULL;
+    opts.attributeKey = (attributeKey == Py_None) ? NULL : pyObj2str(attributeKey);
+    opts.regions = NULL;
+    if(pyAttributeKeys(attributes, &(opts.attributes), &(opts.nAttributes))) return NULL;
+
+    rv = initMergeState(&ms, t, fname, &opts, munge);
+    if(!rv) {
+        rv = mergeEnrichment(&ms, &opts, features, defaultFeature);
+        destroyMergeState(&ms);
+    }
+    free(opts.attributes);
+    if(rv) return NULL;
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+/*
+    Balance (or compact) the tree on nThreads threads without the GIL. Queries
+    and modifications are refused until it's done.
+*/
+static int buildTree(pyGTFtree_t *self, uint32_t minDelta, int nThreads) {
+    int rv;
+
+    self->building = 1;
+    Py_BEGIN_ALLOW_THREADS
+    rv = balanceGTFtree(self->t, minDelta, nThreads);
+    Py_END_ALLOW_THREADS
+    self->building = 0;
+    return rv;
+}
+
+static PyObject *pyVine2Tree(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    PyObject *flatten = Py_False;
+    int nThreads = 1;
+
+    if(!PyArg_ParseTuple(args, "|Oi", &flatten, &nThreads)) return NULL;
+    if(treeIsReadOnly(self)) return NULL;
+    if(buildTree(self, 0, nThreads)) {
+        PyErr_SetString(PyExc_RuntimeError, "Received an error while building the tree!");
+        return NULL;
+    }
+    if(PyObject_IsTrue(flatten) && flattenGTFtree(t)) {
+        PyErr_SetString(PyExc_RuntimeError, "Received an error while flattening the tree!");
+        return NULL;
+    }
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+static PyObject *pyCompact(pyGTFtree_t *self, PyObject *args) {
+    int nThreads = 1;
+
+    if(!PyArg_ParseTuple(args, "|i", &nThreads)) return NULL;
+    if(treeIsReadOnly(self)) return NULL;
+    if(!self->t->balanced) Py_RETURN_NONE;
+    if(buildTree(self, DELTA_MIN, nThreads)) {
+        PyErr_SetString(PyExc_RuntimeError, "Received an error while compacting the tree!");
+        return NULL;
+    }
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+static PyObject *pyPrintGTFtree(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    printGTFtree(t);
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+static PyObject *pyCountEntries(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    uint32_t nEntries = 0;
+    unsigned long lnEntries = 0;
+    int32_t i;
+    PyObject *out = NULL;
+
+    for(i=0; i<t->n_targets; i++) {
+        nEntries += t->chroms[i]->n_entries;
+    }
+    lnEntries = (unsigned long) nEntries;
+    out = PyLong_FromUnsignedLong(lnEntries);
+
+    return out;
+}
+
+static PyObject *pyIsTree(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    if(t->balanced && !self->building) Py_RETURN_TRUE;
+    Py_RETURN_FALSE;
+}
+
+static PyObject *pyHasOverlaps(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    int rv;
+    uint32_t minDistance = (uint32_t) -1;
+    unsigned long long ominDistance;
+    PyObject *otuple = NULL, *oval = NULL;
+
+    rv = hasOverlaps(t, &minDistance);
+    ominDistance = minDistance; // ominDistance should have at least as much space as minDistance
+    otuple = PyTuple_New(2);
+    if(!otuple) {
+        PyErr_SetString(PyExc_RuntimeError, "Could not allocate space for a tuple!\n");
+        return NULL;
+    }
+    oval = PyLong_FromUnsignedLongLong(ominDistance);
+    if(!oval) {
+        PyErr_SetString(PyExc_RuntimeError, "Could not allocate space for a single integer!\n");
+        return NULL;
+    }
+
+    if(rv) {
+        Py_INCREF(Py_True);
+        PyTuple_SET_ITEM(otuple, 0, Py_True);
+    } else {
+        Py_INCREF(Py_False);
+        PyTuple_SET_ITEM(otuple, 0, Py_False);
+    }
+    PyTuple_SetItem(otuple, 1, oval);
+
+    return otuple;
+}
+
+//Returns a new list of (start, end) tuples, the entry bounds if there are no exons
+static PyObject *exonList(GTFtree *t, uint32_t start, uint32_t end, uint64_t exons, uint32_t nExons) {
+    PyObject *olist, *otuple;
+    uint32_t i;
+
+    if(!nExons) return Py_BuildValue("[(kk)]", (unsigned long) start, (unsigned long) end);
+    olist = PyList_New(nExons);
+    if(!olist) return NULL;
+    for(i=0; i<nExons; i++) {
+        otuple = Py_BuildValue("(kk)", (unsigned long) t->exons[2*(exons + i)], (unsigned long) t->exons[2*(exons + i) + 1]);
+        if(!otuple) {
+            Py_DECREF(olist);
+            return NULL;
+        }
+        PyList_SET_ITEM(olist, i, otuple);
+    }
+    return olist;
+}
+
+//The tuple returned for a single overlap by findOverlaps(). exons may be NULL
+static PyObject *overlapTuple(uint32_t start, uint32_t end, char *name, uint32_t labelIdx, PyObject *exons, uint8_t strand, double score, int includeStrand) {
+    char strandChar = '.';
+    PyObject *oscore = NULL, *otuple = NULL;
+
+    if(strand == 0) {
+        strandChar = '+';
+    } else if(strand == 1) {
+        strandChar = '-';
+    }
+    if(score == DBL_MAX) {
+        oscore = Py_BuildValue("s", ".");
+    } else {
+        oscore = Py_BuildValue("d", score);
+    }
+    if(!oscore) return NULL;
+
+    if(exons && includeStrand) {
+        otuple = Py_BuildValue("(kkskOcO)", (unsigned long) start, (unsigned long) end, name, (unsigned long) labelIdx, exons, strandChar, oscore);
+    } else if(exons) {
+        otuple = Py_BuildValue("(kkskOO)", (unsigned long) start, (unsigned long) end, name, (unsigned long) labelIdx, exons, oscore);
+    } else if(includeStrand) {
+        otuple = Py_BuildValue("(kkskcO)", (unsigned long) start, (unsigned long) end, name, (unsigned long) labelIdx, strandChar, oscore);
+    } else {
+        otuple = Py_BuildValue("(kkskO)", (unsigned long) start, (unsigned long) end, name, (unsigned long) labelIdx, oscore);
+    }
+    Py_DECREF(oscore);
+    return otuple;
+}
+
+/*
+    Convert the overlaps found in a flattened (fos) or unflattened (os) tree to
+    the list of tuples returned by findOverlaps(). The sets aren't destroyed.
+*/
+static PyObject *overlapList(GTFtree *t, flatOverlapSet *fos, overlapSet *os, char *transcript_id, int includeStrand, int includeExons) {
+    int32_t i;
+    flatEntry *fe;
+    GTFentry *e;
+    PyObject *olist = NULL, *otuple = NULL, *oexons = NULL;
+
+    olist = PyList_New(fos ? fos->l : os->l);
+    if(!olist) return NULL;
+    for(i=0; i<PyList_GET_SIZE(olist); i++) {
+        if(fos) {
+            fe = fos->overlaps[i];
+            if(includeExons) {
+                oexons = exonList(t, fe->start, fe->end, fe->exons, fe->nExons);
+                if(!oexons) goto error;
+            }
+            otuple = overlapTuple(fe->start, fe->end, val2strHT(t->htAttributes, fe->name), fe->labelIdx, oexons, fe->strand, fe->score, includeStrand);
+        } else {
+            e = os->overlaps[i];
+            if(includeExons) {
+                oexons = exonList(t, e->start, e->end, e->exons, e->nExons);
+                if(!oexons) goto error;
+            }
+            otuple = overlapTuple(e->start, e->end, getAttribute(t, e, transcript_id), e->labelIdx, oexons, e->strand, e->score, includeStrand);
+        }
+        Py_XDECREF(oexons);
+        oexons = NULL;
+        if(!otuple) goto error;
+
+        // Add the tuple
+        PyList_SET_ITEM(olist, i, otuple);
+    }
+    return olist;
+
+error:
+    Py_DECREF(olist);
+    return NULL;
+}
+
+static void destroyAttributeFilter(attributeFilter *af) {
+    if(!af) return;
+    if(af->keys) free(af->keys);
+    if(af->offsets) free(af->offsets);
+    if(af->vals) free(af->vals);
+    free(af);
+}
+
+//Look up an attribute key or value, which must be a string, returning -2 on error
+static int32_t attributeID(GTFtree *t, PyObject *obj) {
+    char *s;
+
+    if(!PyUnicode_Check(obj) && !PyBytes_Check(obj)) {
+        PyErr_SetString(PyExc_RuntimeError, "Attribute keys and values must be strings!");
+        return -2;
+    }
+    s = PyBytes_Check(obj) ? PyBytes_AsString(obj) : pyObj2str(obj);
+    if(!s) return -2;
+    return str2valHT(t->htAttributes, s);
+}
+
+/*
+    Convert the require argument of the query functions, a dict of attribute
+    keys to a value or a list of values, to an attributeFilter. af is set to
+    NULL if require is None. Returns 1 on error.
+*/
+static int pyDict2attributeFilter(GTFtree *t, PyObject *require, attributeFilter **af) {
+    PyObject *key, *value, *seq = NULL;
+    Py_ssize_t pos = 0, i, nVals = 0;
+    int32_t *tmp;
+    int k = 0;
+
+    *af = NULL;
+    if(require == Py_None) return 0;
+    if(!PyDict_Check(require)) {
+        PyErr_SetString(PyExc_RuntimeError, "require must be a dict of attribute keys and values!");
+        return 1;
+    }
+    if(t->image) {
+        PyErr_SetString(PyExc_RuntimeError, "Trees loaded from an index have no attributes!");
+        return 1;
+    }
+    *af = calloc(1, sizeof(attributeFilter));
+    if(!*af) goto memError;
+    (*af)->n = (int) PyDict_Size(require);
+    (*af)->keys = malloc(((*af)->n + 1) * sizeof(int32_t));
+    (*af)->offsets = malloc(((*af)->n + 1) * sizeof(int));
+    if(!(*af)->keys || !(*af)->offsets) goto memError;
+
+    while(PyDict_Next(require, &pos, &key, &value)) {
+        if(((*af)->keys[k] = attributeID(t, key)) < -1) goto error;
+        (*af)->offsets[k++] = (int) nVals;
+        if(PyUnicode_Check(value) || PyBytes_Check(value)) {
+            seq = PyTuple_Pack(1, value);
+        } else {
+            seq = PySequence_Fast(value, "The required values of an attribute must be a string or a list of strings!");
+        }
+        if(!seq) goto error;
+        tmp = realloc((*af)->vals, (nVals + PySequence_Fast_GET_SIZE(seq) + 1) * sizeof(int32_t));
+        if(!tmp) goto memError;
+        (*af)->vals = tmp;
+        for(i=0; i<PySequence_Fast_GET_SIZE(seq); i++) {
+            if(((*af)->vals[nVals++] = attributeID(t, PySequence_Fast_GET_ITEM(seq, i))) < -1) goto error;
+        }
+        Py_DECREF(seq);
+        seq = NULL;
+    }
+    (*af)->offsets[k] = (int) nVals;
+    return 0;
+
+memError:
+    PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the required attributes!");
+error:
+    Py_XDECREF(seq);
+    destroyAttributeFilter(*af);
+    *af = NULL;
+    return 1;
+}
+
+static PyObject *pyFindOverlaps(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    char *chrom = NULL, *transcript_id = NULL;
+    uint32_t start, end;
+    int strand = 3, strandType = 0, matchType = 0, includeExons = 0;
+    unsigned long lstrand, lstart, lend, lmatchType, lstrandType;
+    overlapSet *os = NULL;
+    flatOverlapSet *fos = NULL;
+    attributeFilter *af = NULL;
+    PyObject *olist = NULL, *includeStrand = Py_False, *oIncludeExons = Py_False, *require = Py_None;
+
+    if(treeIsBuilding(self)) return NULL;
+    if(!(PyArg_ParseTuple(args, "skkkkksO|OO", &chrom, &lstart, &lend, &lstrand, &lmatchType, &lstrandType, &transcript_id, &includeStrand, &oIncludeExons, &require))) {
+        PyErr_SetString(PyExc_RuntimeError, "pyFindOverlaps received an invalid or missing argument!");
+        return NULL;
+    }
+    if(pyDict2attributeFilter(t, require, &af)) return NULL;
+
+    //I'm assuming that this is never called outside of the module
+    strandType = (int) lstrandType;
+    strand = (int) lstrand;
+    matchType = (int) lmatchType;
+    start = (uint32_t) lstart;
+    end = (uint32_t) lend;
+    includeExons = PyObject_IsTrue(oIncludeExons);
+
+    //Filtering attributes needs the GTFentries, which flattened trees also keep
+    self->readers++;
+    Py_BEGIN_ALLOW_THREADS
+    if(t->flat && !af) {
+        fos = findOverlapsFlat(NULL, t, chrom, start, end, strand, matchType, strandType);
+    } else {
+        os = findOverlaps(NULL, t, chrom, start, end, strand, matchType, strandType, 0, af ? requireAttributes : NULL, af);
+    }
+    Py_END_ALLOW_THREADS
+    self->readers--;
+    destroyAttributeFilter(af);
+
+    // Did we receive an error?
+    if(!os && !fos) {
+        PyErr_SetString(PyExc_RuntimeError, "findOverlaps returned NULL!");
+        return NULL;
+    }
+
+    // Convert the overlapSet to a list of tuples
+    olist = overlapList(t, fos, os, transcript_id, includeStrand == Py_True, includeExons);
+    if(os) os_destroy(os);
+    if(fos) fos_destroy(fos);
+    if(!olist) {
+        PyErr_SetString(PyExc_RuntimeError, "findOverlaps received an error!");
+        return NULL;
+    }
+    return olist;
+}
+
+/*
+    A sweep-line cursor from openSweep() is held in a capsule, whose context is
+    the tree it belongs to (a reference to which is held until it's destroyed).
+*/
+#define SWEEP_CAPSULE "deeptoolsintervals.tree.sweepCursor"
+
+static void destroySweepCapsule(PyObject *capsule) {
+    sweepCursor *sc = PyCapsule_GetPointer(capsule, SWEEP_CAPSULE);
+    PyObject *tree = PyCapsule_GetContext(capsule);
+    if(sc) sc_destroy(sc);
+    Py_XDECREF(tree);
+}
+
+static PyObject *pyOpenSweep(pyGTFtree_t *self, PyObject *args) {
+    sweepCursor *sc = sc_init(self->t);
+    PyObject *capsule;
+
+    if(!sc) {
+        PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for a sweep cursor!");
+        return NULL;
+    }
+    capsule = PyCapsule_New(sc, SWEEP_CAPSULE, destroySweepCapsule);
+    if(!capsule) {
+        sc_destroy(sc);
+        return NULL;
+    }
+    Py_INCREF(self);
+    if(PyCapsule_SetContext(capsule, self)) {
+        Py_DECREF(self);
+        Py_DECREF(capsule);
+        return NULL;
+    }
+    return capsule;
+}
+
+static PyObject *pySweepOverlaps(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    char *chrom = NULL, *transcript_id = NULL;
+    int32_t tid, rv;
+    uint32_t start, end;
+    unsigned long lstrand, lstart, lend, lmatchType, lstrandType;
+    sweepCursor *sc;
+    overlapSet *os = NULL;
+    flatOverlapSet *fos = NULL;
+    PyObject *capsule = NULL, *olist = NULL, *includeStrand = Py_False, *oIncludeExons = Py_False;
+
+    if(treeIsBuilding(self)) return NULL;
+    if(!(PyArg_ParseTuple(args, "OskkkkksO|O", &capsule, &chrom, &lstart, &lend, &lstrand, &lmatchType, &lstrandType, &transcript_id, &includeStrand, &oIncludeExons))) {
+        PyErr_SetString(PyExc_RuntimeError, "pySweepOverlaps received an invalid or missing argument!");
+        return NULL;
+    }
+    sc = PyCapsule_GetPointer(capsule, SWEEP_CAPSULE);
+    if(!sc) return NULL;
+    if(sc->t != t) {
+        PyErr_SetString(PyExc_RuntimeError, "This sweep cursor belongs to a different tree!");
+        return NULL;
+    }
+    start = (uint32_t) lstart;
+    end = (uint32_t) lend;
+
+    if(t->flat) fos = fos_init(t);
+    else os = os_init(t);
+    if(!os && !fos) {
+        PyErr_SetString(PyExc_MemoryError, "Could not allocate memory for the overlaps!");
+        return NULL;
+    }
+
+    tid = str2valHT(t->htChroms, chrom);
+    self->readers++;
+    Py_BEGIN_ALLOW_THREADS
+    rv = sweepOverlaps(sc, tid, start, end, (int) lstrand, (int) lmatchType, (int) lstrandType, fos, os);
+    Py_END_ALLOW_THREADS
+    self->readers--;
+
+    if(rv == -2) {
+        PyErr_Format(PyExc_RuntimeError, "The regions aren't sorted, %s:%lu comes after %s:%lu!", chrom, lstart, chrom, (unsigned long) sc->start);
+    } else if(rv < 0) {
+        PyErr_SetString(PyExc_MemoryError, "Could not allocate memory while sweeping!");
+    } else {
+        olist = overlapList(t, fos, os, transcript_id, includeStrand == Py_True, PyObject_IsTrue(oIncludeExons));
+        if(!olist) PyErr_SetString(PyExc_RuntimeError, "sweepOverlaps received an error!");
+    }
+    if(os) os_destroy(os);
+    if(fos) fos_destroy(fos);
+    return olist;
+}
+
+/*
+    The feature of an Enrichment entry for its key-th attribute key, given its
+    feature and exons (see GTFentry), or -1 if it has none
+*/
+static int32_t keyFeature(GTFtree *t, int32_t feature, uint64_t exons, uint32_t nExons, int key) {
+    if(!key) return feature;
+    if(key < 0 || (uint32_t) key > nExons) return -1;
+    return (int32_t) t->exons[2 * (exons + key - 1) + 1];
+}
+
+static PyObject *pyFindOverlappingFeatures(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    char *chrom = NULL;
+    int32_t i, n, feature;
+    uint32_t start, end;
+    int strand = 3, strandType = 0, matchType = 0, nKeys = 0, k;
+    unsigned long lstrand, lstart, lend, lmatchType, lstrandType;
+    overlapSet *os = NULL;
+    flatOverlapSet *fos = NULL;
+    PyObject *olist = NULL, *ostring = NULL, *okey = NULL;
+
+    if(treeIsBuilding(self)) return NULL;
+    if(!(PyArg_ParseTuple(args, "skkkkk|i", &chrom, &lstart, &lend, &lstrand, &lmatchType, &lstrandType, &nKeys))) {
+        PyErr_SetString(PyExc_RuntimeError, "pyFindOverlaps received an invalid or missing argument!");
+        return NULL;
+    }
+
+    //I'm assuming that this is never called outside of the module
+    strandType = (int) lstrandType;
+    strand = (int) lstrand;
+    matchType = (int) lmatchType;
+    start = (uint32_t) lstart;
+    end = (uint32_t) lend;
+
+    self->readers++;
+    Py_BEGIN_ALLOW_THREADS
+    if(t->flat) {
+        fos = findOverlapsFlat(NULL, t, chrom, start, end, strand, matchType, strandType);
+    } else {
+        os = findOverlaps(NULL, t, chrom, start, end, strand, matchType, strandType, 0, NULL, NULL);
+    }
+    Py_END_ALLOW_THREADS
+    self->readers--;
+
+    if(fos) {
+        n = fos->l;
+    } else {
+        // Did we receive an error?
+        if(!os) {
+            PyErr_SetString(PyExc_RuntimeError, "findOverlaps returned NULL!");
+            return NULL;
+        }
+        n = os->l;
+    }
+
+    if(!n) {
+        if(os) os_destroy(os);
+        if(fos) fos_destroy(fos);
+        Py_INCREF(Py_None);
+        return Py_None;
+    }
+
+    // Convert the overlapSet to a list of tuples
+    if(nKeys <= 0) {
+        olist = PyList_New(n);
+        if(!olist) goto error;
+        for(i=0; i<n; i++) {
+            //Make the python string
+            if(fos) {
+                ostring = PyString_FromString(val2strHT(t->htFeatures, fos->overlaps[i]->feature));
+            } else {
+                ostring = PyString_FromString(val2strHT(t->htFeatures, os->overlaps[i]->feature));
+            }
+            if(!ostring) goto error;
+
+            // Add the item
+            if(PyList_SetItem(olist, i, ostring)) goto error;
+            ostring = NULL;
+        }
+    } else {
+        //A list of the features for each attribute key
+        olist = PyList_New(nKeys);
+        if(!olist) goto error;
+        for(k=0; k<nKeys; k++) {
+            okey = PyList_New(0);
+            if(!okey) goto error;
+            PyList_SET_ITEM(olist, k, okey);
+            for(i=0; i<n; i++) {
+                if(fos) {
+                    feature = keyFeature(t, fos->overlaps[i]->feature, fos->overlaps[i]->exons, fos->overlaps[i]->nExons, k);
+                } else {
+                    feature = keyFeature(t, os->overlaps[i]->feature, os->overlaps[i]->exons, os->overlaps[i]->nExons, k);
+                }
+                if(feature < 0) continue;
+                ostring = PyString_FromString(val2strHT(t->htFeatures, feature));
+                if(!ostring) goto error;
+                if(PyList_Append(okey, ostring)) goto error;
+                Py_DECREF(ostring);
+                ostring = NULL;
+            }
+        }
+    }
+    if(os) os_destroy(os);
+    if(fos) fos_destroy(fos);
+
+    return olist;
+
+error:
+    if(os) os_destroy(os);
+    if(fos) fos_destroy(fos);
+    if(ostring) Py_DECREF(ostring);
+    if(olist) Py_DECREF(olist);
+    PyErr_SetString(PyExc_RuntimeError, "findOverlappingFeatures received an error!");
+    return NULL;
+}
+
+/*
+    countOverlaps() and overlapsAny() share their arguments: chrom, start, end,
+    strand, matchType, strandType and, optionally, the attributes to require
+    (see pyDict2attributeFilter()). Returns 0 on success.
+*/
+static int parseCountArgs(GTFtree *t, PyObject *args, char **chrom, uint32_t *start, uint32_t *end, int *strand, int *matchType, int *strandType, attributeFilter **af) {
+    unsigned long lstart, lend;
+    PyObject *require = Py_None;
+
+    if(!(PyArg_ParseTuple(args, "skkiii|O", chrom, &lstart, &lend, strand, matchType, strandType, &require))) {
+        PyErr_SetString(PyExc_RuntimeError, "Received an invalid or missing argument!");
+        return 1;
+    }
+    *start = (uint32_t) lstart;
+    *end = (uint32_t) lend;
+    return pyDict2attributeFilter(t, require, af);
+}
+
+static PyObject *pyCountOverlaps(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    char *chrom = NULL;
+    uint32_t start, end;
+    int strand, matchType, strandType;
+    int32_t n;
+    attributeFilter *af = NULL;
+
+    if(treeIsBuilding(self)) return NULL;
+    if(parseCountArgs(t, args, &chrom, &start, &end, &strand, &matchType, &strandType, &af)) return NULL;
+
+    self->readers++;
+    Py_BEGIN_ALLOW_THREADS
+    n = countOverlaps(t, chrom, start, end, strand, matchType, strandType, af ? requireAttributes : NULL, af);
+    Py_END_ALLOW_THREADS
+    self->readers--;
+    destroyAttributeFilter(af);
+
+    return pyCount((long) n);
+}
+
+static PyObject *pyOverlapsAny(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    char *chrom = NULL;
+    uint32_t start, end;
+    int strand, matchType, strandType, rv;
+    attributeFilter *af = NULL;
+
+    if(treeIsBuilding(self)) return NULL;
+    if(parseCountArgs(t, args, &chrom, &start, &end, &strand, &matchType, &strandType, &af)) return NULL;
+
+    self->readers++;
+    Py_BEGIN_ALLOW_THREADS
+    rv = overlapsAny(t, chrom, start, end, strand, matchType, strandType, af ? requireAttributes : NULL, af);
+    Py_END_ALLOW_THREADS
+    self->readers--;
+    destroyAttributeFilter(af);
+
+    return PyBool_FromLong((long) rv);
+}
+
+/*
+    Return a dict of the values of an attribute among the overlaps that
+    findOverlaps() would return and the number of overlaps with each. The
+    arguments are chrom, start, end, strand, matchType, strandType, the key
+    and, optionally, the attributes to require.
+*/
+static PyObject *pyAttributeCounts(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    char *chrom = NULL, *key = NULL;
+    unsigned long lstart, lend;
+    int strand, matchType, strandType;
+    int32_t i;
+    overlapSet *os;
+    uniqueSet *us = NULL;
+    attributeFilter *af = NULL;
+    PyObject *require = Py_None, *out = NULL, *ocnt;
+
+    if(treeIsBuilding(self)) return NULL;
+    if(!(PyArg_ParseTuple(args, "skkiiis|O", &chrom, &lstart, &lend, &strand, &matchType, &strandType, &key, &require))) {
+        PyErr_SetString(PyExc_RuntimeError, "pyAttributeCounts received an invalid or missing argument!");
+        return NULL;
+    }
+    if(t->image) {
+        PyErr_SetString(PyExc_RuntimeError, "Trees loaded from an index have no attributes!");
+        return NULL;
+    }
+    if(pyDict2attributeFilter(t, require, &af)) return NULL;
+
+    self->readers++;
+    Py_BEGIN_ALLOW_THREADS
+    os = findOverlaps(NULL, t, chrom, (uint32_t) lstart, (uint32_t) lend, strand, matchType, strandType, 0, af ? requireAttributes : NULL, af);
+    us = uniqueAttributes(os, key);
+    Py_END_ALLOW_THREADS
+    self->readers--;
+    destroyAttributeFilter(af);
+    os_destroy(os);
+
+    out = PyDict_New();
+    if(!out) goto error;
+    for(i=0; us && i<us->l; i++) {
+        ocnt = pyCount((long) us_cnt(us, i));
+        if(!ocnt) goto error;
+        if(PyDict_SetItemString(out, us_val(us, i), ocnt)) {
+            Py_DECREF(ocnt);
+            goto error;
+        }
+        Py_DECREF(ocnt);
+    }
+    us_destroy(us);
+    return out;
+
+error:
+    us_destroy(us);
+    Py_XDECREF(out);
+    return NULL;
+}
+
+/*******************************************************************************
+*
+* Batch queries
+*
+* A batch of regions is given as columns (numpy arrays, array.array objects or
+* plain sequences) and the results are returned as CSR-style columns: the
+* overlaps of query i are entries offsets[i] through offsets[i+1]-1.
+*
+*******************************************************************************/
+//A column of integers, read via the buffer protocol if possible and otherwise as a sequence
+typedef struct {
+    Py_buffer view;
+    int isBuffer;
+    char format;
+    PyObject *seq;
+    Py_ssize_t n;
+} batchColumn;
+
+typedef struct {
+    uint64_t l, m;
+    int32_t *names;
+    uint32_t *starts, *ends, *labels;
+    double *scores;
+    uint8_t *strands;
+} batchResults;
+
+static void destroyBatchColumn(batchColumn *col) {
+    if(col->isBuffer) PyBuffer_Release(&(col->view));
+    Py_XDECREF(col->seq);
+    col->isBuffer = 0;
+    col->seq = NULL;
+}
+
+//Returns 0 on success, sets an exception otherwise
+static int initBatchColumn(batchColumn *col, PyObject *obj) {
+    char *fmt;
+
+    memset(col, 0, sizeof(batchColumn));
+    //A string (of strands) has the buffer interface on python 2, but is a sequence of characters
+    if(!PyBytes_Check(obj) && PyObject_CheckBuffer(obj) && !PyObject_GetBuffer(obj, &(col->view), PyBUF_FORMAT | PyBUF_C_CONTIGUOUS)) {
+        col->isBuffer = 1;
+        fmt = col->view.format;
+        if(fmt && (*fmt == '@' || *fmt == '=' || (*fmt == '<' && PY_LITTLE_ENDIAN))) fmt++;
+        //Anything other than 1-dimensional native integers is read as a sequence
+        if(col->view.ndim == 1 && fmt && strlen(fmt) == 1 && strchr("bBhHiIlLqQnN", *fmt)) {
+            col->format = *fmt;
+            col->n = col->view.shape[0];
+            return 0;
+        }
+        destroyBatchColumn(col);
+    }
+    PyErr_Clear();
+
+    col->seq = PySequence_Fast(obj, "Expected a sequence or an array of integers!");
+    if(!col->seq) return 1;
+    col->n = PySequence_Fast_GET_SIZE(col->seq);
+    return 0;
+}
+
+//On error, an exception is set and 0 is returned, so use PyErr_Occurred() after this
+static int64_t batchColumnValue(batchColumn *col, Py_ssize_t i) {
+    PyObject *obj;
+    void *p;
+    int64_t val;
+
+    if(col->isBuffer) {
+        p = (char*) col->view.buf + i * col->view.itemsize;
+        switch(col->format) {
+        case 'b' : return *(signed char*) p;
+        case 'B' : return *(unsigned char*) p;
+        case 'h' : return *(short*) p;
+        case 'H' : return *(unsigned short*) p;
+        case 'i' : return *(int*) p;
+        case 'I' : return *(unsigned int*) p;
+        case 'l' : return *(long*) p;
+        case 'L' : return (int64_t) *(unsigned long*) p;
+        case 'q' : return *(long long*) p;
+        case 'Q' : return (int64_t) *(unsigned long long*) p;
+        case 'n' : return *(Py_ssize_t*) p;
+        default : return (int64_t) *(size_t*) p;
+        }
+    }
+
+    //Floats and the like are rejected rather than truncated
+    obj = PySequence_Fast_GET_ITEM(col->seq, i);
+    if(!PyIndex_Check(obj)) {
+        PyErr_Format(PyExc_RuntimeError, "Expected an integer, but received a %.200s!", Py_TYPE(obj)->tp_name);
+        return 0;
+    }
+    obj = PyNumber_Index(obj);
+    if(!obj) return 0;
+    val = PyLong_AsLongLong(obj);
+    Py_DECREF(obj);
+    return val;
+}
+
+//The strand of query i, as used by findOverlaps(). Strings and integers are both accepted.
+static int batchStrand(PyObject *strands, batchColumn *col, Py_ssize_t i) {
+    PyObject *obj;
+    int64_t val;
+    char *s;
+
+    if(!strands) return 3;
+    if(col->seq) {
+        obj = PySequence_Fast_GET_ITEM(col->seq, i);
+        if(PyBytes_Check(obj) || PyUnicode_Check(obj)) {
+            s = PyBytes_Check(obj) ? PyBytes_AsString(obj) : pyObj2str(obj);
+            if(!s) return -1;
+            if(*s == '+') return 0;
+            if(*s == '-') return 1;
+            return 3;
+        }
+    }
+    val = batchColumnValue(col, i);
+    if(PyErr_Occurred()) return -1;
+    if(val == 0 || val == 1) return (int) val;
+    return 3;
+}
+
+/*
+    Convert a chromosome name to its index in t->htChroms. The munge function
+    is called once for each distinct chromosome object, the results are cached
+    in the tids dictionary. Returns -2 on error.
+*/
+static int32_t batchChrom(GTFtree *t, PyObject *chrom, PyObject *munge, PyObject *tids) {
+    PyObject *otid, *name, *munged = NULL;
+    int32_t tid = -1;
+    char *s;
+
+    otid = PyDict_GetItem(tids, chrom);
+    if(otid) return (int32_t) PyLong_AsLong(otid);
+
+    if(PyBytes_Check(chrom)) {
+        name = PyUnicode_FromEncodedObject(chrom, "ascii", "strict");
+    } else {
+        name = PyObject_Str(chrom);
+    }
+    if(!name) return -2;
+    if(munge && munge != Py_None) {
+        munged = PyObject_CallFunctionObjArgs(munge, name, NULL);
+        Py_DECREF(name);
+        if(!munged) return -2;
+        name = munged;
+    }
+    if(PyObject_IsTrue(name)) {
+        s = pyObj2str(name);
+        if(!s) {
+            Py_DECREF(name);
+            return -2;
+        }
+        tid = str2valHT(t->htChroms, s);
+    }
+    Py_DECREF(name);
+
+    otid = PyLong_FromLong(tid);
+    if(!otid) return -2;
+    if(PyDict_SetItem(tids, chrom, otid)) tid = -2;
+    Py_DECREF(otid);
+    return tid;
+}
+
+static void destroyBatchResults(batchResults *br) {
+    if(br->names) free(br->names);
+    if(br->starts) free(br->starts);
+    if(br->ends) free(br->ends);
+    if(br->labels) free(br->labels);
+    if(br->scores) free(br->scores);
+    if(br->strands) free(br->strands);
+}
+
+//Returns 0 on success and 1 on error (i.e., out of memory)
+static int pushBatchResult(batchResults *br, int32_t name, uint32_t start, uint32_t end, uint32_t labelIdx, double score, uint8_t strand) {
+    void *tmp;
+    uint64_t m;
+
+    if(br->l >= br->m) {
+        m = br->m ? 2 * br->m : 1024;
+        if(!(tmp = realloc(br->names, m * sizeof(int32_t)))) return 1;
+        br->names = tmp;
+        if(!(tmp = realloc(br->starts, m * sizeof(uint32_t)))) return 1;
+        br->starts = tmp;
+        if(!(tmp = realloc(br->ends, m * sizeof(uint32_t)))) return 1;
+        br->ends = tmp;
+        if(!(tmp = realloc(br->labels, m * sizeof(uint32_t)))) return 1;
+        br->labels = tmp;
+        if(!(tmp = realloc(br->scores, m * sizeof(double)))) return 1;
+        br->scores = tmp;
+        if(!(tmp = realloc(br->strands, m * sizeof(uint8_t)))) return 1;
+        br->strands = tmp;
+        br->m = m;
+    }
+    br->names[br->l] = name;
+    br->starts[br->l] = start;
+    br->ends[br->l] = end;
+    br->labels[br->l] = labelIdx;
+    br->strands[br->l] = strand;
+    br->scores[br->l++] = (score == DBL_MAX) ? Py_NAN : score;
+    return 0;
+}
+
+//The attribute value ID of a GTFentry's name, or -1 if it lacks one
+static int32_t entryName(GTFentry *e, int32_t nameKey) {
+    int i;
+    for(i=0; i<e->nAttributes; i++) {
+        if(e->attrib[i].key == nameKey) return e->attrib[i].val;
+    }
+    return -1;
+}
+
+//Returns a new bytearray holding a copy of len bytes of buf
+static PyObject *column2bytearray(void *buf, uint64_t len) {
+    if(!len) return PyByteArray_FromStringAndSize("", 0);
+    return PyByteArray_FromStringAndSize((char*) buf, (Py_ssize_t) len);
+}
+
+//Set items i to i+4 of the tuple out to the names, starts, ends, labels and scores columns. Returns 1 on error
+static int setResultColumns(PyObject *out, Py_ssize_t i, batchResults *br) {
+    PyObject *ocol;
+
+    if(!(ocol = column2bytearray(br->names, br->l * sizeof(int32_t)))) return 1;
+    PyTuple_SET_ITEM(out, i, ocol);
+    if(!(ocol = column2bytearray(br->starts, br->l * sizeof(uint32_t)))) return 1;
+    PyTuple_SET_ITEM(out, i + 1, ocol);
+    if(!(ocol = column2bytearray(br->ends, br->l * sizeof(uint32_t)))) return 1;
+    PyTuple_SET_ITEM(out, i + 2, ocol);
+    if(!(ocol = column2bytearray(br->labels, br->l * sizeof(uint32_t)))) return 1;
+    PyTuple_SET_ITEM(out, i + 3, ocol);
+    if(!(ocol = column2bytearray(br->scores, br->l * sizeof(double)))) return 1;
+    PyTuple_SET_ITEM(out, i + 4, ocol);
+    return 0;
+}
+
+/*
+    The queries of a batch, converted from python objects. A tid of -1 denotes
+    a query that can't have any overlaps.
+*/
+typedef struct {
+    int32_t *tids;
+    uint32_t *starts, *ends;
+    int8_t *strands;
+} batchQueries;
+
+static void destroyBatchQueries(batchQueries *bq) {
+    if(bq->tids) free(bq->tids);
+    if(bq->starts) free(bq->starts);
+    if(bq->ends) free(bq->ends);
+    if(bq->strands) free(bq->strands);
+}
+
+//Returns 0 on success, sets an exception otherwise
+static int initBatchQueries(batchQueries *bq, GTFtree *t, Py_ssize_t n, PyObject *ochroms, batchColumn *starts, batchColumn *ends, PyObject *ostrands, batchColumn *strands, PyObject *munge) {
+    PyObject *chromSeq = NULL, *tids = NULL;
+    int64_t lstart, lend;
+    int32_t tid = -1;
+    int strand;
+    Py_ssize_t i;
+
+    bq->tids = malloc((n + 1) * sizeof(int32_t));
+    bq->starts = malloc((n + 1) * sizeof(uint32_t));
+    bq->ends = malloc((n + 1) * sizeof(uint32_t));
+    bq->strands = malloc((n + 1) * sizeof(int8_t));
+    if(!bq->tids || !bq->starts || !bq->ends || !bq->strands) {
+        PyErr_SetString(PyExc_RuntimeError, "Could not allocate space for the queries!");
+        return 1;
+    }
+
+    //A single chromosome name applies to every region
+    tids = PyDict_New();
+    if(!tids) goto error;
+    if(PyUnicode_Check(ochroms) || PyBytes_Check(ochroms)) {
+        tid = batchChrom(t, ochroms, munge, tids);
+        if(tid == -2) goto error;
+    } else {
+        chromSeq = PySequence_Fast(ochroms, "The chromosomes must be a string or a sequence of strings!");
+        if(!chromSeq) goto error;
+        if(PySequence_Fast_GET_SIZE(chromSeq) != n) {
+            PyErr_SetString(PyExc_RuntimeError, "The chromosomes must be of the same length as the starts!");
+            goto error;
+        }
+    }
+
+    for(i=0; i<n; i++) {
+        if(chromSeq) {
+            tid = batchChrom(t, PySequence_Fast_GET_ITEM(chromSeq, i), munge, tids);
+            if(tid == -2) goto error;
+        }
+        lstart = batchColumnValue(starts, i);
+        lend = batchColumnValue(ends, i);
+        strand = batchStrand(ostrands, strands, i);
+        if(PyErr_Occurred()) goto error;
+        if(lstart < 0 || lend < lstart) {
+            PyErr_Format(PyExc_RuntimeError, "Region %zd (%lld-%lld) has a negative start or ends before it starts!", i, (long long) lstart, (long long) lend);
+            goto error;
+        }
+        //Zero-length regions are searched as single positions, as by findOverlaps()
+        bq->tids[i] = (lstart > 0xFFFFFFFF) ? -1 : tid;
+        if(lend > 0xFFFFFFFF) lend = 0xFFFFFFFF;
+        bq->starts[i] = (uint32_t) lstart;
+        bq->ends[i] = (uint32_t) lend;
+        bq->strands[i] = (int8_t) strand;
+    }
+
+    Py_XDECREF(chromSeq);
+    Py_DECREF(tids);
+    return 0;
+
+error:
+    Py_XDECREF(chromSeq);
+    Py_XDECREF(tids);
+    return 1;
+}
+
+/*
+    Run a batch of queries, without needing the GIL. offsets must hold n+1
+    values. If af isn't NULL, only overlaps with those attributes are kept.
+    Returns 0 on success and 1 if memory couldn't be allocated.
+*/
+static int runBatchQueries(GTFtree *t, batchQueries *bq, Py_ssize_t n, int matchType, int strandType, int trimOverlap, attributeFilter *af, int64_t *offsets, batchResults *br) {
+    overlapSet *os = NULL;
+    flatOverlapSet *fos = NULL;
+    GTFentry *e;
+    flatEntry *fe;
+    int32_t nameKey;
+    int i, l, rv = 1;
+    Py_ssize_t j;
+
+    if(t->flat && !af) {
+        fos = fos_init(t);
+    } else {
+        os = os_init(t);
+    }
+    nameKey = str2valHT(t->htAttributes, "transcript_id");
+
+    for(j=0; j<n; j++) {
+        offsets[j] = (int64_t) br->l;
+        if(bq->tids[j] < 0) continue;
+
+        if(fos) {
+            findOverlapsFlatChrom(fos, t, bq->tids[j], bq->starts[j], bq->ends[j], bq->strands[j], matchType, strandType);
+            l = fos->l;
+        } else {
+            findOverlapsChrom(os, t, bq->tids[j], bq->starts[j], bq->ends[j], bq->strands[j], matchType, strandType, 0, af ? requireAttributes : NULL, af);
+            l = os->l;
+        }
+        for(i=0; i<l; i++) {
+            if(fos) {
+                fe = fos->overlaps[i];
+                if(trimOverlap && fe->start < bq->starts[j]) continue;
+                if(pushBatchResult(br, fe->name, fe->start, fe->end, fe->labelIdx, fe->score, fe->strand)) goto out;
+            } else {
+                e = os->overlaps[i];
+                if(trimOverlap && e->start < bq->starts[j]) continue;
+                if(pushBatchResult(br, entryName(e, nameKey), e->start, e->end, e->labelIdx, e->score, e->strand)) goto out;
+            }
+        }
+    }
+    offsets[n] = (int64_t) br->l;
+    rv = 0;
+
+out:
+    if(os) os_destroy(os);
+    if(fos) fos_destroy(fos);
+    return rv;
+}
+
+static PyObject *pyFindOverlapsBatch(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    PyObject *ochroms, *ostarts, *oends, *ostrands = Py_None, *munge = Py_None, *oTrim = Py_False;
+    PyObject *out = NULL, *ocol;
+    batchColumn starts, ends, strands;
+    batchQueries bq;
+    batchResults br;
+    int64_t *offsets = NULL;
+    int rv, trimOverlap, matchType = 0, strandType = 0;
+    Py_ssize_t n;
+
+    memset(&starts, 0, sizeof(batchColumn));
+    memset(&ends, 0, sizeof(batchColumn));
+    memset(&strands, 0, sizeof(batchColumn));
+    memset(&bq, 0, sizeof(batchQueries));
+    memset(&br, 0, sizeof(batchResults));
+
+    if(!(PyArg_ParseTuple(args, "OOO|OiiOO", &ochroms, &ostarts, &oends, &ostrands, &matchType, &strandType, &oTrim, &munge))) {
+        PyErr_SetString(PyExc_RuntimeError, "pyFindOverlapsBatch received an invalid or missing argument!");
+        return NULL;
+    }
+    if(!t->balanced || self->building) {
+        PyErr_SetString(PyExc_RuntimeError, "The tree must be finished before it can be queried!");
+        return NULL;
+    }
+    trimOverlap = PyObject_IsTrue(oTrim);
+
+    if(initBatchColumn(&starts, ostarts)) goto error;
+    if(initBatchColumn(&ends, oends)) goto error;
+    n = starts.n;
+    if(ends.n != n) {
+        PyErr_SetString(PyExc_RuntimeError, "The starts and ends must be of the same length!");
+        goto error;
+    }
+    if(ostrands == Py_None) {
+        ostrands = NULL;
+    } else {
+        if(initBatchColumn(&strands, ostrands)) goto error;
+        if(strands.n != n) {
+            PyErr_SetString(PyExc_RuntimeError, "The strands must be of the same length as the starts!");
+            goto error;
+        }
+    }
+    if(initBatchQueries(&bq, t, n, ochroms, &starts, &ends, ostrands, &strands, munge)) goto error;
+
+    offsets = malloc((n + 1) * sizeof(int64_t));
+    if(!offsets) goto nomem;
+    self->readers++;
+    Py_BEGIN_ALLOW_THREADS
+    rv = runBatchQueries(t, &bq, n, matchType, strandType, trimOverlap, NULL, offsets, &br);
+    Py_END_ALLOW_THREADS
+    self->readers--;
+    if(rv) goto nomem;
+
+    out = PyTuple_New(6);
+    if(!out) goto error;
+    ocol = column2bytearray(offsets, (n + 1) * sizeof(int64_t));
+    if(!ocol) goto error;
+    PyTuple_SET_ITEM(out, 0, ocol);
+    if(setResultColumns(out, 1, &br)) goto error;
+
+    free(offsets);
+    destroyBatchResults(&br);
+    destroyBatchQueries(&bq);
+    destroyBatchColumn(&starts);
+    destroyBatchColumn(&ends);
+    destroyBatchColumn(&strands);
+    return out;
+
+nomem:
+    PyErr_SetString(PyExc_RuntimeError, "Could not allocate space for the overlaps!");
+error:
+    if(offsets) free(offsets);
+    destroyBatchResults(&br);
+    destroyBatchQueries(&bq);
+    destroyBatchColumn(&starts);
+    destroyBatchColumn(&ends);
+    destroyBatchColumn(&strands);
+    Py_XDECREF(out);
+    return NULL;
+}
+
+/*
+    The overlaps of a single region as columns, which avoids creating a tuple
+    per overlap: a tuple of bytearrays of int32 name IDs, uint32 starts, ends
+    and label indices, double scores and uint8 strands. The arguments are as
+    in countOverlaps(), but with trimOverlap before the attributes to require,
+    so chrom must already be munged. The overlaps are sorted by start and then end position.
+*/
+static PyObject *pyFindOverlapsColumns(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    char *chrom = NULL;
+    uint32_t start, end;
+    unsigned long lstart, lend;
+    int32_t tid = -1;
+    int8_t strand8;
+    int rv, strand, strandType, matchType, trimOverlap;
+    int64_t offsets[2];
+    batchQueries bq;
+    batchResults br;
+    attributeFilter *af = NULL;
+    PyObject *out = NULL, *ocol, *oTrim = Py_False, *require = Py_None;
+
+    if(!(PyArg_ParseTuple(args, "skkiii|OO", &chrom, &lstart, &lend, &strand, &matchType, &strandType, &oTrim, &require))) {
+        PyErr_SetString(PyExc_RuntimeError, "pyFindOverlapsColumns received an invalid or missing argument!");
+        return NULL;
+    }
+    start = (uint32_t) lstart;
+    end = (uint32_t) lend;
+    trimOverlap = PyObject_IsTrue(oTrim);
+    if(!t->balanced || self->building) {
+        PyErr_SetString(PyExc_RuntimeError, "The tree must be finished before it can be queried!");
+        return NULL;
+    }
+    if(pyDict2attributeFilter(t, require, &af)) return NULL;
+
+    memset(&br, 0, sizeof(batchResults));
+    if(start < end) tid = str2valHT(t->htChroms, chrom);
+    bq.tids = &tid;
+    bq.starts = &start;
+    bq.ends = &end;
+    strand8 = (int8_t) strand;
+    bq.strands = &strand8;
+    self->readers++;
+    Py_BEGIN_ALLOW_THREADS
+    rv = runBatchQueries(t, &bq, 1, matchType, strandType, trimOverlap, af, offsets, &br);
+    Py_END_ALLOW_THREADS
+    self->readers--;
+    destroyAttributeFilter(af);
+    if(rv) {
+        PyErr_SetString(PyExc_RuntimeError, "Could not allocate space for the overlaps!");
+        goto error;
+    }
+
+    out = PyTuple_New(6);
+    if(!out) goto error;
+    if(setResultColumns(out, 0, &br)) goto error;
+    if(!(ocol = column2bytearray(br.strands, br.l * sizeof(uint8_t)))) goto error;
+    PyTuple_SET_ITEM(out, 5, ocol);
+
+    destroyBatchResults(&br);
+    return out;
+
+error:
+    destroyBatchResults(&br);
+    Py_XDECREF(out);
+    return NULL;
+}
+
+/*
+    As runBatchQueries(), but only counting the overlaps of each query (up to
+    max, if not 0) into counts. This needs no memory.
+*/
+static void runBatchCounts(GTFtree *t, batchQueries *bq, Py_ssize_t n, int matchType, int strandType, int32_t max, int32_t *counts) {
+    Py_ssize_t j;
+
+    for(j=0; j<n; j++) {
+        if(bq->tids[j] < 0) {
+            counts[j] = 0;
+        } else if(max) {
+            counts[j] = overlapsAnyChrom(t, bq->tids[j], bq->starts[j], bq->ends[j], bq->strands[j], matchType, strandType, NULL, NULL);
+        } else {
+            counts[j] = countOverlapsChrom(t, bq->tids[j], bq->starts[j], bq->ends[j], bq->strands[j], matchType, strandType, NULL, NULL);
+        }
+    }
+}
+
+/*
+    The batch versions of countOverlaps() and overlapsAny(), which take the
+    same arguments as findOverlapsBatch() other than trimOverlap. A bytearray
+    of int32 counts (or uint8 booleans for overlapsAny()) is returned.
+*/
+static PyObject *countBatch(pyGTFtree_t *self, PyObject *args, int any) {
+    GTFtree *t = self->t;
+    PyObject *ochroms, *ostarts, *oends, *ostrands = Py_None, *munge = Py_None;
+    PyObject *out = NULL;
+    batchColumn starts, ends, strands;
+    batchQueries bq;
+    int32_t *counts = NULL;
+    uint8_t *found;
+    int matchType = 0, strandType = 0;
+    Py_ssize_t i, n;
+
+    memset(&starts, 0, sizeof(batchColumn));
+    memset(&ends, 0, sizeof(batchColumn));
+    memset(&strands, 0, sizeof(batchColumn));
+    memset(&bq, 0, sizeof(batchQueries));
+
+    if(!(PyArg_ParseTuple(args, "OOO|OiiO", &ochroms, &ostarts, &oends, &ostrands, &matchType, &strandType, &munge))) {
+        PyErr_SetString(PyExc_RuntimeError, "Received an invalid or missing argument!");
+        return NULL;
+    }
+    if(!t->balanced || self->building) {
+        PyErr_SetString(PyExc_RuntimeError, "The tree must be finished before it can be queried!");
+        return NULL;
+    }
+
+    if(initBatchColumn(&starts, ostarts)) goto error;
+    if(initBatchColumn(&ends, oends)) goto error;
+    n = starts.n;
+    if(ends.n != n) {
+        PyErr_SetString(PyExc_RuntimeError, "The starts and ends must be of the same length!");
+        goto error;
+    }
+    if(ostrands == Py_None) {
+        ostrands = NULL;
+    } else {
+        if(initBatchColumn(&strands, ostrands)) goto error;
+        if(strands.n != n) {
+            PyErr_SetString(PyExc_RuntimeError, "The strands must be of the same length as the starts!");
+            goto error;
+        }
+    }
+    if(initBatchQueries(&bq, t, n, ochroms, &starts, &ends, ostrands, &strands, munge)) goto error;
+
+    counts = malloc((n + 1) * sizeof(int32_t));
+    if(!counts) {
+        PyErr_SetString(PyExc_RuntimeError, "Could not allocate space for the counts!");
+        goto error;
+    }
+    self->readers++;
+    Py_BEGIN_ALLOW_THREADS
+    runBatchCounts(t, &bq, n, matchType, strandType, any, counts);
+    Py_END_ALLOW_THREADS
+    self->readers--;
+
+    if(any) {
+        //Narrow the results in place
+        found = (uint8_t*) counts;
+        for(i=0; i<n; i++) found[i] = (counts[i] > 0);
+        out = column2bytearray(found, n * sizeof(uint8_t));
+    } else {
+        out = column2bytearray(counts, n * sizeof(int32_t));
+    }
+
+error:
+    if(counts) free(counts);
+    destroyBatchQueries(&bq);
+    destroyBatchColumn(&starts);
+    destroyBatchColumn(&ends);
+    destroyBatchColumn(&strands);
+    return out;
+}
+
+static PyObject *pyCountOverlapsBatch(pyGTFtree_t *self, PyObject *args) {
+    return countBatch(self, args, 0);
+}
+
+static PyObject *pyOverlapsAnyBatch(pyGTFtree_t *self, PyObject *args) {
+    return countBatch(self, args, 1);
+}
+
+/*
+    Enrichment-style queries, where each read is a group of consecutive
+    queries (its blocks) and what's wanted is the set of features that any of
+    them overlaps. Features are given by their index in t->htFeatures, which is
+    also their index in the Enrichment class's features list.
+*/
+typedef struct {
+    uint64_t l, m;
+    int32_t *IDs;
+} featureList;
+
+static int cmpInt32(const void *a, const void *b) {
+    int32_t ia = *((int32_t*) a);
+    int32_t ib = *((int32_t*) b);
+    if(ia < ib) return -1;
+    return ia > ib;
+}
+
+//Returns 0 on success and 1 on error (i.e., out of memory)
+static int pushFeature(featureList *fl, int32_t ID) {
+    int32_t *tmp;
+    uint64_t m;
+
+    if(fl->l >= fl->m) {
+        m = fl->m ? 2 * fl->m : 1024;
+        if(!(tmp = realloc(fl->IDs, m * sizeof(int32_t)))) return 1;
+        fl->IDs = tmp;
+        fl->m = m;
+    }
+    fl->IDs[fl->l++] = ID;
+    return 0;
+}
+
+/*
+    Convert the offsets of each read's blocks (or None, for one block per read)
+    to an array of nReads+1 values. Returns 0 on success, sets an exception
+    otherwise.
+*/
+static int initReadOffsets(PyObject *oOffsets, Py_ssize_t nBlocks, int64_t **offsets, Py_ssize_t *nReads) {
+    batchColumn col;
+    Py_ssize_t i;
+
+    if(oOffsets == Py_None) {
+        *nReads = nBlocks;
+    } else {
+        if(initBatchColumn(&col, oOffsets)) return 1;
+        *nReads = col.n - 1;
+    }
+    *offsets = malloc((*nReads + 2) * sizeof(int64_t));
+    if(!*offsets) {
+        PyErr_SetString(PyExc_RuntimeError, "Could not allocate space for the read offsets!");
+        if(oOffsets != Py_None) destroyBatchColumn(&col);
+        return 1;
+    }
+    if(oOffsets == Py_None) {
+        for(i=0; i<=nBlocks; i++) (*offsets)[i] = i;
+        return 0;
+    }
+
+    for(i=0; i<=*nReads; i++) {
+        (*offsets)[i] = batchColumnValue(&col, i);
+        if(PyErr_Occurred()) break;
+        if((i == 0 && (*offsets)[i] != 0) || (i > 0 && (*offsets)[i] < (*offsets)[i-1]) || (*offsets)[i] > nBlocks) {
+            PyErr_SetString(PyExc_RuntimeError, "The read offsets must start at 0 and not decrease!");
+            break;
+        }
+    }
+    if(!PyErr_Occurred() && (*nReads < 0 || (*offsets)[*nReads] != nBlocks)) {
+        PyErr_SetString(PyExc_RuntimeError, "The last read offset must be the number of blocks!");
+    }
+    destroyBatchColumn(&col);
+    if(PyErr_Occurred()) {
+        free(*offsets);
+        *offsets = NULL;
+        return 1;
+    }
+    return 0;
+}
+
+/*
+    Find the features overlapped by each read, without needing the GIL. If
+    counts isn't NULL, then the count of each feature is incremented once for
+    each read overlapping it. Otherwise, the (sorted) features of each read
+    are appended to fl and out, which must hold nReads+1 values, is filled with
+    the offsets of each read's features. Returns 1 if memory couldn't be
+    allocated.
+*/
+static int runFeatureQueries(GTFtree *t, batchQueries *bq, int64_t *readOffsets, Py_ssize_t nReads, int matchType, int strandType, int key, int64_t *counts, featureList *fl, int64_t *out) {
+    overlapSet *os = NULL;
+    flatOverlapSet *fos = NULL;
+    uint64_t *seen = NULL, first, nFeatures = t->htFeatures->l;
+    int32_t feature;
+    int i, l, rv = 1;
+    Py_ssize_t r;
+    int64_t j;
+
+    //seen[feature] is 1 + the last read overlapping it
+    seen = calloc(nFeatures + 1, sizeof(uint64_t));
+    if(!seen) return 1;
+    if(t->flat) {
+        fos = fos_init(t);
+    } else {
+        os = os_init(t);
+    }
+
+    for(r=0; r<nReads; r++) {
+        first = fl->l;
+        if(out) out[r] = (int64_t) first;
+        for(j=readOffsets[r]; j<readOffsets[r+1]; j++) {
+            if(bq->tids[j] < 0) continue;
+            if(fos) {
+                findOverlapsFlatChrom(fos, t, bq->tids[j], bq->starts[j], bq->ends[j], bq->strands[j], matchType, strandType);
+                l = fos->l;
+            } else {
+                findOverlapsChrom(os, t, bq->tids[j], bq->starts[j], bq->ends[j], bq->strands[j], matchType, strandType, 0, NULL, NULL);
+                l = os->l;
+            }
+            for(i=0; i<l; i++) {
+                if(fos) {
+                    feature = keyFeature(t, fos->overlaps[i]->feature, fos->overlaps[i]->exons, fos->overlaps[i]->nExons, key);
+                } else {
+                    feature = keyFeature(t, os->overlaps[i]->feature, os->overlaps[i]->exons, os->overlaps[i]->nExons, key);
+                }
+                if(feature < 0 || (uint64_t) feature >= nFeatures || seen[feature] == (uint64_t) r + 1) continue;
+                seen[feature] = (uint64_t) r + 1;
+                if(counts) {
+                    counts[feature]++;
+                } else if(pushFeature(fl, feature)) {
+                    goto out;
+                }
+            }
+        }
+        if(fl->l - first > 1) qsort(fl->IDs + first, fl->l - first, sizeof(int32_t), cmpInt32);
+    }
+    if(out) out[nReads] = (int64_t) fl->l;
+    rv = 0;
+
+out:
+    if(os) os_destroy(os);
+    if(fos) fos_destroy(fos);
+    free(seen);
+    return rv;
+}
+
+/*
+    Arguments: chroms, starts, ends, offsets, strands, matchType, strandType,
+    munge, counts and key, where the blocks of read i are offsets[i] through
+    offsets[i+1]-1 (or each block is a read if offsets is None) and the other
+    columns are as in findOverlapsBatch(). If counts (a writable buffer of
+    int64 with a value per feature) is given, it's incremented in place and
+    None is returned. Otherwise, a tuple of bytearrays of int64 offsets and the
+    int32 features of each read is returned. key is the index of the attribute
+    key whose features are used (see keyFeature()).
+*/
+static PyObject *pyFindFeaturesBatch(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    PyObject *ochroms, *ostarts, *oends, *oOffsets = Py_None, *ostrands = Py_None, *munge = Py_None, *ocounts = Py_None;
+    PyObject *out = NULL, *ocol;
+    batchColumn starts, ends, strands;
+    batchQueries bq;
+    featureList fl;
+    Py_buffer counts;
+    int64_t *readOffsets = NULL, *featureOffsets = NULL;
+    int rv, hasCounts = 0, matchType = 0, strandType = 0, key = 0;
+    char *fmt;
+    Py_ssize_t n, nReads = 0;
+
+    memset(&starts, 0, sizeof(batchColumn));
+    memset(&ends, 0, sizeof(batchColumn));
+    memset(&strands, 0, sizeof(batchColumn));
+    memset(&bq, 0, sizeof(batchQueries));
+    memset(&fl, 0, sizeof(featureList));
+
+    if(!(PyArg_ParseTuple(args, "OOO|OOiiOOi", &ochroms, &ostarts, &oends, &oOffsets, &ostrands, &matchType, &strandType, &munge, &ocounts, &key))) {
+        PyErr_SetString(PyExc_RuntimeError, "pyFindFeaturesBatch received an invalid or missing argument!");
+        return NULL;
+    }
+    if(!t->balanced || self->building) {
+        PyErr_SetString(PyExc_RuntimeError, "The tree must be finished before it can be queried!");
+        return NULL;
+    }
+
+    if(ocounts != Py_None) {
+        if(PyObject_GetBuffer(ocounts, &counts, PyBUF_WRITABLE | PyBUF_FORMAT | PyBUF_C_CONTIGUOUS)) return NULL;
+        hasCounts = 1;
+        fmt = counts.format;
+        if(fmt && (*fmt == '@' || *fmt == '=' || (*fmt == '<' && PY_LITTLE_ENDIAN))) fmt++;
+        if(counts.ndim != 1 || counts.itemsize != sizeof(int64_t) || !fmt || strlen(fmt) != 1 || !strchr("qQlL", *fmt)) {
+            PyErr_SetString(PyExc_RuntimeError, "The counts must be a writable, 1-dimensional array of int64!");
+            goto error;
+        }
+        if((uint64_t) counts.shape[0] < t->htFeatures->l) {
+            PyErr_SetString(PyExc_RuntimeError, "The counts must have a value for every feature!");
+            goto error;
+        }
+    }
+
+    if(initBatchColumn(&starts, ostarts)) goto error;
+    if(initBatchColumn(&ends, oends)) goto error;
+    n = starts.n;
+    if(ends.n != n) {
+        PyErr_SetString(PyExc_RuntimeError, "The starts and ends must be of the same length!");
+        goto error;
+    }
+    if(ostrands == Py_None) {
+        ostrands = NULL;
+    } else {
+        if(initBatchColumn(&strands, ostrands)) goto error;
+        if(strands.n != n) {
+            PyErr_SetString(PyExc_RuntimeError, "The strands must be of the same length as the starts!");
+            goto error;
+        }
+    }
+    if(initBatchQueries(&bq, t, n, ochroms, &starts, &ends, ostrands, &strands, munge)) goto error;
+    if(initReadOffsets(oOffsets, n, &readOffsets, &nReads)) goto error;
+
+    if(!hasCounts) {
+        featureOffsets = malloc((nReads + 1) * sizeof(int64_t));
+        if(!featureOffsets) goto nomem;
+    }
+    self->readers++;
+    Py_BEGIN_ALLOW_THREADS
+    rv = runFeatureQueries(t, &bq, readOffsets, nReads, matchType, strandType, key, hasCounts ? (int64_t*) counts.buf : NULL, &fl, featureOffsets);
+    Py_END_ALLOW_THREADS
+    self->readers--;
+    if(rv) goto nomem;
+
+    if(hasCounts) {
+        Py_INCREF(Py_None);
+        out = Py_None;
+    } else {
+        out = PyTuple_New(2);
+        if(!out) goto error;
+        ocol = column2bytearray(featureOffsets, (nReads + 1) * sizeof(int64_t));
+        if(!ocol) goto error;
+        PyTuple_SET_ITEM(out, 0, ocol);
+        ocol = column2bytearray(fl.IDs, fl.l * sizeof(int32_t));
+        if(!ocol) goto error;
+        PyTuple_SET_ITEM(out, 1, ocol);
+    }
+    goto cleanup;
+
+nomem:
+    PyErr_SetString(PyExc_RuntimeError, "Could not allocate space for the features!");
+error:
+    Py_XDECREF(out);
+    out = NULL;
+cleanup:
+    if(hasCounts) PyBuffer_Release(&counts);
+    if(readOffsets) free(readOffsets);
+    if(featureOffsets) free(featureOffsets);
+    if(fl.IDs) free(fl.IDs);
+    destroyBatchQueries(&bq);
+    destroyBatchColumn(&starts);
+    destroyBatchColumn(&ends);
+    destroyBatchColumn(&strands);
+    return out;
+}
+
+static PyObject *pyGetAttributeValues(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    PyObject *oids, *olist = NULL, *oval;
+    batchColumn ids;
+    int64_t id;
+    Py_ssize_t i;
+
+    if(!(PyArg_ParseTuple(args, "O", &oids))) {
+        PyErr_SetString(PyExc_RuntimeError, "pyGetAttributeValues received an invalid or missing argument!");
+        return NULL;
+    }
+    if(initBatchColumn(&ids, oids)) return NULL;
+
+    olist = PyList_New(ids.n);
+    if(!olist) goto error;
+    for(i=0; i<ids.n; i++) {
+        id = batchColumnValue(&ids, i);
+        if(PyErr_Occurred()) goto error;
+        if(id < 0 || (uint64_t) id >= t->htAttributes->l) {
+            Py_INCREF(Py_None);
+            oval = Py_None;
+        } else {
+            oval = PyString_FromString(val2strHT(t->htAttributes, (int32_t) id));
+            if(!oval) goto error;
+        }
+        PyList_SET_ITEM(olist, i, oval);
+    }
+    destroyBatchColumn(&ids);
+    return olist;
+
+error:
+    destroyBatchColumn(&ids);
+    Py_XDECREF(olist);
+    return NULL;
+}
+
+/*******************************************************************************
+*
+* Index files (see index.c)
+*
+*******************************************************************************/
+typedef struct {
+    GTFtree *t;
+    PyObject *exons;
+    uint32_t *bounds;
+    uint32_t m;
+} exonLookup;
+
+//Fetch the exons of name from the GTF class's exons list of dicts, storing them in el->bounds
+static int exonBounds(exonLookup *el, char *name, uint32_t labelIdx, uint32_t **bounds, uint32_t *nBounds) {
+    PyObject *d, *olist, *otuple;
+    uint32_t i, *tmp;
+    Py_ssize_t n;
+
+    *nBounds = 0;
+    if(!name || (Py_ssize_t) labelIdx >= PyList_Size(el->exons)) return 0;
+    d = PyList_GetItem(el->exons, labelIdx);
+    if(!d || !PyDict_Check(d)) return 1;
+    olist = PyDict_GetItemString(d, name);
+    if(!olist) return 0;
+    n = PySequence_Size(olist);
+    if(n < 0) return 1;
+    if(n > el->m) {
+        tmp = realloc(el->bounds, 2 * n * sizeof(uint32_t));
+        if(!tmp) return 1;
+        el->bounds = tmp;
+        el->m = n;
+    }
+    for(i=0; i<n; i++) {
+        otuple = PySequence_GetItem(olist, i);
+        if(!otuple) return 1;
+        if(!PyArg_ParseTuple(otuple, "II", el->bounds + 2*i, el->bounds + 2*i + 1)) {
+            Py_DECREF(otuple);
+            return 1;
+        }
+        Py_DECREF(otuple);
+    }
+    *bounds = el->bounds;
+    *nBounds = (uint32_t) n;
+    return 0;
+}
+
+//The getExons() callback for saveIndex(), using the GTF class's exons list of dicts
+static int lookupExons(void *data, flatEntry *e, uint32_t **bounds, uint32_t *nBounds) {
+    exonLookup *el = (exonLookup*) data;
+    return exonBounds(el, val2strHT(el->t->htAttributes, e->name), e->labelIdx, bounds, nBounds);
+}
+
+/*
+    Move the exons from the GTF class's exons list of dicts into the tree, which
+    then returns them from findOverlaps(). Entries that already have exons are
+    skipped, so this can be called again after adding files.
+*/
+static PyObject *pyStoreExons(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    PyObject *exons = NULL;
+    GTFentry **entries;
+    exonLookup el;
+    uint32_t *bounds, nBounds;
+    int32_t i;
+    uint32_t j;
+
+    if(!PyArg_ParseTuple(args, "O", &exons) || !PyList_Check(exons)) {
+        PyErr_SetString(PyExc_RuntimeError, "pyStoreExons received an invalid or missing argument!");
+        return NULL;
+    }
+    if(treeIsReadOnly(self)) return NULL;
+
+    el.t = t;
+    el.exons = exons;
+    el.bounds = NULL;
+    el.m = 0;
+    for(i=0; i<t->n_targets; i++) {
+        entries = getChromEntries(t->chroms[i]);
+        if(!entries && t->chroms[i]->n_entries) goto error;
+        for(j=0; j<t->chroms[i]->n_entries; j++) {
+            if(entries[j]->nExons) continue;
+            if(exonBounds(&el, getAttribute(t, entries[j], "transcript_id"), entries[j]->labelIdx, &bounds, &nBounds)) {
+                free(entries);
+                goto error;
+            }
+            if(nBounds && addExons(t, entries[j], bounds, nBounds)) {
+                free(entries);
+                goto error;
+            }
+        }
+        if(entries) free(entries);
+    }
+    if(el.bounds) free(el.bounds);
+
+    Py_INCREF(Py_None);
+    return Py_None;
+
+error:
+    if(el.bounds) free(el.bounds);
+    if(!PyErr_Occurred()) PyErr_SetString(PyExc_RuntimeError, "Could not store the exons in the tree!");
+    return NULL;
+}
+
+static PyObject *pySaveIndex(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    char *fname = NULL, *meta = NULL;
+    Py_ssize_t metaLen = 0;
+    int rv;
+    exonLookup el;
+    PyObject *ometa = NULL, *exons = NULL;
+
+    if(!(PyArg_ParseTuple(args, "sOO", &fname, &ometa, &exons)) || PyBytes_AsStringAndSize(ometa, &meta, &metaLen)) {
+        PyErr_SetString(PyExc_RuntimeError, "pySaveIndex received an invalid or missing argument!");
+        return NULL;
+    }
+    if(!t->balanced || self->building) {
+        PyErr_SetString(PyExc_RuntimeError, "Only a finished tree can be saved!");
+        return NULL;
+    }
+
+    el.t = t;
+    el.exons = exons;
+    el.bounds = NULL;
+    el.m = 0;
+    if(exons != Py_None && PyList_Check(exons)) {
+        rv = saveIndex(t, fname, meta, (uint64_t) metaLen, lookupExons, &el);
+    } else {
+        rv = saveIndex(t, fname, meta, (uint64_t) metaLen, NULL, NULL);
+    }
+    if(el.bounds) free(el.bounds);
+    if(rv) {
+        if(!PyErr_Occurred()) PyErr_Format(PyExc_RuntimeError, "Could not write the index file %s!", fname);
+        return NULL;
+    }
+
+    Py_INCREF(Py_None);
+    return Py_None;
+}
+
+static PyObject *pyDumpIndex(pyGTFtree_t *self, PyObject *args) {
+    GTFtree *t = self->t;
+    char *meta = NULL, *image = NULL;
+    Py_ssize_t metaLen = 0;
+    uint64_t size = 0;
+    int rv;
+    exonLookup el;
+    Py_buffer view;
+    PyObject *ometa = NULL, *exons = NULL, *allocate = NULL, *out = NULL;
+
+    if(!(PyArg_ParseTuple(args, "OOO", &ometa, &exons, &allocate)) || PyBytes_AsStringAndSize(ometa, &meta, &metaLen) || !PyCallable_Check(allocate)) {
+        PyErr_SetString(PyExc_RuntimeError, "pyDumpIndex received an invalid or missing argument!");
+        return NULL;
+    }
+    if(!t->balanced || self->building) {
+        PyErr_SetString(PyExc_RuntimeError, "Only a finished tree can be saved!");
+        return NULL;
+    }
+
+    el.t = t;
+    el.exons = exons;
+    el.bounds = NULL;
+    el.m = 0;
+    if(exons != Py_None && PyList_Check(exons)) {
+        rv = dumpIndex(t, &image, &size, meta, (uint64_t) metaLen, lookupExons, &el);
+    } else {
+        rv = dumpIndex(t, &image, &size, meta, (uint64_t) metaLen, NULL, NULL);
+    }
+    if(el.bounds) free(el.bounds);
+    if(rv) {
+        if(!PyErr_Occurred()) PyErr_SetString(PyExc_RuntimeError, "Could not create the index image!");
+        return NULL;
+    }
+
+    //Copy the image to a buffer from allocate(size)
+    out = PyObject_CallFunction(allocate, "K", (unsigned long long) size);
+    if(!out) goto error;
+    if(PyObject_GetBuffer(out, &view, PyBUF_WRITABLE)) goto error;
+    if((uint64_t) view.len < size) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_RuntimeError, "The buffer is too small to hold the index image!");
+        goto error;
+    }
+    memcpy(view.buf, image, size);
+    PyBuffer_Release(&view);
+    free(image);
+    return out;
+
+error:
+    free(image);
+    Py_XDECREF(out);
+    return NULL;
+}
+
+//Returns a tuple of a new python object wrapping t and its metadata, destroying t on error
+static PyObject *indexTuple(GTFtree *t, char *meta, uint64_t metaLen) {
+    pyGTFtree_t *pt = NULL;
+    PyObject *out, *ometa;
+
+    pt = PyObject_New(pyGTFtree_t, &pyGTFtree);
+    if(!pt) {
+        destroyGTFtree(t);
+        return NULL;
+    }
+    pt->t = t;
+    pt->readers = 0;
+    pt->building = 0;
+    pt->image = NULL;
+    pt->imageOwner = NULL;
+
+    ometa = PyBytes_FromStringAndSize(meta, (Py_ssize_t) metaLen);
+    out = PyTuple_New(2);
+    if(!ometa || !out) {
+        Py_XDECREF(ometa);
+        Py_XDECREF(out);
+        Py_DECREF((PyObject*) pt);
+        return NULL;
+    }
+    PyTuple_SET_ITEM(out, 0, (PyObject*) pt);
+    PyTuple_SET_ITEM(out, 1, ometa);
+    return out;
+}
+
+static PyObject *pyLoadIndex(PyObject *self, PyObject *args) {
+    GTFtree *t = NULL;
+    char *fname = NULL, *meta = NULL, *err = NULL;
+    uint64_t metaLen = 0;
+
+    if(!(PyArg_ParseTuple(args, "s", &fname))) {
+        PyErr_SetString(PyExc_RuntimeError, "pyLoadIndex received an invalid or missing argument!");
+        return NULL;
+    }
+
+    t = mapIndex(fname, &meta, &metaLen, &err);
+    if(!t) {
+        PyErr_Format(PyExc_RuntimeError, "%s can't be used as an index, since %s!", fname, err);
+        return NULL;
+    }
+
+    return indexTuple(t, meta, metaLen);
+}
+
+static PyObject *pyLoadIndexBuffer(PyObject *self, PyObject *args) {
+    GTFtree *t = NULL;
+    char *meta = NULL, *err = NULL;
+    uint64_t metaLen = 0;
+    Py_buffer *view = NULL;
+    PyObject *obuf = NULL, *owner = Py_None, *out = NULL;
+    pyGTFtree_t *pt;
+
+    if(!(PyArg_ParseTuple(args, "O|O", &obuf, &owner))) {
+        PyErr_SetString(PyExc_RuntimeError, "pyLoadIndexBuffer received an invalid or missing argument!");
+        return NULL;
+    }
+
+    view = malloc(sizeof(Py_buffer));
+    if(!view) {
+        PyErr_SetString(PyExc_RuntimeError, "Could not allocate space for a buffer!");
+        return NULL;
+    }
+    if(PyObject_GetBuffer(obuf, view, PyBUF_SIMPLE)) {
+        free(view);
+        return NULL;
+    }
+
+    t = imageIndex((char*) view->buf, (uint64_t) view->len, &meta, &metaLen, &err);
+    if(!t) {
+        PyErr_Format(PyExc_RuntimeError, "The buffer can't be used as an index, since %s!", err);
+        goto error;
+    }
+    out = indexTuple(t, meta, metaLen);
+    if(!out) goto error;
+
+    //The tree keeps the buffer, and whatever it came from, alive
+    pt = (pyGTFtree_t*) PyTuple_GET_ITEM(out, 0);
+    pt->image = view;
+    if(owner != Py_None) {
+        Py_INCREF(owner);
+        pt->imageOwner = owner;
+    }
+    return out;
+
+error:
+    PyBuffer_Release(view);
+    free(view);
     return NULL;
 }
 
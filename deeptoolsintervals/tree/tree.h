@@ -5,6 +5,10 @@
 typedef struct {
     PyObject_HEAD
     GTFtree *t;
+    int readers; //The number of queries currently running without the GIL
+    int building; //Set while finish() or compact() runs without the GIL
+    Py_buffer *image; //For trees from loadIndexBuffer(), the buffer holding their image
+    PyObject *imageOwner; //and the object (e.g., shared memory) that buffer belongs to
 } pyGTFtree_t;
 
 /* 
@@ -16,24 +20,91 @@ typedef struct {
 static PyObject *pyGTFinit(PyObject *self, PyObject *args);
 static PyObject *pyAddEntry(pyGTFtree_t *self, PyObject *args);
 static PyObject *pyAddEnrichmentEntry(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyStageFile(PyObject *self, PyObject *args);
+static PyObject *pyOpenChunks(PyObject *self, PyObject *args);
+static PyObject *pyNextChunk(PyObject *self, PyObject *args);
+static PyObject *pyParseAttributes(PyObject *self, PyObject *args);
+static PyObject *pyLoadFile(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyLoadEnrichmentFile(pyGTFtree_t *self, PyObject *args);
 static PyObject *pyVine2Tree(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyCompact(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyStoreExons(pyGTFtree_t *self, PyObject *args);
 static PyObject *pyPrintGTFtree(pyGTFtree_t *self, PyObject *args);
 static PyObject *pyCountEntries(pyGTFtree_t *self, PyObject *args);
 static PyObject *pyFindOverlaps(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyOpenSweep(pyGTFtree_t *self, PyObject *args);
+static PyObject *pySweepOverlaps(pyGTFtree_t *self, PyObject *args);
 static PyObject *pyFindOverlappingFeatures(pyGTFtree_t *self, PyObject *args);
 static PyObject *pyIsTree(pyGTFtree_t *self, PyObject *args);
 static PyObject *pyHasOverlaps(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyCountOverlaps(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyOverlapsAny(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyAttributeCounts(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyFindOverlapsBatch(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyFindOverlapsColumns(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyCountOverlapsBatch(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyOverlapsAnyBatch(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyFindFeaturesBatch(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyGetAttributeValues(pyGTFtree_t *self, PyObject *args);
+static PyObject *pySaveIndex(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyDumpIndex(pyGTFtree_t *self, PyObject *args);
+static PyObject *pyLoadIndex(PyObject *self, PyObject *args);
+static PyObject *pyLoadIndexBuffer(PyObject *self, PyObject *args);
 static void pyGTFDealloc(pyGTFtree_t *self);
 
 static PyMethodDef treeMethods[] = {
     {"initTree", (PyCFunction) pyGTFinit, METH_VARARGS,
 "Initialize the tree\n"},
     {"addEntry", (PyCFunction) pyAddEntry, METH_VARARGS,
-"Some documentation for pyAddEntry\n"},
+"Some documentation for pyAddEntry. The optional last two arguments are a GTF\n\
+attribute column and the keys of the attributes in it to keep (a list, or True\n\
+for all of them).\n"},
     {"addEnrichmentEntry", (PyCFunction) pyAddEnrichmentEntry, METH_VARARGS,
 "Some documentation for pyAddEnrichmentEntry\n"},
+    {"stageFile", (PyCFunction) pyStageFile, METH_VARARGS,
+"Read and tokenize a (possibly gzipped) BED or GTF file, returning an object that\n\
+can be passed to loadFile() or loadEnrichmentFile() in place of the file name.\n\
+The GIL is released while the file is read, so many files can be staged at once.\n\
+An optional final argument, a dict of chromosome names to (starts, ends) lists,\n\
+restricts staging to those regions, using a tabix or CSI index if there is one.\n\
+After that, the GTF attributes of each transcript to keep can be given as a list\n\
+of keys, or True for all of them. For Enrichment, this is instead the list of\n\
+attribute keys whose features are staged, with None for the feature column.\n"},
+    {"openChunks", (PyCFunction) pyOpenChunks, METH_VARARGS,
+"As stageFile(), but returning a reader for a file sorted by chromosome, which is\n\
+then staged a chromosome at a time by nextChunk().\n"},
+    {"nextChunk", (PyCFunction) pyNextChunk, METH_VARARGS,
+"Stage the next block of lines on a single chromosome from a reader returned by\n\
+openChunks(), returning a tuple of the chromosome, the number of entries and the\n\
+staged lines (for loadFile() or loadEnrichmentFile()), or None at the end of the file.\n"},
+    {"parseAttributes", (PyCFunction) pyParseAttributes, METH_VARARGS,
+"Given a GTF attribute column and a list of keys, return a tuple of their values,\n\
+with any trailing ';' removed, or None for keys that aren't present. The column is\n\
+tokenized as csv.reader() with a space delimiter would, in a single pass.\n"},
+    {"loadFile", (PyCFunction) pyLoadFile, METH_VARARGS,
+"Parse a (possibly gzipped) BED or GTF file in C, adding its entries to the tree.\n\
+Labels, exons and duplicated transcript IDs are updated in place, as the GTF\n\
+class's python parsing functions would do. The file may already be staged.\n"},
+    {"loadEnrichmentFile", (PyCFunction) pyLoadEnrichmentFile, METH_VARARGS,
+"Parse a (possibly gzipped) BED or GTF file in C, adding its entries to the tree.\n\
+The features list is updated in place, as the Enrichment class's python parsing\n\
+functions would do. With several attribute keys (an optional final argument, as\n\
+in stageFile()), the default feature is a tuple of one per key.\n"},
     {"finish", (PyCFunction) pyVine2Tree, METH_VARARGS,
-"This must be called after ALL entries from ALL files have been added.\n"},
+"This must be called after ALL entries from ALL files have been added. If the\n\
+optional argument is True, the tree is then flattened into a sorted array, which\n\
+is generally faster to query but can no longer be modified. Entries added to a\n\
+finished tree are held in a delta, which calling this again compacts into the tree.\n\
+The optional second argument is the number of threads to build it with (default 1),\n\
+which run without the GIL.\n"},
+    {"compact", (PyCFunction) pyCompact, METH_VARARGS,
+"Compact the entries added to each chromosome of a finished tree into its interval\n\
+tree, if there are enough of them that scanning them would slow queries. The\n\
+optional argument is the number of threads to use (default 1).\n"},
+    {"storeExons", (PyCFunction) pyStoreExons, METH_VARARGS,
+"Move the exons from the GTF class's list of exon dicts into an unflattened tree,\n\
+which then returns them from findOverlaps(). Entries already holding exons are\n\
+skipped.\n"},
     {"printGTFtree", (PyCFunction) pyPrintGTFtree, METH_VARARGS,
 "Prints a text representation in dot format.\n"},
     {"countEntries", (PyCFunction) pyCountEntries, METH_VARARGS,
@@ -43,9 +114,68 @@ static PyMethodDef treeMethods[] = {
     {"hasOverlaps", (PyCFunction) pyHasOverlaps, METH_VARARGS,
 "Returns a tuple with the first value True if ANY of the entries in the tree overlap (ignoring strand) and False otherwise. The second value in the tuple is the minimum distance between intervals (0 on overlap).\n"},
     {"findOverlaps", (PyCFunction) pyFindOverlaps, METH_VARARGS,
-"Find overlapping intervals\n"},
+"Find overlapping intervals. If the optional argument after includeStrand is True,\n\
+then a list of exon bounds is included after the label index. The optional last\n\
+argument is a dict of attribute keys to a value or list of values, one of which\n\
+each overlap must have for every key.\n"},
+    {"openSweep", (PyCFunction) pyOpenSweep, METH_VARARGS,
+"Return a cursor for sweepOverlaps(), which finds the overlaps of regions sorted by\n\
+start position in a single pass over each chromosome.\n"},
+    {"sweepOverlaps", (PyCFunction) pySweepOverlaps, METH_VARARGS,
+"As findOverlaps(), but given a cursor from openSweep() before the other arguments.\n\
+Regions on the same chromosome must be queried in order of their start positions.\n"},
     {"findOverlappingFeatures", (PyCFunction) pyFindOverlappingFeatures, METH_VARARGS,
-"Find overlapping intervals, returning a list of features\n"},
+"Find overlapping intervals, returning a list of features. If the optional final\n\
+argument, the number of attribute keys, is given then a list of the features for\n\
+each key is returned instead.\n"},
+    {"countOverlaps", (PyCFunction) pyCountOverlaps, METH_VARARGS,
+"Count the intervals that findOverlaps() would return, given a chromosome, start,\n\
+end, strand, matchType, strandType and, optionally, the attributes to require.\n"},
+    {"overlapsAny", (PyCFunction) pyOverlapsAny, METH_VARARGS,
+"As countOverlaps(), but returning whether there are any overlaps. The search stops\n\
+at the first one.\n"},
+    {"attributeCounts", (PyCFunction) pyAttributeCounts, METH_VARARGS,
+"Given the arguments of countOverlaps() with an attribute key before the optional\n\
+attributes to require, return a dict of that attribute's values among the overlaps\n\
+and the number of overlaps with each.\n"},
+    {"findOverlapsBatch", (PyCFunction) pyFindOverlapsBatch, METH_VARARGS,
+"Find the overlaps of each of a batch of regions, given as columns of chromosomes\n\
+(or a single chromosome), starts, ends and, optionally, strands. The results are\n\
+returned as a tuple of bytearrays: int64 offsets, int32 name IDs, uint32 starts,\n\
+uint32 ends, uint32 label indices and float64 scores.\n"},
+    {"findOverlapsColumns", (PyCFunction) pyFindOverlapsColumns, METH_VARARGS,
+"Find the overlaps of a single region, taking the arguments of countOverlaps(),\n\
+with trimOverlap before the optional attributes to require.\n\
+Rather than a tuple per overlap, a tuple of bytearrays is returned: int32 name IDs,\n\
+uint32 starts, uint32 ends, uint32 label indices, float64 scores and uint8 strands.\n"},
+    {"countOverlapsBatch", (PyCFunction) pyCountOverlapsBatch, METH_VARARGS,
+"The batch version of countOverlaps(), taking the same columns as findOverlapsBatch().\n\
+A bytearray of int32 counts is returned.\n"},
+    {"overlapsAnyBatch", (PyCFunction) pyOverlapsAnyBatch, METH_VARARGS,
+"The batch version of overlapsAny(), taking the same columns as findOverlapsBatch().\n\
+A bytearray of uint8 booleans is returned.\n"},
+    {"findFeaturesBatch", (PyCFunction) pyFindFeaturesBatch, METH_VARARGS,
+"Find the features overlapped by each of a batch of reads, each a group of blocks\n\
+given as in findOverlapsBatch() plus a column of offsets. Features are returned\n\
+as a tuple of bytearrays of int64 offsets and int32 feature indices or, if the\n\
+counts argument is an int64 array, counted into it in place. The final optional\n\
+argument is the index of the attribute key whose features are used.\n"},
+    {"getAttributeValues", (PyCFunction) pyGetAttributeValues, METH_VARARGS,
+"Return a list of the attribute values (e.g., transcript names) with the given IDs.\n"},
+    {"saveIndex", (PyCFunction) pySaveIndex, METH_VARARGS,
+"Write a finished tree to an index file, along with a bytes object of metadata\n\
+and, optionally, the GTF class's list of exon dicts.\n"},
+    {"dumpIndex", (PyCFunction) pyDumpIndex, METH_VARARGS,
+"As saveIndex(), but the index is copied into a writable buffer rather than a file.\n\
+The last argument is called with the size of the index and must return a writable\n\
+buffer at least that large (e.g., shared memory), which is then returned.\n"},
+    {"loadIndex", (PyCFunction) pyLoadIndex, METH_VARARGS,
+"Memory-map an index file, returning a tuple of the (read-only) tree and its\n\
+metadata.\n"},
+    {"loadIndexBuffer", (PyCFunction) pyLoadIndexBuffer, METH_VARARGS,
+"As loadIndex(), but using an index held in an object supporting the buffer\n\
+protocol (e.g., shared memory). The tree refers to the buffer rather than copying\n\
+it. The optional second argument is an object kept alive for as long as the tree.\n"},
     {NULL, NULL, 0, NULL}
 };
 
@@ -6,7 +6,7 @@ import sys
 
 srcs = [x for x in glob.glob("deeptoolsintervals/tree/*.c")]
 
-libs = ["z"]
+libs = ["z", "pthread"]
 if sysconfig.get_config_vars('BLDLIBRARY') is not None:
     # Note the "-l" prefix!
     for e in sysconfig.get_config_vars('BLDLIBRARY')[0].split():